@@ -16,8 +16,19 @@ class Config:
         _C.SYSTEM = CN()
         # Number of GPUs to use
         _C.SYSTEM.NUM_GPUS = 1
-        # Number of CPUs to use
+        # Number of CPUs to use. It is also the number of worker processes used to prepare the data, e.g. to create
+        # the instance channels when _C.PROBLEM.TYPE = 'INSTANCE_SEG'. Set it to -1 to use all the CPUs available
         _C.SYSTEM.NUM_CPUS = 1
+        # Number of workers used to create the train and validation batches while the model is being trained. With 1
+        # the batches are created one after another as they are requested. With more workers the batches are created in
+        # order, so set _C.AUGMENTOR.SHUFFLE_TRAIN_DATA_EACH_EPOCH to shuffle the training samples
+        _C.SYSTEM.NUM_WORKERS = 1
+        # Number of batches to prepare in advance when _C.SYSTEM.NUM_WORKERS > 1
+        _C.SYSTEM.PREFETCH_BATCHES = 4
+        # Whether the workers are threads or processes. Options: 'thread' or 'process'. In 'thread' mode only the
+        # loading of the samples is made in parallel, as the random crops and transformations need to be made one batch
+        # at a time to be reproducible. Use 'process' to create the whole batches in parallel
+        _C.SYSTEM.WORKERS_MODE = 'thread'
         # Math seed
         _C.SYSTEM.SEED = 0
 
@@ -83,8 +94,18 @@ class Config:
         # Wheter to find an optimum value for each threshold with the validation data. If True the previous MW_TH*
         # variables will be replaced by the optimum values found
         _C.DATA.MW_OPTIMIZE_THS = False
+        # Number of worker processes used to search the optimum thresholds when _C.DATA.MW_OPTIMIZE_THS = True
+        _C.DATA.MW_OPTIMIZE_WORKERS = 1
         # Wheter to save watershed check files
         _C.DATA.CHECK_MW = True
+        # Apply the watershed by chunks of this shape, in (z, y, x) order (or (y, x) in 2D), so big volumes can be processed
+        # with bounded memory. The instances cut by the chunk borders are joined afterwards. Disabled if empty. The
+        # check files of DATA.CHECK_MW are not saved when processing by chunks
+        _C.DATA.MW_CHUNK_SHAPE = ()
+        # Pixels each chunk is extended on each side. It should be larger than the seeds of the instances
+        _C.DATA.MW_CHUNK_HALO = 16
+        # Number of worker processes to apply the watershed to the chunks
+        _C.DATA.MW_CHUNK_WORKERS = 1
 
         # Wheter to reshape de dimensions that does not satisfy the pathc shape selected by padding it with reflect.
         _C.DATA.REFLECT_TO_COMPLETE_SHAPE = False
@@ -94,6 +115,11 @@ class Config:
         # Whether to check if the data mask contains correct values, e.g. same classes as defined
         _C.DATA.TRAIN.CHECK_DATA = True
         _C.DATA.TRAIN.IN_MEMORY = True
+        # Whether to store the train data, once loaded and cropped, in a cache of memory-mapped files inside
+        # _C.PATHS.DATA_CACHE. The cache is reused in the next runs while the data and the settings used to prepare it do
+        # not change, and the data is read from disk on demand instead of being loaded into memory. Used when
+        # _C.DATA.TRAIN.IN_MEMORY = True
+        _C.DATA.TRAIN.CACHE = False
         _C.DATA.TRAIN.PATH = os.path.join(_C.DATA.ROOT_DIR, 'train', 'x')
         _C.DATA.TRAIN.MASK_PATH = os.path.join(_C.DATA.ROOT_DIR, 'train', 'y')
         # File to load/save data prepared with the appropiate channels in a instance segmentation problem.
@@ -141,6 +167,10 @@ class Config:
         _C.DATA.TEST.PADDING = (0,0)
         # Wheter to use median values to fill padded pixels or zeros
         _C.DATA.TEST.MEDIAN_PADDING = False
+        # Window to weight the pixels of each patch when merging them back: 'none' (plain average of the overlapping
+        # patches), 'spline' or 'gaussian'. Weighting down the borders of the patches removes the seams between them
+        # with less _C.DATA.TEST.OVERLAP, and therefore less patches to predict
+        _C.DATA.TEST.MERGE_BLENDING = 'none'
         # Directory where binary masks to apply to resulting images should be. Used when _C.TEST.APPLY_MASK  == True
         _C.DATA.TEST.BINARY_MASKS = os.path.join(_C.DATA.ROOT_DIR, 'test', 'bin_mask')
         # Not used yet.
@@ -165,6 +195,9 @@ class Config:
         _C.DATA.VAL.RANDOM = True
         # Used when _C.DATA.VAL.FROM_TRAIN = False, as DATA.VAL.FROM_TRAIN = True always implies DATA.VAL.IN_MEMORY = True
         _C.DATA.VAL.IN_MEMORY = True
+        # Same as _C.DATA.TRAIN.CACHE but for the validation data. Used when _C.DATA.VAL.FROM_TRAIN = False and
+        # _C.DATA.VAL.IN_MEMORY = True
+        _C.DATA.VAL.CACHE = False
         # Path to the validation data. Used when _C.DATA.VAL.FROM_TRAIN = False
         _C.DATA.VAL.PATH = os.path.join(_C.DATA.ROOT_DIR, 'val', 'x')
         # Path to the validation data mask. Used when _C.DATA.VAL.FROM_TRAIN = False
@@ -198,6 +231,21 @@ class Config:
         _C.DATA.W_FOREGROUND = 0.94 # Used when _C.DATA.PROBABILITY_MAP=True
         _C.DATA.W_BACKGROUND = 0.06 # Used when _C.DATA.PROBABILITY_MAP=True
 
+        # Feed the train and validation batches to the model with a tf.data pipeline instead of the generators directly.
+        # The batches are the same, but they are created in parallel and prefetched by TensorFlow
+        _C.DATA.TF_DATA = CN()
+        _C.DATA.TF_DATA.ENABLE = False
+        # Number of batches to create in parallel. Set it to -1 to let TensorFlow choose it dynamically
+        _C.DATA.TF_DATA.NUM_PARALLEL_CALLS = -1
+        # Keep the validation batches in memory after the first epoch. Only applied if they are the same on each epoch,
+        # i.e. _C.AUGMENTOR.SHUFFLE_VAL_DATA_EACH_EPOCH = False
+        _C.DATA.TF_DATA.CACHE = False
+        # Save the validation batches into _C.PATHS.TF_DATA_SNAPSHOT after the first epoch to read them from disk in
+        # the next ones, instead of creating them again. Same constraints as _C.DATA.TF_DATA.CACHE
+        _C.DATA.TF_DATA.SNAPSHOT = False
+        # Print the time spent on each stage of the pipeline after each epoch
+        _C.DATA.TF_DATA.TIMINGS = False
+
 
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # Data augmentation (DA)
@@ -223,6 +271,10 @@ class Config:
         _C.AUGMENTOR.RANDOM_ROT = False
         # Range of random rotations
         _C.AUGMENTOR.RANDOM_ROT_RANGE = (-180, 180)
+        # In 3D, make the random rotations around an axis with a random direction instead of around z, so the volumes
+        # are also rotated out of the yx plane. _C.DATA.TRAIN.RESOLUTION is used to keep the real proportions of the
+        # volumes. Only available with _C.AUGMENTOR.SPATIAL_BACKEND = 'composed'
+        _C.AUGMENTOR.RANDOM_ROT_3D = False
         # Apply shear to images
         _C.AUGMENTOR.SHEAR = False
         # Shear range
@@ -252,6 +304,20 @@ class Config:
         _C.AUGMENTOR.E_SIGMA = 4
         # Parameter that defines the handling of newly created pixels with the elastic transformation
         _C.AUGMENTOR.E_MODE = 'constant'
+        # How to apply the spatial transformations (rotations, shear, zoom, shift, flips and elastic). Options:
+        #   'imgaug': apply them one by one with imgaug. 3D volumes are passed merging z and channels.
+        #   'composed': compose them into a single coordinate map shared by image and mask, so they are resampled only
+        #   once. Volumes are transformed directly, so the elastic deformation is done in 3D. Rotations, shear, zoom and
+        #   shift are done in the yx plane as with 'imgaug', unless RANDOM_ROT_3D is set to rotate the volumes around
+        #   random axes. The samples with both an affine transformation and an elastic deformation use AFFINE_MODE to
+        #   fill the new pixels
+        _C.AUGMENTOR.SPATIAL_BACKEND = 'imgaug'
+        # Number of elastic deformation fields precomputed per patch shape and reused, randomly rolled and flipped,
+        # instead of creating a new one per sample. 0 to disable it. Only used when SPATIAL_BACKEND is 'composed'
+        _C.AUGMENTOR.E_CACHE_SIZE = 0
+        # Number of epochs the precomputed elastic fields are used before being replaced by new ones, created in a
+        # background thread. 0 to never replace them
+        _C.AUGMENTOR.E_CACHE_EPOCHS = 5
         # Gaussian blur
         _C.AUGMENTOR.G_BLUR = False
         # Standard deviation of the gaussian kernel
@@ -436,6 +502,21 @@ class Config:
         _C.TEST.ENABLE = False
         # Tries to reduce the memory footprint by separating crop/merge operations (it is slower). 
         _C.TEST.REDUCE_MEMORY = False
+        # Predict 3D test volumes by batches of _C.TRAIN.BATCH_SIZE patches, creating them on the fly and adding their
+        # predictions directly to the output volume, so only the output volume and one batch are kept in memory. Only
+        # used when PROBLEM.NDIM = '3D' and _C.TEST.STATS.PER_PATCH = True
+        _C.TEST.STREAMING = False
+        # Store the output volume of _C.TEST.STREAMING in a memory-mapped file inside _C.PATHS.STREAMING_DIR
+        _C.TEST.STREAMING_MEMMAP = False
+        # Predict the patches of consecutive test images together in batches of _C.TRAIN.BATCH_SIZE, so the images do not
+        # end with a partial batch. Each image is merged and post-processed once all its patches are predicted
+        _C.TEST.BATCH_ACROSS_IMAGES = False
+        # Number of threads that post-process the images (watershed, Voronoi, matching...) while the next images are
+        # predicted. Only used when _C.PROBLEM.TYPE = 'INSTANCE_SEG'. If 0 each image is post-processed before predicting
+        # the next one
+        _C.TEST.POST_PROCESSING_WORKERS = 0
+        # Maximum number of images waiting to be post-processed when _C.TEST.POST_PROCESSING_WORKERS > 0
+        _C.TEST.POST_PROCESSING_QUEUE_SIZE = 2
         # Enable verbosity
         _C.TEST.VERBOSE = True
         # Make test-time augmentation. Infer over 8 possible rotations for 2D img and 16 when 3D
@@ -465,6 +546,11 @@ class Config:
         # Weights to be multiply by each axis. Useful when dealing with anysotropic data to reduce the distance value
         # on the axis with less resolution. Need to be provided in (z,y,y) order. Only applies when _C.PROBLEM.TYPE = 'DETECTION'.
         _C.TEST.DET_VOXEL_SIZE = (1,1,1)
+        # Whether to approximate the matching of the predicted and ground truth points using only the pairs closer than
+        # _C.TEST.DET_TOLERANCE, which allows to evaluate volumes with a very large number of points. It maximizes the
+        # number of matched pairs, so in crowded areas it may count more true positives than matching all the points by
+        # their total distance, never fewer. Only applies when _C.PROBLEM.TYPE = 'DETECTION'.
+        _C.TEST.DET_APPROX_MATCHING = False
 
         _C.TEST.STATS = CN()
         _C.TEST.STATS.PER_PATCH = False
@@ -486,17 +572,6 @@ class Config:
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         _C.PATHS = CN()
 
-        ### mAP calculation options
-        # Do not forgive to clone the repo:
-        #       git clone https://github.com/danifranco/mAP_3Dvolume.git
-        #
-        # Change the branch:
-        #       git checkout grand-challenge
-        # Folder where the mAP code should be placed
-        _C.PATHS.MAP_CODE_DIR = ''
-        # Path to the GT h5 files to calculate the mAP
-        _C.PATHS.TEST_FULL_GT_H5 = os.path.join(_C.DATA.TEST.MASK_PATH, 'h5')
-
         # Directories to store the results
         _C.PATHS.RESULT_DIR = CN()
         _C.PATHS.RESULT_DIR.PATH = os.path.join(job_dir, 'results', job_identifier)
@@ -525,6 +600,12 @@ class Config:
         _C.PATHS.TRAIN_INSTANCE_CHANNELS_CHECK = os.path.join(_C.PATHS.RESULT_DIR.PATH, 'train_instance_channels')
         _C.PATHS.VAL_INSTANCE_CHANNELS_CHECK = os.path.join(_C.PATHS.RESULT_DIR.PATH, 'val_instance_channels')
         _C.PATHS.TEST_INSTANCE_CHANNELS_CHECK = os.path.join(_C.PATHS.RESULT_DIR.PATH, 'test_instance_channels')
+        # Folder where the data cache will be stored. Used when _C.DATA.TRAIN.CACHE or _C.DATA.VAL.CACHE are enabled
+        _C.PATHS.DATA_CACHE = os.path.join(job_dir, 'data_cache')
+        # Folder where the tf.data snapshot of the validation data will be stored. Used when _C.DATA.TF_DATA.SNAPSHOT = True
+        _C.PATHS.TF_DATA_SNAPSHOT = os.path.join(job_dir, 'tf_data_snapshot')
+        # Folder where the memory-mapped predictions will be stored. Used when _C.TEST.STREAMING_MEMMAP = True
+        _C.PATHS.STREAMING_DIR = os.path.join(job_dir, 'streaming')
         # Name of the folder where weights files will be stored/loaded from.
         _C.PATHS.CHECKPOINT = os.path.join(job_dir, 'h5_files')
         # Checkpoint file to load/store the model weights
@@ -534,8 +615,6 @@ class Config:
         _C.PATHS.PROB_MAP_FILENAME = 'prob_map.npy'
         # Watershed dubgging folder
         _C.PATHS.WATERSHED_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, 'watershed')
-        # To store h5 files needed for the mAP calculation
-        _C.PATHS.MAP_H5_DIR = os.path.join(_C.PATHS.RESULT_DIR.PATH, 'mAP_h5_files')
 
         self._C = _C
 
@@ -557,4 +636,3 @@ class Config:
         self._C.DATA.TEST.INSTANCE_CHANNELS_DIR = self._C.DATA.TEST.PATH+'_'+self._C.DATA.CHANNELS+'_'+self._C.DATA.CONTOUR_MODE
         self._C.DATA.TEST.INSTANCE_CHANNELS_MASK_DIR = self._C.DATA.TEST.MASK_PATH+'_'+self._C.DATA.CHANNELS+'_'+self._C.DATA.CONTOUR_MODE
         self._C.DATA.TEST.BINARY_MASKS = os.path.join(self._C.DATA.TEST.PATH, '..', 'bin_mask')
-        self._C.PATHS.TEST_FULL_GT_H5 = os.path.join(self._C.DATA.TEST.MASK_PATH, 'h5')
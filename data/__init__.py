@@ -1,6 +1,10 @@
+import os
+import json
+import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from utils.util import load_data_from_dir, load_3d_images_from_dir, labels_into_bcd, save_npy_files
+from utils.util import load_img_from_file, labels_into_bcd
 
 
 def create_instance_channels(cfg, data_type='train'):
@@ -23,23 +27,13 @@ def create_instance_channels(cfg, data_type='train'):
 
     assert data_type in ['train', 'val']
 
-    f_name = load_data_from_dir if cfg.PROBLEM.NDIM == '2D' else load_3d_images_from_dir
     tag = "TRAIN" if data_type == "train" else "VAL"
-    Y, _, _, filenames = f_name(getattr(cfg.DATA, tag).MASK_PATH, return_filenames=True)
     print("Creating Y_{} channels . . .".format(data_type))
-    if isinstance(Y, list):
-        for i in tqdm(range(len(Y))):
-            Y[i] = labels_into_bcd(Y[i], mode=cfg.DATA.CHANNELS, save_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'),
-                          fb_mode=cfg.DATA.CONTOUR_MODE)
-    else:
-        Y = labels_into_bcd(Y, mode=cfg.DATA.CHANNELS, save_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'),
-                   fb_mode=cfg.DATA.CONTOUR_MODE)
-    save_npy_files(Y, data_dir=getattr(cfg.DATA, tag).INSTANCE_CHANNELS_MASK_DIR, filenames=filenames,
-                   verbose=cfg.TEST.VERBOSE)
-    X, _, _, filenames = f_name(getattr(cfg.DATA, tag).PATH, return_filenames=True)
+    prepare_instance_channels_dir(cfg, getattr(cfg.DATA, tag).MASK_PATH, getattr(cfg.DATA, tag).INSTANCE_CHANNELS_MASK_DIR,
+        create_channels=True, check_dir=getattr(cfg.PATHS, tag+'_INSTANCE_CHANNELS_CHECK'))
     print("Creating X_{} channels . . .".format(data_type))
-    save_npy_files(X, data_dir=getattr(cfg.DATA, tag).INSTANCE_CHANNELS_DIR, filenames=filenames,
-                   verbose=cfg.TEST.VERBOSE)
+    filenames = prepare_instance_channels_dir(cfg, getattr(cfg.DATA, tag).PATH,
+        getattr(cfg.DATA, tag).INSTANCE_CHANNELS_DIR)
     return filenames
 
 
@@ -52,25 +46,126 @@ def create_test_instance_channels(cfg):
            Configuration.
     """
 
-    f_name = load_data_from_dir if cfg.PROBLEM.NDIM == '2D' else load_3d_images_from_dir
-
     if cfg.DATA.TEST.LOAD_GT and cfg.TEST.EVALUATE:
-        Y_test, _, _, test_filenames = f_name(cfg.DATA.TEST.MASK_PATH, return_filenames=True)
         print("Creating Y_test channels . . .")
-        if isinstance(Y_test, list):
-            for i in tqdm(range(len(Y_test))):
-                Y_test[i] = labels_into_bcd(Y_test[i], mode=cfg.DATA.CHANNELS, save_dir=cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK,
-                                            fb_mode=cfg.DATA.CONTOUR_MODE)
-        else:
-            Y_test = labels_into_bcd(Y_test, mode=cfg.DATA.CHANNELS, save_dir=cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK,
-                                     fb_mode=cfg.DATA.CONTOUR_MODE)
-        save_npy_files(Y_test, data_dir=cfg.DATA.TEST.INSTANCE_CHANNELS_MASK_DIR, filenames=test_filenames,
-                       verbose=cfg.TEST.VERBOSE)
+        prepare_instance_channels_dir(cfg, cfg.DATA.TEST.MASK_PATH, cfg.DATA.TEST.INSTANCE_CHANNELS_MASK_DIR,
+            create_channels=True, check_dir=cfg.PATHS.TEST_INSTANCE_CHANNELS_CHECK)
 
     print("Creating X_test channels . . .")
-    X_test, _, _, test_filenames = f_name(cfg.DATA.TEST.PATH, return_filenames=True)
-    save_npy_files(X_test, data_dir=cfg.DATA.TEST.INSTANCE_CHANNELS_DIR, filenames=test_filenames,
-                   verbose=cfg.TEST.VERBOSE)
+    prepare_instance_channels_dir(cfg, cfg.DATA.TEST.PATH, cfg.DATA.TEST.INSTANCE_CHANNELS_DIR)
+
+
+def prepare_instance_channels_dir(cfg, data_dir, out_dir, create_channels=False, check_dir=None):
+    """Convert each file of ``data_dir`` into a ``.npy`` file in ``out_dir``, creating the instance channels defined
+       by ``DATA.CHANNELS`` if ``create_channels`` is set. Each file is loaded, converted and saved independently by a
+       pool of ``SYSTEM.NUM_CPUS`` processes, so only one image per worker is kept in memory.
+
+       The process can be resumed: a record of the processed files is saved next to ``out_dir`` (``out_dir.json``)
+       after each file, and the files whose source has not changed (same size and modification time) and were created
+       with the same ``DATA.CHANNELS`` and ``DATA.CONTOUR_MODE`` are skipped.
+
+       Parameters
+       ----------
+       cfg : YACS CN object
+           Configuration.
+
+       data_dir : str
+           Directory to read the images from.
+
+       out_dir : str
+           Directory to save the ``.npy`` files into.
+
+       create_channels : bool, optional
+           Whether ``data_dir`` contains instance masks that need to be converted with ``labels_into_bcd``.
+
+       check_dir : str, optional
+           Path to store samples of the created channels of the first three files. Used when ``create_channels`` is
+           set.
+
+       Returns
+       -------
+       filenames: List of str
+           Filenames found in ``data_dir``.
+    """
+
+    ids = sorted(next(os.walk(data_dir))[2])
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Record of the files already processed
+    info_file = os.path.normpath(out_dir)+'.json'
+    info = {}
+    if os.path.isfile(info_file):
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+
+    settings = {'channels': cfg.DATA.CHANNELS, 'contour_mode': cfg.DATA.CONTOUR_MODE} if create_channels else {}
+    pending = []
+    for n, id_ in enumerate(ids):
+        in_file = os.path.join(data_dir, id_)
+        out_file = os.path.join(out_dir, os.path.splitext(id_)[0]+'.npy')
+        stat = os.stat(in_file)
+        signature = dict(size=stat.st_size, mtime=stat.st_mtime_ns, **settings)
+        if os.path.isfile(out_file) and info.get(id_) == signature:
+            continue
+        save_dir = os.path.join(check_dir, os.path.splitext(id_)[0]) if check_dir is not None and n < 3 else None
+        args = dict(in_file=in_file, out_file=out_file, is_3d=cfg.PROBLEM.NDIM == '3D',
+            channels=cfg.DATA.CHANNELS if create_channels else None, fb_mode=cfg.DATA.CONTOUR_MODE, save_dir=save_dir)
+        pending.append((id_, signature, args))
+
+    print("{} files up to date in {}, {} to process".format(len(ids)-len(pending), out_dir, len(pending)))
+    if len(pending) == 0:
+        return ids
+
+    def save_info(id_, signature):
+        info[id_] = signature
+        with open(info_file+'.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(info_file+'.tmp', info_file)
+
+    workers = cfg.SYSTEM.NUM_CPUS if cfg.SYSTEM.NUM_CPUS > 0 else os.cpu_count()
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = {executor.submit(create_instance_channels_file, **args): (id_, signature)
+                       for id_, signature, args in pending}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                future.result()
+                save_info(*futures[future])
+    else:
+        for id_, signature, args in tqdm(pending):
+            create_instance_channels_file(**args)
+            save_info(id_, signature)
+
+    return ids
+
+
+def create_instance_channels_file(in_file, out_file, is_3d=False, channels=None, fb_mode="outer", save_dir=None):
+    """Load one image, create its instance channels if ``channels`` is provided, and save it as ``.npy``.
+
+       Parameters
+       ----------
+       in_file : str
+           Path of the image to read.
+
+       out_file : str
+           Path of the ``.npy`` file to create.
+
+       is_3d : bool, optional
+           Whether the image is a 3D volume.
+
+       channels : str, optional
+           Channels to create from the instance mask. Same options as ``mode`` in ``labels_into_bcd``. If ``None`` the
+           image is saved as it is.
+
+       fb_mode : str, optional
+           Contour creation mode. Same as ``fb_mode`` in ``labels_into_bcd``.
+
+       save_dir : str, optional
+           Path to store samples of the created channels.
+    """
+    img = load_img_from_file(in_file, is_3d=is_3d, is_mask=channels is not None)
+    if channels is not None:
+        img = labels_into_bcd(np.expand_dims(img,0), mode=channels, fb_mode=fb_mode, save_dir=save_dir)[0]
+    np.save(out_file, img)
 
 
 def data_checks(cfg):
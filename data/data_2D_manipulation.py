@@ -8,12 +8,14 @@ from skimage.io import imread
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from PIL import Image
 from utils.util import load_data_from_dir, normalize
+from data.data_cache import load_cached_data
+from data.tiling import tile_positions, extract_patches, merge_patches, overlap_counter
 from skimage.io import imsave
 
 
 def load_and_prepare_2D_train_data(train_path, train_mask_path, val_split=0.1, seed=0, shuffle_val=True, e_d_data=[],
     e_d_mask=[], e_d_data_dim=[], num_crops_per_dataset=0, random_crops_in_DA=False, crop_shape=None, ov=(0,0),
-    padding=(0,0), check_crop=True, check_crop_path="check_crop", reflect_to_complete_shape=False):
+    padding=(0,0), check_crop=True, check_crop_path="check_crop", reflect_to_complete_shape=False, cache_dir=None):
     """Load train and validation images from the given paths to create 2D data.
 
        Parameters
@@ -72,6 +74,11 @@ def load_and_prepare_2D_train_data(train_path, train_mask_path, val_split=0.1, s
            Wheter to increase the shape of the dimension that have less size than selected patch size padding it with
            'reflect'.
 
+       cache_dir : str, optional
+           Directory to store the prepared data in, so it can be reused in next runs. The returned arrays will be
+           memory-mapped to the files of this directory. It can not be used together with ``e_d_data`` and
+           ``num_crops_per_dataset``. See ``data.data_cache.load_cached_data`` for more details.
+
        Returns
        -------
        X_train : 4D Numpy array
@@ -147,32 +154,47 @@ def load_and_prepare_2D_train_data(train_path, train_mask_path, val_split=0.1, s
     # Check validation
     create_val = True if val_split > 0 else False
 
-    print("0) Loading train images . . .")
-    X_train, orig_train_shape, _, _ = load_data_from_dir(train_path, crop=crop, crop_shape=crop_shape, overlap=ov,
-                                                         padding=padding, return_filenames=True,
-                                                         reflect_to_complete_shape=reflect_to_complete_shape)
-    print("1) Loading train masks . . .")
-    Y_train, _, _, t_filenames = load_data_from_dir(train_mask_path, crop=crop, crop_shape=crop_shape, overlap=ov,
-                                                    padding=padding, return_filenames=True,
-                                                    reflect_to_complete_shape=reflect_to_complete_shape)
-
-    if num_crops_per_dataset != 0:
-        X_train = X_train[:num_crops_per_dataset]
-        Y_train = Y_train[:num_crops_per_dataset]
-
-    if check_crop and (orig_train_shape[0] != X_train.shape[1:]):
-        print("Checking the crops . . .")
-        print("WARNING: All the images in train need to be of the same shape in order to use this option. If not, the "
-              "merge function will crash")
-        s = [len(orig_train_shape), *orig_train_shape[0]]
-        check_crops(X_train, s, ov, out_dir=check_crop_path, prefix="X_train_")
-        s[-1] = Y_train.shape[-1]
-        check_crops(Y_train, s, ov, out_dir=check_crop_path, prefix="Y_train_")
-
-    # Create validation data splitting the train
-    if create_val:
-        X_train, X_val, Y_train, Y_val = train_test_split(
-            X_train, Y_train, test_size=val_split, shuffle=shuffle_val, random_state=seed)
+    cached = None
+    if cache_dir is not None:
+        if e_d_data or num_crops_per_dataset != 0:
+            print("WARNING: the data cache can not be used with extra datasets or 'num_crops_per_dataset', so the data "
+                  "will be loaded into memory")
+        else:
+            cached = load_cached_data(cache_dir, train_path, train_mask_path, crop=crop, crop_shape=crop_shape,
+                overlap=ov, padding=padding, reflect_to_complete_shape=reflect_to_complete_shape,
+                val_split=val_split, seed=seed, shuffle_val=shuffle_val)
+
+    if cached is not None:
+        X_train, Y_train, X_val, Y_val, _, t_filenames = cached
+        if check_crop:
+            print("WARNING: crops are not checked when the data is loaded from the cache")
+    else:
+        print("0) Loading train images . . .")
+        X_train, orig_train_shape, _, _ = load_data_from_dir(train_path, crop=crop, crop_shape=crop_shape, overlap=ov,
+                                                             padding=padding, return_filenames=True,
+                                                             reflect_to_complete_shape=reflect_to_complete_shape)
+        print("1) Loading train masks . . .")
+        Y_train, _, _, t_filenames = load_data_from_dir(train_mask_path, crop=crop, crop_shape=crop_shape, overlap=ov,
+                                                        padding=padding, return_filenames=True,
+                                                        reflect_to_complete_shape=reflect_to_complete_shape)
+
+        if num_crops_per_dataset != 0:
+            X_train = X_train[:num_crops_per_dataset]
+            Y_train = Y_train[:num_crops_per_dataset]
+
+        if check_crop and (orig_train_shape[0] != X_train.shape[1:]):
+            print("Checking the crops . . .")
+            print("WARNING: All the images in train need to be of the same shape in order to use this option. If not, the "
+                  "merge function will crash")
+            s = [len(orig_train_shape), *orig_train_shape[0]]
+            check_crops(X_train, s, ov, out_dir=check_crop_path, prefix="X_train_")
+            s[-1] = Y_train.shape[-1]
+            check_crops(Y_train, s, ov, out_dir=check_crop_path, prefix="Y_train_")
+
+        # Create validation data splitting the train
+        if create_val:
+            X_train, X_val, Y_train, Y_val = train_test_split(
+                X_train, Y_train, test_size=val_split, shuffle=shuffle_val, random_state=seed)
 
     # Load the extra datasets
     if e_d_data:
@@ -352,56 +374,27 @@ def crop_data_with_overlap(data, crop_shape, data_mask=None, overlap=(0,0), padd
     if data_mask is not None:
         padded_data_mask = np.pad(data_mask,((0,0),(padding[1],padding[1]),(padding[0],padding[0]),(0,0)), 'reflect')
 
-    crop_shape = tuple(crop_shape[i] for i in [1, 0, 2])
+    # Patch grid in (y, x) order
+    crop_shape = tuple(crop_shape[i] for i in [1, 0])
     padding = tuple(padding[i] for i in [1, 0])
-
-    # Calculate overlapping variables
-    overlap_x = 1 if overlap[0] == 0 else 1-overlap[0]
-    overlap_y = 1 if overlap[1] == 0 else 1-overlap[1]
-
-    # Y
-    step_y = int((crop_shape[0]-padding[0]*2)*overlap_y)
-    crops_per_y = math.ceil(data.shape[1]/step_y)
-    last_y = 0 if crops_per_y == 1 else (((crops_per_y-1)*step_y)+crop_shape[0])-padded_data.shape[1]
-
-    # X
-    step_x = int((crop_shape[1]-padding[1]*2)*overlap_x)
-    crops_per_x = math.ceil(data.shape[2]/step_x)
-    last_x = 0 if crops_per_x == 1 else (((crops_per_x-1)*step_x)+crop_shape[1])-padded_data.shape[2]
+    overlap = tuple(overlap[i] for i in [1, 0])
+    pos_y, step_y = tile_positions(data.shape[1], crop_shape[0], overlap[0], padding[0])
+    pos_x, step_x = tile_positions(data.shape[2], crop_shape[1], overlap[1], padding[1])
+    positions = [np.arange(data.shape[0]), pos_y, pos_x]
 
     # Real overlap calculation for printing
     real_ov_y = ((crop_shape[0]-padding[0]*2)-step_y)/(crop_shape[0]-padding[0]*2)
     real_ov_x = ((crop_shape[1]-padding[1]*2)-step_x)/(crop_shape[1]-padding[1]*2)
 
     if verbose:
-        print("Real overlapping (%): {}".format(real_ov_x,real_ov_y))
-        print("Real overlapping (pixels): {}".format((crop_shape[1]-padding[1]*2)*real_ov_x,
-            (crop_shape[0]-padding[0]*2)*real_ov_y))
-        print("{} patches per (x,y) axis".format(crops_per_x,crops_per_y))
+        print("Real overlapping (%): {}".format((real_ov_x,real_ov_y)))
+        print("Real overlapping (pixels): {}".format(((crop_shape[1]-padding[1]*2)*real_ov_x,
+            (crop_shape[0]-padding[0]*2)*real_ov_y)))
+        print("{} patches per (x,y) axis".format((len(pos_x),len(pos_y))))
 
-    total_vol = data.shape[0]*(crops_per_x)*(crops_per_y)
-    cropped_data = np.zeros((total_vol,) + crop_shape, dtype=data.dtype)
+    cropped_data = extract_patches(padded_data, positions, (1,)+crop_shape)[:,0]
     if data_mask is not None:
-        cropped_data_mask = np.zeros((total_vol,)+crop_shape[:2]+(data_mask.shape[-1],), dtype=data_mask.dtype)
-
-    c = 0
-    for z in range(data.shape[0]):
-        for y in range(crops_per_y):
-            for x in range(crops_per_x):
-                d_y = 0 if (y*step_y+crop_shape[1]) < padded_data.shape[1] else last_y
-                d_x = 0 if (x*step_x+crop_shape[0]) < padded_data.shape[2] else last_x
-
-                cropped_data[c] = \
-                    padded_data[z,
-                                y*step_y-d_y:y*step_y+crop_shape[1]-d_y,
-                                x*step_x-d_x:x*step_x+crop_shape[0]-d_x]
-
-                if data_mask is not None:
-                    cropped_data_mask[c] = \
-                        padded_data_mask[z,
-                                         y*step_y-d_y:y*step_y+crop_shape[1]-d_y,
-                                         x*step_x-d_x:x*step_x+crop_shape[0]-d_x]
-                c += 1
+        cropped_data_mask = extract_patches(padded_data_mask, positions, (1,)+crop_shape)[:,0]
 
     if verbose:
         print("**** New data shape is: {}".format(cropped_data.shape))
@@ -414,7 +407,7 @@ def crop_data_with_overlap(data, crop_shape, data_mask=None, overlap=(0,0), padd
 
 
 def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0), padding=(0,0), verbose=True,
-    out_dir=None, prefix=""):
+    out_dir=None, prefix="", blending='none'):
     """Merge data with an amount of overlap.
 
        The opposite function is :func:`~crop_data_with_overlap`.
@@ -449,6 +442,11 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
        prefix : str, optional
            Prefix to save overlap map with.
 
+       blending : str, optional
+           Window used to weight the pixels of each crop when merging them, so the pixels close to their borders
+           contribute less to the result. This removes the seams between crops with less overlap. Options: ``'none'``
+           (plain average), ``'spline'`` or ``'gaussian'`` (see :func:`~data.tiling.blending_window`).
+
        Returns
        -------
        merged_data : 4D Numpy array
@@ -556,35 +554,13 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
         raise ValueError("'overlap' values must be floats between range [0, 1)")
 
     padding = tuple(padding[i] for i in [1, 0])
+    overlap = tuple(overlap[i] for i in [1, 0])
 
-    # Remove the padding
+    # Patch grid in (y, x) order
     pad_input_shape = data.shape
-    data = data[:, padding[0]:data.shape[1]-padding[0], padding[1]:data.shape[2]-padding[1]]
-
-    merged_data = np.zeros((original_shape), dtype=np.float32)
-    if data_mask is not None:
-        merged_data_mask = np.zeros((original_shape), dtype=np.float32)
-        data_mask = data_mask[:, padding[0]:data_mask.shape[1]-padding[0], padding[1]:data_mask.shape[2]-padding[1]]
-
-    ov_map_counter = np.zeros(original_shape, dtype=np.int32)
-    if out_dir is not None:
-        crop_grid = np.zeros(original_shape[1:], dtype=np.int32)
-
-    # Calculate overlapping variables
-    overlap_x = 1 if overlap[0] == 0 else 1-overlap[0]
-    overlap_y = 1 if overlap[1] == 0 else 1-overlap[1]
-
-    padded_data_shape = [original_shape[1]+2*padding[0], original_shape[2]+2*padding[1]]
-
-    # Y
-    step_y = int((pad_input_shape[1]-padding[0]*2)*overlap_y)
-    crops_per_y = math.ceil(original_shape[1]/step_y)
-    last_y = 0 if crops_per_y == 1 else (((crops_per_y-1)*step_y)+pad_input_shape[1])-padded_data_shape[0]
-
-    # X
-    step_x = int((pad_input_shape[2]-padding[1]*2)*overlap_x)
-    crops_per_x = math.ceil(original_shape[2]/step_x)
-    last_x = 0 if crops_per_x == 1 else (((crops_per_x-1)*step_x)+pad_input_shape[2])-padded_data_shape[1]
+    pos_y, step_y = tile_positions(original_shape[1], pad_input_shape[1], overlap[0], padding[0])
+    pos_x, step_x = tile_positions(original_shape[2], pad_input_shape[2], overlap[1], padding[1])
+    positions = [np.arange(original_shape[0]), pos_y, pos_x]
 
     # Real overlap calculation for printing
     real_ov_y = ((pad_input_shape[1]-padding[0]*2)-step_y)/(pad_input_shape[1]-padding[0]*2)
@@ -593,45 +569,34 @@ def merge_data_with_overlap(data, original_shape, data_mask=None, overlap=(0,0),
         print("Real overlapping (%): {}".format((real_ov_x,real_ov_y)))
         print("Real overlapping (pixels): {}".format(((pad_input_shape[2]-padding[1]*2)*real_ov_x,
             (pad_input_shape[1]-padding[0]*2)*real_ov_y)))
-        print("{} patches per (x,y) axis".format((crops_per_x,crops_per_y)))
-
-    c = 0
-    for z in range(original_shape[0]):
-        for y in range(crops_per_y):
-            for x in range(crops_per_x):
-                d_y = 0 if (y*step_y+data.shape[1]) < original_shape[1] else last_y
-                d_x = 0 if (x*step_x+data.shape[2]) < original_shape[2] else last_x
-
-                merged_data[z,y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += data[c]
-
-                if data_mask is not None:
-                    merged_data_mask[z, y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += data_mask[c]
-
-                ov_map_counter[z, y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] += 1
+        print("{} patches per (x,y) axis".format((len(pos_x),len(pos_y))))
 
-                if z == 0 and out_dir is not None:
-                    crop_grid[y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x-d_x] = 1
-                    crop_grid[y*step_y-d_y:y*step_y+data.shape[1]-d_y, x*step_x+data.shape[2]-d_x-1] = 1
-                    crop_grid[y*step_y-d_y, x*step_x-d_x:x*step_x+data.shape[2]-d_x] = 1
-                    crop_grid[y*step_y+data.shape[1]-d_y-1, x*step_x-d_x:x*step_x+data.shape[2]-d_x] = 1
-
-                c += 1
-
-    merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
+    # Remove the padding
+    data = data[:, padding[0]:data.shape[1]-padding[0], padding[1]:data.shape[2]-padding[1]]
+    merged_data = merge_patches(data[:,None], positions, original_shape[:3], blending=blending).astype(data.dtype)
     if data_mask is not None:
-        merged_data_mask = np.true_divide(merged_data_mask, ov_map_counter).astype(data_mask.dtype)
+        data_mask = data_mask[:, padding[0]:data_mask.shape[1]-padding[0], padding[1]:data_mask.shape[2]-padding[1]]
+        merged_data_mask = merge_patches(data_mask[:,None], positions, original_shape[:3]).astype(data_mask.dtype)
 
     # Save a copy of the merged data with the overlapped regions colored as: green when 2 crops overlap, yellow when
     # (2 < x < 6) and red when more than 6 overlaps are merged
     if out_dir is not None:
         os.makedirs(out_dir, exist_ok=True)
 
-        ov_map = ov_map_counter[0]
-        ov_map = ov_map.astype('int32')
+        ov_map_counter = overlap_counter(positions[1:], data.shape[1:3], original_shape[1:3])
+        crop_grid = np.zeros(original_shape[1:3], dtype=np.int32)
+        for y in pos_y:
+            for x in pos_x:
+                crop_grid[y:y+data.shape[1], x] = 1
+                crop_grid[y:y+data.shape[1], x+data.shape[2]-1] = 1
+                crop_grid[y, x:x+data.shape[2]] = 1
+                crop_grid[y+data.shape[1]-1, x:x+data.shape[2]] = 1
+
+        ov_map = np.expand_dims(ov_map_counter.astype('int32'), -1)
 
-        ov_map[np.where(ov_map_counter[0] >= 2)] = -3
-        ov_map[np.where(ov_map_counter[0] >= 3)] = -2
-        ov_map[np.where(ov_map_counter[0] >= 6)] = -1
+        ov_map[np.where(ov_map_counter >= 2)] = -3
+        ov_map[np.where(ov_map_counter >= 3)] = -2
+        ov_map[np.where(ov_map_counter >= 6)] = -1
         ov_map[np.where(crop_grid == 1)] = -4
 
         # Paint overlap regions
@@ -747,7 +712,7 @@ def check_crops(data, original_shape, ov, num_examples=1, include_crops=True, ou
 
 
 def random_crop(image, mask, random_crop_size, val=False, draw_prob_map_points=False, img_prob=None, weight_map=None,
-                scale=1):
+                scale=1, center=None):
     """Random crop.
 
        Parameters
@@ -777,6 +742,10 @@ def random_crop(image, mask, random_crop_size, val=False, draw_prob_map_points=F
        scale : int, optional
            Scale factor the second image given.
 
+       center : tuple of ints, optional
+           Pixel to be the center of the crop, already drawn from the probability map, e.g. with
+           :class:`~data.prob_map_sampler.ProbMapSampler`. E.g. ``(y, x, channel)``. Used instead of ``img_prob``.
+
        Returns
        -------
        img : 2D Numpy array
@@ -811,17 +780,18 @@ def random_crop(image, mask, random_crop_size, val=False, draw_prob_map_points=F
         ox = 0
         oy = 0
     else:
-        if img_prob is not None:
-            prob = img_prob.ravel()
-
-            # Generate the random coordinates based on the distribution
-            choices = np.prod(img_prob.shape)
-            index = np.random.choice(choices, size=1, p=prob)
-            coordinates = np.unravel_index(index, dims=img_prob.shape)
-            x = int(coordinates[1][0])
-            y = int(coordinates[0][0])
-            ox = int(coordinates[1][0])
-            oy = int(coordinates[0][0])
+        if img_prob is not None or center is not None:
+            if center is None:
+                prob = img_prob.ravel().astype(np.float64)
+
+                # Generate the random coordinates based on the distribution
+                choices = np.prod(img_prob.shape)
+                index = np.random.choice(choices, size=1, p=prob/prob.sum())
+                center = [c[0] for c in np.unravel_index(index, img_prob.shape)]
+            x = int(center[1])
+            y = int(center[0])
+            ox = int(center[1])
+            oy = int(center[0])
 
             # Adjust the coordinates to be the origin of the crop and control to
             # not be out of the image
@@ -1,12 +1,13 @@
-import math
 import numpy as np
 from sklearn.model_selection import train_test_split
 from utils.util import load_3d_images_from_dir
+from data.data_cache import load_cached_data
+from data.tiling import tile_positions, patch_grid, extract_patches, merge_patches, patch_window
 
 
 def load_and_prepare_3D_data(train_path, train_mask_path, val_split=0.1, seed=0, shuffle_val=True,
                              crop_shape=(80, 80, 80, 1), random_crops_in_DA=False, ov=(0,0,0), padding=(0,0,0),
-                             reflect_to_complete_shape=False):
+                             reflect_to_complete_shape=False, cache_dir=None):
     """Load train and validation images from the given paths to create 3D data.
 
        Parameters
@@ -44,6 +45,10 @@ def load_and_prepare_3D_data(train_path, train_mask_path, val_split=0.1, seed=0,
            Wheter to increase the shape of the dimension that have less size than selected patch size padding it with
            'reflect'.
 
+       cache_dir : str, optional
+           Directory to store the prepared data in, so it can be reused in next runs. The returned arrays will be
+           memory-mapped to the files of this directory. See ``data.data_cache.load_cached_data`` for more details.
+
        Returns
        -------
        X_train : 5D Numpy array
@@ -95,24 +100,33 @@ def load_and_prepare_3D_data(train_path, train_mask_path, val_split=0.1, seed=0,
     # Check validation
     create_val = True if val_split > 0 else False
 
-    print("0) Loading train images . . .")
-    X_train, _, _, t_filenames = load_3d_images_from_dir(train_path, crop=crop, crop_shape=crop_shape,
-        overlap=ov, return_filenames=True, reflect_to_complete_shape=reflect_to_complete_shape)
+    cached = None
+    if cache_dir is not None:
+        cached = load_cached_data(cache_dir, train_path, train_mask_path, is_3d=True, crop=crop, crop_shape=crop_shape,
+            overlap=ov, reflect_to_complete_shape=reflect_to_complete_shape, val_split=val_split, seed=seed,
+            shuffle_val=shuffle_val)
 
-    print("1) Loading train masks . . .")
-    Y_train, _, _ = load_3d_images_from_dir(train_mask_path, crop=crop, crop_shape=crop_shape, overlap=ov,
-        reflect_to_complete_shape=reflect_to_complete_shape)
+    if cached is not None:
+        X_train, Y_train, X_val, Y_val, _, t_filenames = cached
+    else:
+        print("0) Loading train images . . .")
+        X_train, _, _, t_filenames = load_3d_images_from_dir(train_path, crop=crop, crop_shape=crop_shape,
+            overlap=ov, return_filenames=True, reflect_to_complete_shape=reflect_to_complete_shape)
 
-    if isinstance(X_train, list):
-        raise NotImplementedError("If you arrived here means that your images are not all of the same shape, and you "
-                                  "select DATA.EXTRACT_RANDOM_PATCH = True, so no crops are made to ensure all images "
-                                  "have the same shape. Please, crop them into your DATA.PATCH_SIZE and run again (you "
-                                  "can use one of the script from here to crop: https://github.com/danifranco/BiaPy/tree/master/utils/scripts)")
+        print("1) Loading train masks . . .")
+        Y_train, _, _ = load_3d_images_from_dir(train_mask_path, crop=crop, crop_shape=crop_shape, overlap=ov,
+            reflect_to_complete_shape=reflect_to_complete_shape)
 
-    # Create validation data splitting the train
-    if create_val:
-        X_train, X_val, \
-        Y_train, Y_val = train_test_split(X_train, Y_train, test_size=val_split, shuffle=shuffle_val, random_state=seed)
+        if isinstance(X_train, list):
+            raise NotImplementedError("If you arrived here means that your images are not all of the same shape, and you "
+                                      "select DATA.EXTRACT_RANDOM_PATCH = True, so no crops are made to ensure all images "
+                                      "have the same shape. Please, crop them into your DATA.PATCH_SIZE and run again (you "
+                                      "can use one of the script from here to crop: https://github.com/danifranco/BiaPy/tree/master/utils/scripts)")
+
+        # Create validation data splitting the train
+        if create_val:
+            X_train, X_val, \
+            Y_train, Y_val = train_test_split(X_train, Y_train, test_size=val_split, shuffle=shuffle_val, random_state=seed)
 
     # Convert the original volumes as they were a unique subvolume
     if random_crops_in_DA and X_train.ndim == 4:
@@ -247,59 +261,22 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
     	padded_data[:, padding[1]+data.shape[1]:2*padding[1]+data.shape[0], :, :] = np.median(data[:, -1, :, :])
     	padded_data[:, :, 0:padding[2], :] = np.median(data[:, :, 0, :])
     	padded_data[ :, :, padding[2]+data.shape[2]:2*padding[2]+data.shape[2], :] = np.median(data[:, :, -1, :])
-    padded_vol_shape = vol_shape
-
-    # Calculate overlapping variables
-    overlap_z = 1 if overlap[0] == 0 else 1-overlap[0]
-    overlap_y = 1 if overlap[1] == 0 else 1-overlap[1]
-    overlap_x = 1 if overlap[2] == 0 else 1-overlap[2]
-
-    # Z
-    step_z = int((vol_shape[0]-padding[0]*2)*overlap_z)
-    vols_per_z = math.ceil(data.shape[0]/step_z)
-    last_z = 0 if vols_per_z == 1 else (((vols_per_z-1)*step_z)+vol_shape[0])-padded_data.shape[0]
-
-    # Y
-    step_y = int((vol_shape[1]-padding[1]*2)*overlap_y)
-    vols_per_y = math.ceil(data.shape[1]/step_y)
-    last_y = 0 if vols_per_y == 1 else (((vols_per_y-1)*step_y)+vol_shape[1])-padded_data.shape[1]
-
-    # X
-    step_x = int((vol_shape[2]-padding[2]*2)*overlap_x)
-    vols_per_x = math.ceil(data.shape[2]/step_x)
-    last_x = 0 if vols_per_x == 1 else (((vols_per_x-1)*step_x)+vol_shape[2])-padded_data.shape[2]
+    positions, steps = [], []
+    for i in range(3):
+        pos, step = tile_positions(data.shape[i], vol_shape[i], overlap[i], padding[i])
+        positions.append(pos)
+        steps.append(step)
 
     # Real overlap calculation for printing
-    real_ov_z = ((vol_shape[0]-padding[0]*2)-step_z)/(vol_shape[0]-padding[0]*2)
-    real_ov_y = ((vol_shape[1]-padding[1]*2)-step_y)/(vol_shape[1]-padding[1]*2)
-    real_ov_x = ((vol_shape[2]-padding[2]*2)-step_x)/(vol_shape[2]-padding[2]*2)
+    real_ov = [((vol_shape[i]-padding[i]*2)-steps[i])/(vol_shape[i]-padding[i]*2) for i in range(3)]
     if verbose:
-        print("Real overlapping (%): {}".format((real_ov_z,real_ov_y,real_ov_x)))
-        print("Real overlapping (pixels): {}".format(((vol_shape[0]-padding[0]*2)*real_ov_z,
-              (vol_shape[1]-padding[1]*2)*real_ov_y,(vol_shape[2]-padding[2]*2)*real_ov_x)))
-        print("{} patches per (z,y,x) axis".format((vols_per_z,vols_per_x,vols_per_y)))
+        print("Real overlapping (%): {}".format(tuple(real_ov)))
+        print("Real overlapping (pixels): {}".format(tuple((vol_shape[i]-padding[i]*2)*real_ov[i] for i in range(3))))
+        print("{} patches per (z,y,x) axis".format(tuple(len(p) for p in positions)))
 
-    total_vol = vols_per_z*vols_per_y*vols_per_x
-    cropped_data = np.zeros((total_vol,) + padded_vol_shape, dtype=data.dtype)
+    cropped_data = extract_patches(padded_data, positions, vol_shape[:3])
     if data_mask is not None:
-        cropped_data_mask = np.zeros((total_vol,) + padded_vol_shape[:3]+(data_mask.shape[-1],), dtype=data_mask.dtype)
-
-    c = 0
-    for z in range(vols_per_z):
-        for y in range(vols_per_y):
-            for x in range(vols_per_x):
-                d_z = 0 if (z*step_z+vol_shape[0]) < padded_data.shape[0] else last_z
-                d_y = 0 if (y*step_y+vol_shape[1]) < padded_data.shape[1] else last_y
-                d_x = 0 if (x*step_x+vol_shape[2]) < padded_data.shape[2] else last_x
-
-                cropped_data[c] = padded_data[z*step_z-d_z:z*step_z+vol_shape[0]-d_z,
-                                              y*step_y-d_y:y*step_y+vol_shape[1]-d_y,
-                                              x*step_x-d_x:x*step_x+vol_shape[2]-d_x]
-                if data_mask is not None:
-                    cropped_data_mask[c] = padded_data_mask[z*step_z-d_z:(z*step_z)+vol_shape[0]-d_z,
-                                                            y*step_y-d_y:y*step_y+vol_shape[1]-d_y,
-                                                            x*step_x-d_x:x*step_x+vol_shape[2]-d_x]
-                c += 1
+        cropped_data_mask = extract_patches(padded_data_mask, positions, vol_shape[:3])
 
     if verbose:
         print("**** New data shape is: {}".format(cropped_data.shape))
@@ -311,7 +288,8 @@ def crop_3D_data_with_overlap(data, vol_shape, data_mask=None, overlap=(0,0,0),
         return cropped_data
 
 
-def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,0,0), padding=(0,0,0), verbose=True):
+def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,0,0), padding=(0,0,0), verbose=True,
+    blending='none'):
     """Merge 3D subvolumes in a 3D volume with a defined overlap.
 
        The opposite function is :func:`~crop_3D_data_with_overlap`.
@@ -338,6 +316,11 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
        verbose : bool, optional
             To print information about the crop to be made.
 
+       blending : str, optional
+           Window used to weight the pixels of each subvolume when merging them, so the pixels close to their borders
+           contribute less to the result. This removes the seams between subvolumes with less overlap. Options:
+           ``'none'`` (plain average), ``'spline'`` or ``'gaussian'`` (see :func:`~data.tiling.blending_window`).
+
        Returns
        -------
        merged_data : 4D Numpy array
@@ -395,89 +378,191 @@ def merge_3D_data_with_overlap(data, orig_vol_shape, data_mask=None, overlap=(0,
         print("Minimum overlap selected: {}".format(overlap))
         print("Padding: {}".format(padding))
 
+    positions, steps = [], []
+    for i in range(3):
+        pos, step = tile_positions(orig_vol_shape[i], data.shape[i+1], overlap[i], padding[i])
+        positions.append(pos)
+        steps.append(step)
+
+    # Real overlap calculation for printing
+    real_ov = [((data.shape[i+1]-padding[i]*2)-steps[i])/(data.shape[i+1]-padding[i]*2) for i in range(3)]
+    if verbose:
+        print("Real overlapping (%): {}".format(tuple(real_ov)))
+        print("Real overlapping (pixels): {}".format(tuple((data.shape[i+1]-padding[i]*2)*real_ov[i] for i in range(3))))
+        print("{} patches per (z,y,x) axis".format(tuple(len(p) for p in positions)))
+
     # Remove the padding
-    pad_input_shape = data.shape
     data = data[:, padding[0]:data.shape[1]-padding[0],
                 padding[1]:data.shape[2]-padding[1],
                 padding[2]:data.shape[3]-padding[2], :]
-
-    merged_data = np.zeros((orig_vol_shape), dtype=np.float32)
+    merged_data = merge_patches(data, positions, orig_vol_shape[:3], blending=blending).astype(data.dtype)
     if data_mask is not None:
         data_mask = data_mask[:, padding[0]:data_mask.shape[1]-padding[0],
                               padding[1]:data_mask.shape[2]-padding[1],
                               padding[2]:data_mask.shape[3]-padding[2], :]
-        merged_data_mask = np.zeros(orig_vol_shape[:3]+(data_mask.shape[-1],), dtype=np.float32)
-    ov_map_counter = np.zeros((orig_vol_shape), dtype=np.uint16)
-
-    # Calculate overlapping variables
-    overlap_z = 1 if overlap[0] == 0 else 1-overlap[0]
-    overlap_y = 1 if overlap[1] == 0 else 1-overlap[1]
-    overlap_x = 1 if overlap[2] == 0 else 1-overlap[2]
-    
-    padded_vol_shape = [orig_vol_shape[0]+2*padding[0], orig_vol_shape[1]+2*padding[1], orig_vol_shape[2]+2*padding[2]]
-
-    # Z
-    step_z = int((pad_input_shape[1]-padding[0]*2)*overlap_z)
-    vols_per_z = math.ceil(orig_vol_shape[0]/step_z)
-    last_z = 0 if vols_per_z == 1 else (((vols_per_z-1)*step_z)+pad_input_shape[1])-padded_vol_shape[0]
-
-    # Y
-    step_y = int((pad_input_shape[2]-padding[1]*2)*overlap_y)
-    vols_per_y = math.ceil(orig_vol_shape[1]/step_y)
-    last_y = 0 if vols_per_y == 1 else (((vols_per_y-1)*step_y)+pad_input_shape[2])-padded_vol_shape[1]
-
-    # X
-    step_x = int((pad_input_shape[3]-padding[2]*2)*overlap_x)
-    vols_per_x = math.ceil(orig_vol_shape[2]/step_x)
-    last_x = 0 if vols_per_x == 1 else (((vols_per_x-1)*step_x)+pad_input_shape[3])-padded_vol_shape[2]
-
-    # Real overlap calculation for printing
-    real_ov_z = ((pad_input_shape[1]-padding[0]*2)-step_z)/(pad_input_shape[1]-padding[0]*2) 
-    real_ov_y = ((pad_input_shape[2]-padding[1]*2)-step_y)/(pad_input_shape[2]-padding[1]*2) 
-    real_ov_x = ((pad_input_shape[3]-padding[2]*2)-step_x)/(pad_input_shape[3]-padding[2]*2) 
-
-    if verbose:
-        print("Real overlapping (%): {}".format((real_ov_z,real_ov_y,real_ov_x)))
-        print("Real overlapping (pixels): {}".format(((pad_input_shape[1]-padding[0]*2)*real_ov_z,
-            (pad_input_shape[2]-padding[1]*2)*real_ov_y,(pad_input_shape[3]-padding[2]*2)*real_ov_x)))
-        print("{} patches per (z,y,x) axis".format((vols_per_z,vols_per_x,vols_per_y)))
-
-    c = 0
-    for z in range(vols_per_z):
-        for y in range(vols_per_y):
-            for x in range(vols_per_x):
-                d_z = 0 if (z*step_z+data.shape[1]) < orig_vol_shape[0] else last_z
-                d_y = 0 if (y*step_y+data.shape[2]) < orig_vol_shape[1] else last_y
-                d_x = 0 if (x*step_x+data.shape[3]) < orig_vol_shape[2] else last_x
-
-                merged_data[z*step_z-d_z:(z*step_z)+data.shape[1]-d_z,
-                            y*step_y-d_y:y*step_y+data.shape[2]-d_y,
-                            x*step_x-d_x:x*step_x+data.shape[3]-d_x] += data[c]
-
-                if data_mask is not None:
-                    merged_data_mask[z*step_z-d_z:(z*step_z)+data.shape[1]-d_z,
-                                     y*step_y-d_y:y*step_y+data.shape[2]-d_y,
-                                     x*step_x-d_x:x*step_x+data.shape[3]-d_x] += data_mask[c]
-
-                ov_map_counter[z*step_z-d_z:(z*step_z)+data.shape[1]-d_z,
-                               y*step_y-d_y:y*step_y+data.shape[2]-d_y,
-                               x*step_x-d_x:x*step_x+data.shape[3]-d_x] += 1
-                c += 1
-
-    merged_data = np.true_divide(merged_data, ov_map_counter).astype(data.dtype)
+        merged_data_mask = merge_patches(data_mask, positions, orig_vol_shape[:3]).astype(data_mask.dtype)
 
     if verbose:
         print("**** New data shape is: {}".format(merged_data.shape))
         print("### END MERGE-3D-OV-CROP ###")
 
     if data_mask is not None:
-        merged_data_mask = np.true_divide(merged_data_mask, ov_map_counter).astype(data_mask.dtype)
         return merged_data, merged_data_mask
     else:
         return merged_data
 
 
-def random_3D_crop(vol, vol_mask, random_crop_size, val=False, vol_prob=None, weight_map=None, draw_prob_map_points=False):
+def crop_3D_data_with_overlap_by_batches(data, vol_shape, batch_size, data_mask=None, overlap=(0,0,0), padding=(0,0,0),
+    median_padding=False, verbose=True):
+    """Crop 3D data into smaller volumes as :func:`~crop_3D_data_with_overlap` does, but creating them lazily in
+       batches, so only one batch is kept in memory. The subvolumes are placed with the same
+       :func:`~data.tiling.tile_positions` and in the same order, and the padding is made on each subvolume instead of
+       on the whole volume. Use :func:`~merge_3D_batch_with_overlap` to merge them back.
+
+       Parameters
+       ----------
+       data : 4D Numpy array
+           Data to crop. E.g. ``(z, y, x, channels)``.
+
+       vol_shape : 4D int tuple
+           Shape of the volumes to create. E.g. ``(z, y, x, channels)``.
+
+       batch_size : int
+           Number of subvolumes of each batch.
+
+       data_mask : 4D Numpy array, optional
+            Data mask to crop. E.g. ``(z, y, x, channels)``.
+
+       overlap : Tuple of 3 floats, optional
+            Amount of minimum overlap on z, y and x dimensions. The values must be on range ``[0, 1)``, that is, ``0%``
+            or ``99%`` of overlap. E.g. ``(z, y, x)``.
+
+       padding : tuple of ints, optional
+           Size of padding to be added on each axis ``(z, y, x)``. E.g. ``(24, 24, 24)``.
+
+       median_padding : bool, optional
+           If ``True`` the padding value is the median value. If ``False``, the padding is made with 'reflect'.
+
+       verbose : bool, optional
+            To print information about the crop to be made.
+
+       Yields
+       ------
+       coords : List of 3 int tuples
+           Position of each subvolume of the batch in the padded data. E.g. ``(z, y, x)``.
+
+       batch : 5D Numpy array
+           Subvolumes. E.g. ``(batch_size, z, y, x, channels)``.
+
+       batch_mask : 5D Numpy array, optional
+           Subvolumes of the data mask. E.g. ``(batch_size, z, y, x, channels)``. Returned only if ``data_mask`` is
+           provided.
+    """
+    if data.ndim != 4:
+        raise ValueError("data expected to be 4 dimensional, given {}".format(data.shape))
+    if data_mask is not None and data.shape[:-1] != data_mask.shape[:-1]:
+        raise ValueError("data and data_mask shapes mismatch: {} vs {}".format(data.shape[:-1], data_mask.shape[:-1]))
+    if len(vol_shape) != 4:
+        raise ValueError("vol_shape expected to be of length 4, given {}".format(vol_shape))
+    for i in range(3):
+        if vol_shape[i] > data.shape[i]:
+            raise ValueError("'vol_shape[{}]' {} greater than {}".format(i, vol_shape[i], data.shape[i]))
+        if overlap[i] >= 1 or overlap[i] < 0:
+            raise ValueError("'overlap' values must be floats between range [0, 1)")
+        if padding[i] >= vol_shape[i]//2:
+            raise ValueError("'Padding' can not be greater than the half of 'vol_shape'. Max value for this {} input "
+                             "shape is {}".format(data.shape, [(vol_shape[0]//2)-1,(vol_shape[1]//2)-1,(vol_shape[2]//2)-1]))
+
+    axis_coords = [tile_positions(data.shape[i], vol_shape[i], overlap[i], padding[i])[0] for i in range(3)]
+    total_vol = len(axis_coords[0])*len(axis_coords[1])*len(axis_coords[2])
+
+    if verbose:
+        print("### 3D-OV-CROP (BY BATCHES) ###")
+        print("Cropping {} image into {} with overlapping in batches of {} . . .".format(data.shape, vol_shape,
+              batch_size))
+        print("Minimum overlap selected: {}".format(overlap))
+        print("Padding: {}".format(padding))
+        print("{} patches per (z,y,x) axis".format(tuple(len(c) for c in axis_coords)))
+        print("**** Number of subvolumes: {}".format(total_vol))
+
+    if median_padding:
+        medians = [(np.median(data[0]), np.median(data[-1])), (np.median(data[:,0]), np.median(data[:,-1])),
+                   (np.median(data[:,:,0]), np.median(data[:,:,-1]))]
+
+    def extract_patch(img, coord, median=False):
+        slices, pads = [], []
+        for i in range(3):
+            start, end = coord[i]-padding[i], coord[i]-padding[i]+vol_shape[i]
+            c_start, c_end = max(start, 0), min(end, img.shape[i])
+            slices.append(slice(c_start, c_end))
+            pads.append((c_start-start, end-c_end))
+        patch = img[tuple(slices)]
+        if any(p != (0,0) for p in pads):
+            patch = np.pad(patch, pads+[(0,0)], 'reflect')
+            if median:
+                for i in range(3):
+                    s = [slice(None)]*4
+                    if pads[i][0] > 0:
+                        s[i] = slice(0, pads[i][0])
+                        patch[tuple(s)] = medians[i][0]
+                    if pads[i][1] > 0:
+                        s[i] = slice(vol_shape[i]-pads[i][1], vol_shape[i])
+                        patch[tuple(s)] = medians[i][1]
+        return patch
+
+    all_coords = [tuple(c) for c in patch_grid(axis_coords).tolist()]
+    for i in range(0, total_vol, batch_size):
+        coords = all_coords[i:i+batch_size]
+        batch = np.array([extract_patch(data, c, median_padding) for c in coords])
+        if data_mask is not None:
+            yield coords, batch, np.array([extract_patch(data_mask, c) for c in coords])
+        else:
+            yield coords, batch
+
+
+def merge_3D_batch_with_overlap(merged_data, ov_map_counter, batch, coords, padding=(0,0,0), blending='none'):
+    """Add a batch of subvolumes created by :func:`~crop_3D_data_with_overlap_by_batches` to the merged volume. Once
+       all the batches are added, ``merged_data`` needs to be divided by ``ov_map_counter`` to obtain the same result as
+       :func:`~merge_3D_data_with_overlap`.
+
+       Parameters
+       ----------
+       merged_data : 4D Numpy array
+           Volume to add the subvolumes to. E.g. ``(z, y, x, channels)``. A memory-mapped array can be used to not keep
+           the volume in memory.
+
+       ov_map_counter : 3D Numpy array
+           Number of subvolumes added on each position, or the sum of their weights if ``blending`` is used. E.g.
+           ``(z, y, x)``.
+
+       batch : 5D Numpy array
+           Subvolumes. E.g. ``(batch_size, z, y, x, channels)``.
+
+       coords : List of 3 int tuples
+           Position of each subvolume in the padded data, as returned by
+           :func:`~crop_3D_data_with_overlap_by_batches`. E.g. ``(z, y, x)``.
+
+       padding : tuple of ints, optional
+           Size of padding added on each axis ``(z, y, x)``. E.g. ``(24, 24, 24)``.
+
+       blending : str, optional
+           Window used to weight the pixels of each subvolume when merging them, so the pixels close to their borders
+           contribute less to the result. This removes the seams between subvolumes with less overlap. Options:
+           ``'none'`` (plain average), ``'spline'`` or ``'gaussian'`` (see :func:`~data.tiling.blending_window`).
+    """
+    wind = patch_window(tuple(batch.shape[i+1]-2*padding[i] for i in range(3)), blending)
+    for patch, (z, y, x) in zip(batch, coords):
+        patch = patch[padding[0]:patch.shape[0]-padding[0], padding[1]:patch.shape[1]-padding[1],
+                      padding[2]:patch.shape[2]-padding[2]]
+        if blending == 'none':
+            merged_data[z:z+patch.shape[0], y:y+patch.shape[1], x:x+patch.shape[2]] += patch
+        else:
+            merged_data[z:z+patch.shape[0], y:y+patch.shape[1], x:x+patch.shape[2]] += patch*wind[...,None]
+        ov_map_counter[z:z+patch.shape[0], y:y+patch.shape[1], x:x+patch.shape[2]] += wind
+
+
+def random_3D_crop(vol, vol_mask, random_crop_size, val=False, vol_prob=None, weight_map=None, draw_prob_map_points=False,
+                   center=None):
     """Extracts a random 3D patch from the given image and mask.
 
        Parameters
@@ -504,6 +589,10 @@ def random_3D_crop(vol, vol_mask, random_crop_size, val=False, vol_prob=None, we
        draw_prob_map_points : bool, optional
            To return the voxel chosen to be the center of the crop.
 
+       center : tuple of ints, optional
+           Voxel to be the center of the crop, already drawn from the probability map, e.g. with
+           :class:`~data.prob_map_sampler.ProbMapSampler`. E.g. ``(z, y, x, channel)``. Used instead of ``vol_prob``.
+
        Returns
        -------
        img : 4D Numpy array
@@ -542,19 +631,20 @@ def random_3D_crop(vol, vol_mask, random_crop_size, val=False, vol_prob=None, we
     if val:
         x, y, z, ox, oy, oz = 0, 0, 0, 0, 0, 0
     else:
-        if vol_prob is not None:
-            prob = vol_prob.ravel()
-
-            # Generate the random coordinates based on the distribution
-            choices = np.prod(vol_prob.shape)
-            index = np.random.choice(choices, size=1, p=prob)
-            coordinates = np.unravel_index(index, shape=vol_prob.shape)
-            x = int(coordinates[2])
-            y = int(coordinates[1])
-            z = int(coordinates[0])
-            ox = int(coordinates[2])
-            oy = int(coordinates[1])
-            oz = int(coordinates[0])
+        if vol_prob is not None or center is not None:
+            if center is None:
+                prob = vol_prob.ravel().astype(np.float64)
+
+                # Generate the random coordinates based on the distribution
+                choices = np.prod(vol_prob.shape)
+                index = np.random.choice(choices, size=1, p=prob/prob.sum())
+                center = [c[0] for c in np.unravel_index(index, vol_prob.shape)]
+            x = int(center[2])
+            y = int(center[1])
+            z = int(center[0])
+            ox = int(center[2])
+            oy = int(center[1])
+            oz = int(center[0])
 
             # Adjust the coordinates to be the origin of the crop and control to
             # not be out of the volume
@@ -0,0 +1,276 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from tqdm import tqdm
+from sklearn.model_selection import train_test_split
+
+from utils.util import load_img_from_file, pad_and_reflect
+
+
+def dataset_fingerprint(paths, **kwargs):
+    """Calculate a fingerprint of the files inside the given directories (name, size and modification time) and the
+       settings used to prepare them.
+
+       Parameters
+       ----------
+       paths : List of str
+           Directories to calculate the fingerprint of.
+
+       kwargs : dict, optional
+           Settings used to prepare the data. E.g. crop shape, overlap etc.
+
+       Returns
+       -------
+       fingerprint : str
+           Hexadecimal SHA-1 digest.
+    """
+    h = hashlib.sha1()
+    for p in paths:
+        for id_ in sorted(next(os.walk(p))[2]):
+            stat = os.stat(os.path.join(p, id_))
+            h.update("{}:{}:{};".format(id_, stat.st_size, stat.st_mtime_ns).encode())
+    h.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def load_cached_data(cache_dir, data_path, mask_path, is_3d=False, crop=True, crop_shape=None, overlap=None,
+                     padding=None, reflect_to_complete_shape=False, val_split=0, seed=0, shuffle_val=True):
+    """Load the data and masks of the given directories from an on-disk cache, building it if it does not exist or if
+       the files or the settings changed since it was built. The cache contains one ``.npy`` file per split (train and
+       validation) and data type (data and mask), which are returned memory-mapped, so the data is not loaded into
+       memory. Each ``.npy`` file is preallocated and filled image by image, so the building process only keeps the
+       crops of one image in memory.
+
+       The ``index.json`` file of the cache stores, for each loaded file, its original shape, the position of its first
+       crop and the number of crops made, together with the crops that belong to each split.
+
+       Parameters
+       ----------
+       cache_dir : str
+           Directory to store the cache in.
+
+       data_path : str
+           Path to the data.
+
+       mask_path : str
+           Path to the data masks.
+
+       is_3d : bool, optional
+           Whether the data is composed by 3D volumes.
+
+       crop : bool, optional
+           Crop each image into ``crop_shape`` patches.
+
+       crop_shape : 3/4 int tuple, optional
+           Shape of the crops. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+
+       overlap : Tuple of 2/3 floats, optional
+           Amount of minimum overlap on each dimension. The values must be on range ``[0, 1)``, that is, ``0%`` or
+           ``99%`` of overlap. E. g. ``(y, x)`` or ``(z, y, x)``. No overlap by default.
+
+       padding : Tuple of 2/3 ints, optional
+           Size of padding to be added on each axis. E.g. ``(24, 24)`` or ``(24, 24, 24)``. No padding by default.
+
+       reflect_to_complete_shape : bool, optional
+           Wheter to increase the shape of the dimension that have less size than selected patch size padding it with
+           'reflect'.
+
+       val_split : float, optional
+           % of the data used as validation (value between ``0`` and ``1``).
+
+       seed : int, optional
+           Seed value.
+
+       shuffle_val : bool, optional
+           Take random examples to create validation data.
+
+       Returns
+       -------
+       X : 4D/5D Numpy memmap
+           Data. E.g. ``(num_of_images, y, x, channels)`` or ``(num_of_images, z, y, x, channels)``.
+
+       Y : 4D/5D Numpy memmap
+           Data masks. E.g. ``(num_of_images, y, x, channels)`` or ``(num_of_images, z, y, x, channels)``.
+
+       X_val : 4D/5D Numpy memmap
+           Validation data. ``None`` if ``val_split == 0``.
+
+       Y_val : 4D/5D Numpy memmap
+           Validation data masks. ``None`` if ``val_split == 0``.
+
+       data_shape : List of tuples
+           Shapes of the images loaded.
+
+       filenames : List of str
+           Loaded filenames.
+
+       ``None`` is returned if the data can not be cached, i.e. when the images (or crops) do not share the same shape
+       and data type.
+    """
+    if overlap is None: overlap = (0,0,0) if is_3d else (0,0)
+    if padding is None: padding = (0,0,0) if is_3d else (0,0)
+    settings = dict(is_3d=is_3d, crop=crop, crop_shape=crop_shape, overlap=overlap, padding=padding,
+                    reflect_to_complete_shape=reflect_to_complete_shape, val_split=val_split, seed=seed,
+                    shuffle_val=shuffle_val)
+    fingerprint = dataset_fingerprint([data_path, mask_path], **settings)
+    index_file = os.path.join(cache_dir, 'index.json')
+
+    index = None
+    if os.path.isfile(index_file):
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        if index['fingerprint'] != fingerprint:
+            print("Data in {} or {} changed since the cache in {} was built. Building it again . . ."
+                  .format(data_path, mask_path, cache_dir))
+            index = None
+        else:
+            print("Loading data from cache {}".format(cache_dir))
+
+    if index is None:
+        index = build_data_cache(cache_dir, data_path, mask_path, fingerprint, settings)
+        if index is None:
+            return None
+
+    data = {}
+    for split in index['splits']:
+        for k in ['x', 'y']:
+            # Copy-on-write so the changes made by the generators do not reach the cache
+            data[split+'_'+k] = np.load(os.path.join(cache_dir, split+'_'+k+'.npy'), mmap_mode='c')
+    data_shape = [tuple(f['shape']) for f in index['files']]
+    filenames = [f['name'] for f in index['files']]
+
+    return (data['train_x'], data['train_y'], data.get('val_x', None), data.get('val_y', None), data_shape,
+            filenames)
+
+
+def build_data_cache(cache_dir, data_path, mask_path, fingerprint, settings):
+    """Build the cache used by ``load_cached_data``.
+
+       Parameters
+       ----------
+       cache_dir : str
+           Directory to store the cache in.
+
+       data_path : str
+           Path to the data.
+
+       mask_path : str
+           Path to the data masks.
+
+       fingerprint : str
+           Fingerprint of the data and settings, as returned by ``dataset_fingerprint``.
+
+       settings : dict
+           Arguments of ``load_cached_data`` used to prepare the data.
+
+       Returns
+       -------
+       index : dict
+           Information of the cache. ``None`` if the data can not be cached.
+    """
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+
+    print("Building data cache in {} . . .".format(cache_dir))
+    ids = sorted(next(os.walk(data_path))[2])
+    mask_ids = sorted(next(os.walk(mask_path))[2])
+    if len(ids) != len(mask_ids):
+        raise ValueError("Different number of files found in {} and {}: {} vs {}"
+                         .format(data_path, mask_path, len(ids), len(mask_ids)))
+
+    # First pass: count the crops of each image so the final arrays can be preallocated. The crops are written to a
+    # temporary raw file to avoid cropping again
+    files = []
+    info = {}
+    for k, path, f_ids in [('x', data_path, ids), ('y', mask_path, mask_ids)]:
+        print("Preparing {} . . .".format(path))
+        n = 0
+        with open(os.path.join(cache_dir, 'all_'+k+'.raw'), 'wb') as raw:
+            for i, id_ in tqdm(enumerate(f_ids), total=len(f_ids)):
+                img = load_img_from_file(os.path.join(path, id_), is_3d=settings['is_3d'])
+                img_shape = img.shape
+                img = crop_sample(img, **settings)
+
+                if k not in info:
+                    info[k] = dict(dtype=img.dtype.str, shape=img.shape[1:])
+                elif img.dtype.str != info[k]['dtype'] or img.shape[1:] != info[k]['shape']:
+                    print("WARNING: {} has a different shape or data type than the rest of the files ({} vs {}), so "
+                          "the data can not be cached".format(os.path.join(path, id_), (img.shape[1:], img.dtype),
+                          (info[k]['shape'], np.dtype(info[k]['dtype']))))
+                    shutil.rmtree(cache_dir)
+                    return None
+
+                if k == 'x':
+                    files.append(dict(name=id_, shape=img_shape, first_crop=n, crops=len(img)))
+                raw.write(np.ascontiguousarray(img).tobytes())
+                n += len(img)
+        info[k]['len'] = n
+
+    if info['x']['len'] != info['y']['len']:
+        raise ValueError("Different number of samples created from {} and {}: {} vs {}"
+                         .format(data_path, mask_path, info['x']['len'], info['y']['len']))
+
+    # Split the data as train_test_split would do with the arrays
+    idx = np.arange(info['x']['len'])
+    splits = {}
+    if settings['val_split'] > 0:
+        splits['train'], splits['val'] = train_test_split(idx, test_size=settings['val_split'],
+            shuffle=settings['shuffle_val'], random_state=settings['seed'])
+    else:
+        splits['train'] = idx
+
+    # Second pass: fill the preallocated arrays of each split
+    for k in ['x', 'y']:
+        raw_file = os.path.join(cache_dir, 'all_'+k+'.raw')
+        all_data = np.memmap(raw_file, dtype=info[k]['dtype'], mode='r', shape=(info[k]['len'],)+info[k]['shape'])
+        for split, s_idx in splits.items():
+            out = np.lib.format.open_memmap(os.path.join(cache_dir, split+'_'+k+'.npy'), mode='w+',
+                dtype=info[k]['dtype'], shape=(len(s_idx),)+info[k]['shape'])
+            for i, j in enumerate(s_idx):
+                out[i] = all_data[j]
+            out.flush()
+            del out
+        del all_data
+        os.remove(raw_file)
+
+    index = dict(fingerprint=fingerprint, files=files, splits={s: v.tolist() for s, v in splits.items()})
+    # The index is written at the end so an interrupted build is never taken as valid
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def crop_sample(img, is_3d=False, crop=True, crop_shape=None, overlap=(0,0), padding=(0,0),
+                reflect_to_complete_shape=False, **kwargs):
+    """Prepare one image as ``load_data_from_dir`` (2D) or ``load_3d_images_from_dir`` (3D) do.
+
+       Parameters
+       ----------
+       img : 3D/4D Numpy array
+           Image to crop. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+
+       Rest of the parameters are the same as in ``load_cached_data``.
+
+       Returns
+       -------
+       img : 4D/5D Numpy array
+           Crops of the image. E.g. ``(num_of_crops, y, x, channels)`` or ``(num_of_crops, z, y, x, channels)``.
+    """
+    if reflect_to_complete_shape: img = pad_and_reflect(img, crop_shape, verbose=False)
+    if is_3d:
+        from data.data_3D_manipulation import crop_3D_data_with_overlap
+        if crop and img.shape != crop_shape[:3]+(img.shape[-1],):
+            img = crop_3D_data_with_overlap(img, crop_shape[:3]+(img.shape[-1],), overlap=overlap, padding=padding,
+                                            verbose=False)
+        else:
+            img = np.expand_dims(img, axis=0)
+    else:
+        from data.data_2D_manipulation import crop_data_with_overlap
+        img = np.expand_dims(img, axis=0)
+        if crop and img[0].shape != crop_shape[:2]+(img.shape[-1],):
+            img = crop_data_with_overlap(img, crop_shape[:2]+(img.shape[-1],), overlap=overlap, padding=padding,
+                                         verbose=False)
+    return img
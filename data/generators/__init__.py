@@ -3,6 +3,7 @@ import numpy as np
 from tqdm import tqdm
 
 from utils.util import calculate_2D_volume_prob_map, calculate_3D_volume_prob_map, save_tif, check_value
+from data.prob_map_sampler import create_prob_map_sampler, load_prob_map_sampler
 from data.generators.data_2D_generator import ImageDataGenerator
 from data.generators.data_2D_generator_img_pair import PairImageDataGenerator
 from data.generators.data_2D_generator_classification import ClassImageDataGenerator
@@ -42,15 +43,22 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val):
     # Calculate the probability map per image
     prob_map = None
     if cfg.DATA.PROBABILITY_MAP and cfg.DATA.EXTRACT_RANDOM_PATCH:
-        if os.path.exists(cfg.PATHS.PROB_MAP_DIR):
-            print("Loading probability map")
-            prob_map_file = os.path.join(cfg.PATHS.PROB_MAP_DIR, cfg.PATHS.PROB_MAP_FILENAME)
-            num_files = len(next(os.walk(cfg.PATHS.PROB_MAP_DIR))[2])
-            prob_map = cfg.PATHS.PROB_MAP_DIR if num_files > 1 else np.load(prob_map_file)
+        # The crop centers are drawn from a sampler stored next to the maps, which is memory-mapped
+        sampler_dir = os.path.join(cfg.PATHS.PROB_MAP_DIR, 'sampler')
+        if os.path.exists(sampler_dir):
+            print("Loading probability map sampler")
+            prob_map = load_prob_map_sampler(sampler_dir)
         else:
-            f_name = calculate_2D_volume_prob_map if cfg.PROBLEM.NDIM == '2D' else calculate_3D_volume_prob_map
-            prob_map = f_name(Y_train, cfg.DATA.TRAIN.MASK_PATH, cfg.DATA.W_FOREGROUND, cfg.DATA.W_BACKGROUND,
-                              save_dir=cfg.PATHS.PROB_MAP_DIR)
+            if os.path.exists(cfg.PATHS.PROB_MAP_DIR):
+                print("Loading probability map")
+                prob_map_file = os.path.join(cfg.PATHS.PROB_MAP_DIR, cfg.PATHS.PROB_MAP_FILENAME)
+                num_files = len(next(os.walk(cfg.PATHS.PROB_MAP_DIR))[2])
+                prob_map = cfg.PATHS.PROB_MAP_DIR if num_files > 1 else np.load(prob_map_file, mmap_mode='r')
+            else:
+                f_name = calculate_2D_volume_prob_map if cfg.PROBLEM.NDIM == '2D' else calculate_3D_volume_prob_map
+                prob_map = f_name(Y_train, cfg.DATA.TRAIN.MASK_PATH, cfg.DATA.W_FOREGROUND, cfg.DATA.W_BACKGROUND,
+                                  save_dir=cfg.PATHS.PROB_MAP_DIR)
+            prob_map = create_prob_map_sampler(prob_map, save_dir=sampler_dir)
 
     # Checks
     if cfg.AUGMENTOR.GRIDMASK:
@@ -86,8 +94,10 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val):
             zoom=cfg.AUGMENTOR.ZOOM, zoom_range=cfg.AUGMENTOR.ZOOM_RANGE, shift=cfg.AUGMENTOR.SHIFT,
             affine_mode=cfg.AUGMENTOR.AFFINE_MODE, shift_range=cfg.AUGMENTOR.SHIFT_RANGE, vflip=cfg.AUGMENTOR.VFLIP,
             hflip=cfg.AUGMENTOR.HFLIP, elastic=cfg.AUGMENTOR.ELASTIC, e_alpha=cfg.AUGMENTOR.E_ALPHA,
-            e_sigma=cfg.AUGMENTOR.E_SIGMA, e_mode=cfg.AUGMENTOR.E_MODE, g_blur=cfg.AUGMENTOR.G_BLUR,
-            g_sigma=cfg.AUGMENTOR.G_SIGMA, median_blur=cfg.AUGMENTOR.MEDIAN_BLUR, mb_kernel=cfg.AUGMENTOR.MB_KERNEL,
+            e_sigma=cfg.AUGMENTOR.E_SIGMA, e_mode=cfg.AUGMENTOR.E_MODE, spatial_backend=cfg.AUGMENTOR.SPATIAL_BACKEND,
+            e_cache_size=cfg.AUGMENTOR.E_CACHE_SIZE, e_cache_epochs=cfg.AUGMENTOR.E_CACHE_EPOCHS,
+            g_blur=cfg.AUGMENTOR.G_BLUR, g_sigma=cfg.AUGMENTOR.G_SIGMA, median_blur=cfg.AUGMENTOR.MEDIAN_BLUR,
+            mb_kernel=cfg.AUGMENTOR.MB_KERNEL,
             motion_blur=cfg.AUGMENTOR.MOTION_BLUR, motb_k_range=cfg.AUGMENTOR.MOTB_K_RANGE,
             gamma_contrast=cfg.AUGMENTOR.GAMMA_CONTRAST, gc_gamma=cfg.AUGMENTOR.GC_GAMMA, brightness=cfg.AUGMENTOR.BRIGHTNESS,
             brightness_factor=cfg.AUGMENTOR.BRIGHTNESS_FACTOR, brightness_mode=cfg.AUGMENTOR.BRIGHTNESS_MODE,
@@ -113,6 +123,7 @@ def create_train_val_augmentors(cfg, X_train, Y_train, X_val, Y_val):
             extra_data_factor=cfg.DATA.TRAIN.REPLICATE)
         if cfg.PROBLEM.NDIM == '3D':
             dic['zflip'] = cfg.AUGMENTOR.ZFLIP
+            dic['rand_rot_3d'] = cfg.AUGMENTOR.RANDOM_ROT_3D
 
         if cfg.PROBLEM.TYPE == 'SUPER_RESOLUTION':
             dic['random_crop_scale']=cfg.AUGMENTOR.RANDOM_CROP_SCALE
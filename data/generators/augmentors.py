@@ -6,7 +6,7 @@ from PIL import Image
 from skimage.transform import resize
 from skimage.draw import line
 from scipy.ndimage.measurements import label
-from scipy.ndimage.morphology import binary_dilation
+from scipy.ndimage.morphology import binary_dilation, distance_transform_cdt
 
 
 def cutout(img, mask, channels, z_size, nb_iterations=(1,3), size=(0.2,0.4), cval=0, res_relation=(1,1), apply_to_mask=False):
@@ -657,7 +657,7 @@ def brightness_em(image, brightness_factor=(0,0),  mode='2D', invert=False, inve
     if brightness_factor[0] == 0 and brightness_factor[1] == 0: return image
 
     # Force mode if 2D
-    if img.ndim == 3: mode == '3D'
+    if image.ndim == 3: mode == '3D'
 
     b_factor = random.uniform(brightness_factor[0], brightness_factor[1])
     if mode == '2D':
@@ -1018,3 +1018,512 @@ def GridMask(img, channels, z_size, ratio=0.6, d_range=(30,60), rotate=1, invert
         return img
     else:
         return img*np.stack((mask,)*img.shape[-1], axis=-1)
+
+
+
+def _selected_samples(n, apply=None):
+    """Auxiliary function for the batch augmentations. Returns the indexes of the samples to transform."""
+    if apply is None: return np.arange(n)
+    return np.flatnonzero(apply)
+
+
+def cutout_batch(imgs, masks, channels, z_size, nb_iterations=(1,3), size=(0.2,0.4), cval=0, res_relation=(1,1),
+                 apply_to_mask=False, apply=None):
+    """Batch version of :func:`~cutout`. The areas of all the samples are drawn at once and filled in place.
+
+       Parameters
+       ----------
+       imgs : 4D Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       masks : 4D Numpy array
+           Masks to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       channels : int
+           Size of channel dimension. Used for 3D images as the channels have been merged with the z axis.
+
+       z_size : int
+           Size of z dimension. Used for 3D images as the z axis has been merged with the channels. Set to -1 to when
+           do not want to be applied.
+
+       nb_iterations : tuple of ints, optional
+           Number of areas to fill each image with. E.g. ``(1, 3)``.
+
+       size : tuple of floats, optional
+           Range to choose the size of the areas to create.
+
+       cval : int, optional
+           Value to fill the area with.
+
+       res_relation: tuple of ints/floats, optional
+           Relation between axis resolution. E.g. ``(1,1,0.27)`` for anisotropic data of 8umx8umx30um resolution.
+
+       apply_to_mask : boolean, optional
+           To apply cutout to the masks.
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : 4D Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+
+       masks : 4D Numpy array
+           Transformed masks. E.g. ``(batch_size, y, x, channels)``.
+    """
+    idx = _selected_samples(len(imgs), apply)
+    if len(idx) == 0: return imgs, masks
+
+    n, (h, w) = len(idx), imgs.shape[1:3]
+    it = np.random.randint(nb_iterations[0], nb_iterations[1], n)
+    _size = np.random.uniform(size[0], size[1], (n, it.max()))
+    y_size = np.clip(h*_size*res_relation[1], 1, h).astype(int)
+    x_size = np.clip(w*_size*res_relation[0], 1, w).astype(int)
+
+    # Choose a random point
+    cy = (np.random.rand(*_size.shape)*(h-y_size)).astype(int)
+    cx = (np.random.rand(*_size.shape)*(w-x_size)).astype(int)
+    if z_size != -1:
+        _z_size = np.clip(z_size*_size*res_relation[2], 1, z_size).astype(int)
+        cz = (np.random.rand(*_size.shape)*(z_size-_z_size)).astype(int)
+
+    for k, i in enumerate(idx):
+        for j in range(it[k]):
+            region = (i, slice(cy[k,j], cy[k,j]+y_size[k,j]), slice(cx[k,j], cx[k,j]+x_size[k,j]))
+            if z_size != -1:
+                region += (slice(cz[k,j]*channels, (cz[k,j]+_z_size[k,j])*channels),)
+            imgs[region] = cval
+            if apply_to_mask:
+                masks[region] = 0
+    return imgs, masks
+
+
+def cutblur_batch(imgs, size=(0.2,0.4), down_ratio_range=(2,8), only_inside=True, apply=None):
+    """Batch version of :func:`~cutblur`. The regions and ratios of all the samples are drawn at once and each region
+       is resized with all its channels together.
+
+       Parameters
+       ----------
+       imgs : 4D Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       size : float, optional
+           Size of the region to transform.
+
+       down_ratio_range : tuple of ints, optional
+           Downsampling ratio range to be applied. E.g. ``(2, 8)``.
+
+       only_inside : bool, optional
+           If ``True`` only the region inside will be modified (cut LR into HR image). If ``False`` the ``50%`` of the
+           times the region inside will be modified (cut LR into HR image) and the other ``50%`` the inverse will be
+           done (cut HR into LR image).
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : 4D Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    idx = _selected_samples(len(imgs), apply)
+    if len(idx) == 0: return imgs
+
+    n, (h, w, c) = len(idx), imgs.shape[1:]
+    _size = np.random.uniform(size[0], size[1], n)
+    y_size = (h*_size).astype(int)
+    x_size = (w*_size).astype(int)
+
+    # Choose a random point
+    cy = (np.random.rand(n)*(h-y_size)).astype(int)
+    cx = (np.random.rand(n)*(w-x_size)).astype(int)
+
+    # Choose a random downsampling ratio
+    down_ratio = np.random.randint(down_ratio_range[0], down_ratio_range[1]+1, n)
+    if not only_inside:
+        inside = np.random.rand(n) < 0.5
+    else:
+        inside = np.ones(n, dtype=bool)
+
+    for k, i in enumerate(idx):
+        region = (slice(cy[k], cy[k]+y_size[k]), slice(cx[k], cx[k]+x_size[k]))
+        temp = imgs[i][region] if inside[k] else imgs[i]
+
+        # Resize all the channels at once, as a 2D image if there is only one as it is faster
+        out_shape = (h//down_ratio[k], w//down_ratio[k], c)
+        if c == 1: temp, out_shape = temp[...,0], out_shape[:2]
+        downsampled = resize(temp, out_shape, order=1, mode='reflect',
+                             clip=True, preserve_range=True, anti_aliasing=True)
+        upsampled = resize(downsampled, temp.shape, order=0, mode='reflect',
+                           clip=True, preserve_range=True, anti_aliasing=False)
+        if c == 1: upsampled = upsampled[...,None]
+
+        if inside[k]:
+            imgs[i][region] = upsampled
+        else:
+            hr = imgs[i][region].copy()
+            imgs[i] = upsampled
+            imgs[i][region] = hr
+    return imgs
+
+
+def cutnoise_batch(imgs, scale=(0.1,0.2), nb_iterations=(1,3), size=(0.2,0.4), apply=None):
+    """Batch version of :func:`~cutnoise`. The regions and scales of all the samples are drawn at once and the noise
+       is added in place to all the channels of each region. The noise is not truncated to integers and each region
+       is clipped to ``[0, max]``, being ``max`` the maximum value of the input image.
+
+       Parameters
+       ----------
+       imgs : 4D Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       scale : tuple of floats, optional
+           Scale of the random noise. E.g. ``(0.1, 0.2)``.
+
+       nb_iterations : tuple of ints, optional
+           Number of areas with noise to create. E.g. ``(1, 3)``.
+
+       size : boolean, optional
+           Range to choose the size of the areas to transform. E.g. ``(0.2, 0.4)``.
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : 4D Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    idx = _selected_samples(len(imgs), apply)
+    if len(idx) == 0: return imgs
+
+    n, (h, w) = len(idx), imgs.shape[1:3]
+    it = np.random.randint(nb_iterations[0], nb_iterations[1], n)
+    _size = np.random.uniform(size[0], size[1], (n, it.max()))
+    y_size = (h*_size).astype(int)
+    x_size = (w*_size).astype(int)
+
+    # Choose a random point
+    cy = (np.random.rand(*_size.shape)*(h-y_size)).astype(int)
+    cx = (np.random.rand(*_size.shape)*(w-x_size)).astype(int)
+    _scale = np.random.uniform(scale[0], scale[1], _size.shape)
+
+    for k, i in enumerate(idx):
+        max_value = np.max(imgs[i])
+        for j in range(it[k]):
+            region = (i, slice(cy[k,j], cy[k,j]+y_size[k,j]), slice(cx[k,j], cx[k,j]+x_size[k,j]))
+            noise = np.random.normal(loc=0, scale=_scale[k,j]*max_value, size=(y_size[k,j], x_size[k,j], 1))
+            imgs[region] = np.clip(imgs[region] + noise, 0, max_value)
+    return imgs
+
+
+def _intensity_factors(imgs, n, factor_range, mode):
+    """Auxiliary function for the batch intensity augmentations. Draws a factor per channel (slice) on ``2D`` mode
+       and one per sample on ``3D`` mode, shaped to be broadcasted against each sample."""
+    shape = (n,)+(1,)*(imgs.ndim-2)+(imgs.shape[-1] if mode == '2D' else 1,)
+    return np.random.uniform(factor_range[0], factor_range[1], shape).astype(np.float32)
+
+
+def brightness_batch(imgs, brightness_factor=(0,0), mode='2D', apply=None):
+    """Batch version of :func:`~brightness`. The factors of all the samples are drawn at once and each sample is
+       changed in place with a single broadcasted operation for all its channels.
+
+       Parameters
+       ----------
+       imgs : Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       brightness_factor : tuple of 2 floats, optional
+           Range of brightness' intensity. E.g. ``(0.1, 0.3)``.
+
+       mode : str, optional
+           One of ``2D`` (a factor per channel) or ``3D`` (a factor per sample).
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    if brightness_factor[0] == 0 and brightness_factor[1] == 0: return imgs
+
+    idx = _selected_samples(len(imgs), apply)
+    b_factor = _intensity_factors(imgs, len(idx), brightness_factor, mode)
+    for k, i in enumerate(idx):
+        img = imgs[i]
+        img += b_factor[k]
+        np.clip(img, 0, 1, out=img)
+    return imgs
+
+
+def contrast_batch(imgs, contrast_factor=(0,0), mode='2D', apply=None):
+    """Batch version of :func:`~contrast`. The factors of all the samples are drawn at once and each sample is
+       changed in place with a single broadcasted operation for all its channels.
+
+       Parameters
+       ----------
+       imgs : Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       contrast_factor : tuple of 2 floats, optional
+           Range of contrast's intensity. E.g. ``(0.1, 0.3)``.
+
+       mode : str, optional
+           One of ``2D`` (a factor per channel) or ``3D`` (a factor per sample).
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    if contrast_factor[0] == 0 and contrast_factor[1] == 0: return imgs
+
+    idx = _selected_samples(len(imgs), apply)
+    c_factor = 1 + _intensity_factors(imgs, len(idx), contrast_factor, mode)
+    for k, i in enumerate(idx):
+        img = imgs[i]
+        img *= c_factor[k]
+        np.clip(img, 0, 1, out=img)
+    return imgs
+
+
+def brightness_em_batch(imgs, brightness_factor=(0,0), mode='2D', invert=False, invert_p=0, apply=None):
+    """Batch version of :func:`~brightness_em`. The factors, gammas and inversions of all the samples are drawn at
+       once and each sample is changed in place with broadcasted operations for all its channels.
+
+       Parameters
+       ----------
+       imgs : Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       brightness_factor : tuple of 2 floats, optional
+           Range of brightness' intensity. E.g. ``(0.1, 0.3)``.
+
+       mode : str, optional
+           One of ``2D`` (a change per channel) or ``3D`` (a change per sample).
+
+       invert : bool, optional
+           Whether to invert the images.
+
+       invert_p : float, optional
+           Probability of inverting the images.
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    if brightness_factor[0] == 0 and brightness_factor[1] == 0: return imgs
+
+    idx = _selected_samples(len(imgs), apply)
+    b_factor = _intensity_factors(imgs, len(idx), brightness_factor, '3D')
+    shift = (_intensity_factors(imgs, len(idx), (0,1), mode) - 0.5)*b_factor
+    gamma = 2.0**(_intensity_factors(imgs, len(idx), (0,1), mode)*2 - 1)
+    inv = np.random.rand(len(idx)) < invert_p
+    for k, i in enumerate(idx):
+        img = imgs[i]
+        img += shift[k]
+        np.clip(img, 0, 1, out=img)
+        img **= gamma[k]
+        if invert and inv[k]:
+            np.subtract(1, img, out=img)
+    return imgs
+
+
+def contrast_em_batch(imgs, contrast_factor=(0,0), mode='2D', invert=False, invert_p=0, apply=None):
+    """Batch version of :func:`~contrast_em`. The factors, gammas and inversions of all the samples are drawn at once
+       and each sample is changed in place with broadcasted operations for all its channels.
+
+       Parameters
+       ----------
+       imgs : Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       contrast_factor : tuple of 2 floats, optional
+           Range of contrast's intensity. E.g. ``(0.1, 0.3)``.
+
+       mode : str, optional
+           One of ``2D`` (a change per channel) or ``3D`` (a change per sample).
+
+       invert : bool, optional
+           Whether to invert the images.
+
+       invert_p : float, optional
+           Probability of inverting the images.
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    if contrast_factor[0] == 0 and contrast_factor[1] == 0: return imgs
+
+    idx = _selected_samples(len(imgs), apply)
+    c_factor = _intensity_factors(imgs, len(idx), contrast_factor, '3D')
+    factor = 1 + (_intensity_factors(imgs, len(idx), (0,1), mode) - 0.5)*c_factor
+    gamma = 2.0**(_intensity_factors(imgs, len(idx), (0,1), mode)*2 - 1)
+    inv = np.random.rand(len(idx)) < invert_p
+    for k, i in enumerate(idx):
+        img = imgs[i]
+        img *= factor[k]
+        np.clip(img, 0, 1, out=img)
+        img **= gamma[k]
+        if invert and inv[k]:
+            np.subtract(1, img, out=img)
+    return imgs
+
+
+def _dilated_line(rr, cc, shape, iterations):
+    """Auxiliary function for missing_parts_batch. Returns the mask of the line ``(rr, cc)`` dilated ``iterations``
+       times with a cross, i.e. the pixels whose taxicab distance to the line is at most ``iterations``. When the line
+       has one pixel per row (or column), as the lines that cross square images do, that distance is just the distance
+       to the pixel of the line on the same row (column)."""
+    if len(rr) == shape[0] and len(np.unique(rr)) == shape[0]:
+        col = np.empty(shape[0], dtype=int)
+        col[rr] = cc
+        return np.abs(np.arange(shape[1])[None] - col[:,None]) <= iterations
+    if len(cc) == shape[1] and len(np.unique(cc)) == shape[1]:
+        row = np.empty(shape[1], dtype=int)
+        row[cc] = rr
+        return np.abs(np.arange(shape[0])[:,None] - row[None]) <= iterations
+
+    line_mask = np.ones(shape, dtype=bool)
+    line_mask[rr, cc] = False
+    return distance_transform_cdt(line_mask, metric='taxicab') <= iterations
+
+
+def missing_parts_batch(imgs, iterations=(30,40), apply=None):
+    """Batch version of :func:`~missing_parts`. The slices of all the samples are chosen at once and the dilated
+       lines are calculated from the distance to the line instead of dilating it iteratively.
+
+       Parameters
+       ----------
+       imgs : 4D Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       iterations : tuple of 2 ints, optional
+           Iterations to dilate the missing line with. E.g. ``(30, 40)``.
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : 4D Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    idx = _selected_samples(len(imgs), apply)
+    if len(idx) == 0: return imgs
+
+    n, (h, w, c) = len(idx), imgs.shape[1:]
+    it = np.random.randint(iterations[0], iterations[1], n)
+
+    # Choose the slices of each sample, at most one deformed slice in any consecutive 3 slices
+    transforms = np.zeros((n, c), dtype=bool)
+    next_slice = np.zeros(n, dtype=int)
+    for i in range(c):
+        sel = (next_slice <= i) & (np.random.rand(n) < 0.5)
+        next_slice[sel] = i+3
+        transforms[sel, i] = True
+
+    for k, i in zip(*np.nonzero(transforms)):
+        # randomly choose fixed x or fixed y with p = 1/2
+        if np.random.rand() < 0.5:
+            rr, cc = line(0, np.random.randint(1, w - 2), h - 1, np.random.randint(1, w - 2))
+        else:
+            rr, cc = line(np.random.randint(1, h - 2), 0, np.random.randint(1, h - 2), w - 1)
+        img = imgs[idx[k],...,i]
+        img[_dilated_line(rr, cc, (h, w), it[k])] = img.mean()
+    return imgs
+
+
+def _grid_mask(h, w, d, l, st_h, st_w, angle=0):
+    """Auxiliary function for GridMask_batch. Returns the grid mask of :func:`~GridMask` (before inverting it)
+       cropped to ``(h, w)``. It is calculated on each pixel from the position it takes in the square mask when
+       rotating it with the same nearest neighbour mapping ``PIL`` uses (up to the rounding of a few pixels on the
+       borders of the stripes), so it is separable if there is no rotation."""
+    hh = math.ceil((math.sqrt(h*h + w*w)))
+    y = np.arange(h) + (hh-h)//2
+    x = np.arange(w) + (hh-w)//2
+    if angle == 0:
+        return (((y - st_h) % d) >= l)[:,None] & (((x - st_w) % d) >= l)[None]
+
+    angle = -math.radians(angle)
+    cos, sin = round(math.cos(angle), 15), round(math.sin(angle), 15)
+    y, x = y[:,None] + 0.5 - hh/2, x[None] + 0.5 - hh/2
+    xin = np.floor(cos*x + sin*y + hh/2).astype(int)
+    yin = np.floor(-sin*x + cos*y + hh/2).astype(int)
+    inside = (xin >= 0) & (xin < hh) & (yin >= 0) & (yin < hh)
+    return inside & (((yin - st_h) % d) >= l) & (((xin - st_w) % d) >= l)
+
+
+def GridMask_batch(imgs, channels, z_size, ratio=0.6, d_range=(30,60), rotate=1, invert=False, apply=None):
+    """Batch version of :func:`~GridMask`. The grids of all the samples are drawn at once and their masks calculated
+       directly with the size of the images, without drawing and rotating a bigger square mask.
+
+       Parameters
+       ----------
+       imgs : 4D Numpy array
+           Images to transform. E.g. ``(batch_size, y, x, channels)``. It is modified in place.
+
+       channels : int
+           Size of channel dimension. Used for 3D images as the channels have been merged with the z axis.
+
+       z_size : int
+           Size of z dimension. Used for 3D images as the z axis has been merged with the channels. Set to -1 to when
+           do not want to be applied.
+
+       ratio : tuple of floats, optional
+           Range to choose the size of the areas to create.
+
+       d_range : tuple of ints, optional
+           Range to choose the ``d`` value in the original paper.
+
+       rotate : float, optional
+           Rotation of the mask in GridMask. Needs to be between ``[0,1]`` where 1 is 360 degrees.
+
+       invert : bool, optional
+           Whether to invert the mask.
+
+       apply : 1D Numpy array of bools, optional
+           Samples of the batch to transform. If ``None`` all of them are transformed.
+
+       Returns
+       -------
+       imgs : 4D Numpy array
+           Transformed images. E.g. ``(batch_size, y, x, channels)``.
+    """
+    idx = _selected_samples(len(imgs), apply)
+    if len(idx) == 0: return imgs
+
+    n, (h, w) = len(idx), imgs.shape[1:3]
+    d = np.random.randint(d_range[0], d_range[1], n)
+    l = np.ceil(d*ratio).astype(int)
+    st_h = np.random.randint(0, d)
+    st_w = np.random.randint(0, d)
+    r = np.random.randint(rotate, size=n)
+    if z_size != -1:
+        _z_size = np.random.randint(d_range[2], d_range[3], n)
+        cz = np.random.randint(0, z_size-_z_size)
+
+    for k, i in enumerate(idx):
+        mask = _grid_mask(h, w, d[k], l[k], st_h[k], st_w[k], r[k])
+        if not invert: mask = ~mask
+        mask = mask.astype(imgs.dtype)[...,None]
+        if z_size != -1:
+            imgs[i,...,cz[k]*channels:(cz[k]+_z_size[k])*channels] *= mask
+        else:
+            imgs[i] *= mask
+    return imgs
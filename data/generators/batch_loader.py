@@ -0,0 +1,136 @@
+import random
+import threading
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import imgaug as ia
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# The random generators used by the generators (random, numpy and imgaug) are global, so the batches created in
+# parallel by threads need to draw their random numbers one at a time to be reproducible
+batch_rng_lock = threading.Lock()
+
+# Generator used by the worker processes of a BatchLoader
+worker_generator = None
+
+
+def set_batch_seed(seed):
+    """Seed the random generators used to create a batch (``random``, ``numpy`` and ``imgaug``).
+
+       Parameters
+       ----------
+       seed : int
+           Seed of the batch. The generators use ``seed + epoch*len(generator) + batch_index`` so each batch is always
+           created with the same random numbers, no matter which worker creates it.
+    """
+    seed = seed % (2**32)
+    random.seed(seed)
+    np.random.seed(seed)
+    ia.seed(seed)
+
+
+def init_batch_worker(generator):
+    """Store the generator to be used by a worker process of ``BatchLoader``."""
+    global worker_generator
+    worker_generator = generator
+
+
+def get_worker_batch(index):
+    """Create a batch in a worker process of ``BatchLoader``."""
+    return worker_generator[index]
+
+
+class BatchLoader(tf.keras.utils.Sequence):
+    """Wrap a generator to create its batches in parallel with a pool of threads or processes, keeping
+       ``prefetch`` batches ready ahead of the one requested.
+
+       As the generators seed their random generators on each batch based on its index (see ``set_batch_seed``), the
+       batches created are the same regardless of the number of workers and the mode used.
+
+       Parameters
+       ----------
+       generator : tf.keras.utils.Sequence
+           Generator to create the batches with. E.g. ``ImageDataGenerator`` or ``VoxelDataGenerator``.
+
+       workers : int, optional
+           Number of threads/processes to create the batches with.
+
+       prefetch : int, optional
+           Number of batches to prepare ahead of the requested one. At least ``workers`` batches are prepared so no
+           worker is idle.
+
+       mode : str, optional
+           Whether to use threads or processes. Options: ``'thread'`` or ``'process'``. In ``'thread'`` mode the random
+           part of each batch (crops and transformations) is created one batch at a time to be reproducible, so only
+           the rest of the work, e.g. loading the images from disk, is done in parallel. The processes are
+           created again on each epoch so they see the changes made by ``on_epoch_end`` in the generator.
+    """
+    def __init__(self, generator, workers=1, prefetch=2, mode='thread'):
+        if mode not in ['thread', 'process']:
+            raise ValueError("'mode' must be one between ['thread', 'process']")
+        if workers < 1:
+            raise ValueError("'workers' must be greater than 0")
+
+        self.generator = generator
+        self.workers = workers
+        self.prefetch = max(prefetch, workers)
+        self.mode = mode
+        self.executor = None
+        self.pending = {}
+
+    def __len__(self):
+        """Defines the number of batches per epoch."""
+        return len(self.generator)
+
+    def __getitem__(self, index):
+        """Return one batch of the generator, requesting the next ones to the workers.
+
+           Parameters
+           ----------
+           index : int
+               Batch index counter.
+
+           Returns
+           -------
+           batch : tuple
+               Batch created by the generator.
+        """
+        if self.executor is None:
+            self.start()
+
+        for i in range(index, min(index+self.prefetch+1, len(self))):
+            if i not in self.pending:
+                if self.mode == 'thread':
+                    self.pending[i] = self.executor.submit(self.generator.__getitem__, i)
+                else:
+                    self.pending[i] = self.executor.submit(get_worker_batch, i)
+
+        return self.pending.pop(index).result()
+
+    def start(self):
+        """Create the pool of workers."""
+        if self.mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            # Fork the processes so the data of the generator is shared and not copied, if possible
+            ctx = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                                initializer=init_batch_worker, initargs=(self.generator,))
+
+    def stop(self):
+        """Cancel the pending batches and remove the pool of workers."""
+        for f in self.pending.values():
+            f.cancel()
+        self.pending = {}
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def on_epoch_end(self):
+        """Stop the workers and updates the generator after each epoch."""
+        self.stop()
+        self.generator.on_epoch_end()
+
+    def __del__(self):
+        self.stop()
@@ -9,6 +9,8 @@ from skimage.io import imsave, imread
 from imgaug import augmenters as iaa
 
 from utils.util import normalize
+from data.generators.batch_loader import batch_rng_lock, set_batch_seed
+from data.generators.tf_data import stage_timer
 
 
 class ClassImageDataGenerator(tf.keras.utils.Sequence):
@@ -197,6 +199,8 @@ class ClassImageDataGenerator(tf.keras.utils.Sequence):
         self.da_prob = da_prob
 
         self.total_batches_seen = 0
+        self.epoch = 0
+        self.timer = None
 
         self.da_options = []
         self.trans_made = ''
@@ -275,57 +279,62 @@ class ClassImageDataGenerator(tf.keras.utils.Sequence):
         batch_x = np.zeros((len(indexes), *self.shape), dtype=np.uint8)
         batch_y = np.zeros(len(indexes), dtype=np.uint8)
 
-        for i, j in zip(range(len(indexes)), indexes):
+        # Load the samples outside the lock so it can be done in parallel by the workers
+        with stage_timer(self.timer, 'load'):
+            for i, j in zip(range(len(indexes)), indexes):
 
-            # Choose the data source
-            if self.in_memory:
-                img = self.X[j]
-                batch_y[i] = self.Y[j]
-            else:
-                sample_id = self.all_samples[j]
-                sample_class_dir = self.classes[sample_id]
-                img = imread(os.path.join(self.data_path, sample_class_dir, sample_id))
-                if img.ndim == 2:
-                    img = np.expand_dims(img, -1)
+                # Choose the data source
+                if self.in_memory:
+                    img = self.X[j]
+                    batch_y[i] = self.Y[j]
                 else:
-                    if img.shape[0] <= 3: img = img.transpose((1,2,0))
-
-                # Ensure uint8
-                if img.dtype == np.uint16:
-                    if np.max(img) > 255:
-                        img = normalize(img, 0, 65535)
+                    sample_id = self.all_samples[j]
+                    sample_class_dir = self.classes[sample_id]
+                    img = imread(os.path.join(self.data_path, sample_class_dir, sample_id))
+                    if img.ndim == 2:
+                        img = np.expand_dims(img, -1)
                     else:
-                        img = img.astype(np.uint8)
+                        if img.shape[0] <= 3: img = img.transpose((1,2,0))
 
-                batch_y[i] = self.class_numbers[sample_class_dir]
+                    # Ensure uint8
+                    if img.dtype == np.uint16:
+                        if np.max(img) > 255:
+                            img = normalize(img, 0, 65535)
+                        else:
+                            img = img.astype(np.uint8)
 
-            if img.shape[:-1] != self.shape[:-1]:
-                img = self.resize_img(img, self.shape)
+                    batch_y[i] = self.class_numbers[sample_class_dir]
 
-            batch_x[i] = img
+                if img.shape[:-1] != self.shape[:-1]:
+                    img = self.resize_img(img, self.shape)
 
-            # Apply transformations
-            if self.da:
-                extra_img = np.random.randint(0, self.len-1)
-                if self.in_memory:
-                    e_img = self.X[extra_img]
-                else:
-                    sample_id = self.all_samples[extra_img]
-                    sample_class_dir = self.classes[sample_id]
-                    e_img = imread(os.path.join(self.data_path, sample_class_dir, sample_id))
-                    if e_img.ndim == 2:
-                        e_img = np.expand_dims(e_img, -1)
-                    else:
-                        if e_img.shape[0] == 1 or e_img.shape[0] == 3: e_img = e_img.transpose((1,2,0))
+                batch_x[i] = img
 
-                    # Ensure uint8
-                    if e_img.dtype == np.uint16:
-                        if np.max(e_img) > 255:
-                            e_img = normalize(e_img, 0, 65535)
+        # Apply transformations
+        if self.da:
+            with batch_rng_lock, stage_timer(self.timer, 'augment'):
+                set_batch_seed(self.seed + self.epoch*len(self) + index)
+                for i in range(len(indexes)):
+                    extra_img = np.random.randint(0, self.len-1)
+                    if self.in_memory:
+                        e_img = self.X[extra_img]
+                    else:
+                        sample_id = self.all_samples[extra_img]
+                        sample_class_dir = self.classes[sample_id]
+                        e_img = imread(os.path.join(self.data_path, sample_class_dir, sample_id))
+                        if e_img.ndim == 2:
+                            e_img = np.expand_dims(e_img, -1)
                         else:
-                            e_img = e_img.astype(np.uint8)
+                            if e_img.shape[0] == 1 or e_img.shape[0] == 3: e_img = e_img.transpose((1,2,0))
 
-                batch_x[i] = self.apply_transform(batch_x[i], e_im=e_img)
+                        # Ensure uint8
+                        if e_img.dtype == np.uint16:
+                            if np.max(e_img) > 255:
+                                e_img = normalize(e_img, 0, 65535)
+                            else:
+                                e_img = e_img.astype(np.uint8)
+
+                    batch_x[i] = self.apply_transform(batch_x[i], e_im=e_img)
 
         # Divide the values
         if self.div_X_on_load: batch_x = batch_x/255
@@ -341,10 +350,11 @@ class ClassImageDataGenerator(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         """Updates indexes after each epoch."""
-        ia.seed(self.seed + self.total_batches_seen)
+        ia.seed(self.seed + self.epoch)
         self.indexes = self.o_indexes
         if self.shuffle:
-            random.Random(self.seed + self.total_batches_seen).shuffle(self.indexes)
+            random.Random(self.seed + self.epoch).shuffle(self.indexes)
+        self.epoch += 1
 
 
     def apply_transform(self, image, e_im=None):
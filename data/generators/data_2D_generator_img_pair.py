@@ -9,8 +9,13 @@ from imgaug import augmenters as iaa
 
 from utils.util import normalize
 from data.data_2D_manipulation import random_crop
-from data.generators.augmentors import (cutout, cutblur, cutmix, cutnoise, misalignment, brightness, contrast,
-                                        brightness_em, contrast_em, missing_parts, grayscale, shuffle_channels, GridMask)
+from data.generators.augmentors import (cutout_batch, cutblur_batch, cutmix, cutnoise_batch, misalignment,
+                                        brightness_batch, contrast_batch, brightness_em_batch, contrast_em_batch,
+                                        missing_parts_batch, grayscale, shuffle_channels, GridMask_batch)
+from data.generators.spatial_augmentors import SpatialAugmentor
+from data.prob_map_sampler import ProbMapSampler, create_prob_map_sampler
+from data.generators.batch_loader import batch_rng_lock, set_batch_seed
+from data.generators.tf_data import stage_timer
 
 
 class PairImageDataGenerator(tf.keras.utils.Sequence):
@@ -101,6 +106,20 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
        e_mode : str, optional
            Parameter that defines the handling of newly created pixels with the elastic transformation.
 
+       spatial_backend : str, optional
+           How to apply the spatial transformations (rotations, shear, zoom, shift, flips and elastic). ``'imgaug'``
+           applies them one by one with imgaug. ``'composed'`` composes them into a single coordinate map shared by
+           image and image B (see :class:`~data.generators.spatial_augmentors.SpatialAugmentor`), so they are resampled
+           only once.
+
+       e_cache_size : int, optional
+           Number of elastic deformation fields to precompute and reuse, randomly rolled and flipped, instead of
+           creating a new one for each sample. ``0`` to disable it. Only used with ``spatial_backend='composed'``.
+
+       e_cache_epochs : int, optional
+           Number of epochs the precomputed elastic deformation fields are used before being replaced by new ones,
+           which are created in a background thread. ``0`` to never replace them.
+
        g_blur : bool, optional
            To insert gaussian blur on the images.
 
@@ -269,9 +288,10 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
        resolution : 2D tuple of floats, optional
            Resolution of the given data ``(y,x)``. E.g. ``(8,8)``.
 
-       prob_map : 4D Numpy array or str, optional
+       prob_map : 4D Numpy array, str or ProbMapSampler, optional
            If it is an array, it should represent the probability map used to make random crops when
-           ``random_crops_in_DA`` is set. If str given should be the path to read these maps from.
+           ``random_crops_in_DA`` is set. If str is given should be the path to read these maps from. Both are turned
+           into a :class:`~data.prob_map_sampler.ProbMapSampler`, which can also be given directly.
 
        val : bool, optional
            Advise the generator that the images will be to validate the model to not make random crops (as the val.
@@ -338,9 +358,10 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
                  da_prob=0.5, rotation90=False, rand_rot=False, rnd_rot_range=(-180,180), shear=False,
                  shear_range=(-20,20), zoom=False, zoom_range=(0.8,1.2), shift=False, shift_range=(0.1,0.2),
                  affine_mode='constant', vflip=False, hflip=False, elastic=False, e_alpha=(240,250), e_sigma=25,
-                 e_mode='constant', g_blur=False, g_sigma=(1.0,2.0), median_blur=False, mb_kernel=(3,7), motion_blur=False,
-                 motb_k_range=(3,8), gamma_contrast=False, gc_gamma=(1.25,1.75), brightness=False, brightness_factor=(1,3),
-                 brightness_mode='2D', contrast=False, contrast_factor=(1,3), contrast_mode='2D', brightness_em=False,
+                 e_mode='constant', spatial_backend='imgaug', e_cache_size=0, e_cache_epochs=5, g_blur=False,
+                 g_sigma=(1.0,2.0), median_blur=False,
+                 mb_kernel=(3,7), motion_blur=False, motb_k_range=(3,8), gamma_contrast=False, gc_gamma=(1.25,1.75),
+                 brightness=False, brightness_factor=(1,3), brightness_mode='2D', contrast=False, contrast_factor=(1,3), contrast_mode='2D', brightness_em=False,
                  brightness_em_factor=(1,3), brightness_em_mode='2D', contrast_em=False, contrast_em_factor=(1,3),
                  contrast_em_mode='2D', dropout=False, drop_range=(0, 0.2), cutout=False, cout_nb_iterations=(1,3),
                  cout_size=(0.2,0.4), cout_cval=0, cout_apply_to_mask=False, cutblur=False, cblur_size=(0.1,0.5),
@@ -372,6 +393,9 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
                   "'random_crops_in_DA=False' so all samples are expected to have the same shape. If it is not "
                   "the case set batch_size to 1 or the generator will throw an error")
 
+        if spatial_backend not in ['imgaug', 'composed']:
+            raise ValueError("'spatial_backend' must be one between ['imgaug', 'composed']")
+
         if rotation90 and rand_rot:
             print("Warning: you selected double rotation type. Maybe you should set only 'rand_rot'?")
 
@@ -414,8 +438,8 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
             del imgB
         else:
             if type(X) != list:
-                self.X = X.astype(np.uint8) 
-                self.Y = Y.astype(np.uint8)
+                self.X = X.astype(np.uint8, copy=False)
+                self.Y = Y.astype(np.uint8, copy=False)
                 self.channels = Y.shape[-1] 
             else:
                 self.X = X 
@@ -478,13 +502,11 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
 
         self.prob_map = None
         if random_crops_in_DA and prob_map is not None:
-            if isinstance(prob_map, str):
-                f = sorted(next(os.walk(prob_map))[2])
-                self.prob_map = []
-                for i in range(len(f)):
-                    self.prob_map.append(os.path.join(prob_map, f[i]))
-            else:
+            # Only the pixels that can be drawn are kept, so the maps are not loaded while training
+            if isinstance(prob_map, ProbMapSampler):
                 self.prob_map = prob_map
+            else:
+                self.prob_map = create_prob_map_sampler(prob_map)
 
         self.val = val
         if extra_data_factor > 1:
@@ -493,33 +515,44 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
         else:
             self.extra_data_factor = 1
         self.total_batches_seen = 0
+        self.epoch = 0
+        self.timer = None
 
-        self.da_options = []
+        spatial_options = []
         self.trans_made = ''
         if rotation90:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Rot90((1, 3))))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Rot90((1, 3))))
             self.trans_made += '_rot[90,180,270]'
         if rand_rot:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=rnd_rot_range, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=rnd_rot_range, mode=affine_mode)))
             self.trans_made += '_rrot'+str(rnd_rot_range)
         if shear:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=shear_range, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=shear_range, mode=affine_mode)))
             self.trans_made += '_shear'+str(shear_range)
         if zoom:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(scale={"x": zoom_range, "y": zoom_range}, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(scale={"x": zoom_range, "y": zoom_range}, mode=affine_mode)))
             self.trans_made += '_zoom'+str(zoom_range)
         if shift:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(translate_percent=shift_range, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(translate_percent=shift_range, mode=affine_mode)))
             self.trans_made += '_shift'+str(shift_range)
         if vflip:
-            self.da_options.append(iaa.Flipud(da_prob))
+            spatial_options.append(iaa.Flipud(da_prob))
             self.trans_made += '_vflip'
         if hflip:
-            self.da_options.append(iaa.Fliplr(da_prob))
+            spatial_options.append(iaa.Fliplr(da_prob))
             self.trans_made += '_hflip'
         if elastic:
-            self.da_options.append(iaa.Sometimes(da_prob,iaa.ElasticTransformation(alpha=e_alpha, sigma=e_sigma, mode=e_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob,iaa.ElasticTransformation(alpha=e_alpha, sigma=e_sigma, mode=e_mode)))
             self.trans_made += '_elastic'+str(e_alpha)+'+'+str(e_sigma)+'+'+str(e_mode)
+        # With the composed backend the spatial transformations are done by self.spatial instead of imgaug
+        self.da_options = spatial_options if spatial_backend == 'imgaug' else []
+        self.spatial = None
+        if spatial_backend == 'composed':
+            self.spatial = SpatialAugmentor(da_prob=da_prob, rotation90=rotation90, rand_rot=rand_rot,
+                rnd_rot_range=rnd_rot_range, shear=shear, shear_range=shear_range, zoom=zoom, zoom_range=zoom_range,
+                shift=shift, shift_range=shift_range, affine_mode=affine_mode, vflip=vflip, hflip=hflip,
+                flip_prob=da_prob, elastic=elastic, e_alpha=e_alpha, e_sigma=e_sigma, e_mode=e_mode,
+                e_cache_size=e_cache_size, e_cache_epochs=e_cache_epochs, seed=seed)
         if g_blur:
             self.da_options.append(iaa.Sometimes(da_prob,iaa.GaussianBlur(g_sigma)))
             self.trans_made += '_gblur'+str(g_sigma)
@@ -595,34 +628,38 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
         batch_x = np.zeros((len(indexes), *self.shape_imgA), dtype=np.uint8)
         batch_y = np.zeros((len(indexes), *self.shape_imgB), dtype=np.uint8)
 
-        for i, j in zip(range(len(indexes)), indexes):
-            
-            imgA, imgB = self.__load_sample(j)
+        # Load the samples outside the lock so it can be done in parallel by the workers
+        with stage_timer(self.timer, 'load'):
+            samples = [self.__load_sample(j) for j in indexes]
 
-            # Apply random crops if it is selected
-            if self.random_crops_in_DA:
-                # Capture probability map
-                if self.prob_map is not None:
-                    if isinstance(self.prob_map, list):
-                        img_prob = np.load(self.prob_map[j])
-                    else:
-                        img_prob = self.prob_map[j]
-                else:
-                    img_prob = None
+        with batch_rng_lock, stage_timer(self.timer, 'augment'):
+            set_batch_seed(self.seed + self.epoch*len(self) + index)
+            for i, j in zip(range(len(indexes)), indexes):
+                imgA, imgB = samples[i]
 
-                batch_x[i], batch_y[i] = random_crop(imgA, imgB, self.shape_imgB[:2], self.val, img_prob=img_prob, 
-                    scale=self.random_crop_scale)
-            else:
-                batch_x[i], batch_y[i] = imgA, imgB
+                # Apply random crops if it is selected
+                if self.random_crops_in_DA:
+                    # Draw the center of the crop from the probability map
+                    center = self.prob_map.sample(j) if self.prob_map is not None else None
+
+                    batch_x[i], batch_y[i] = random_crop(imgA, imgB, self.shape_imgB[:2], self.val, center=center, 
+                        scale=self.random_crop_scale)
+                else:
+                    batch_x[i], batch_y[i] = imgA, imgB
 
             # Apply transformations
             if self.da:
-                e_imgA, e_imgB = None, None
+                e_imgsA, e_imgsB = None, None
                 if self.cutmix:
-                    extra_img = np.random.randint(0, self.len-1) if self.len > 2 else 0
-                    e_imgA, e_imgB = self.__load_sample(extra_img)
+                    e_imgsA, e_imgsB = [], []
+                    for _ in range(len(indexes)):
+                        extra_img = np.random.randint(0, self.len-1) if self.len > 2 else 0
+                        e_imgA, e_imgB = self.__load_sample(extra_img)
+                        e_imgsA.append(e_imgA)
+                        e_imgsB.append(e_imgB)
 
-                batch_x[i], batch_y[i] = self.apply_transform(batch_x[i], batch_y[i], e_imgA=e_imgA, e_imgB=e_imgB)
+                batch_x, batch_y = self.apply_batch_transform(batch_x, batch_y, e_imgsA=e_imgsA, e_imgsB=e_imgsB)
+        del samples
 
         self.total_batches_seen += 1
 
@@ -633,10 +670,14 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         """Updates indexes after each epoch."""
-        ia.seed(self.seed + self.total_batches_seen)
+        ia.seed(self.seed + self.epoch)
         self.indexes = self.o_indexes
         if self.shuffle:
-            random.Random(self.seed + self.total_batches_seen).shuffle(self.indexes)
+            random.Random(self.seed + self.epoch).shuffle(self.indexes)
+        # The first call is done when the generator is created, not at the end of an epoch
+        if self.spatial is not None and self.epoch > 0:
+            self.spatial.on_epoch_end()
+        self.epoch += 1
 
     def __load_sample(self, idx):
         """Load one data sample given its corresponding index."""
@@ -711,65 +752,114 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
                Transformed image imgB. E.g. ``(y, x, channels)``.
         """
 
+        imgsA, imgsB = self.apply_batch_transform(imgA[None], imgB[None], e_imgsA=[e_imgA], e_imgsB=[e_imgB])
+        return imgsA[0], imgsB[0]
+
+    def apply_batch_transform(self, imgsA, imgsB, e_imgsA=None, e_imgsB=None):
+        """Transform a batch of imgA and their imgB at the same time. The augmentations with a batch version in
+           :mod:`~data.generators.augmentors` are applied once to all the samples selected, and the rest sample by
+           sample. With the ``'composed'`` spatial backend the spatial transformations are applied first.
+
+           Parameters
+           ----------
+           imgsA : 4D Numpy array
+               Images to transform. E.g. ``(batch_size, y, x, channels)``.
+
+           imgsB : 4D Numpy array
+               Masks to transform. E.g. ``(batch_size, y, x, channels)``.
+
+           e_imgsA : List of 3D Numpy arrays, optional
+               Extra image of each sample to help transforming ``imgsA``. E.g. ``(y, x, channels)``.
+
+           e_imgsB : List of 3D Numpy arrays, optional
+               Extra imgB of each sample to help transforming ``imgsB``. E.g. ``(y, x, channels)``.
+
+           Returns
+           -------
+           trans_imgsA : 4D Numpy array
+               Transformed images. E.g. ``(batch_size, y, x, channels)``.
+
+           trans_imgsB : 4D Numpy array
+               Transformed images imgB. E.g. ``(batch_size, y, x, channels)``.
+        """
+        n = len(imgsA)
+
+        # Apply the spatial transformations composed in a single resampling
+        if self.spatial is not None:
+            for i in range(n):
+                imgsA[i], imgsB[i] = self.spatial.transform(imgsA[i], imgsB[i], first_no_bin_channel=0)
+
         # Apply cutout
-        if self.cutout and random.uniform(0, 1) < self.da_prob:
-            imgA, imgB = cutout(imgA, imgB, self.channels, -1, self.cout_nb_iterations, self.cout_size, self.cout_cval,
-                                 self.res_relation, self.cout_apply_to_mask)
+        if self.cutout:
+            imgsA, imgsB = cutout_batch(imgsA, imgsB, self.channels, -1, self.cout_nb_iterations, self.cout_size,
+                                        self.cout_cval, self.res_relation, self.cout_apply_to_mask,
+                                        apply=np.random.rand(n) < self.da_prob)
 
         # Apply cblur
-        if self.cutblur and random.uniform(0, 1) < self.da_prob:
-            imgA = cutblur(imgA, self.cblur_size, self.cblur_down_range, self.cblur_inside)
+        if self.cutblur:
+            imgsA = cutblur_batch(imgsA, self.cblur_size, self.cblur_down_range, self.cblur_inside,
+                                  apply=np.random.rand(n) < self.da_prob)
 
         # Apply cutmix
-        if self.cutmix and random.uniform(0, 1) < self.da_prob:
-            imgA, imgB = cutmix(imgA, e_imgA, imgB, e_imgB, self.cmix_size)
+        if self.cutmix:
+            for i in np.flatnonzero(np.random.rand(n) < self.da_prob):
+                imgsA[i], imgsB[i] = cutmix(imgsA[i], e_imgsA[i], imgsB[i], e_imgsB[i], self.cmix_size)
 
         # Apply cutnoise
-        if self.cutnoise and random.uniform(0, 1) < self.da_prob:
-            imgA = cutnoise(imgA, self.cnoise_scale, self.cnoise_nb_iterations, self.cnoise_size)
+        if self.cutnoise:
+            imgsA = cutnoise_batch(imgsA, self.cnoise_scale, self.cnoise_nb_iterations, self.cnoise_size,
+                                   apply=np.random.rand(n) < self.da_prob)
 
         # Apply misalignment
-        if self.misalignment and random.uniform(0, 1) < self.da_prob:
-            imgA, imgB = misalignment(imgA, imgB, self.ms_displacement, self.ms_rotate_ratio)
+        if self.misalignment:
+            for i in np.flatnonzero(np.random.rand(n) < self.da_prob):
+                imgsA[i], imgsB[i] = misalignment(imgsA[i], imgsB[i], self.ms_displacement, self.ms_rotate_ratio)
 
         # Apply brightness
-        if self.brightness and random.uniform(0, 1) < self.da_prob:
-            imgA = brightness(imgA, brightness_factor=self.brightness_factor)
+        if self.brightness:
+            imgsA = brightness_batch(imgsA, brightness_factor=self.brightness_factor,
+                                     apply=np.random.rand(n) < self.da_prob)
 
         # Apply contrast
-        if self.contrast and random.uniform(0, 1) < self.da_prob:
-            imgA = contrast(imgA, contrast_factor=self.contrast_factor)
+        if self.contrast:
+            imgsA = contrast_batch(imgsA, contrast_factor=self.contrast_factor, apply=np.random.rand(n) < self.da_prob)
 
         # Apply brightness (EM)
-        if self.brightness_em and random.uniform(0, 1) < self.da_prob:
-            imgA = brightness_em(imgA, brightness_em_factor=self.brightness_em_factor)
+        if self.brightness_em:
+            imgsA = brightness_em_batch(imgsA, brightness_factor=self.brightness_em_factor,
+                                        apply=np.random.rand(n) < self.da_prob)
 
         # Apply contrast (EM)
-        if self.contrast_em and random.uniform(0, 1) < self.da_prob:
-            imgA = contrast_em(imgA, contrast_em_factor=self.contrast_em_factor)
+        if self.contrast_em:
+            imgsA = contrast_em_batch(imgsA, contrast_factor=self.contrast_em_factor,
+                                      apply=np.random.rand(n) < self.da_prob)
 
         # Apply missing parts
-        if self.missing_parts and random.uniform(0, 1) < self.da_prob:
-            imgA = missing_parts(imgA, self.missp_iterations)
+        if self.missing_parts:
+            imgsA = missing_parts_batch(imgsA, self.missp_iterations, apply=np.random.rand(n) < self.da_prob)
 
         # Convert to grayscale
-        if self.grayscale and random.uniform(0, 1) < self.da_prob:
-            imgA = grayscale(imgA)
+        if self.grayscale:
+            for i in np.flatnonzero(np.random.rand(n) < self.da_prob):
+                imgsA[i] = grayscale(imgsA[i])
 
         # Apply channel shuffle
-        if self.channel_shuffle and random.uniform(0, 1) < self.da_prob:
-            imgA = shuffle_channels(imgA)
+        if self.channel_shuffle:
+            for i in np.flatnonzero(np.random.rand(n) < self.da_prob):
+                imgsA[i] = shuffle_channels(imgsA[i])
 
         # Apply GridMask
-        if self.gridmask and random.uniform(0, 1) < self.da_prob:
-            imgA = GridMask(imgA, self.channels, -1, self.grid_ratio, self.grid_d_size, self.grid_rotate,
-                             self.grid_invert)
+        if self.gridmask:
+            imgsA = GridMask_batch(imgsA, self.channels, -1, self.grid_ratio, self.grid_d_size, self.grid_rotate,
+                                   self.grid_invert, apply=np.random.rand(n) < self.da_prob)
 
         # Apply transformations to both images
-        augseq_det = self.seq.to_deterministic()
-        imgA = augseq_det.augment_image(imgA)
-        imgB = augseq_det.augment_image(imgB)
-        return imgA, imgB
+        if len(self.da_options) == 0: return imgsA, imgsB
+        for i in range(n):
+            augseq_det = self.seq.to_deterministic()
+            imgsA[i] = augseq_det.augment_image(imgsA[i])
+            imgsB[i] = augseq_det.augment_image(imgsB[i])
+        return imgsA, imgsB
 
     def __draw_grid(self, im, grid_width=50):
         """Draw grid of the specified size on an image.
@@ -852,17 +942,11 @@ class PairImageDataGenerator(tf.keras.utils.Sequence):
                 
             # Apply random crops if it is selected
             if self.random_crops_in_DA:
-                # Capture probability map
-                if self.prob_map is not None:
-                    if isinstance(self.prob_map, list):
-                        img_prob = np.load(self.prob_map[pos])
-                    else:
-                        img_prob = self.prob_map[pos]
-                else:
-                    img_prob = None
+                # Draw the center of the crop from the probability map
+                center = self.prob_map.sample(pos) if self.prob_map is not None else None
 
                 batch_x[i], batch_y[i] = random_crop(imgA, imgB, self.shape_imgB[:2], self.val, 
-                    img_prob=img_prob, scale=self.random_crop_scale)
+                    center=center, scale=self.random_crop_scale)
             else:
                 batch_x[i], batch_y[i] = imgA, imgB
 
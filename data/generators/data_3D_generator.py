@@ -12,9 +12,14 @@ from imgaug.augmentables.segmaps import SegmentationMapsOnImage
 from imgaug.augmentables.heatmaps import HeatmapsOnImage
 from skimage.io import imsave
 from utils.util import img_to_onehot_encoding, normalize, ensure_3D_dims_and_datatype
-from data.generators.augmentors import (cutout, cutblur, cutmix, cutnoise, misalignment, brightness_em, contrast_em,
-                                        brightness, contrast, missing_parts, shuffle_channels, grayscale, GridMask)
+from data.generators.augmentors import (cutout_batch, cutblur_batch, cutmix, cutnoise_batch, misalignment,
+                                        brightness_em_batch, contrast_em_batch, brightness_batch, contrast_batch,
+                                        missing_parts_batch, shuffle_channels, grayscale, GridMask_batch)
 from data.data_3D_manipulation import random_3D_crop
+from data.generators.spatial_augmentors import SpatialAugmentor
+from data.prob_map_sampler import ProbMapSampler, create_prob_map_sampler
+from data.generators.batch_loader import batch_rng_lock, set_batch_seed
+from data.generators.tf_data import stage_timer
 
 
 class VoxelDataGenerator(tf.keras.utils.Sequence):
@@ -51,9 +56,10 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
        resolution : 3D tuple of floats, optional
            Resolution of the given data ``(x,y,z)``. E.g. ``(8,8,30)``.
 
-       prob_map : 5D Numpy array or str, optional
+       prob_map : 5D Numpy array, str or ProbMapSampler, optional
            If it is an array, it should represent the probability map used to make random crops when
-           ``random_crops_in_DA`` is set. If ``str`` is given it should be the path to read these maps from.
+           ``random_crops_in_DA`` is set. If ``str`` is given should be the path to read these maps from. Both are turned
+           into a :class:`~data.prob_map_sampler.ProbMapSampler`, which can also be given directly.
 
        seed : int, optional
            Seed for random functions.
@@ -79,6 +85,10 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
        rnd_rot_range : tuple of float, optional
            Range of random rotations. E. g. ``(-180, 180)``.
 
+       rand_rot_3d : bool, optional
+           To make the random rotations around an axis with a random direction instead of around ``z``, taking into
+           account the ``resolution``. Only available with ``spatial_backend='composed'``.
+
        shear : bool, optional
            To make shear transformations.
 
@@ -122,6 +132,21 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
        e_mode : str, optional
            Parameter that defines the handling of newly created pixels with the elastic transformation.
 
+       spatial_backend : str, optional
+           How to apply the spatial transformations (rotations, shear, zoom, shift, flips and elastic). ``'imgaug'``
+           merges ``z`` and channels to pass the volumes through imgaug, applying them one by one. ``'composed'``
+           applies them directly over the volumes with a single coordinate map shared by image and mask (see
+           :class:`~data.generators.spatial_augmentors.SpatialAugmentor`), so they are resampled only once and the
+           elastic deformation is done in 3D.
+
+       e_cache_size : int, optional
+           Number of elastic deformation fields to precompute and reuse, randomly rolled and flipped, instead of
+           creating a new one for each sample. ``0`` to disable it. Only used with ``spatial_backend='composed'``.
+
+       e_cache_epochs : int, optional
+           Number of epochs the precomputed elastic deformation fields are used before being replaced by new ones,
+           which are created in a background thread. ``0`` to never replace them.
+
        g_blur : bool, optional
            To insert gaussian blur on the images.
 
@@ -296,14 +321,15 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
 
     def __init__(self, X, Y, in_memory=True, data_paths=None, random_crops_in_DA=False, shape=None, resolution=(1,1,1),
                  prob_map=None, seed=0, shuffle_each_epoch=False, batch_size=32, da=True, da_prob=0.5, rotation90=False,
-                 rand_rot=False, rnd_rot_range=(-180,180), shear=False, shear_range=(-20,20), zoom=False,
-                 zoom_range=(0.8,1.2), shift=False, shift_range=(0.1,0.2), affine_mode='constant', vflip=False,
-                 hflip=False, zflip=False, elastic=False, e_alpha=(240,250), e_sigma=25, e_mode='constant', g_blur=False,
-                 g_sigma=(1.0,2.0), median_blur=False, mb_kernel=(3,7), motion_blur=False, motb_k_range=(3,8),
-                 gamma_contrast=False, gc_gamma=(1.25,1.75), brightness=False, brightness_factor=(1,3),
-                 brightness_mode="3D", contrast=False, contrast_factor=(1,3), contrast_mode="3D", brightness_em=False,
-                 brightness_em_factor=(1,3), brightness_em_mode="3D", contrast_em=False, contrast_em_factor=(1,3),
-                 contrast_em_mode="3D", dropout=False, drop_range=(0,0.2), cutout=False, cout_nb_iterations=(1,3),
+                 rand_rot=False, rnd_rot_range=(-180,180), rand_rot_3d=False, shear=False, shear_range=(-20,20),
+                 zoom=False, zoom_range=(0.8,1.2), shift=False, shift_range=(0.1,0.2), affine_mode='constant',
+                 vflip=False, hflip=False, zflip=False, elastic=False, e_alpha=(240,250), e_sigma=25, e_mode='constant',
+                 spatial_backend='imgaug', e_cache_size=0, e_cache_epochs=5, g_blur=False, g_sigma=(1.0,2.0),
+                 median_blur=False, mb_kernel=(3,7),
+                 motion_blur=False, motb_k_range=(3,8), gamma_contrast=False, gc_gamma=(1.25,1.75), brightness=False,
+                 brightness_factor=(1,3), brightness_mode="3D", contrast=False, contrast_factor=(1,3),
+                 contrast_mode="3D", brightness_em=False, brightness_em_factor=(1,3), brightness_em_mode="3D",
+                 contrast_em=False, contrast_em_factor=(1,3), contrast_em_mode="3D", dropout=False, drop_range=(0,0.2), cutout=False, cout_nb_iterations=(1,3),
                  cout_size=(0.2,0.4), cout_cval=0, cout_apply_to_mask=False, cutblur=False, cblur_size=(0.2,0.4),
                  cblur_down_range=(2,8), cblur_inside=True, cutmix=False, cmix_size=(0.2,0.4), cutnoise=False,
                  cnoise_scale=(0.1,0.2), cnoise_nb_iterations=(1,3), cnoise_size=(0.2,0.4), misalignment=False,
@@ -341,6 +367,11 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
                   "'random_crops_in_DA=False' so all samples are expected to have the same shape. If it is not the "
                   "case set batch_size to 1 or the generator will throw an error")
 
+        if spatial_backend not in ['imgaug', 'composed']:
+            raise ValueError("'spatial_backend' must be one between ['imgaug', 'composed']")
+        if rand_rot_3d and spatial_backend != 'composed':
+            raise ValueError("'rand_rot_3d' is only available with spatial_backend='composed'")
+
         if rotation90 and rand_rot:
             print("Warning: you selected double rotation type. Maybe you should set only 'rand_rot'?")
 
@@ -444,7 +475,7 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
                 self.Y_dtype = img.dtype
                 del img
         else:
-            self.X = X.astype(np.uint8)
+            self.X = X.astype(np.uint8, copy=False)
             self.Y = Y
             self.Y_dtype = Y.dtype
             # Store wheter all channels of the gt are binary or not (e.g. distance transform channel)
@@ -481,13 +512,11 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
         
         self.prob_map = None
         if random_crops_in_DA and prob_map is not None:
-            if isinstance(prob_map, str):
-                f = sorted(next(os.walk(prob_map))[2])
-                self.prob_map = []
-                for i in range(len(f)):
-                    self.prob_map.append(os.path.join(prob_map, f[i]))
-            else:
+            # Only the pixels that can be drawn are kept, so the maps are not loaded while training
+            if isinstance(prob_map, ProbMapSampler):
                 self.prob_map = prob_map
+            else:
+                self.prob_map = create_prob_map_sampler(prob_map)
 
         self.resolution = resolution
         self.res_relation = (1.0,resolution[0]/resolution[1],resolution[0]/resolution[2])
@@ -540,34 +569,45 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
         else:
             self.extra_data_factor = 1
         self.total_batches_seen = 0
+        self.epoch = 0
+        self.timer = None
 
-        self.da_options = []
+        spatial_options = []
         self.trans_made = ''
         if rotation90:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Rot90((1, 3))))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Rot90((1, 3))))
             self.trans_made += '_rot[90,180,270]'
         if rand_rot:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=rnd_rot_range, mode=affine_mode)))
-            self.trans_made += '_rrot'+str(rnd_rot_range)
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=rnd_rot_range, mode=affine_mode)))
+            self.trans_made += ('_rrot3d' if rand_rot_3d else '_rrot')+str(rnd_rot_range)
         if shear:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=shear_range, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(rotate=shear_range, mode=affine_mode)))
             self.trans_made += '_shear'+str(shear_range)
         if zoom:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(scale={"x": zoom_range, "y": zoom_range}, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(scale={"x": zoom_range, "y": zoom_range}, mode=affine_mode)))
             self.trans_made += '_zoom'+str(zoom_range)
         if shift:
-            self.da_options.append(iaa.Sometimes(da_prob, iaa.Affine(translate_percent=shift_range, mode=affine_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob, iaa.Affine(translate_percent=shift_range, mode=affine_mode)))
             self.trans_made += '_shift'+str(shift_range)
         if vflip:
-            self.da_options.append(iaa.Flipud(0.5))
+            spatial_options.append(iaa.Flipud(0.5))
             self.trans_made += '_vflip'
         if hflip:
-            self.da_options.append(iaa.Fliplr(0.5))
+            spatial_options.append(iaa.Fliplr(0.5))
             self.trans_made += '_hflip'
         if zflip: self.trans_made += '_zflip'
         if elastic:
-            self.da_options.append(iaa.Sometimes(da_prob,iaa.ElasticTransformation(alpha=e_alpha, sigma=e_sigma, mode=e_mode)))
+            spatial_options.append(iaa.Sometimes(da_prob,iaa.ElasticTransformation(alpha=e_alpha, sigma=e_sigma, mode=e_mode)))
             self.trans_made += '_elastic'+str(e_alpha)+'+'+str(e_sigma)+'+'+str(e_mode)
+        # With the composed backend the spatial transformations are done by self.spatial instead of imgaug
+        self.da_options = spatial_options if spatial_backend == 'imgaug' else []
+        self.spatial = None
+        if spatial_backend == 'composed':
+            self.spatial = SpatialAugmentor(da_prob=da_prob, rotation90=rotation90, rand_rot=rand_rot,
+                rnd_rot_range=rnd_rot_range, rand_rot_3d=rand_rot_3d, shear=shear, shear_range=shear_range, zoom=zoom,
+                zoom_range=zoom_range, shift=shift, shift_range=shift_range, affine_mode=affine_mode, vflip=vflip,
+                hflip=hflip, zflip=zflip, elastic=elastic, e_alpha=e_alpha, e_sigma=e_sigma, e_mode=e_mode,
+                res_relation=self.res_relation, e_cache_size=e_cache_size, e_cache_epochs=e_cache_epochs, seed=seed)
         if g_blur:
             self.da_options.append(iaa.Sometimes(da_prob,iaa.GaussianBlur(g_sigma)))
             self.trans_made += '_gblur'+str(g_sigma)
@@ -616,6 +656,10 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
         self.trans_made = self.trans_made.replace(" ", "")
         if not self.da: self.trans_made = ''
         self.seq = iaa.Sequential(self.da_options)
+        # Whether any transformation needs the volumes with z and channels merged
+        self.merge_z_channels = self.spatial is None or len(self.da_options) > 0 or \
+            any([grayscale, channel_shuffle, cutout, cutblur, cutmix, cutnoise, misalignment, brightness, contrast,
+                 brightness_em, contrast_em, missing_parts, gridmask])
         ia.seed(seed)
         self.on_epoch_end()
 
@@ -672,33 +716,37 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
         batch_x = np.zeros((len(indexes), *self.shape), dtype=np.float32)
         batch_y = np.zeros((len(indexes), *self.shape[:3])+(self.channels,), dtype=self.Y_dtype)
 
-        for i, j in zip(range(len(indexes)), indexes):
+        # Load the samples outside the lock so it can be done in parallel by the workers
+        with stage_timer(self.timer, 'load'):
+            samples = [self.__load_sample(j) for j in indexes]
 
-            img, mask =  self.__load_sample(j)
+        with batch_rng_lock, stage_timer(self.timer, 'augment'):
+            set_batch_seed(self.seed + self.epoch*len(self) + index)
+            for i, j in zip(range(len(indexes)), indexes):
+                img, mask = samples[i]
 
-            # Apply random crops if it is selected
-            if self.random_crops_in_DA:
-                # Capture probability map
-                if self.prob_map is not None:
-                    if isinstance(self.prob_map, list):
-                        img_prob = np.load(self.prob_map[j])
-                    else:
-                        img_prob = self.prob_map[j]
-                else:
-                    img_prob = None
+                # Apply random crops if it is selected
+                if self.random_crops_in_DA:
+                    # Draw the center of the crop from the probability map
+                    center = self.prob_map.sample(j) if self.prob_map is not None else None
 
-                batch_x[i], batch_y[i] = random_3D_crop(img, mask, self.shape[:3], self.val, vol_prob=img_prob)
-            else:
-                batch_x[i], batch_y[i] = img, mask
+                    batch_x[i], batch_y[i] = random_3D_crop(img, mask, self.shape[:3], self.val, center=center)
+                else:
+                    batch_x[i], batch_y[i] = img, mask
 
             # Apply transformations
             if self.da:
-                e_img, e_mask = None, None
+                e_imgs, e_masks = None, None
                 if self.cutmix:
-                    extra_img = np.random.randint(0, self.len-1) if self.len > 2 else 0
-                    e_img, e_mask =  self.__load_sample(extra_img)
+                    e_imgs, e_masks = [], []
+                    for _ in range(len(indexes)):
+                        extra_img = np.random.randint(0, self.len-1) if self.len > 2 else 0
+                        e_img, e_mask = self.__load_sample(extra_img)
+                        e_imgs.append(e_img)
+                        e_masks.append(e_mask)
 
-                batch_x[i], batch_y[i] = self.apply_transform(batch_x[i], batch_y[i], e_im=e_img, e_mask=e_mask)
+                batch_x, batch_y = self.apply_batch_transform(batch_x, batch_y, e_ims=e_imgs, e_masks=e_masks)
+        del samples
 
         if self.n_classes > 1 and (self.n_classes != self.channels):
             batch_y_ = np.zeros((len(indexes), ) + self.shape[:3] + (self.n_classes,))
@@ -747,10 +795,14 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
 
     def on_epoch_end(self):
         """Updates indexes after each epoch."""
-        ia.seed(self.seed + self.total_batches_seen)
+        ia.seed(self.seed + self.epoch)
         self.indexes = self.o_indexes
         if self.shuffle_each_epoch:
-            random.Random(self.seed + self.total_batches_seen).shuffle(self.indexes)
+            random.Random(self.seed + self.epoch).shuffle(self.indexes)
+        # The first call is done when the generator is created, not at the end of an epoch
+        if self.spatial is not None and self.epoch > 0:
+            self.spatial.on_epoch_end()
+        self.epoch += 1
 
     def apply_transform(self, image, mask, e_im=None, e_mask=None):
         """Transform the input image and its mask at the same time with one of the selected choices based on a
@@ -779,127 +831,199 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
                Transformed image mask. E.g. ``(z, y, x, channels)``.
         """
 
-        # Transpose them so we can merge the z and c channels easily. 
-        # z, y, x, c --> x, y, z, c
-        image = image.transpose((2,1,0,3))
-        mask = mask.transpose((2,1,0,3))
-
-        # Apply flips in z as imgaug can not do it
-        if self.zflip and random.uniform(0, 1) < self.da_prob:
-            l_image = []
-            l_mask = []
-            for i in range(image.shape[-1]):
-                l_image.append(np.expand_dims(np.flip(image[...,i], 2), -1))
-            for i in range(mask.shape[-1]):
-                l_mask.append(np.expand_dims(np.flip(mask[...,i], 2), -1))
-            image = np.concatenate(l_image, axis=-1)
-            mask = np.concatenate(l_mask, axis=-1)
-
-        # Split heatmaps from masks
-        if self.first_no_bin_channel != -1:
-            if self.first_no_bin_channel != 0:
-                heat = mask[...,self.first_no_bin_channel:]
-                mask = mask[...,:self.first_no_bin_channel]
-            else:
-                heat = mask
-                mask = np.zeros(mask.shape) # Fake mask
-            o_heat_shape = heat.shape
-            o_mask_shape = mask.shape
-            heat = heat.reshape(heat.shape[:2]+(heat.shape[2]*heat.shape[3],))
-            heat = HeatmapsOnImage(heat, shape=heat.shape, min_value=0.0, max_value=np.max(heat)+sys.float_info.epsilon)
-        else:
-            heat = None
+        images, masks = self.apply_batch_transform(image[None], mask[None], e_ims=[e_im], e_masks=[e_mask])
+        return images[0], masks[0]
+
+    def apply_batch_transform(self, images, masks, e_ims=None, e_masks=None):
+        """Transform a batch of images and their masks at the same time with one of the selected choices based on a
+           probability. The volumes are reshaped sample by sample, merging z and channels, and stacked so the
+           augmentations with a batch version in :mod:`~data.generators.augmentors` are applied once to all the samples
+           selected. The rest are applied sample by sample. With the ``'composed'`` spatial backend the spatial
+           transformations are applied first, over the volumes with their original shape.
+
+           Parameters
+           ----------
+           images : 5D Numpy array
+               Images to transform. E.g. ``(batch_size, z, y, x, channels)``.
 
-        # Change dtype to supported one by imgaug
-        mask = mask.astype(np.uint8)
+           masks : 5D Numpy array
+               Masks to transform. E.g. ``(batch_size, z, y, x, channels)``.
 
-        # Save shape
-        o_img_shape = image.shape
-        o_mask_shape = mask.shape
+           e_ims : List of 4D Numpy arrays, optional
+               Extra image of each sample to help transforming ``images``. E.g. ``(z, y, x, channels)``.
 
-        # Convert to grayscale
-        if self.grayscale and random.uniform(0, 1) < self.da_prob:
-            image = grayscale(image)
+           e_masks : List of 4D Numpy arrays, optional
+               Extra mask of each sample to help transforming ``masks``. E.g. ``(z, y, x, channels)``.
 
-        # Apply channel shuffle
-        if self.channel_shuffle and random.uniform(0, 1) < self.da_prob:
-            image = shuffle_channels(image)
+           Returns
+           -------
+           trans_images : 5D Numpy array
+               Transformed images. E.g. ``(batch_size, z, y, x, channels)``.
 
-        # Reshape 3D volumes to 2D image type with multiple channels to pass
-        # through imgaug lib
-        image = image.reshape(image.shape[:2]+(image.shape[2]*image.shape[3],))
-        mask = mask.reshape(mask.shape[:2]+(mask.shape[2]*mask.shape[3],))
-        if e_im is not None: e_im = e_im.reshape(e_im.shape[:2]+(e_im.shape[2]*e_im.shape[3],))
-        if e_mask is not None: e_mask = e_mask.reshape(e_mask.shape[:2]+(e_mask.shape[2]*e_mask.shape[3],))
-        #if e_heat is not None: e_heat = e_heat.reshape(e_heat.shape[:2]+(e_heat.shape[2]*e_heat.shape[3],))
+           trans_masks : 5D Numpy array
+               Transformed image masks. E.g. ``(batch_size, z, y, x, channels)``.
+        """
+        n = len(images)
+        if not self.merge_z_channels:
+            out_images = np.zeros(images.shape, dtype=images.dtype)
+            out_masks = np.zeros(masks.shape, dtype=masks.dtype)
+            for i in range(n):
+                out_images[i], out_masks[i] = self.spatial.transform(images[i], masks[i], self.first_no_bin_channel)
+            return out_images, out_masks
+
+        x, y, heats = [], [], []
+        for i in range(n):
+            image, mask = images[i], masks[i]
+
+            # Apply the spatial transformations directly over the volumes
+            if self.spatial is not None:
+                image, mask = self.spatial.transform(image, mask, self.first_no_bin_channel)
+
+            # Transpose them so we can merge the z and c channels easily.
+            # z, y, x, c --> x, y, z, c
+            image = image.transpose((2,1,0,3))
+            mask = mask.transpose((2,1,0,3))
+
+            # Apply flips in z as imgaug can not do it
+            if self.spatial is None and self.zflip and random.uniform(0, 1) < self.da_prob:
+                image = np.flip(image, 2)
+                mask = np.flip(mask, 2)
+
+            # Split heatmaps from masks
+            if self.spatial is None and self.first_no_bin_channel != -1:
+                if self.first_no_bin_channel != 0:
+                    heat = mask[...,self.first_no_bin_channel:]
+                    mask = mask[...,:self.first_no_bin_channel]
+                else:
+                    heat = mask
+                    mask = np.zeros(mask.shape) # Fake mask
+                o_heat_shape = heat.shape
+                heat = heat.reshape(heat.shape[:2]+(heat.shape[2]*heat.shape[3],))
+                heat = HeatmapsOnImage(heat, shape=heat.shape, min_value=0.0, max_value=np.max(heat)+sys.float_info.epsilon)
+                heats.append((heat, o_heat_shape))
+            else:
+                heats.append((None, None))
+
+            # Change dtype to supported one by imgaug
+            if self.spatial is None:
+                mask = mask.astype(np.uint8)
+
+            # Save shape
+            o_img_shape = image.shape
+            o_mask_shape = mask.shape
+
+            # Convert to grayscale
+            if self.grayscale and random.uniform(0, 1) < self.da_prob:
+                image = grayscale(image)
+
+            # Apply channel shuffle
+            if self.channel_shuffle and random.uniform(0, 1) < self.da_prob:
+                image = shuffle_channels(image)
+
+            # Reshape 3D volumes to 2D image type with multiple channels to pass
+            # through imgaug lib
+            x.append(image.reshape(image.shape[:2]+(image.shape[2]*image.shape[3],)))
+            y.append(mask.reshape(mask.shape[:2]+(mask.shape[2]*mask.shape[3],)))
+        image = np.stack(x)
+        mask = np.stack(y)
+        del x, y
+        if e_ims is not None:
+            e_ims = [e if e is None else e.reshape(e.shape[:2]+(e.shape[2]*e.shape[3],)) for e in e_ims]
+        if e_masks is not None:
+            e_masks = [e if e is None else e.reshape(e.shape[:2]+(e.shape[2]*e.shape[3],)) for e in e_masks]
 
         # Apply cutout
-        if self.cutout and random.uniform(0, 1) < self.da_prob:
-            image, mask = cutout(image, mask, self.X_channels, self.z_size, self.cout_nb_iterations, self.cout_size,
-                                 self.cout_cval, self.res_relation, self.cout_apply_to_mask)
+        if self.cutout:
+            image, mask = cutout_batch(image, mask, self.X_channels, self.z_size, self.cout_nb_iterations,
+                                       self.cout_size, self.cout_cval, self.res_relation, self.cout_apply_to_mask,
+                                       apply=np.random.rand(n) < self.da_prob)
 
         # Apply cblur
-        if self.cutblur and random.uniform(0, 1) < self.da_prob:
-            image = cutblur(image, self.cblur_size, self.cblur_down_range, self.cblur_inside)
+        if self.cutblur:
+            image = cutblur_batch(image, self.cblur_size, self.cblur_down_range, self.cblur_inside,
+                                  apply=np.random.rand(n) < self.da_prob)
 
         # Apply cutmix
-        if self.cutmix and random.uniform(0, 1) < self.da_prob:
-            image, mask = cutmix(image, e_im, mask, e_mask, self.cmix_size)
+        if self.cutmix:
+            for i in np.flatnonzero(np.random.rand(n) < self.da_prob):
+                image[i], mask[i] = cutmix(image[i], e_ims[i], mask[i], e_masks[i], self.cmix_size)
 
         # Apply cutnoise
-        if self.cutnoise and random.uniform(0, 1) < self.da_prob:
-            image = cutnoise(image, self.cnoise_scale, self.cnoise_nb_iterations, self.cnoise_size)
+        if self.cutnoise:
+            image = cutnoise_batch(image, self.cnoise_scale, self.cnoise_nb_iterations, self.cnoise_size,
+                                   apply=np.random.rand(n) < self.da_prob)
 
         # Apply misalignment
-        if self.misalignment and random.uniform(0, 1) < self.da_prob:
+        if self.misalignment:
             rel = str(o_img_shape[-1])+"_"+str(o_mask_shape[-1])
-            image, mask = misalignment(image, mask, self.ms_displacement, self.ms_rotate_ratio, c_relation=rel)
+            for i in np.flatnonzero(np.random.rand(n) < self.da_prob):
+                image[i], mask[i] = misalignment(image[i], mask[i], self.ms_displacement, self.ms_rotate_ratio,
+                                                 c_relation=rel)
 
         # Apply brightness
-        if self.brightness and random.uniform(0, 1) < self.da_prob:
-            image = brightness(image, brightness_factor=self.brightness_factor, mode=self.brightness_mode)
+        if self.brightness:
+            image = brightness_batch(image, brightness_factor=self.brightness_factor, mode=self.brightness_mode,
+                                     apply=np.random.rand(n) < self.da_prob)
 
         # Apply contrast
-        if self.contrast and random.uniform(0, 1) < self.da_prob:
-            image = contrast(image, contrast_factor=self.contrast_factor, mode=self.contrast_mode)
+        if self.contrast:
+            image = contrast_batch(image, contrast_factor=self.contrast_factor, mode=self.contrast_mode,
+                                   apply=np.random.rand(n) < self.da_prob)
 
         # Apply brightness (EM)
-        if self.brightness_em and random.uniform(0, 1) < self.da_prob:
-            image = brightness_em(image, brightness_factor=self.brightness_em_factor, mode=self.brightness_em_mode)
+        if self.brightness_em:
+            image = brightness_em_batch(image, brightness_factor=self.brightness_em_factor,
+                                        mode=self.brightness_em_mode, apply=np.random.rand(n) < self.da_prob)
 
         # Apply contrast (EM)
-        if self.contrast_em and random.uniform(0, 1) < self.da_prob:
-            image = contrast_em(image, contrast_factor=self.contrast_em_factor, mode=self.contrast_em_mode)
+        if self.contrast_em:
+            image = contrast_em_batch(image, contrast_factor=self.contrast_em_factor, mode=self.contrast_em_mode,
+                                      apply=np.random.rand(n) < self.da_prob)
 
         # Apply missing parts
-        if self.missing_parts and random.uniform(0, 1) < self.da_prob:
-            image = missing_parts(image, self.missp_iterations)
+        if self.missing_parts:
+            image = missing_parts_batch(image, self.missp_iterations, apply=np.random.rand(n) < self.da_prob)
 
         # Apply GridMask
-        if self.gridmask and random.uniform(0, 1) < self.da_prob:
-            image = GridMask(image, self.X_channels, self.z_size, self.grid_ratio, self.grid_d_size, self.grid_rotate,
-                             self.grid_invert)
-
-        # Apply transformations to the volume and its mask
-        segmap = SegmentationMapsOnImage(mask, shape=mask.shape)
-        image, vol_mask, heat_out = self.seq(image=image, segmentation_maps=segmap, heatmaps=heat)
-        mask = vol_mask.get_arr()
-
-        # Recover the original shape
-        image = image.reshape(o_img_shape)
-        mask = mask.reshape(o_mask_shape)
+        if self.gridmask:
+            image = GridMask_batch(image, self.X_channels, self.z_size, self.grid_ratio, self.grid_d_size,
+                                   self.grid_rotate, self.grid_invert, apply=np.random.rand(n) < self.da_prob)
+
+        out_images = np.zeros(images.shape, dtype=images.dtype)
+        out_masks = np.zeros(masks.shape, dtype=masks.dtype)
+        for i in range(n):
+            if self.spatial is not None:
+                # Apply the rest of imgaug transformations, which do not change the mask
+                _image = image[i] if len(self.da_options) == 0 else self.seq(image=image[i])
+                out_images[i] = _image.reshape(o_img_shape).transpose((2,1,0,3))
+                out_masks[i] = mask[i].reshape(o_mask_shape).transpose((2,1,0,3))
+                continue
+
+            heat, o_heat_shape = heats[i]
+
+            # Apply transformations to the volume and its mask
+            segmap = SegmentationMapsOnImage(mask[i], shape=mask[i].shape)
+            _image, vol_mask, heat_out = self.seq(image=image[i], segmentation_maps=segmap, heatmaps=heat)
+            _mask = vol_mask.get_arr()
+
+            # Recover the original shape
+            _image = _image.reshape(o_img_shape)
+            _mask = _mask.reshape(o_mask_shape)
+
+            # Merge heatmaps and masks again
+            if self.first_no_bin_channel != -1:
+                heat = heat_out.get_arr()
+                heat = heat.reshape(o_heat_shape)
+                if self.first_no_bin_channel != 0:
+                    _mask = np.concatenate((_mask,heat),axis=-1)
+                else:
+                    _mask = heat
 
-        # Merge heatmaps and masks again
-        if self.first_no_bin_channel != -1:
-            heat = heat_out.get_arr()
-            heat = heat.reshape(o_heat_shape)
-            if self.first_no_bin_channel != 0:
-                mask = np.concatenate((mask,heat),axis=-1)
-            else:
-                mask = heat
+            # x, y, z, c --> z, y, x, c
+            out_images[i] = _image.transpose((2,1,0,3))
+            out_masks[i] = _mask.transpose((2,1,0,3))
 
-        # x, y, z, c --> z, y, x, c
-        return image.transpose((2,1,0,3)), mask.transpose((2,1,0,3))
+        return out_images, out_masks
 
     def get_transformed_samples(self, num_examples, random_images=True, save_to_dir=True, out_dir='aug_3d', train=False,
                                 draw_grid=True):
@@ -955,16 +1079,10 @@ class VoxelDataGenerator(tf.keras.utils.Sequence):
 
             # Apply random crops if it is selected
             if self.random_crops_in_DA:
-                # Capture probability map
-                if self.prob_map is not None:
-                    if isinstance(self.prob_map, list):
-                        img_prob = np.load(self.prob_map[pos])
-                    else:
-                        img_prob = self.prob_map[pos]
-                else:
-                    img_prob = None
+                # Draw the center of the crop from the probability map
+                center = self.prob_map.sample(pos) if self.prob_map is not None else None
                 vol, vol_mask, oz, oy, ox,\
-                s_z, s_y, s_x = random_3D_crop(img, mask, self.shape[:3], self.val, vol_prob=img_prob,
+                s_z, s_y, s_x = random_3D_crop(img, mask, self.shape[:3], self.val, center=center,
                                                draw_prob_map_points=True)
                 sample_x.append(vol)
                 sample_y.append(vol_mask)
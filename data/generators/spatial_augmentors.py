@@ -0,0 +1,652 @@
+import threading
+import warnings
+import numpy as np
+import cv2
+from scipy.ndimage import gaussian_filter
+
+
+# Equivalence between the modes of skimage (and numpy.pad()), used by imgaug, and the border modes of OpenCV
+cv2_border_modes = {'constant': cv2.BORDER_CONSTANT, 'edge': cv2.BORDER_REPLICATE, 'symmetric': cv2.BORDER_REFLECT,
+                    'reflect': cv2.BORDER_REFLECT_101, 'wrap': cv2.BORDER_WRAP}
+
+
+def affine_matrix(shape, rotation=0, shear=0, zoom=(1,1), shift=(0,0), axis_rotation=0, axis=(1,0,0), z_scale=1):
+    """Compose a rotation, a shear, a zoom and a shift into a single homogeneous matrix. The transformations are done
+       in the ``yx`` plane around the center of the image. In 3D a rotation around any axis can be added after them,
+       which also moves the pixels along ``z``. The matrix maps each pixel of the output to the position of the input
+       it is taken from.
+
+       Parameters
+       ----------
+       shape : Tuple of ints
+           Shape of the image without channels. E.g. ``(y, x)`` or ``(z, y, x)``.
+
+       rotation : float, optional
+           Rotation in degrees.
+
+       shear : float, optional
+           Shear along the ``x`` axis in degrees.
+
+       zoom : tuple of 2 floats, optional
+           Scale factor of the ``y`` and ``x`` axes. Values greater than ``1`` enlarge the image.
+
+       shift : tuple of 2 floats, optional
+           Displacement of the image in pixels along the ``y`` and ``x`` axes.
+
+       axis_rotation : float, optional
+           Rotation in degrees around ``axis``. Only used in 3D.
+
+       axis : tuple of 3 floats, optional
+           Direction of the rotation axis as ``(z, y, x)``. It does not need to be normalized. ``(1, 0, 0)`` rotates
+           in the ``yx`` plane as ``rotation`` does.
+
+       z_scale : float, optional
+           Size of a pixel along ``x`` relative to its size along ``z``, e.g. ``0.25`` for pixels four times longer
+           along ``z``. The rotation around ``axis`` is done with the real proportions of the volume.
+
+       Returns
+       -------
+       matrix : 2D Numpy array
+           Homogeneous matrix. E.g. ``(4, 4)`` for ``(z, y, x)`` images.
+    """
+    theta, s = np.deg2rad(rotation), np.deg2rad(shear)
+    rot = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+    ndim = len(shape)
+    forward = np.eye(ndim)
+    forward[ndim-2:, ndim-2:] = rot @ np.array([[1, 0], [np.tan(s), 1]]) @ np.diag(zoom)
+    if ndim == 3 and axis_rotation != 0:
+        # Rodrigues' rotation formula, with z measured in the units of x
+        k = np.array(axis, dtype=np.float64)/np.linalg.norm(axis)
+        cross = np.array([[0, -k[2], k[1]], [k[2], 0, -k[0]], [-k[1], k[0], 0]])
+        phi = np.deg2rad(axis_rotation)
+        rot3 = np.cos(phi)*np.eye(3) + np.sin(phi)*cross + (1-np.cos(phi))*np.outer(k, k)
+        scale = np.diag([1/z_scale, 1, 1])
+        forward = np.linalg.inv(scale) @ rot3 @ scale @ forward
+    inverse = np.linalg.inv(forward)
+    center = (np.array(shape)-1)/2
+    full_shift = np.zeros(ndim)
+    full_shift[ndim-2:] = shift
+
+    matrix = np.eye(ndim+1)
+    matrix[:ndim, :ndim] = inverse
+    matrix[:ndim, ndim] = center - inverse @ (center + full_shift)
+    # Avoid rounding errors, e.g. on 90º rotations, that would leave the borders out of the image
+    return np.round(matrix, 10)
+
+
+def _interp_matrix(size, coarse_size, spacing, periodic=False):
+    """Linear interpolation weights to upsample an axis of ``coarse_size`` nodes, placed every ``spacing`` pixels,
+       into ``size`` pixels. If ``periodic`` the last pixels are interpolated between the last node and the first
+       one."""
+    pos = np.arange(size)/spacing
+    i0 = np.minimum(pos.astype(int), coarse_size-1 if periodic else coarse_size-2)
+    i1 = (i0+1) % coarse_size
+    w = (pos-i0).astype(np.float32)
+    m = np.zeros((size, coarse_size), dtype=np.float32)
+    m[np.arange(size), i0] = 1-w
+    m[np.arange(size), i1] = w
+    return m
+
+
+# Minimum number of grid nodes per axis of the periodic fields. With fewer nodes the wrapped smoothing leaves the
+# grid almost constant
+MIN_PERIODIC_NODES = 4
+
+
+def _elastic_scales(ndim, res_relation):
+    """Relative length of the displacements along each axis."""
+    scales = [1.0]*ndim
+    if ndim == 3 and res_relation is not None:
+        scales[0] = res_relation[2]
+    return scales
+
+
+def periodic_fits(shape, sigma, res_relation=None):
+    """Whether :func:`~elastic_field` can create a periodic field of ``shape``, i.e. at least
+       ``MIN_PERIODIC_NODES`` grid nodes fit in each axis."""
+    scales = _elastic_scales(len(shape), res_relation)
+    return all(int(round(s/max(sigma*sc, 1))) >= MIN_PERIODIC_NODES for s, sc in zip(shape, scales))
+
+
+def elastic_field(shape, alpha, sigma, res_relation=None, periodic=False, rng=None):
+    """Create a random displacement field for an elastic deformation. Instead of smoothing a random field of the size
+       of the image, as imgaug does, random displacements are drawn in a coarse grid with a node every ``sigma``
+       pixels, smoothed there and linearly upsampled axis by axis. The field is scaled to have the strength the full
+       resolution field of imgaug would have with the same ``alpha`` and ``sigma``.
+
+       Parameters
+       ----------
+       shape : Tuple of ints
+           Shape of the image without channels. E.g. ``(y, x)`` or ``(z, y, x)``.
+
+       alpha : float
+           Strength of the distortion field.
+
+       sigma : float
+           Standard deviation of the gaussian kernel used to smooth the distortion field.
+
+       res_relation: tuple of floats, optional
+           Relation between the ``x``, ``y`` and ``z`` resolutions. Used in 3D to shorten the displacements and enlarge
+           the grid spacing along ``z`` accordingly.
+
+       periodic : bool, optional
+           Create a field that wraps around the image borders, so it can be rolled without discontinuities. The grid
+           spacing is slightly adjusted to fit a whole number of nodes in each axis. Only possible if
+           :func:`~periodic_fits` is ``True`` for the shape.
+
+       rng : Numpy random generator, optional
+           Generator to draw the random displacements from. ``np.random`` is used if not provided.
+
+       Returns
+       -------
+       field : Numpy array
+           Displacement of each pixel along each axis. E.g. ``(3, z, y, x)``.
+
+       Raises
+       ------
+       ValueError
+           if ``periodic`` is requested for a shape where it does not fit.
+    """
+    rng = np.random if rng is None else rng
+    ndim = len(shape)
+    scales = _elastic_scales(ndim, res_relation)
+    spacings = [max(sigma*s, 1) for s in scales]
+    if periodic:
+        if not periodic_fits(shape, sigma, res_relation):
+            raise ValueError("A periodic field of shape {} needs at least {} grid nodes per axis with sigma {}"
+                             .format(shape, MIN_PERIODIC_NODES, sigma))
+        coarse_shape = tuple(int(round(s/sp)) for s, sp in zip(shape, spacings))
+        spacings = [s/c for s, c in zip(shape, coarse_shape)]
+    else:
+        coarse_shape = tuple(int(np.ceil(s/sp))+1 for s, sp in zip(shape, spacings))
+    interps = [_interp_matrix(s, c, sp, periodic) for s, c, sp in zip(shape, coarse_shape, spacings)]
+    std = alpha/(np.sqrt(3)*2*np.sqrt(np.pi)*sigma)
+
+    field = np.empty((ndim,)+tuple(shape), dtype=np.float32)
+    for axis in range(ndim):
+        coarse = gaussian_filter(rng.uniform(-1, 1, coarse_shape), 1, mode='wrap' if periodic else 'reflect')
+        # Without the mean, the normalisation of small grids, which are almost constant after the smoothing, would
+        # turn it into a large translation
+        coarse -= coarse.mean()
+        coarse *= std*scales[axis]/(coarse.std()+1e-7)
+        # Upsample axis by axis, from the last one, so each product gives a contiguous array
+        f = np.matmul(interps[-2], coarse.astype(np.float32) @ interps[-1].T)
+        if ndim == 3:
+            f = np.tensordot(interps[0], f, axes=1)
+        field[axis] = f
+    return field
+
+
+class ElasticFieldCache():
+    """Pool of precomputed elastic displacement fields, one pool per image shape, to avoid creating a new field for
+       each sample. The fields are created with :func:`~elastic_field` as periodic fields of unit strength, so each
+       time one is taken it is randomly rolled, flipped and negated along each axis and scaled by the ``alpha`` drawn
+       for the sample, which gives a different deformation each time with the same statistics. Shapes too small for
+       a periodic field (see :func:`~periodic_fits`) get regular fields, which are only flipped and negated.
+
+       Every ``refresh_epochs`` epochs the pool is replaced by a new one, created in a background thread during the
+       previous epochs. The fields of each pool are drawn from a generator seeded with ``seed`` and the number of the
+       pool, so the deformations do not depend on the timing of the thread.
+
+       Parameters
+       ----------
+       size : int
+           Number of fields of each pool. The memory used is ``size`` fields of ``(ndim, *shape)`` ``float32`` values
+           per image shape, and the double while a new pool is being created.
+
+       sigma : float
+           Standard deviation of the gaussian kernel used to smooth the distortion fields.
+
+       res_relation: tuple of floats, optional
+           Relation between the ``x``, ``y`` and ``z`` resolutions. Used to scale the elastic deformation along ``z``.
+
+       refresh_epochs : int, optional
+           Number of epochs each pool is used. If ``0`` the first pool is never replaced.
+
+       seed : int, optional
+           Seed of the fields.
+    """
+    def __init__(self, size, sigma, res_relation=None, refresh_epochs=5, seed=0):
+        if size < 1:
+            raise ValueError("'size' must be greater than 0")
+        self.size = size
+        self.sigma = sigma
+        self.res_relation = res_relation
+        self.refresh_epochs = refresh_epochs
+        self.seed = seed
+        self.epoch = 0
+        self.generation = 0
+        self.pools = {}
+        self.next_pools = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _create_pool(self, shape, generation):
+        """Create the pool of fields of ``shape`` for the given generation."""
+        pool = np.empty((self.size, len(shape))+tuple(shape), dtype=np.float32)
+        periodic = periodic_fits(shape, self.sigma, self.res_relation)
+        for i in range(self.size):
+            rng = np.random.default_rng([self.seed, generation, i]+list(shape))
+            pool[i] = elastic_field(shape, 1, self.sigma, self.res_relation, periodic=periodic, rng=rng)
+        return pool
+
+    def _prepare_next(self):
+        """Start creating the pools of the next generation in a background thread."""
+        shapes, generation = list(self.pools.keys()), self.generation+1
+        self.next_pools = {}
+        def work():
+            for shape in shapes:
+                self.next_pools[shape] = self._create_pool(shape, generation)
+        self.thread = threading.Thread(target=work, daemon=True)
+        self.thread.start()
+
+    def get(self, shape, alpha):
+        """Take a random field of the given ``shape`` and strength ``alpha``. The random choices are drawn with
+           ``np.random``."""
+        shape = tuple(shape)
+        with self.lock:
+            if shape not in self.pools:
+                self.pools[shape] = self._create_pool(shape, self.generation)
+                if self.refresh_epochs > 0 and self.thread is None:
+                    self._prepare_next()
+            pool = self.pools[shape]
+
+        field = pool[np.random.randint(len(pool))]
+        ndim = len(shape)
+        shifts = tuple(np.random.randint(s) for s in shape)
+        signs = np.random.choice([-1, 1], size=ndim)
+        for axis in np.flatnonzero(np.random.rand(ndim) < 0.5):
+            # Flipping an axis reverses the displacements along it
+            field = np.flip(field, axis+1)
+            signs[axis] = -signs[axis]
+        # Flips are views, so the roll is the only copy of the field
+        if periodic_fits(shape, self.sigma, self.res_relation):
+            field = np.roll(field, shifts, axis=tuple(range(1, ndim+1)))
+        else:
+            field = field.copy()
+        field *= (alpha*signs).astype(np.float32).reshape((-1,)+(1,)*ndim)
+        return field
+
+    def on_epoch_end(self):
+        """Count an epoch, replacing the pools every ``refresh_epochs`` epochs."""
+        self.epoch += 1
+        if self.refresh_epochs < 1 or self.epoch % self.refresh_epochs != 0:
+            return
+        with self.lock:
+            if self.thread is None:
+                return
+            self.thread.join()
+            self.generation += 1
+            for shape in self.pools:
+                if shape not in self.next_pools:
+                    self.next_pools[shape] = self._create_pool(shape, self.generation)
+            self.pools = self.next_pools
+            self._prepare_next()
+
+
+def _border_index(k, size, mode):
+    """Index of the slice read for position ``k`` of an axis of ``size`` slices following the border ``mode``.
+       ``None`` if the slice is outside and filled with zeros."""
+    if 0 <= k < size: return k
+    if mode == 'constant': return None
+    if mode == 'edge' or size == 1: return min(max(k, 0), size-1)
+    if mode == 'wrap': return k % size
+    period = 2*size if mode == 'symmetric' else 2*size-2
+    k = k % period
+    return k if k < size else period-k-(1 if mode == 'symmetric' else 0)
+
+
+def _fold(coords, size, mode):
+    """Move the positions outside an axis of ``size`` pixels inside it following the border ``mode``. With
+       ``'constant'`` they are only clipped to one pixel outside, as all the positions beyond are zeros anyway."""
+    if mode == 'constant': return np.clip(coords, -1, size)
+    if mode == 'edge' or size == 1: return np.clip(coords, 0, size-1)
+    if mode == 'wrap': return np.mod(coords, size)
+    if mode == 'symmetric':
+        c = np.mod(coords+0.5, 2*size)
+        return np.where(c < size, c, 2*size-c)-0.5
+    c = np.mod(coords, 2*size-2)
+    return np.where(c <= size-1, c, 2*size-2-c)
+
+
+def _remap_slice(img, xs, ys, order, mode):
+    """Resample a 2D image with OpenCV, keeping its channel axis."""
+    flags = cv2.INTER_LINEAR if order == 1 else cv2.INTER_NEAREST
+    out = cv2.remap(np.ascontiguousarray(img), np.ascontiguousarray(xs, dtype=np.float32),
+                    np.ascontiguousarray(ys, dtype=np.float32), flags, borderMode=cv2_border_modes[mode],
+                    borderValue=0)
+    return out.reshape(xs.shape+(img.shape[-1],))
+
+
+def _remap_slices(data, zs, ys, xs, order, mode, out):
+    """Resample the output slices ``out`` from an atlas with the input slices they need placed one below the other,
+       with a border row between them, so each neighbour slice is read with a single ``cv2.remap`` call. ``ys`` must
+       be already folded inside the slices and shifted by the border row."""
+    y_size = data.shape[1]+2
+    z0 = np.floor(zs) if order == 1 else np.floor(zs+0.5)
+    first = int(z0.min())
+    lut = [_border_index(k, data.shape[0], mode) for k in range(first, int(z0.max())+2)]
+    src = sorted(set(i for i in lut if i is not None))
+    if len(src)*y_size >= 32767 and len(zs) > 1:
+        # cv2.remap only works with images smaller than 32767 pixels, so split the output slices
+        h = len(zs)//2
+        _remap_slices(data, zs[:h], ys[:h], xs[:h], order, mode, out[:h])
+        _remap_slices(data, zs[h:], ys[h:], xs[h:], order, mode, out[h:])
+        return
+
+    atlas = np.pad(data[src], ((0,0),(1,1),(0,0),(0,0)), mode=mode)
+    atlas = atlas.reshape((len(src)*y_size,)+atlas.shape[2:])
+    # First row of each slice in the atlas. Slices outside the volume are placed outside the atlas to read zeros
+    starts = np.array([-4*y_size if i is None else src.index(i)*y_size for i in lut], dtype=np.float32)
+    shape2d = (zs.shape[0]*zs.shape[1], zs.shape[2])
+    xs = xs.reshape(shape2d)
+
+    def sample(k):
+        rows = starts[k.astype(int)-first] + ys
+        return _remap_slice(atlas, xs, rows.reshape(shape2d), order, mode).reshape(out.shape)
+
+    res = sample(z0)
+    if order == 1 and np.any(zs != z0):
+        res = res.astype(np.float32)
+        res += (zs-z0)[...,None]*(sample(z0+1)-res)
+        if np.issubdtype(out.dtype, np.integer): res = np.rint(res)
+    out[:] = res
+
+
+def remap(data, coords, order=1, mode='constant'):
+    """Resample all the channels of an image at the positions given by ``coords`` with ``cv2.remap``. In 3D the
+       slices are placed in a 2D atlas, so the volume is resampled with one call, or two if the positions change along
+       ``z`` (then the two slices each position falls between are blended, which gives a trilinear interpolation).
+
+       Parameters
+       ----------
+       data : Numpy array
+           Image to resample. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+
+       coords : Tuple of Numpy arrays
+           Input position of each output pixel along each axis, as ``float32``. In 2D ``(ys, xs)``, each of them
+           ``(y, x)``. In 3D ``(zs, ys, xs)``, each of them ``(z, y, x)``. ``zs`` may be ``None`` if the positions do
+           not change along ``z``, and then ``ys`` and ``xs`` may be ``(y, x)`` to use the same ones on all slices.
+
+       order : int, optional
+           Interpolation order: ``0`` (nearest) or ``1`` (linear).
+
+       mode : str, optional
+           How to fill the points outside the image. Same meaning as in `skimage` (and `numpy.pad()`).
+
+       Returns
+       -------
+       out : Numpy array
+           Resampled image with the shape and dtype of ``data``.
+    """
+    if data.dtype not in [np.uint8, np.uint16, np.int16, np.float32, np.float64]:
+        return remap(data.astype(np.float32), coords, order, mode).astype(data.dtype)
+    if data.ndim == 3:
+        return _remap_slice(data, coords[1], coords[0], order, mode)
+
+    zs, ys, xs = coords
+    if ys.ndim == 2:
+        ys, xs = np.broadcast_to(ys, data.shape[:3]), np.broadcast_to(xs, data.shape[:3])
+    if zs is None:
+        zs = np.broadcast_to(np.arange(data.shape[0], dtype=np.float32).reshape(-1,1,1), data.shape[:3])
+    out = np.empty(data.shape, dtype=data.dtype)
+    _remap_slices(data, zs, _fold(ys, data.shape[1], mode)+1, xs, order, mode, out)
+    return out
+
+
+def _positions(shape, rotation, shear, zoom, shift, field=None, axis_rotation=0, axis=(1,0,0), z_scale=1):
+    """Input position of each output pixel for the given transformation (see :func:`~affine_matrix`), in the format
+       expected by :func:`~remap`. ``shift`` is given as a fraction of the image size and ``field`` is the elastic
+       displacement to add, if any."""
+    ndim = len(shape)
+    matrix = affine_matrix(shape, rotation, shear, zoom, shift*np.array(shape[-2:]), axis_rotation, axis, z_scale)
+    zs = None
+    if ndim == 3 and axis_rotation != 0:
+        # The positions change along z, so they are calculated for every pixel of the volume
+        grid = np.indices(shape, dtype=np.float32)
+        zs, ys, xs = [(sum(matrix[i,j]*grid[j] for j in range(3)) + matrix[i,3]).astype(np.float32) for i in range(3)]
+        if field is not None:
+            zs, ys, xs = zs + field[0], ys + field[1], xs + field[2]
+        return zs, ys, xs
+
+    a, t = matrix[ndim-2:ndim, ndim-2:ndim], matrix[ndim-2:ndim, ndim]
+    yy, xx = np.indices(shape[-2:], dtype=np.float32)
+    ys = (a[0,0]*yy + a[0,1]*xx + t[0]).astype(np.float32)
+    xs = (a[1,0]*yy + a[1,1]*xx + t[1]).astype(np.float32)
+    if field is not None:
+        ys, xs = ys + field[-2], xs + field[-1]
+        if ndim == 3:
+            zs = np.arange(shape[0], dtype=np.float32).reshape(-1,1,1) + field[0]
+    return (ys, xs) if ndim == 2 else (zs, ys, xs)
+
+
+class SpatialAugmentor():
+    """Apply the spatial augmentations (flips, 90º rotations, rotations, shear, zoom, shift and elastic deformations)
+       composing them into a single coordinate map, so the image and its mask are resampled once with it instead of
+       once per augmentation as imgaug does. Flips and 90º rotations of square images are done as views, without
+       resampling. 3D volumes are transformed as they are, without merging ``z`` and channels, so the elastic
+       deformation is done in 3D. Rotations, shear, zoom and shift are done in the ``yx`` plane, as imgaug does, unless
+       ``rand_rot_3d`` is set, which makes the random rotations of volumes around a random axis.
+
+       The random values are drawn with ``np.random``, so they follow the seed of each batch.
+
+       Parameters
+       ----------
+       da_prob : float, optional
+           Probability of doing each transformation.
+
+       rotation90 : bool, optional
+           To make square (90, 180,270) degree rotations.
+
+       rand_rot : bool, optional
+           To make random degree range rotations.
+
+       rnd_rot_range : tuple of float, optional
+           Range of random rotations. E. g. ``(-180, 180)``.
+
+       rand_rot_3d : bool, optional
+           To make the random rotations of 3D volumes around an axis with a random direction instead of around ``z``.
+           The axis lengths are taken from ``res_relation``, so anisotropic volumes keep their real proportions.
+
+       shear : bool, optional
+           To make shear transformations.
+
+       shear_range : tuple of int, optional
+           Degree range to make shear. E. g. ``(-20, 20)``.
+
+       zoom : bool, optional
+           To make zoom on images.
+
+       zoom_range : tuple of floats, optional
+           Zoom range to apply. E. g. ``(0.8, 1.2)``.
+
+       shift : float, optional
+           To make shifts.
+
+       shift_range : tuple of float, optional
+           Range to make a shift, as a fraction of the image size. E. g. ``(0.1, 0.2)``.
+
+       affine_mode: str, optional
+           Method to use when filling in newly created pixels. Same meaning as in `skimage` (and `numpy.pad()`).
+           E.g. ``constant``, ``reflect`` etc.
+
+       vflip : bool, optional
+           To activate vertical flips.
+
+       hflip : bool, optional
+           To activate horizontal flips.
+
+       zflip : bool, optional
+           To activate flips in z dimension.
+
+       flip_prob : float, optional
+           Probability of doing each vertical and horizontal flip. Flips in ``z`` are done with ``da_prob``.
+
+       elastic : bool, optional
+           To make elastic deformations.
+
+       e_alpha : tuple of ints, optional
+            Strength of the distortion field. E. g. ``(240, 250)``.
+
+       e_sigma : int, optional
+           Standard deviation of the gaussian kernel used to smooth the distortion fields.
+
+       e_mode : str, optional
+           Parameter that defines the handling of newly created pixels with the elastic transformation. As both
+           transformations are done in a single resampling, it is only used when no affine transformation is applied
+           together with the elastic deformation. Otherwise ``affine_mode`` is used.
+
+       res_relation: tuple of floats, optional
+           Relation between the ``x``, ``y`` and ``z`` resolutions. Used to scale the elastic deformation and the 3D
+           rotations along ``z``.
+
+       e_cache_size : int, optional
+           Number of elastic fields to precompute per image shape (see
+           :class:`~data.generators.spatial_augmentors.ElasticFieldCache`). If ``0`` a new field is created for each
+           sample.
+
+       e_cache_epochs : int, optional
+           Number of epochs the precomputed elastic fields are used before being replaced by new ones. ``0`` to never
+           replace them.
+
+       seed : int, optional
+           Seed of the precomputed elastic fields.
+    """
+    def __init__(self, da_prob=0.5, rotation90=False, rand_rot=False, rnd_rot_range=(-180,180), rand_rot_3d=False,
+                 shear=False, shear_range=(-20,20), zoom=False, zoom_range=(0.8,1.2), shift=False,
+                 shift_range=(0.1,0.2), affine_mode='constant', vflip=False, hflip=False, zflip=False, flip_prob=0.5,
+                 elastic=False, e_alpha=(240,250), e_sigma=25, e_mode='constant', res_relation=None, e_cache_size=0,
+                 e_cache_epochs=5, seed=0):
+        for m in [affine_mode, e_mode]:
+            if m not in cv2_border_modes:
+                raise ValueError("Mode '{}' not supported. Options: {}".format(m, list(cv2_border_modes.keys())))
+        if elastic and (rand_rot or shear or zoom or shift or rotation90) and affine_mode != e_mode:
+            warnings.warn("'affine_mode' ({}) and 'e_mode' ({}) differ. The samples with both an affine transformation "
+                          "and an elastic deformation will be filled using 'affine_mode'".format(affine_mode, e_mode))
+        self.da_prob = da_prob
+        self.rotation90 = rotation90
+        self.rand_rot = rand_rot
+        self.rnd_rot_range = rnd_rot_range
+        self.rand_rot_3d = rand_rot_3d
+        self.shear = shear
+        self.shear_range = shear_range
+        self.zoom = zoom
+        self.zoom_range = zoom_range
+        self.shift = shift
+        self.shift_range = shift_range
+        self.affine_mode = affine_mode
+        self.vflip = vflip
+        self.hflip = hflip
+        self.zflip = zflip
+        self.flip_prob = flip_prob
+        self.elastic = elastic
+        self.e_alpha = e_alpha
+        self.e_sigma = e_sigma
+        self.e_mode = e_mode
+        self.res_relation = res_relation
+        self.e_cache = None
+        if elastic and e_cache_size > 0:
+            self.e_cache = ElasticFieldCache(e_cache_size, e_sigma, res_relation, e_cache_epochs, seed)
+
+    def transform(self, image, mask, first_no_bin_channel=-1):
+        """Transform an image and its mask with the same random spatial augmentations.
+
+           Parameters
+           ----------
+           image : Numpy array
+               Image to transform. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+
+           mask : Numpy array
+               Mask to transform. E.g. ``(z, y, x, channels)``. In 2D it can be larger than ``image``, e.g. the high
+               resolution image in super-resolution, and the same transformation is done at its scale.
+
+           first_no_bin_channel : int, optional
+               First channel of ``mask`` that is not binary (e.g. distance transform channels), which is interpolated
+               linearly. The previous channels are interpolated with nearest neighbour. ``-1`` if all the channels are
+               binary.
+
+           Returns
+           -------
+           image : Numpy array
+               Transformed image. It may be a view of ``image``.
+
+           mask : Numpy array
+               Transformed mask. It may be a view of ``mask``.
+        """
+        shape = image.shape[:-1]
+        ndim = len(shape)
+
+        # Flips and 90º rotations as views
+        if ndim == 3 and self.zflip and np.random.rand() < self.da_prob:
+            image, mask = image[::-1], mask[::-1]
+        if self.vflip and np.random.rand() < self.flip_prob:
+            image, mask = image[...,::-1,:,:], mask[...,::-1,:,:]
+        if self.hflip and np.random.rand() < self.flip_prob:
+            image, mask = image[...,::-1,:], mask[...,::-1,:]
+        rotation = 0
+        if self.rotation90 and np.random.rand() < self.da_prob:
+            k = np.random.randint(1, 4)
+            if shape[-2] == shape[-1] or k == 2:
+                image, mask = np.rot90(image, k, axes=(-3,-2)), np.rot90(mask, k, axes=(-3,-2))
+            else:
+                # Keep the shape of non-square images rotating them in the affine transformation
+                rotation = 90*k
+
+        axis_rotation, axis = 0, (1, 0, 0)
+        if self.rand_rot and np.random.rand() < self.da_prob:
+            if ndim == 3 and self.rand_rot_3d:
+                axis_rotation = np.random.uniform(*self.rnd_rot_range)
+                # Normal values give a direction uniformly distributed on the sphere
+                axis = np.random.normal(size=3)
+            else:
+                rotation += np.random.uniform(*self.rnd_rot_range)
+        shear = np.random.uniform(*self.shear_range) if self.shear and np.random.rand() < self.da_prob else 0
+        zoom = (1, 1)
+        if self.zoom and np.random.rand() < self.da_prob:
+            zoom = tuple(np.random.uniform(*self.zoom_range, size=2))
+        shift = 0
+        if self.shift and np.random.rand() < self.da_prob:
+            shift = np.random.uniform(*self.shift_range)
+        field = None
+        if self.elastic and np.random.rand() < self.da_prob:
+            alpha = np.random.uniform(*self.e_alpha)
+            if self.e_cache is not None:
+                field = self.e_cache.get(shape, alpha)
+            else:
+                field = elastic_field(shape, alpha, self.e_sigma, self.res_relation)
+
+        affine = rotation != 0 or axis_rotation != 0 or shear != 0 or zoom != (1, 1) or shift != 0
+        if not affine and field is None:
+            return image, mask
+
+        # A single resampling is done, so only one border mode can be used. The elastic one only without affine part
+        mode = self.affine_mode if affine else self.e_mode
+        z_scale = self.res_relation[2] if self.res_relation is not None else 1
+        coords = _positions(shape, rotation, shear, zoom, shift, field, axis_rotation, axis, z_scale)
+        if mask.shape[:-1] != shape:
+            # Mask of a different size, e.g. the high resolution image in super-resolution. The same transformation is
+            # done scaling the displacements
+            scale = np.array(mask.shape[:-1])/np.array(shape)
+            m_field = None
+            if field is not None:
+                m_field = np.stack([cv2.resize(f, mask.shape[1::-1], interpolation=cv2.INTER_LINEAR)*s
+                                    for f, s in zip(field, scale)])
+            m_coords = _positions(mask.shape[:-1], rotation, shear, zoom, shift, m_field)
+            m_orders = 1 if first_no_bin_channel == 0 else 0
+            return remap(image, coords, 1, mode), remap(mask, m_coords, m_orders, mode)
+
+        # Channels interpolated the same way are resampled together
+        if first_no_bin_channel == -1:
+            return remap(image, coords, 1, mode), remap(mask, coords, 0, mode)
+        linear = np.concatenate([image, mask[...,first_no_bin_channel:].astype(image.dtype)], axis=-1)
+        linear = remap(linear, coords, 1, mode)
+        image = linear[...,:image.shape[-1]]
+        heat = linear[...,image.shape[-1]:].astype(mask.dtype)
+        if first_no_bin_channel == 0:
+            return image, heat
+        return image, np.concatenate([remap(mask[...,:first_no_bin_channel], coords, 0, mode), heat], axis=-1)
+
+    def on_epoch_end(self):
+        """To be called at the end of each epoch to refresh the precomputed elastic fields."""
+        if self.e_cache is not None:
+            self.e_cache.on_epoch_end()
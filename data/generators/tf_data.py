@@ -0,0 +1,138 @@
+import time
+import threading
+import contextlib
+import numpy as np
+import tensorflow as tf
+
+
+class PipelineTimer():
+    """Accumulate the time spent on each stage of the input pipeline. It can be shared by several threads.
+
+       Parameters
+       ----------
+       name : str, optional
+           Name to print in the summary.
+    """
+    def __init__(self, name=""):
+        self.name = name
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Remove all the times recorded."""
+        with self.lock:
+            self.times = {}
+            self.counts = {}
+
+    def add(self, stage, seconds):
+        """Record ``seconds`` spent on ``stage``."""
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Context manager to record the time spent inside it on ``stage``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter()-start)
+
+    def summary(self):
+        """Print the total and mean time of each stage."""
+        with self.lock:
+            print("{} input pipeline timings:".format(self.name))
+            for stage in self.times:
+                print("    {:<10} total: {:8.3f}s - mean: {:.4f}s ({} calls)".format(stage, self.times[stage],
+                      self.times[stage]/self.counts[stage], self.counts[stage]))
+
+
+def stage_timer(timer, stage):
+    """Return ``timer.stage(stage)`` or a context manager that does nothing if ``timer`` is ``None``."""
+    return contextlib.nullcontext() if timer is None else timer.stage(stage)
+
+
+def is_generator_deterministic(generator):
+    """Whether the generator creates the same batches on every epoch, i.e. it does not apply data augmentation,
+       random crops nor shuffle the data.
+
+       Parameters
+       ----------
+       generator : tf.keras.utils.Sequence
+           Generator to check. E.g. ``ImageDataGenerator`` or ``VoxelDataGenerator``.
+
+       Returns
+       -------
+       deterministic : bool
+           ``True`` if the batches created are always the same.
+    """
+    shuffle = getattr(generator, 'shuffle', getattr(generator, 'shuffle_each_epoch', False))
+    random_crops = getattr(generator, 'random_crops_in_DA', False) and not getattr(generator, 'val', False)
+    return not generator.da and not shuffle and not random_crops
+
+
+def create_tf_dataset(generator, num_parallel_calls=-1, cache=False, snapshot_dir=None, timer=None):
+    """Create a ``tf.data.Dataset`` that returns the same batches as the given generator.
+
+       The batches are created in parallel by ``num_parallel_calls`` threads calling the generator, keeping the order,
+       and prefetched while the model is being trained. As the batches depend on the epoch, ``on_epoch_end`` of the
+       generator still needs to be called after each epoch (see ``utils.callbacks.GeneratorEpochEnd``).
+
+       Parameters
+       ----------
+       generator : tf.keras.utils.Sequence
+           Generator to create the batches with. E.g. ``ImageDataGenerator`` or ``VoxelDataGenerator``.
+
+       num_parallel_calls : int, optional
+           Number of batches to create in parallel. Set it to ``-1`` to let TensorFlow choose it dynamically.
+
+       cache : bool, optional
+           To keep the batches in memory after the first epoch. Only used if the generator creates the same batches on
+           every epoch (see ``is_generator_deterministic``), e.g. the validation generator.
+
+       snapshot_dir : str, optional
+           Directory to save the batches to after the first epoch, so they are read from disk in the next ones. Same
+           constraints as ``cache``.
+
+       timer : PipelineTimer, optional
+           Timer to record the time spent on each stage: ``load`` and ``augment`` inside the generator and ``batch``
+           for the whole batch creation.
+
+       Returns
+       -------
+       dataset : tf.data.Dataset
+           Dataset with the batches of the generator.
+    """
+    # Take the structure and types of the batches from the first one
+    structure = generator[0]
+    flat = [np.asarray(x) for x in tf.nest.flatten(structure)]
+
+    if timer is not None:
+        generator.timer = timer
+
+    def create_batch(index):
+        with stage_timer(timer, 'batch'):
+            batch = generator[int(index)]
+        return [np.asarray(x, dtype=f.dtype) for x, f in zip(tf.nest.flatten(batch), flat)]
+
+    def map_batch(index):
+        batch = tf.numpy_function(create_batch, [index], [tf.as_dtype(f.dtype) for f in flat])
+        for t, f in zip(batch, flat):
+            t.set_shape((None,)+f.shape[1:])
+        return tf.nest.pack_sequence_as(structure, batch)
+
+    num_parallel_calls = tf.data.experimental.AUTOTUNE if num_parallel_calls == -1 else num_parallel_calls
+    dataset = tf.data.Dataset.range(len(generator))
+    dataset = dataset.map(map_batch, num_parallel_calls=num_parallel_calls, deterministic=True)
+
+    if cache or snapshot_dir is not None:
+        if not is_generator_deterministic(generator):
+            print("WARNING: the batches can not be cached as the generator creates different batches on each epoch "
+                  "(data augmentation, random crops or shuffling are enabled)")
+        elif snapshot_dir is not None:
+            dataset = dataset.apply(tf.data.experimental.snapshot(snapshot_dir))
+        else:
+            dataset = dataset.cache()
+
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
@@ -1,8 +1,7 @@
 import numpy as np
-from scipy.ndimage.filters import median_filter
 
-from engine.metrics import jaccard_index_numpy, voc_calculation
-from data.post_processing.post_processing import calculate_z_filtering
+from engine.metrics import segmentation_metrics
+from data.post_processing.post_processing import calculate_z_filtering, median_filter_z
 
 
 def apply_post_processing(cfg, data, Y=None):
@@ -37,11 +36,13 @@ def apply_post_processing(cfg, data, Y=None):
         data = calculate_z_filtering(data, cfg.TEST.POST_PROCESSING.YZ_FILTERING_SIZE)
 
     if cfg.TEST.POST_PROCESSING.Z_FILTERING:
-        data = median_filter(data, size=(cfg.TEST.POST_PROCESSING.Z_FILTERING_SIZE,1,1,1))
+        # Filter in place if a new array was already created by the previous filter
+        out = data if cfg.TEST.POST_PROCESSING.YZ_FILTERING else None
+        data = median_filter_z(data, cfg.TEST.POST_PROCESSING.Z_FILTERING_SIZE, out=out)
 
     if Y is not None:
-        iou_post = jaccard_index_numpy((Y>0.5).astype(np.uint8), (data>0.5).astype(np.uint8))
-        ov_iou_post = voc_calculation((Y>0.5).astype(np.uint8), (data>0.5).astype(np.uint8), iou_post)
+        metrics = segmentation_metrics(Y, data, t=0.5)
+        iou_post, ov_iou_post = metrics['iou'], metrics['ov_iou']
     else:
         iou_post, ov_iou_post = 0, 0 
 
@@ -0,0 +1,227 @@
+import itertools
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+from data.post_processing.post_processing import bc_watershed, bcd_watershed, bdv2_watershed
+
+
+class UnionFind():
+    """Disjoint set of labels, used to merge the labels of the same instance found in different chunks."""
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        """Return the representative label of the set ``x`` belongs to."""
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        # Path compression
+        while x != root:
+            self.parent[x], x = root, self.parent.get(x, x)
+        return root
+
+    def union(self, x, y):
+        """Merge the sets of labels ``x`` and ``y``, keeping the lowest label as representative."""
+        rx, ry = self.find(x), self.find(y)
+        if rx != ry:
+            if rx < ry:
+                self.parent[ry] = rx
+            else:
+                self.parent[rx] = ry
+
+
+def chunk_grid(shape, chunk_shape, halo=0):
+    """Split the data in chunks that cover it without overlapping (cores), each one extended by ``halo`` pixels on
+       each side so the watershed of the pixels close to the core borders sees their neighbourhood.
+
+       Parameters
+       ----------
+       shape : Tuple of ints
+           Shape of the data without channels. E.g. ``(z, y, x)``.
+
+       chunk_shape : Tuple of ints
+           Shape of the cores. E.g. ``(z, y, x)``.
+
+       halo : int, optional
+           Pixels each chunk is extended on each side.
+
+       Returns
+       -------
+       chunks : List of tuples
+           ``(grid_index, core, outer)`` of each chunk, where ``core`` and ``outer`` are tuples of slices over the data.
+    """
+    if len(chunk_shape) != len(shape):
+        raise ValueError("'chunk_shape' must have {} values, one per axis of the data, but it has {}"
+                         .format(len(shape), len(chunk_shape)))
+
+    axes = []
+    for s, c in zip(shape, chunk_shape):
+        starts = range(0, s, c)
+        axes.append([(slice(a, min(a+c, s)), slice(max(0, a-halo), min(a+c+halo, s))) for a in starts])
+
+    chunks = []
+    for index in itertools.product(*[range(len(a)) for a in axes]):
+        core = tuple(axes[d][i][0] for d, i in enumerate(index))
+        outer = tuple(axes[d][i][1] for d, i in enumerate(index))
+        chunks.append((index, core, outer))
+    return chunks
+
+
+def watershed_chunk(mode, chunk, scale_to_01, kwargs):
+    """Apply the watershed of ``mode`` to a chunk. Run inside the worker processes."""
+    if scale_to_01:
+        chunk = chunk.astype(np.float32)
+        chunk[...,:2] /= 255
+    f = {'BC': bc_watershed, 'BCD': bcd_watershed, 'BDv2': bdv2_watershed}[mode]
+    return f(chunk, **kwargs).astype(np.int32)
+
+
+def chunked_watershed(data, mode='BC', chunk_shape=(64, 512, 512), halo=16, workers=1, min_overlap=0.5,
+                      thres_small=128, remove_before=False, out=None, **kwargs):
+    """Apply :func:`~data.post_processing.post_processing.bc_watershed`,
+       :func:`~data.post_processing.post_processing.bcd_watershed` or
+       :func:`~data.post_processing.post_processing.bdv2_watershed` by chunks, so big volumes can be processed without
+       creating full-size temporaries and using several worker processes.
+
+       The data is split in chunks extended by ``halo`` pixels on each side and the watershed is run independently on
+       each of them. Only the core of each chunk is written into the output. The instances cut by the core borders are
+       joined comparing the labels of each chunk with the labels already written by the neighbours it shares a face
+       with, on a band of two pixels of the neighbour core next to that face: two labels are merged (union-find) when
+       their intersection over union in the band is at least ``min_overlap``. Small objects are removed at the end over
+       the joined instances. With no ``halo`` the chunks are not joined.
+
+       The halo must be large enough to contain the seeds of the instances cut by the borders, otherwise they may be
+       split differently than when processing the whole volume at once.
+
+       Parameters
+       ----------
+       data : 4D Numpy array
+           Data to apply the watershed into. E.g. ``(z, y, x, channels)``. It can be a memory-mapped array, as only the
+           chunks being processed are read.
+
+       mode : str, optional
+           Watershed to apply: ``'BC'``, ``'BCD'`` or ``'BDv2'``.
+
+       chunk_shape : Tuple of ints, optional
+           Shape of the chunk cores, one value per axis of ``data`` but the channels.
+
+       halo : int, optional
+           Pixels each chunk is extended on each side.
+
+       workers : int, optional
+           Number of worker processes. If ``1`` the chunks are processed in this process.
+
+       min_overlap : float, optional
+           Intersection over union needed to join two labels of neighbour chunks. Values of ``0.5`` or more join each
+           label with one label of the neighbour at most.
+
+       thres_small : int, optional
+           Theshold to remove small objects created by the watershed.
+
+       remove_before : bool, optional
+           To remove objects before watershed (done by chunk). If ``False`` it is done after joining the chunks.
+
+       out : Numpy array, optional
+           Array to store the instances into, with the shape of ``data`` without channels. E.g. a memory-mapped array.
+
+       kwargs : dict
+           Thresholds of the watershed function selected with ``mode``, e.g. ``thres1``.
+
+       Returns
+       -------
+       segm : Numpy array
+           Instances, labelled with consecutive values. E.g. ``(z, y, x)``.
+    """
+    if mode not in ['BC', 'BCD', 'BDv2']:
+        raise ValueError("'mode' must be one between ['BC', 'BCD', 'BDv2']")
+    if not (0 < min_overlap <= 1):
+        raise ValueError("'min_overlap' must be in range (0, 1]")
+
+    shape = data.shape[:-1]
+    chunks = chunk_grid(shape, chunk_shape, halo)
+    segm = np.zeros(shape, dtype=np.int32) if out is None else out
+
+    # The watershed functions decide the range of the data by chunk, so it is checked once for the whole data. Only
+    # 'BC' and 'BCD' rescale it
+    scale_to_01 = False
+    if mode != 'BDv2':
+        scale_to_01 = max(float(np.max(data[i,...,:2])) for i in range(shape[0])) > 1
+
+    # Small objects removed after the watershed are removed here after joining the chunks
+    kwargs = dict(kwargs, remove_before=remove_before, save_dir=None)
+    remove_after = not remove_before and mode != 'BDv2'
+    kwargs['thres_small'] = 0 if remove_after else thres_small
+
+    uf = UnionFind()
+    written = {}
+    band = min(halo, 2)
+    offset = 0
+
+    def stitch(index, core, outer, labels):
+        nonlocal offset
+        labels[labels > 0] += offset
+        offset = max(offset, int(labels.max()))
+
+        # Join the labels with the ones written by the neighbour chunks that share a face with this one, comparing
+        # only a thin band of the neighbour core next to the face, where both watersheds have enough context
+        for n_index, n_core in written.items():
+            diff = [a-b for a, b in zip(index, n_index)]
+            if sum(abs(d) for d in diff) != 1: continue
+            axis = next(i for i, d in enumerate(diff) if d != 0)
+            c = n_core[axis]
+            width = min(band, c.stop-c.start)
+            region = list(core)
+            region[axis] = slice(c.stop-width, c.stop) if diff[axis] > 0 else slice(c.start, c.start+width)
+            region = tuple(region)
+            local = tuple(slice(r.start-o.start, r.stop-o.start) for r, o in zip(region, outer))
+            a, b = labels[local].ravel(), np.asarray(segm[region]).ravel()
+            fg = (a > 0) & (b > 0)
+            if not np.any(fg): continue
+            pairs, counts = np.unique(np.stack([a[fg], b[fg]], axis=-1), axis=0, return_counts=True)
+            a_ids, a_sizes = np.unique(a[a > 0], return_counts=True)
+            b_ids, b_sizes = np.unique(b[b > 0], return_counts=True)
+            a_sizes = a_sizes[np.searchsorted(a_ids, pairs[:,0])]
+            b_sizes = b_sizes[np.searchsorted(b_ids, pairs[:,1])]
+            # An IoU over 0.5 can only be reached by one pair per label, so touching instances are not joined
+            iou = counts/(a_sizes+b_sizes-counts)
+            for (x, y) in pairs[iou >= min_overlap]:
+                uf.union(int(x), int(y))
+
+        local = tuple(slice(c.start-o.start, c.stop-o.start) for c, o in zip(core, outer))
+        segm[core] = labels[local]
+        written[index] = core
+
+    if workers > 1:
+        # Submit a few chunks per worker at a time so only them are kept in memory
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for chunk in tqdm(chunks, leave=False):
+                pending.append((chunk, executor.submit(watershed_chunk, mode, np.asarray(data[chunk[2]]),
+                                                       scale_to_01, kwargs)))
+                if len(pending) >= 2*workers:
+                    (index, core, outer), future = pending.pop(0)
+                    stitch(index, core, outer, future.result())
+            for (index, core, outer), future in pending:
+                stitch(index, core, outer, future.result())
+    else:
+        for index, core, outer in tqdm(chunks, leave=False):
+            stitch(index, core, outer, watershed_chunk(mode, np.asarray(data[outer]), scale_to_01, kwargs))
+
+    # Map each label to its set and remove the small objects
+    lut = np.arange(offset+1, dtype=np.int64)
+    for l in list(uf.parent):
+        lut[l] = uf.find(l)
+    if remove_after:
+        sizes = np.zeros(offset+1, dtype=np.int64)
+        for i in range(shape[0]):
+            sizes += np.bincount(np.asarray(segm[i]).ravel(), minlength=offset+1)
+        set_sizes = np.bincount(lut, weights=sizes, minlength=offset+1)
+        lut[set_sizes[lut] < thres_small] = 0
+    lut[0] = 0
+
+    # Relabel with consecutive values slice by slice to not create a copy of the volume
+    lut = np.searchsorted(np.unique(lut), lut).astype(segm.dtype)
+    for i in range(shape[0]):
+        segm[i] = lut[segm[i]]
+    return segm
@@ -1,16 +1,17 @@
 import cv2
 import os
-import math
 import statistics
 import sys
+import itertools
 import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy import ndimage as ndi
 from skimage import morphology
 from skimage.morphology import disk, remove_small_objects
 from skimage.segmentation import watershed
 from skimage.filters import rank, threshold_otsu
-from scipy.ndimage import rotate
 from skimage.measure import label
 from skimage.io import imsave, imread
 from scipy.ndimage.morphology import binary_erosion, binary_dilation
@@ -20,7 +21,6 @@ import numpy_indexed as npi
 from scipy.spatial import KDTree
 from scipy.spatial.distance import cdist
 
-from engine.metrics import jaccard_index_numpy
 from utils.util import apply_binary_mask, pad_and_reflect, normalize
 from data.data_3D_manipulation import crop_3D_data_with_overlap
 
@@ -379,8 +379,9 @@ def bdv2_watershed(data, bin_th=0.2, thres_small=128, remove_before=False, save_
     return segm
 
 
-def calculate_z_filtering(data, mf_size=5):
-    """Applies a median filtering in the z dimension of the provided data.
+def calculate_z_filtering(data, mf_size=5, out=None, workers=None):
+    """Applies a median filtering in the z dimension of the provided data. Each slice is filtered with
+       ``cv2.medianBlur`` in a pool of threads, as OpenCV releases the GIL.
 
        Parameters
        ----------
@@ -390,29 +391,211 @@ def calculate_z_filtering(data, mf_size=5):
        mf_size : int, optional
            Size of the median filter. Must be an odd number.
 
+       out : 4D Numpy array, optional
+           Array to store the filtered data into. It can be ``data`` itself to filter it in place. If ``None`` a new
+           array is created.
+
+       workers : int, optional
+           Number of threads. If ``None`` one per CPU is used.
+
        Returns
        -------
        Array : 4D Numpy array
            Z filtered data. E.g. ``(num_of_images, y, x, channels)``.
     """
 
-    out_data = np.copy(data)
+    out_data = np.empty_like(data) if out is None else out
 
     # Must be odd
     if mf_size % 2 == 0:
        mf_size += 1
 
-    for i in range(data.shape[0]):
-        sl = (data[i]).astype(np.float32)
-        sl = cv2.medianBlur(sl, mf_size)
-        sl = np.expand_dims(sl,-1) if sl.ndim == 2 else sl
-        out_data[i] = sl
+    def filter_slice(i):
+        sl = cv2.medianBlur(data[i].astype(np.float32, copy=False), mf_size)
+        out_data[i] = sl.reshape(out_data[i].shape)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(filter_slice, range(data.shape[0])))
 
     return out_data
 
 
+def median_filter_z(data, size=5, out=None, workers=None, chunk_size=None, chunk_bytes=32*1024**2):
+    """Applies a 1D median filter along the first axis (``z``) of the data, as
+       ``scipy.ndimage.median_filter(data, size=(size,1,1,1))`` does. The data is split in chunks of rows processed in
+       a pool of threads, taking the median of each window of ``size`` slices with ``np.partition``, which releases the
+       GIL.
+
+       Parameters
+       ----------
+       data : 4D Numpy array
+           Data to apply the filter to. E.g. ``(z, y, x, channels)``.
+
+       size : int, optional
+           Number of slices of the median filter.
+
+       out : 4D Numpy array, optional
+           Array to store the filtered data into. It can be ``data`` itself to filter it in place. If ``None`` a new
+           array is created.
+
+       workers : int, optional
+           Number of threads. If ``None`` one per CPU is used, up to ``4``.
+
+       chunk_size : int, optional
+           Number of rows (``y``) of each chunk. If ``None`` it is calculated from ``chunk_bytes``.
+
+       chunk_bytes : int, optional
+           Approximate size in bytes of the temporary array each thread creates to take the median of a chunk, which
+           holds ``size`` values per element of the chunk. Used when ``chunk_size`` is ``None``. The memory used by the
+           temporary arrays is about ``workers*chunk_bytes``.
+
+       Returns
+       -------
+       Array : 4D Numpy array
+           Z filtered data. E.g. ``(z, y, x, channels)``.
+    """
+
+    out_data = np.empty_like(data) if out is None else out
+    if workers is None:
+        workers = min(os.cpu_count() or 1, 4)
+    if chunk_size is None:
+        row_bytes = data.shape[0]*int(np.prod(data.shape[2:]))*size*data.dtype.itemsize
+        chunk_size = max(1, chunk_bytes//row_bytes)
+    # Same window placement and border mode ('reflect') as scipy.ndimage.median_filter
+    pad = ((size//2, size-1-size//2),) + ((0, 0),)*(data.ndim-1)
+
+    def filter_chunk(y):
+        chunk = np.pad(data[:,y:y+chunk_size], pad, mode='symmetric')
+        windows = sliding_window_view(chunk, size, axis=0)
+        out_data[:,y:y+chunk_size] = np.partition(windows, size//2, axis=-1)[...,size//2]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(filter_chunk, range(0, data.shape[1], chunk_size)))
+
+    return out_data
+
+
+def tta_views(ndim=2):
+    """Transformations made by the test-time augmentation: the 4 rotations of 90 degrees in the ``(y, x)`` plane, with
+       and without flipping the ``x`` axis, that is, the 8 possible rotations and flips of a 2D image. In 3D each of
+       them is also made flipping the ``z`` axis, creating 16 transformations.
+
+       Parameters
+       ----------
+       ndim : int, optional
+           Number of spatial dimensions of the data: ``2`` or ``3``.
+
+       Returns
+       -------
+       views : List of tuples
+           Transformations as ``(rotations, flip_x, flip_z)``.
+    """
+    views = [(k, f, False) for f in [False, True] for k in range(4)]
+    if ndim == 3:
+        views += [(k, f, True) for k, f, _ in views]
+    return views
+
+
+def apply_tta_view(batch, view, inverse=False):
+    """Apply one of the transformations of :func:`~tta_views` to a batch, or undo it. Only views are created, so no
+       data is copied.
+
+       Parameters
+       ----------
+       batch : 4D/5D Numpy array
+           Data to transform. E.g. ``(num_of_images, y, x, channels)`` or ``(num_of_images, z, y, x, channels)``.
+
+       view : tuple
+           Transformation to apply as ``(rotations, flip_x, flip_z)``.
+
+       inverse : bool, optional
+           To undo the transformation instead.
+
+       Returns
+       -------
+       batch : 4D/5D Numpy array
+           Transformed data.
+    """
+    k, flip_x, flip_z = view
+    y_axis, x_axis = batch.ndim-3, batch.ndim-2
+    if inverse:
+        batch = np.rot90(batch, k=-k, axes=(y_axis, x_axis))
+    if flip_x:
+        batch = np.flip(batch, x_axis)
+    if flip_z:
+        batch = np.flip(batch, 1)
+    if not inverse:
+        batch = np.rot90(batch, k=k, axes=(y_axis, x_axis))
+    return batch
+
+
+def ensemble_predictions(X, pred_func, batch_size_value=1, n_classes=1):
+    """Outputs the mean prediction of each image of ``X`` over its 8 (2D) or 16 (3D) possible rotations and flips
+       (see :func:`~tta_views`).
+
+       The transformed copies of all the images are predicted together, filling batches of ``batch_size_value`` items,
+       and each prediction is transformed back and added to a running sum, so the predictions of all the
+       transformations are never stored at the same time.
+
+       Parameters
+       ----------
+       X : 4D/5D Numpy array
+           Input images. E.g. ``(num_of_images, y, x, channels)`` or ``(num_of_images, z, y, x, channels)``.
+
+       pred_func : function
+           Function to make predictions.
+
+       batch_size_value : int, optional
+           Batch size value.
+
+       n_classes : int, optional
+           Number of classes.
+
+       Returns
+       -------
+       out : 4D/5D Numpy array
+           Ensembled predictions. E.g. ``(num_of_images, y, x, channels)`` or ``(num_of_images, z, y, x, channels)``.
+    """
+    views = tta_views(X.ndim-2)
+    y_axis, x_axis = X.ndim-3, X.ndim-2
+
+    # Convert into square images to make the rotations properly
+    pad_to_square = X.shape[y_axis] - X.shape[x_axis]
+    if pad_to_square != 0:
+        pad = [(0, 0)]*X.ndim
+        pad[y_axis if pad_to_square < 0 else x_axis] = (abs(pad_to_square), 0)
+        X = np.pad(X, pad, 'reflect')
+
+    items = [(i, v) for i in range(X.shape[0]) for v in views]
+    out = None
+    for b in range(0, len(items), batch_size_value):
+        batch_items = items[b:b+batch_size_value]
+        r_aux = pred_func(np.array([apply_tta_view(X[i:i+1], v)[0] for i, v in batch_items]))
+
+        # Take just the last output of the network in case it returns more than one output
+        if isinstance(r_aux, list):
+            r_aux = np.array(r_aux[-1])
+
+        if n_classes > 1:
+            r_aux = np.expand_dims(np.argmax(r_aux, -1), -1)
+
+        if out is None:
+            out = np.zeros((X.shape[0],)+r_aux.shape[1:], dtype=np.float32)
+        for p, (i, v) in zip(r_aux, batch_items):
+            out[i] += apply_tta_view(p[None], v, inverse=True)[0]
+    out /= len(views)
+
+    # Undo the padding
+    if pad_to_square < 0:
+        out = out[(slice(None),)*y_axis+(slice(abs(pad_to_square), None),)]
+    elif pad_to_square > 0:
+        out = out[(slice(None),)*x_axis+(slice(abs(pad_to_square), None),)]
+    return out
+
+
 def ensemble8_2d_predictions(o_img, pred_func, batch_size_value=1, n_classes=1):
-    """Outputs the mean prediction of a given image generating its 8 possible rotations and flips.
+    """Outputs the mean prediction of a given image generating its 8 possible rotations and flips. To ensemble several
+       images at once use :func:`~ensemble_predictions`.
 
        Parameters
        ----------
@@ -449,106 +632,18 @@ def ensemble8_2d_predictions(o_img, pred_func, batch_size_value=1, n_classes=1):
 
            # Notice that here pred_func is created based on model.predict function of Keras
     """
-
-    # Prepare all the image transformations per channel
-    total_img = []
-    for channel in range(o_img.shape[-1]):
-        aug_img = []
-
-        # Transformations per channel
-        _img = np.expand_dims(o_img[...,channel], -1)
-
-        # Convert into square image to make the rotations properly
-        pad_to_square = _img.shape[0] - _img.shape[1]
-        if pad_to_square < 0:
-            img = np.pad(_img, [(abs(pad_to_square), 0), (0, 0), (0, 0)], 'reflect')
-        else:
-            img = np.pad(_img, [(0, 0), (pad_to_square, 0), (0, 0)], 'reflect')
-
-        # Make 8 different combinations of the img
-        aug_img.append(img)
-        aug_img.append(np.rot90(img, axes=(0, 1), k=1))
-        aug_img.append(np.rot90(img, axes=(0, 1), k=2))
-        aug_img.append(np.rot90(img, axes=(0, 1), k=3))
-        aug_img.append(img[:, ::-1])
-        img_aux = img[:, ::-1]
-        aug_img.append(np.rot90(img_aux, axes=(0, 1), k=1))
-        aug_img.append(np.rot90(img_aux, axes=(0, 1), k=2))
-        aug_img.append(np.rot90(img_aux, axes=(0, 1), k=3))
-        aug_img = np.array(aug_img)
-
-        total_img.append(aug_img)
-
-    del aug_img, img_aux
-
-    # Merge channels
-    total_img = np.concatenate(total_img, -1)
-
-    # Make the prediction
-    _decoded_aug_img = []
-    l = int(math.ceil(total_img.shape[0]/batch_size_value))
-    for i in range(l):
-        top = (i+1)*batch_size_value if (i+1)*batch_size_value < total_img.shape[0] else total_img.shape[0]
-        r_aux = pred_func(total_img[i*batch_size_value:top])
-
-        # Take just the last output of the network in case it returns more than one output
-        if isinstance(r_aux, list):
-            r_aux = np.array(r_aux[-1])
-
-        if n_classes > 1:
-            r_aux = np.expand_dims(np.argmax(r_aux, -1), -1)
-
-        _decoded_aug_img.append(r_aux)
-    _decoded_aug_img = np.concatenate(_decoded_aug_img)
-
-    # Undo the combinations of the img
-    arr = []
-    for c in range(_decoded_aug_img.shape[-1]):
-        # Remove the last channel to make the transformations correctly
-        decoded_aug_img = _decoded_aug_img[...,c]
-
-        # Undo the combinations of the image
-        out_img = []
-        out_img.append(decoded_aug_img[0])
-        out_img.append(np.rot90(decoded_aug_img[1], axes=(0, 1), k=3))
-        out_img.append(np.rot90(decoded_aug_img[2], axes=(0, 1), k=2))
-        out_img.append(np.rot90(decoded_aug_img[3], axes=(0, 1), k=1))
-        out_img.append(decoded_aug_img[4][:, ::-1])
-        out_img.append(np.rot90(decoded_aug_img[5], axes=(0, 1), k=3)[:, ::-1])
-        out_img.append(np.rot90(decoded_aug_img[6], axes=(0, 1), k=2)[:, ::-1])
-        out_img.append(np.rot90(decoded_aug_img[7], axes=(0, 1), k=1)[:, ::-1])
-        out_img = np.array(out_img)
-        out_img = np.expand_dims(out_img, -1)
-        arr.append(out_img)
-
-    out_img = np.concatenate(arr, -1)
-    del decoded_aug_img, _decoded_aug_img, arr
-
-    if pad_to_square != 0:
-        if pad_to_square < 0:
-            out = np.zeros((out_img.shape[0], img.shape[0]+pad_to_square, img.shape[1], out_img.shape[-1]))
-        else:
-            out = np.zeros((out_img.shape[0], img.shape[0], img.shape[1]-pad_to_square, out_img.shape[-1]))
-    else:
-        out = np.zeros(out_img.shape)
-
-    # Undo the padding
-    for i in range(out_img.shape[0]):
-        if pad_to_square < 0:
-            out[i] = out_img[i,abs(pad_to_square):,:]
-        else:
-            out[i] = out_img[i,:,abs(pad_to_square):]
-
-    return np.mean(out, axis=0)
+    return ensemble_predictions(np.expand_dims(o_img, 0), pred_func, batch_size_value=batch_size_value,
+                                n_classes=n_classes)[0]
 
 
 def ensemble16_3d_predictions(vol, pred_func, batch_size_value=1, n_classes=1):
-    """Outputs the mean prediction of a given image generating its 16 possible rotations and flips.
+    """Outputs the mean prediction of a given volume generating its 16 possible rotations and flips (see
+       :func:`~tta_views`). To ensemble several volumes at once use :func:`~ensemble_predictions`.
 
        Parameters
        ----------
-       o_img : 4D Numpy array
-           Input image. E.g. ``(x, y, z, channels)``.
+       vol : 4D Numpy array
+           Input volume. E.g. ``(z, y, x, channels)``.
 
        pred_func : function
            Function to make predictions.
@@ -562,142 +657,216 @@ def ensemble16_3d_predictions(vol, pred_func, batch_size_value=1, n_classes=1):
        Returns
        -------
        out : 4D Numpy array
-           Output image ensembled. E.g. ``(x, y, z, channels)``.
+           Output volume ensembled. E.g. ``(z, y, x, channels)``.
 
        Examples
        --------
        ::
 
            # EXAMPLE 1
-           # Apply ensemble to each image of X_test
-           X_test = np.ones((10, 165, 768, 1024, 1))
+           # Apply ensemble to each volume of X_test
+           X_test = np.ones((10, 80, 256, 256, 1))
            out_X_test = np.zeros(X_test.shape, dtype=(np.float32))
 
            for i in tqdm(range(X_test.shape[0])):
-               pred_ensembled = ensemble8_2d_predictions(X_test[i],
+               pred_ensembled = ensemble16_3d_predictions(X_test[i],
                    pred_func=(lambda img_batch_subdiv: model.predict(img_batch_subdiv)), n_classes=n_classes)
                out_X_test[i] = pred_ensembled
 
            # Notice that here pred_func is created based on model.predict function of Keras
     """
+    return ensemble_predictions(np.expand_dims(vol, 0), pred_func, batch_size_value=batch_size_value,
+                                n_classes=n_classes)[0]
 
-    total_vol = []
-    for channel in range(vol.shape[-1]):
 
-        aug_vols = []
+def threshold_jaccard(values, mask, ths):
+    """Calculate the Jaccard index between ``mask`` and ``values > th`` for every threshold in ``ths`` with a single
+       pass over the data: the values of the foreground and background pixels are counted in a histogram whose bins
+       are the thresholds, and the number of pixels above each threshold is its reverse cumulative sum.
 
-        # Transformations per channel
-        _vol = vol[...,channel]
+       Parameters
+       ----------
+       values : Numpy array
+           Values to threshold, e.g. one channel of the prediction.
 
-        # Convert into square image to make the rotations properly
-        pad_to_square = _vol.shape[0] - _vol.shape[1]
+       mask : Numpy array
+           Binary mask with the same number of elements as ``values``.
 
-        if pad_to_square < 0:
-            volume = np.pad(_vol, [(abs(pad_to_square),0), (0,0), (0,0)], 'reflect')
-        else:
-            volume = np.pad(_vol, [(0,0), (pad_to_square,0), (0,0)], 'reflect')
-
-        # Make 16 different combinations of the volume
-        aug_vols.append(volume)
-        aug_vols.append(rotate(volume, mode='reflect', axes=(0, 1), angle=90, reshape=False))
-        aug_vols.append(rotate(volume, mode='reflect', axes=(0, 1), angle=180, reshape=False))
-        aug_vols.append(rotate(volume, mode='reflect', axes=(0, 1), angle=270, reshape=False))
-        volume_aux = np.flip(volume, 0)
-        aug_vols.append(volume_aux)
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=90, reshape=False))
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=180, reshape=False))
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=270, reshape=False))
-        volume_aux = np.flip(volume, 1)
-        aug_vols.append(volume_aux)
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=90, reshape=False))
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=180, reshape=False))
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=270, reshape=False))
-        volume_aux = np.flip(volume, 2)
-        aug_vols.append(volume_aux)
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=90, reshape=False))
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=180, reshape=False))
-        aug_vols.append(rotate(volume_aux, mode='reflect', axes=(0, 1), angle=270, reshape=False))
-        aug_vols = np.array(aug_vols)
-
-        # Add the last channel again
-        aug_vols = np.expand_dims(aug_vols, -1)
-        total_vol.append(aug_vols)
-
-    del aug_vols, volume_aux
-    # Merge channels
-    total_vol = np.concatenate(total_vol, -1)
-
-    _decoded_aug_vols = []
-
-    l = int(math.ceil(total_vol.shape[0]/batch_size_value))
-    for i in range(l):
-        top = (i+1)*batch_size_value if (i+1)*batch_size_value < total_vol.shape[0] else total_vol.shape[0]
-        r_aux = pred_func(total_vol[i*batch_size_value:top])
+       ths : List of floats
+           Thresholds to evaluate, in increasing order.
 
-        # Take just the last output of the network in case it returns more than one output
-        if isinstance(r_aux, list):
-            r_aux = np.array(r_aux[-1])
+       Returns
+       -------
+       jac : 1D Numpy array
+           Jaccard index of each threshold, as :func:`~engine.metrics.jaccard_index_numpy` calculates it.
+    """
+    values, mask = values.ravel(), mask.ravel()
+    # Bin i holds the values in (ths[i-1], ths[i]], so the values above ths[j] are the ones in bins > j
+    bins = np.digitize(values, ths, right=True)
+    fg_hist = np.bincount(bins[mask], minlength=len(ths)+1)
+    bg_hist = np.bincount(bins[~mask], minlength=len(ths)+1)
+    TP = np.cumsum(fg_hist[::-1])[::-1][1:]
+    FP = np.cumsum(bg_hist[::-1])[::-1][1:]
+    FN = np.count_nonzero(mask) - TP
+    total = TP + FP + FN
+    return np.where(total == 0, 0, TP/np.maximum(total, 1))
+
+
+def count_objects(data, thres_small=0):
+    """Count the number of values of the labelled ``data`` (the background included) after removing the objects
+       smaller than ``thres_small``, as ``len(np.unique(remove_small_objects(label(data), thres_small)))`` does.
 
-        if n_classes > 1:
-            r_aux = np.expand_dims(np.argmax(r_aux, -1), -1)
+       Parameters
+       ----------
+       data : Numpy array
+           Binary data to label.
 
-        _decoded_aug_vols.append(r_aux)
-
-    _decoded_aug_vols = np.concatenate(_decoded_aug_vols)
-    volume = np.expand_dims(volume, -1)
-
-    arr = []
-    for c in range(_decoded_aug_vols.shape[-1]):
-        # Remove the last channel to make the transformations correctly
-        decoded_aug_vols = _decoded_aug_vols[...,c]
-
-        # Undo the combinations of the volume
-        out_vols = []
-        out_vols.append(np.array(decoded_aug_vols[0]))
-        out_vols.append(rotate(np.array(decoded_aug_vols[1]), mode='reflect', axes=(0, 1), angle=-90, reshape=False))
-        out_vols.append(rotate(np.array(decoded_aug_vols[2]), mode='reflect', axes=(0, 1), angle=-180, reshape=False))
-        out_vols.append(rotate(np.array(decoded_aug_vols[3]), mode='reflect', axes=(0, 1), angle=-270, reshape=False))
-        out_vols.append(np.flip(np.array(decoded_aug_vols[4]), 0))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[5]), mode='reflect', axes=(0, 1), angle=-90, reshape=False), 0))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[6]), mode='reflect', axes=(0, 1), angle=-180, reshape=False), 0))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[7]), mode='reflect', axes=(0, 1), angle=-270, reshape=False), 0))
-        out_vols.append(np.flip(np.array(decoded_aug_vols[8]), 1))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[9]), mode='reflect', axes=(0, 1), angle=-90, reshape=False), 1))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[10]), mode='reflect', axes=(0, 1), angle=-180, reshape=False), 1))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[11]), mode='reflect', axes=(0, 1), angle=-270, reshape=False), 1))
-        out_vols.append(np.flip(np.array(decoded_aug_vols[12]), 2))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[13]), mode='reflect', axes=(0, 1), angle=-90, reshape=False), 2))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[14]), mode='reflect', axes=(0, 1), angle=-180, reshape=False), 2))
-        out_vols.append(np.flip(rotate(np.array(decoded_aug_vols[15]), mode='reflect', axes=(0, 1), angle=-270, reshape=False), 2))
-        out_vols = np.array(out_vols)
-        out_vols = np.expand_dims(out_vols, -1)
-        arr.append(out_vols)
-
-    out_vols = np.concatenate(arr, -1)
-    del decoded_aug_vols, _decoded_aug_vols, arr
-
-    # Create the output data
-    if pad_to_square != 0:
-        if pad_to_square < 0:
-            out = np.zeros((out_vols.shape[0], volume.shape[0]+pad_to_square, volume.shape[1], volume.shape[2], out_vols.shape[-1]))
-        else:
-            out = np.zeros((out_vols.shape[0], volume.shape[0], volume.shape[1]-pad_to_square, volume.shape[2], out_vols.shape[-1]))
+       thres_small : int, optional
+           Theshold to remove small objects. If ``0`` no object is removed.
+
+       Returns
+       -------
+       count : int
+           Number of objects plus one if there is background.
+    """
+    data = label(np.squeeze(data), connectivity=1)
+    sizes = np.bincount(data.ravel())
+    objs = sizes[1:][sizes[1:] > 0]
+    if thres_small > 0 and len(sizes) > 1 and not (sizes[0] == 0 and len(objs) == 1):
+        kept = np.count_nonzero(objs >= thres_small)
+        background = sizes[0] > 0 or kept < len(objs)
     else:
-        out = np.zeros(out_vols.shape)
+        kept = len(objs)
+        background = sizes[0] > 0
+    return kept + int(background)
 
-    # Undo the padding
-    for i in range(out_vols.shape[0]):
-        if pad_to_square < 0:
-            out[i] = out_vols[i,abs(pad_to_square):,:,:,:]
-        else:
-            out[i] = out_vols[i,:,abs(pad_to_square):,:,:]
 
-    return np.mean(out, axis=0)
+def objects_count_threshold(obj_counts, ths, ideal, in_row=False):
+    """Select the threshold whose number of objects is closest to ``ideal``. Used to find TH1 and TH4 in
+       :func:`~calculate_optimal_mw_thresholds`.
+
+       Parameters
+       ----------
+       obj_counts : List of ints
+           Number of objects obtained with each threshold.
+
+       ths : List of floats
+           Thresholds tried.
+
+       ideal : int
+           Number of objects of the ground truth.
+
+       in_row : bool, optional
+           Whether the previous search ended keeping the closest number of objects.
+
+       Returns
+       -------
+       th_min : float
+           First threshold with the closest number of objects.
+
+       th_opt : float
+           Optimum threshold, moved forward while the number of objects is kept.
+
+       in_row : bool
+           Whether the last thresholds kept the closest number of objects.
+    """
+    th_min, th_last, th_repeat_count, th_op_pos, th_obj_min_diff = 0, 0, 0, -1, sys.maxsize
+    for k in range(len(ths)):
+        diff = abs(obj_counts[k]-ideal)
+        if diff <= th_obj_min_diff and th_repeat_count < 4 and diff != th_last:
+            th_obj_min_diff = diff
+            th_min = ths[k]
+            th_op_pos = k
+            th_repeat_count = 0
+            in_row = True
+
+        if diff == th_last and diff == th_obj_min_diff and in_row:
+            th_repeat_count += 1
+        elif k != th_op_pos:
+            in_row = False
+        th_last = diff
+
+    th_opt_pos = min(th_op_pos + th_repeat_count, len(ths)-1)
+    return th_min, ths[th_opt_pos], in_row
+
+
+def mw_thresholds_per_sample(pred, mask, n_labels, ths, ths_dis=None, thres_small=5):
+    """Calculate the marked controlled watershed thresholds of one sample. Used by
+       :func:`~calculate_optimal_mw_thresholds`, which runs it in parallel over the samples.
+
+       Parameters
+       ----------
+       pred : 4D Numpy array
+           Prediction of the sample. E.g. ``(z, y, x, channels)``.
+
+       mask : 4D Numpy array
+           Instance mask of the sample. E.g. ``(z, y, x, 1)``.
+
+       n_labels : int
+           Number of labels in ``mask``, the background included.
+
+       ths : List of floats
+           Thresholds to try for TH1, TH2 and TH3.
+
+       ths_dis : List of floats, optional
+           Thresholds to try for TH4 and TH5. Only used in ``BCD`` mode.
+
+       thres_small : int, optional
+           Theshold to remove small objects in the prediction.
+
+       Returns
+       -------
+       results : dict
+           Values obtained for each threshold (``l_th*``) and the selected ones.
+    """
+    r = {}
+    fg = mask > 0
+    # TH3 and TH5:
+    # Look at the best IoU compared with the original label. Only the region that involve the object is taken
+    # into consideration. This is achieved dilating 2 iterations the original object mask. If we do not dilate
+    # that label, decreasing the TH will always ensure a IoU >= than the previous TH. This way, the IoU will
+    # reach a maximum and then it will start to decrease, as more points that are not from the object are added
+    # into it
+    r['l_th3'] = list(threshold_jaccard(pred[...,0], fg, ths))
+    r['th3_max'] = ths[int(np.argmax(r['l_th3']))]
+    if ths_dis is not None:
+        r['l_th5'] = list(threshold_jaccard(pred[...,2], fg, ths_dis))
+        r['th5_max'] = ths_dis[int(np.argmax(r['l_th5']))]
+
+    # TH2: obtained the optimum value for the TH3, the TH2 threshold is calculated counting the objects. As this
+    # threshold looks at the contour channels, its purpose is to separed the entangled objects. This way, the TH2
+    # optimum should be reached when the number of objects of the prediction match the number of real objects
+    objs_to_divide = pred[...,0] > r['th3_max']
+    r['l_th2'] = [count_objects(objs_to_divide * (pred[...,1] < th), thres_small) for th in ths]
+    th2_min, th2_last, th2_repeat_count, th2_op_pos, th2_obj_min_diff = 0, 0, 0, -1, sys.maxsize
+    for k in range(len(ths)):
+        if abs(r['l_th2'][k]-n_labels) < th2_obj_min_diff:
+            th2_obj_min_diff = abs(r['l_th2'][k]-n_labels)
+            th2_min = ths[k]
+            th2_op_pos = k
+            th2_repeat_count = 0
+
+        if th2_obj_min_diff == th2_last: th2_repeat_count += 1
+        th2_last = abs(r['l_th2'][k]-n_labels)
+    th2_opt_pos = th2_op_pos + int(th2_repeat_count/2) if th2_repeat_count < 10 else th2_op_pos + 2
+    r['th2_min'] = th2_min
+    r['th2_opt'] = ths[min(th2_opt_pos, len(ths)-1)]
+
+    # TH1 and TH4: as TH2 counting the objects of the seeds
+    no_contour = pred[...,1] < th2_min
+    r['l_th1'] = [count_objects((pred[...,0] > th) * no_contour) for th in ths]
+    r['th1_min'], r['th1_opt'], in_row = objects_count_threshold(r['l_th1'], ths, n_labels)
+    if ths_dis is not None:
+        r['l_th4'] = [count_objects((pred[...,2] > th) * no_contour) for th in ths_dis]
+        r['th4_min'], r['th4_opt'], _ = objects_count_threshold(r['l_th4'], ths_dis, n_labels, in_row)
+    return r
 
 
 def calculate_optimal_mw_thresholds(model, data_path, data_mask_path, patch_size, mode="BC", distance_mask_path=None,
-                                    thres_small=5, bin_mask_path=None, use_minimum=False, chart_dir=None, verbose=True):
-    """Calculate the optimum values for the marked controlled watershed thresholds.
+                                    thres_small=5, bin_mask_path=None, use_minimum=False, chart_dir=None, verbose=True,
+                                    batch_size=1, workers=1):
+    """Calculate the optimum values for the marked controlled watershed thresholds. All the patches are predicted
+       once, by batches, and the thresholds of each patch are then searched in parallel.
 
        Parameters
        ----------
@@ -733,6 +902,12 @@ def calculate_optimal_mw_thresholds(model, data_path, data_mask_path, patch_size
        verbose : bool, optional
            To print saving information.
 
+       batch_size : int, optional
+           Number of patches to predict at once.
+
+       workers : int, optional
+           Number of worker processes used to search the thresholds. If ``1`` it is done in this process.
+
        Return
        ------
        global_th1_min_opt: float
@@ -794,6 +969,8 @@ def calculate_optimal_mw_thresholds(model, data_path, data_mask_path, patch_size
         max_distance += max_distance*0.1
         ths_dis = np.arange(0.1, max_distance, 0.05)
 
+    # Load the samples and keep the patches with objects
+    imgs, masks, n_labels = [], [], []
     for i in tqdm(range(len(ids))):
         if verbose: print("Analizing file {}".format(os.path.join(data_path, ids[i])))
 
@@ -847,155 +1024,50 @@ def calculate_optimal_mw_thresholds(model, data_path, data_mask_path, patch_size
                 if verbose:
                     print("Skip this sample as it is just background")
             else:
-                # Prediction
                 if np.max(img) > 100: img = img/255
-                pred = model.predict(img, verbose=0)
-
-                if bin_mask_path is not None:
-                    pred = apply_binary_mask(pred, bin_mask_path)
-
-                # TH3 and TH5:
-                # Look at the best IoU compared with the original label. Only the region that involve the object is taken
-                # into consideration. This is achieved dilating 2 iterations the original object mask. If we do not dilate
-                # that label, decreasing the TH will always ensure a IoU >= than the previous TH. This way, the IoU will
-                # reach a maximum and then it will start to decrease, as more points that are not from the object are added
-                # into it
-                # TH3
-                th3_best = -1
-                th3_max_jac = -1
-                l_th3 = []
-                for j in range(len(ths)):
-                    p = np.expand_dims(pred[...,0] > ths[j],-1).astype(np.uint8)
-                    jac = jaccard_index_numpy((mask>0).astype(np.uint8), p)
-                    if jac > th3_max_jac:
-                        th3_max_jac = jac
-                        th3_best = ths[j]
-                    l_th3.append(jac)
-                l_th3_max.append(th3_best)
-                g_l_th3.append(l_th3)
-                # TH5
-                if mode == 'BCD':
-                    th5_best = -1
-                    th5_max_jac = -1
-                    l_th5 = []
-                    for j in range(len(ths_dis)):
-                        p = np.expand_dims(pred[...,2] > ths_dis[j],-1).astype(np.uint8)
-                        jac = jaccard_index_numpy((mask>0).astype(np.uint8), p)
-                        if jac > th5_max_jac:
-                            th5_max_jac = jac
-                            th5_best = ths_dis[j]
-                        l_th5.append(jac)
-                    l_th5_max.append(th5_best)
-                    g_l_th5.append(l_th5)
-
-                # TH2: obtained the optimum value for the TH3, the TH2 threshold is calculated counting the objects. As this
-                # threshold looks at the contour channels, its purpose is to separed the entangled objects. This way, the TH2
-                # optimum should be reached when the number of objects of the prediction match the number of real objects
-                objs_to_divide = (pred[...,0] > th3_best).astype(np.uint8)
-                th2_min = 0
-                th2_last = 0
-                th2_repeat_count = 0
-                th2_op_pos = -1
-                th2_obj_min_diff = sys.maxsize
-                l_th2 = []
-                for k in range(len(ths)):
-                    p = (objs_to_divide * (pred[...,1] < ths[k])).astype(np.uint8)
-
-                    p = label(np.squeeze(p), connectivity=1)
-                    if len(np.unique(p)) != 1:
-                        p = remove_small_objects(p, thres_small)
-                    obj_count = len(np.unique(p))
-                    l_th2.append(obj_count)
-
-                    if abs(obj_count-len(labels)) < th2_obj_min_diff:
-                        th2_obj_min_diff = abs(obj_count-len(labels))
-                        th2_min = ths[k]
-                        th2_op_pos = k
-                        th2_repeat_count = 0
-
-                    if th2_obj_min_diff == th2_last: th2_repeat_count += 1
-                    th2_last = abs(obj_count-len(labels))
-
-                g_l_th2.append(l_th2)
-                l_th2_min.append(th2_min)
-                th2_opt_pos = th2_op_pos + int(th2_repeat_count/2) if th2_repeat_count < 10 else th2_op_pos + 2
-                if th2_opt_pos >= len(ths): th2_opt_pos = len(ths)-1
-                l_th2_opt.append(ths[th2_opt_pos])
-
-                # TH1 and TH4:
-                th1_min = 0
-                th1_last = 0
-                th1_repeat_count = 0
-                th1_op_pos = -1
-                th1_obj_min_diff = sys.maxsize
-                l_th1 = []
-                in_row = False
-                # TH1
-                for k in range(len(ths)):
-                    p = ((pred[...,0] > ths[k])*(pred[...,1] < th2_min)).astype(np.uint8)
-
-                    p = label(np.squeeze(p), connectivity=1)
-                    obj_count = len(np.unique(p))
-                    l_th1.append(obj_count)
-
-                    diff = abs(obj_count-len(labels))
-                    if diff <= th1_obj_min_diff and th1_repeat_count < 4 and diff != th1_last:
-                        th1_obj_min_diff = diff
-                        th1_min = ths[k]
-                        th1_op_pos = k
-                        th1_repeat_count = 0
-                        in_row = True
-
-                    if diff == th1_last and diff == th1_obj_min_diff and in_row:
-                        th1_repeat_count += 1
-                    elif k != th1_op_pos:
-                        in_row = False
-                    th1_last = diff
-
-                g_l_th1.append(l_th1)
-                l_th1_min.append(th1_min)
-                th1_opt_pos = th1_op_pos + th1_repeat_count
-                if th1_opt_pos >= len(ths): th1_opt_pos = len(ths)-1
-                l_th1_opt.append(ths[th1_opt_pos])
-
-                # TH4
-                if mode == 'BCD':
-                    th4_min = 0
-                    th4_last = 0
-                    th4_repeat_count = 0
-                    th4_op_pos = -1
-                    th4_obj_min_diff = sys.maxsize
-                    l_th4 = []
-                    for k in range(len(ths_dis)):
-                        p = ((pred[...,2] > ths_dis[k])*(pred[...,1] < th2_min)).astype(np.uint8)
-
-                        p = label(np.squeeze(p), connectivity=1)
-                        obj_count = len(np.unique(p))
-                        l_th4.append(obj_count)
-
-                        diff = abs(obj_count-len(labels))
-                        if diff <= th4_obj_min_diff and th4_repeat_count < 4 and diff != th4_last:
-                            th4_obj_min_diff = diff
-                            th4_min = ths_dis[k]
-                            th4_op_pos = k
-                            th4_repeat_count = 0
-                            in_row = True
-
-                        if diff == th4_last and diff == th4_obj_min_diff and in_row:
-                            th4_repeat_count += 1
-                        elif k != th4_op_pos:
-                            in_row = False
-                        th4_last = diff
-
-                    g_l_th4.append(l_th4)
-                    l_th4_min.append(th4_min)
-                    th4_opt_pos = th4_op_pos + th4_repeat_count
-                    if th4_opt_pos >= len(ths_dis): th4_opt_pos = len(ths_dis)-1
-                    l_th4_opt.append(ths_dis[th4_opt_pos])
+                imgs.append(img)
+                masks.append(mask)
+                n_labels.append(len(labels))
 
             # Store the number of nucleus
             ideal_number_obj.append(len(labels))
 
+    # Predict all the patches once, by batches
+    preds = []
+    for k in tqdm(range(0, len(imgs), batch_size), leave=False):
+        pred = model.predict(np.stack(imgs[k:k+batch_size]), verbose=0)
+        for p in pred:
+            if bin_mask_path is not None:
+                p = apply_binary_mask(p, bin_mask_path)
+            preds.append(p)
+    del imgs
+
+    # Try the thresholds on each patch
+    args = (preds, masks, n_labels, itertools.repeat(ths), itertools.repeat(ths_dis if mode == 'BCD' else None),
+            itertools.repeat(thres_small))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(tqdm(executor.map(mw_thresholds_per_sample, *args), total=len(preds), leave=False))
+    else:
+        results = [mw_thresholds_per_sample(*a) for a in tqdm(zip(*args), total=len(preds), leave=False)]
+    del preds, masks
+
+    for r in results:
+        g_l_th3.append(r['l_th3'])
+        l_th3_max.append(r['th3_max'])
+        g_l_th2.append(r['l_th2'])
+        l_th2_min.append(r['th2_min'])
+        l_th2_opt.append(r['th2_opt'])
+        g_l_th1.append(r['l_th1'])
+        l_th1_min.append(r['th1_min'])
+        l_th1_opt.append(r['th1_opt'])
+        if mode == 'BCD':
+            g_l_th5.append(r['l_th5'])
+            l_th5_max.append(r['th5_max'])
+            g_l_th4.append(r['l_th4'])
+            l_th4_min.append(r['th4_min'])
+            l_th4_opt.append(r['th4_opt'])
+
     ideal_objects = statistics.mean(ideal_number_obj)
     create_th_plot(ths, g_l_th1, "TH1", chart_dir)
     create_th_plot(ths, g_l_th1, "TH1", chart_dir, per_sample=False, ideal_value=ideal_objects)
@@ -1142,8 +1214,67 @@ def create_th_plot(ths, y_list, th_name="TH1", chart_dir=None, per_sample=True,
     plt.show()
 
 
-def voronoi_on_mask(data, mask, save_dir, filenames, th=0.3, thres_small=128, verbose=False):
-    """Apply Voronoi to the voxels not labeled yet marked by the mask. Its done witk K-nearest neighbors.
+def voxel_chunks(data, chunk_size=None):
+    """Yield the coordinates of the non-zero voxels of ``data`` by chunks of ``z`` slices, in the same order as
+       ``np.argwhere`` would return them.
+
+       Parameters
+       ----------
+       data : 3D Numpy array
+           Data to find the non-zero voxels of. E.g. ``(z, y, x)``.
+
+       chunk_size : int, optional
+           Number of ``z`` slices of each chunk. If ``None`` all the voxels are returned at once.
+
+       Yields
+       ------
+       pos : 2D Numpy array
+           Coordinates of the non-zero voxels of the chunk. E.g. ``(num_of_voxels, 3)``.
+    """
+    chunk_size = len(data) if chunk_size is None else chunk_size
+    for z in range(0, len(data), chunk_size):
+        pos = np.argwhere(data[z:z+chunk_size])
+        if len(pos) > 0:
+            pos[:,0] += z
+            yield pos
+
+
+def nearest_lowest_index(tree, points, k=8):
+    """Find the nearest point of ``tree`` to each point of ``points``, returning the lowest index when several points
+       are at the same distance, as a brute-force search with ``cdist`` and ``argmin`` does.
+
+       Parameters
+       ----------
+       tree : scipy.spatial.KDTree
+           Tree of the points to search in.
+
+       points : 2D Numpy array
+           Points to query. E.g. ``(num_of_points, 3)``.
+
+       k : int, optional
+           Number of neighbours requested per point to solve the ties. Points with more than ``k`` neighbours at the
+           same distance are solved searching all the points within that distance.
+
+       Returns
+       -------
+       idx : 1D Numpy array
+           Index of the nearest point of ``tree`` to each point.
+    """
+    k = min(k, tree.n)
+    dist, idx = tree.query(points, k=list(range(1, k+1)), workers=-1)
+    ties = dist == dist[:,:1]
+    nearest = np.where(ties, idx, tree.n).min(axis=1)
+    for j in np.nonzero(ties[:,-1])[0] if k < tree.n else []:
+        # The radius is slightly enlarged as rounding can leave the tied points just outside the ball, and the
+        # candidates are compared again with the distances cdist would give
+        cand = np.sort(tree.query_ball_point(points[j], dist[j,0]*(1+1e-9)))
+        nearest[j] = cand[np.argmin(cdist(points[j:j+1], tree.data[cand])[0])]
+    return nearest
+
+
+def voronoi_on_mask(data, mask, save_dir, filenames, th=0.3, thres_small=128, verbose=False, chunk_size=None):
+    """Apply Voronoi to the voxels not labeled yet marked by the mask. Its done witk K-nearest neighbors, querying all
+       the voxels at once.
 
        Parameters
        ----------
@@ -1169,6 +1300,10 @@ def voronoi_on_mask(data, mask, save_dir, filenames, th=0.3, thres_small=128, ve
        verbose : bool, optional
             To print saving information.
 
+       chunk_size : int, optional
+           Number of ``z`` slices whose voxels are queried at once, to limit the memory used by the queries. If
+           ``None`` all the voxels are queried at once.
+
        Returns
        -------
        data : 4D Numpy array
@@ -1211,13 +1346,9 @@ def voronoi_on_mask(data, mask, save_dir, filenames, th=0.3, thres_small=128, ve
         voronoi_mask = binary_erosion(voronoi_mask, iterations=2)
 
         # XOR to determine the particular voxels to apply Voronoi
-        not_labelled_points = ((_data[i] > 0) != voronoi_mask).astype(np.uint8)
-        pos_not_labelled_points = np.argwhere(not_labelled_points>0)
-        for j in range(len(pos_not_labelled_points)):
-            z = pos_not_labelled_points[j][0]
-            x = pos_not_labelled_points[j][1]
-            y = pos_not_labelled_points[j][2]
-            _data[i,z,x,y] = tree.query(pos_not_labelled_points[j])[1]
+        not_labelled_points = (_data[i] > 0) != voronoi_mask
+        for pos in voxel_chunks(not_labelled_points, chunk_size):
+            _data[i][tuple(pos.T)] = tree.query(pos, workers=-1)[1]
 
         # Save image
         if filenames is None:
@@ -1230,9 +1361,9 @@ def voronoi_on_mask(data, mask, save_dir, filenames, th=0.3, thres_small=128, ve
     return _data
 
 
-def voronoi_on_mask_2(data, mask, save_dir, filenames, th=0, verbose=False):
+def voronoi_on_mask_2(data, mask, save_dir, filenames, th=0, verbose=False, chunk_size=None):
     """Apply Voronoi to the voxels not labeled yet marked by the mask. It is done using distances from the un-labeled
-       voxels to the cell perimeters.
+       voxels to the cell perimeters, found with a KD-tree of the perimeter voxels.
 
        Parameters
        ----------
@@ -1258,6 +1389,10 @@ def voronoi_on_mask_2(data, mask, save_dir, filenames, th=0, verbose=False):
        verbose : bool, optional
             To print saving information.
 
+       chunk_size : int, optional
+           Number of ``z`` slices whose voxels are queried at once, to limit the memory used by the queries. If
+           ``None`` all the voxels are queried at once.
+
        Returns
        -------
        data : 4D Numpy array
@@ -1307,20 +1442,14 @@ def voronoi_on_mask_2(data, mask, save_dir, filenames, th=0, verbose=False):
     erodedVoronoiCyst = morphology.binary_erosion(binaryVoronoiCyst, morphology.ball(radius=2))
     cellPerimeter = binaryVoronoiCyst - erodedVoronoiCyst
 
-    # Define ids to fill where there is mask but no labels
-    idsToFill = np.argwhere((closedBinaryMask==1) & (data==0))
-    labelPerId = np.zeros(np.size(idsToFill));
-
     idsPerim = np.argwhere(cellPerimeter==1)
     labelsPerimIds = voronoiCyst[cellPerimeter==1]
 
-    # Generating voronoi
-    for nId in range(1,len(idsToFill)):
-        distCoord = cdist([idsToFill[nId]], idsPerim)
-        idSeedMin = np.argwhere(distCoord==np.min(distCoord))
-        idSeedMin = idSeedMin[0][1]
-        labelPerId[nId] = labelsPerimIds[idSeedMin]
-        voronoiCyst[idsToFill[nId][0], idsToFill[nId][1], idsToFill[nId][2]] = labelsPerimIds[idSeedMin]
+    # Generating voronoi where there is mask but no labels
+    if len(idsPerim) > 0:
+        tree = KDTree(idsPerim)
+        for idsToFill in voxel_chunks((closedBinaryMask==1) & (data==0), chunk_size):
+            voronoiCyst[tuple(idsToFill.T)] = labelsPerimIds[nearest_lowest_index(tree, idsToFill)]
 
     # Save image
     f = os.path.join(save_dir, filenames[0])
@@ -0,0 +1,170 @@
+import os
+import numpy as np
+from tqdm import tqdm
+
+
+class ProbMapSampler():
+    """Draw crop centers following the probability map of each image without loading the maps. The pixels of each
+       map are grouped by their probability, which in the maps created by
+       :func:`~utils.util.calculate_2D_volume_prob_map` and :func:`~utils.util.calculate_3D_volume_prob_map` takes
+       just a few values (foreground and background of each channel). Only the flat indices of the pixels of each group
+       (``uint32``) and the cumulative weight of the groups (``float32``) are stored, so a center is drawn choosing a
+       group with a binary search and a pixel inside it uniformly. Pixels with zero probability are not stored.
+
+       The indices can be memory-mapped from disk (see :func:`~create_prob_map_sampler` and
+       :func:`~load_prob_map_sampler`), so only the drawn pixel is read.
+
+       Parameters
+       ----------
+       indices : 1D Numpy array
+           Flat indices of the pixels of all the groups of all the images, one group after the other.
+
+       group_ends : 1D Numpy array
+           Position in ``indices`` where each group ends.
+
+       group_weights : 1D Numpy array
+           Cumulative probability of the groups of each image. It reaches ``1`` in the last group of each image.
+
+       image_groups : 1D Numpy array
+           Position in ``group_ends`` where the groups of each image start. It has an extra element with the total
+           number of groups.
+
+       shapes : 2D Numpy array
+           Shape of the probability map of each image. E.g. ``(num_of_images, 3)`` for ``(y, x, channels)`` maps.
+    """
+    def __init__(self, indices, group_ends, group_weights, image_groups, shapes):
+        self.indices = indices
+        self.group_ends = group_ends
+        self.group_weights = group_weights
+        self.image_groups = image_groups
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def sample(self, i):
+        """Draw a pixel of image ``i`` following its probability map. The random values are drawn with
+           ``np.random``.
+
+           Parameters
+           ----------
+           i : int
+               Image to draw the pixel from.
+
+           Returns
+           -------
+           coordinates : tuple of ints
+               Coordinates of the pixel in the probability map. E.g. ``(y, x, channel)``.
+        """
+        first, last = self.image_groups[i], self.image_groups[i+1]
+        weights = self.group_weights[first:last]
+        g = min(int(np.searchsorted(weights, np.random.rand(), side='right')), len(weights)-1)
+        start = self.group_ends[first+g-1] if first+g > 0 else 0
+        k = start + np.random.randint(self.group_ends[first+g]-start)
+        return tuple(int(c) for c in np.unravel_index(int(self.indices[k]), tuple(self.shapes[i])))
+
+
+def _map_groups(_map):
+    """Flat indices of the pixels of ``_map`` grouped by probability, skipping the pixels with zero probability, and
+       the probability of each group. They are normalized to sum ``1``, as each channel of the maps does. A map
+       without any positive pixel is sampled uniformly."""
+    values, inverse, counts = np.unique(_map.ravel(), return_inverse=True, return_counts=True)
+    if not np.any(values > 0):
+        return np.arange(_map.size, dtype=np.uint32), np.array([_map.size]), np.ones(1)
+    order = np.argsort(inverse, kind='stable').astype(np.uint32)
+    keep = values > 0
+    order = order[np.repeat(keep, counts)]
+    weights = values[keep].astype(np.float64)*counts[keep]
+    return order, counts[keep], weights/weights.sum()
+
+
+def create_prob_map_sampler(prob_map, save_dir=None):
+    """Create a :class:`~ProbMapSampler` from the given probability maps.
+
+       Parameters
+       ----------
+       prob_map : 4D/5D Numpy array or str
+           Probability maps, e.g. ``(num_of_images, y, x, channels)``, or directory with a ``.npy`` file per image.
+
+       save_dir : str, optional
+           Directory to store the sampler in. If given, the sampler returned has the indices memory-mapped from it.
+
+       Returns
+       -------
+       sampler : ProbMapSampler
+           Sampler of the given probability maps.
+
+       Raises
+       ------
+       ValueError
+           if any probability map has more pixels than an ``uint32`` can index.
+    """
+    if isinstance(prob_map, str):
+        files = [os.path.join(prob_map, f) for f in sorted(next(os.walk(prob_map))[2])]
+        get_map = lambda i: np.load(files[i], mmap_mode='r')
+        l = len(files)
+    else:
+        get_map = lambda i: prob_map[i]
+        l = len(prob_map)
+
+    shapes = np.array([get_map(i).shape for i in range(l)], dtype=np.int64)
+    if np.any(np.prod(shapes, axis=1) > np.iinfo(np.uint32).max):
+        raise ValueError("Probability maps with more than {} pixels are not supported"
+                         .format(np.iinfo(np.uint32).max))
+
+    # The number of indices is counted first so they can be written directly on disk
+    total = 0
+    for i in range(l):
+        positive = np.count_nonzero(np.asarray(get_map(i)) > 0)
+        total += positive if positive > 0 else int(np.prod(shapes[i]))
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+        indices = np.lib.format.open_memmap(os.path.join(save_dir, 'indices.npy'), mode='w+', dtype=np.uint32,
+                                            shape=(total,))
+    else:
+        indices = np.empty((total,), dtype=np.uint32)
+
+    print("Creating the probability map sampler . . .")
+    group_ends, group_weights, image_groups = [], [], [0]
+    pos = 0
+    for i in tqdm(range(l)):
+        order, counts, weights = _map_groups(np.asarray(get_map(i)))
+        indices[pos:pos+len(order)] = order
+        group_ends.append(pos+np.cumsum(counts))
+        group_weights.append(np.cumsum(weights))
+        image_groups.append(image_groups[-1]+len(counts))
+        pos += len(order)
+
+    group_ends = np.concatenate(group_ends).astype(np.int64)
+    group_weights = np.concatenate(group_weights).astype(np.float32)
+    image_groups = np.array(image_groups, dtype=np.int64)
+    if save_dir is not None:
+        indices.flush()
+        del indices
+        np.save(os.path.join(save_dir, 'group_ends.npy'), group_ends)
+        np.save(os.path.join(save_dir, 'group_weights.npy'), group_weights)
+        np.save(os.path.join(save_dir, 'image_groups.npy'), image_groups)
+        np.save(os.path.join(save_dir, 'shapes.npy'), shapes)
+        print("Probability map sampler stored in {}".format(save_dir))
+        return load_prob_map_sampler(save_dir)
+    return ProbMapSampler(indices, group_ends, group_weights, image_groups, shapes)
+
+
+def load_prob_map_sampler(save_dir):
+    """Load a :class:`~ProbMapSampler` stored by :func:`~create_prob_map_sampler`. The indices are memory-mapped.
+
+       Parameters
+       ----------
+       save_dir : str
+           Directory where the sampler is stored.
+
+       Returns
+       -------
+       sampler : ProbMapSampler
+           Loaded sampler.
+    """
+    return ProbMapSampler(np.load(os.path.join(save_dir, 'indices.npy'), mmap_mode='r'),
+                          np.load(os.path.join(save_dir, 'group_ends.npy')),
+                          np.load(os.path.join(save_dir, 'group_weights.npy')),
+                          np.load(os.path.join(save_dir, 'image_groups.npy')),
+                          np.load(os.path.join(save_dir, 'shapes.npy')))
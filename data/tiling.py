@@ -0,0 +1,229 @@
+import math
+import functools
+import numpy as np
+import scipy.signal
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def tile_positions(size, patch_size, overlap=0, padding=0):
+    """Calculate where the patches start along one axis, following the same rules used by
+       :func:`~data.data_2D_manipulation.crop_data_with_overlap` and
+       :func:`~data.data_3D_manipulation.crop_3D_data_with_overlap`: patches are placed every ``step`` pixels and the
+       last one is moved back so it does not go beyond the (padded) data.
+
+       Parameters
+       ----------
+       size : int
+           Size of the axis without padding.
+
+       patch_size : int
+           Size of the patches along the axis, including the padding.
+
+       overlap : float, optional
+           Minimum overlap between patches. The value must be on range ``[0, 1)``.
+
+       padding : int, optional
+           Padding added on each side of the axis.
+
+       Returns
+       -------
+       positions : 1D Numpy array
+           Start of each patch in the padded axis, which is also where its unpadded center starts in the original axis.
+
+       step : int
+           Distance between consecutive patches (except the last one).
+    """
+    step = int((patch_size-padding*2)*(1 if overlap == 0 else 1-overlap))
+    n = math.ceil(size/step)
+    last = 0 if n == 1 else (((n-1)*step)+patch_size)-(size+2*padding)
+    positions = np.arange(n)*step
+    positions[positions+patch_size >= size+2*padding] -= last
+    return positions, step
+
+
+def patch_grid(positions):
+    """Combine the positions of each axis into the coordinates of all the patches. The patches are sorted as the
+       nested loops of the crop functions do, i.e. the last axis changes first.
+
+       Parameters
+       ----------
+       positions : List of 1D Numpy arrays
+           Positions of the patches on each axis, as returned by :func:`~tile_positions`.
+
+       Returns
+       -------
+       coords : 2D Numpy array
+           Start of each patch. E.g. ``(num_of_patches, 3)`` for ``(z, y, x)`` positions.
+    """
+    grid = np.meshgrid(*positions, indexing='ij')
+    return np.stack([g.ravel() for g in grid], axis=-1)
+
+
+def extract_patches(data, positions, patch_shape):
+    """Extract the patches placed on the grid given by ``positions``. The patches are taken from a strided view of
+       ``data`` so they are copied only once, directly into the output array.
+
+       Parameters
+       ----------
+       data : Numpy array
+           Data to take the patches from, with the channels in the last axis. E.g. ``(z, y, x, channels)``.
+
+       positions : List of 1D Numpy arrays
+           Positions of the patches on each axis of ``data`` but the last one.
+
+       patch_shape : Tuple of ints
+           Shape of the patches on each axis of ``data`` but the last one. E.g. ``(z, y, x)``.
+
+       Returns
+       -------
+       patches : Numpy array
+           Patches. E.g. ``(num_of_patches, z, y, x, channels)``.
+    """
+    view = sliding_window_view(data, tuple(patch_shape)+(data.shape[-1],))
+    coords = patch_grid(positions)
+    return view[tuple(coords.T)+(0,)]
+
+
+cached_windows = dict()
+def blending_window(size, blending='none'):
+    """Create the 1D window used to weight the pixels of the patches when merging them. Patch windows are the outer
+       product of the window of each axis. The windows are cached, so they are calculated once per patch shape.
+
+       Parameters
+       ----------
+       size : int
+           Size of the patches along the axis.
+
+       blending : str, optional
+           Window to use. Options: ``'none'`` (all the pixels weight the same), ``'spline'`` (squared spline window, as
+           the one used in :mod:`~data.post_processing.smooth_tiled_predictions`) or ``'gaussian'`` (Gaussian window
+           with sigma of ``1/8`` of the size).
+
+       Returns
+       -------
+       window : 1D Numpy array
+           Weight of each pixel, with a maximum of ``1``.
+    """
+    if blending not in ['none', 'spline', 'gaussian']:
+        raise ValueError("'blending' must be one between ['none', 'spline', 'gaussian']")
+
+    key = (size, blending)
+    if key not in cached_windows:
+        if blending == 'none' or size == 1:
+            wind = np.ones(size)
+        elif blending == 'spline':
+            intersection = int(size/4)
+            tri = scipy.signal.windows.triang(size)
+            wind_outer = (abs(2*tri) ** 2)/2
+            wind_outer[intersection:-intersection] = 0
+            wind_inner = 1 - (abs(2*(tri - 1)) ** 2)/2
+            wind_inner[:intersection] = 0
+            wind_inner[-intersection:] = 0
+            wind = wind_inner + wind_outer
+        else:
+            center = (size-1)/2
+            wind = np.exp(-((np.arange(size)-center)**2)/(2*(size/8)**2))
+        wind = (wind/wind.max()).astype(np.float32)
+        # Avoid zero weights so all the pixels can be recovered
+        wind[wind == 0] = wind[wind > 0].min()
+        cached_windows[key] = wind
+    return cached_windows[key]
+
+
+def patch_window(patch_shape, blending='none'):
+    """Weight of each pixel of a patch when merging it, as the outer product of the windows of each axis (see
+       :func:`~blending_window`).
+
+       Parameters
+       ----------
+       patch_shape : Tuple of ints
+           Shape of the patches on each axis. E.g. ``(z, y, x)``.
+
+       blending : str, optional
+           Window to use. Options: ``'none'``, ``'spline'`` or ``'gaussian'``.
+
+       Returns
+       -------
+       window : Numpy array
+           Weight of each pixel. E.g. ``(z, y, x)``.
+    """
+    key = (tuple(patch_shape), blending)
+    if key not in cached_windows:
+        cached_windows[key] = functools.reduce(np.multiply.outer, [blending_window(p, blending) for p in patch_shape])
+    return cached_windows[key]
+
+
+def overlap_counter(positions, patch_shape, shape, blending='none'):
+    """Count how many patches cover each pixel, or the sum of their weights when blending them. As the patches are
+       placed on a grid and their windows are the outer product of the window of each axis, the count is the outer
+       product of the count of each axis.
+
+       Parameters
+       ----------
+       positions : List of 1D Numpy arrays
+           Positions of the patches on each axis.
+
+       patch_shape : Tuple of ints
+           Shape of the patches on each axis. E.g. ``(z, y, x)``.
+
+       shape : Tuple of ints
+           Shape of the merged data on each axis. E.g. ``(z, y, x)``.
+
+       blending : str, optional
+           Window used to weight the patches (see :func:`~blending_window`).
+
+       Returns
+       -------
+       counter : Numpy array
+           Number of patches, or sum of their weights, on each pixel. E.g. ``(z, y, x)``.
+    """
+    counts = []
+    for pos, p, s in zip(positions, patch_shape, shape):
+        c = np.zeros(s, dtype=np.float32)
+        wind = blending_window(p, blending)
+        for start in pos:
+            c[start:start+p] += wind
+        counts.append(c)
+    return functools.reduce(np.multiply.outer, counts)
+
+
+def merge_patches(patches, positions, shape, blending='none'):
+    """Merge the patches placed on the grid given by ``positions`` averaging the overlapping areas. The patches are
+       added in place into a single output array following the coordinates of :func:`~patch_grid`, and the overlap
+       count is calculated once per axis (see :func:`~overlap_counter`) instead of adding each patch to a counter
+       array.
+
+       Parameters
+       ----------
+       patches : Numpy array
+           Patches sorted as :func:`~patch_grid` does, with the channels in the last axis. E.g.
+           ``(num_of_patches, z, y, x, channels)``.
+
+       positions : List of 1D Numpy arrays
+           Positions of the patches on each axis.
+
+       shape : Tuple of ints
+           Shape of the merged data on each axis but the channels. E.g. ``(z, y, x)``.
+
+       blending : str, optional
+           Window used to weight the pixels of each patch, so the pixels close to the borders of the patches, which
+           are usually worse predicted, contribute less to the merged data. Options: ``'none'`` (plain average),
+           ``'spline'`` or ``'gaussian'`` (see :func:`~blending_window`).
+
+       Returns
+       -------
+       merged : Numpy array
+           Merged data as ``float32``. E.g. ``(z, y, x, channels)``.
+    """
+    patch_shape = patches.shape[1:-1]
+    wind = None if blending == 'none' else patch_window(patch_shape, blending)[...,None]
+    merged = np.zeros(tuple(shape)+(patches.shape[-1],), dtype=np.float32)
+    for patch, coord in zip(patches, patch_grid(positions).tolist()):
+        region = tuple(slice(c, c+p) for c, p in zip(coord, patch_shape))
+        if wind is None:
+            merged[region] += patch
+        else:
+            merged[region] += patch*wind
+
+    merged /= overlap_counter(positions, patch_shape, shape, blending)[...,None]
+    return merged
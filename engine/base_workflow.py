@@ -1,13 +1,18 @@
+import os
 import math
+import functools
 import numpy as np
 from tqdm import tqdm
 from abc import ABCMeta, abstractmethod
 
 from utils.util import pad_and_reflect, apply_binary_mask, save_tif, check_downsample_division
 from data.data_2D_manipulation import crop_data_with_overlap, merge_data_with_overlap
-from data.data_3D_manipulation import crop_3D_data_with_overlap, merge_3D_data_with_overlap
-from data.post_processing.post_processing import ensemble8_2d_predictions, ensemble16_3d_predictions
-from engine.metrics import jaccard_index_numpy, voc_calculation
+from data.data_3D_manipulation import (crop_3D_data_with_overlap, merge_3D_data_with_overlap,
+    crop_3D_data_with_overlap_by_batches, merge_3D_batch_with_overlap)
+from data.post_processing.post_processing import ensemble_predictions
+from engine.metrics import segmentation_metrics
+from engine.batch_predictor import BatchPredictor
+from engine.post_processing_pipeline import PostProcessingPipeline
 from data.post_processing import apply_post_processing
 
 class Base_Workflow(metaclass=ABCMeta):
@@ -39,165 +44,129 @@ class Base_Workflow(metaclass=ABCMeta):
         self.stats['iou_post'] = 0
         self.stats['ov_iou_post'] = 0
 
+        # Post-processing of each image that can run while the next images are predicted
+        self.post_pipeline = PostProcessingPipeline(cfg.TEST.POST_PROCESSING_WORKERS,
+            cfg.TEST.POST_PROCESSING_QUEUE_SIZE)
+
+
+    def predict_batch(self, X):
+        """Predict a batch of patches or images, using test-time augmentation if ``TEST.AUGMENTATION`` is set.
+
+           Parameters
+           ----------
+           X : 4D/5D Numpy array
+               Data to predict. E.g. ``(num_of_images, y, x, channels)`` for ``2D`` or
+               ``(num_of_images, z, y, x, channels)`` for ``3D``.
+
+           Returns
+           -------
+           pred : 4D/5D Numpy array
+               Predictions.
+        """
+        if self.cfg.TEST.AUGMENTATION:
+            return ensemble_predictions(X, batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
+                n_classes=self.cfg.MODEL.N_CLASSES,
+                pred_func=(lambda img_batch_subdiv: self.model.predict(img_batch_subdiv, verbose=0)))
+        return self.model.predict(X, verbose=0)
+
+    def process_sample(self, X, Y, filenames, predictor=None):
+        """Predict a sample and calculate its statistics.
+
+           Parameters
+           ----------
+           X : 4D/5D Numpy array
+               Data to predict. E.g. ``(1, y, x, channels)`` for ``2D`` or ``(1, z, y, x, channels)`` for ``3D``.
+
+           Y : 4D/5D Numpy array
+               Ground truth of ``X``. ``None`` if ``DATA.TEST.LOAD_GT`` is not set.
+
+           filenames : List of str
+               Filename of the sample.
+
+           predictor : BatchPredictor, optional
+               Predictor shared between samples, so the patches of several samples are predicted together. The
+               merge and the rest of the processing of the sample are done once all its patches are predicted, which
+               may happen when processing the following samples or on ``predictor.flush()``. If not provided the
+               sample is fully processed before returning.
+        """
+        own_predictor = predictor is None
+        if own_predictor:
+            predictor = BatchPredictor(self.predict_batch, self.cfg.TRAIN.BATCH_SIZE)
 
-    def process_sample(self, X, Y, filenames):
         #################
         ### PER PATCH ###
         #################
         if self.cfg.TEST.STATS.PER_PATCH:
+            _X, _Y = X, Y
             # Reflect data to complete the needed shape
+            reflected_orig_shape = None
             if self.cfg.DATA.REFLECT_TO_COMPLETE_SHAPE:
-                reflected_orig_shape = X.shape
-                X = np.expand_dims(pad_and_reflect(X[0], self.cfg.DATA.PATCH_SIZE, verbose=self.cfg.TEST.VERBOSE),0)
+                reflected_orig_shape = _X.shape
+                _X = np.expand_dims(pad_and_reflect(_X[0], self.cfg.DATA.PATCH_SIZE, verbose=self.cfg.TEST.VERBOSE),0)
                 if self.cfg.DATA.TEST.LOAD_GT:
-                    Y = np.expand_dims(pad_and_reflect(Y[0], self.cfg.DATA.PATCH_SIZE, verbose=self.cfg.TEST.VERBOSE),0)
+                    _Y = np.expand_dims(pad_and_reflect(_Y[0], self.cfg.DATA.PATCH_SIZE,
+                        verbose=self.cfg.TEST.VERBOSE),0)
 
-            original_data_shape = X.shape
+            original_data_shape = _X.shape
 
-            # Crop if necessary
             if self.cfg.PROBLEM.NDIM == '2D':
                 t_patch_size = self.cfg.DATA.PATCH_SIZE
             else:
                 t_patch_size = tuple(self.cfg.DATA.PATCH_SIZE[i] for i in [2, 1, 0, 3])
-            if X.shape[1:] != t_patch_size:
-                if self.cfg.PROBLEM.NDIM == '2D':
-                    obj = crop_data_with_overlap(X, self.cfg.DATA.PATCH_SIZE, data_mask=Y,
-                        overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
-                        verbose=self.cfg.TEST.VERBOSE)
-                    if self.cfg.DATA.TEST.LOAD_GT:
-                        X, Y = obj
-                    else:
-                        X = obj
-                    del obj
-                else:
-                    if self.cfg.DATA.TEST.LOAD_GT: Y = Y[0]
-                    if self.cfg.TEST.REDUCE_MEMORY:
-                        X = crop_3D_data_with_overlap(X[0], self.cfg.DATA.PATCH_SIZE,
-                            overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
-                            verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
-                        Y = crop_3D_data_with_overlap(Y, self.cfg.DATA.PATCH_SIZE,
-                            overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
-                            verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
-                    else:
-                        obj = crop_3D_data_with_overlap(X[0], self.cfg.DATA.PATCH_SIZE, data_mask=Y,
+
+            # Predict 3D volumes by batches to not keep all the patches in memory
+            if self.cfg.PROBLEM.NDIM == '3D' and self.cfg.TEST.STREAMING and _X.shape[1:] != t_patch_size:
+                pred, _Y = self.predict_3D_by_batches(_X, _Y, filenames)
+                del _X
+                self.process_merged_patches(pred, _Y, filenames, reflected_orig_shape)
+            else:
+                # Crop if necessary
+                if _X.shape[1:] != t_patch_size:
+                    if self.cfg.PROBLEM.NDIM == '2D':
+                        obj = crop_data_with_overlap(_X, self.cfg.DATA.PATCH_SIZE, data_mask=_Y,
                             overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
-                            verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                            verbose=self.cfg.TEST.VERBOSE)
                         if self.cfg.DATA.TEST.LOAD_GT:
-                            X, Y = obj
+                            _X, _Y = obj
                         else:
-                            X = obj
+                            _X = obj
                         del obj
-
-            # Evaluate each patch
-            if self.cfg.DATA.TEST.LOAD_GT and self.cfg.TEST.EVALUATE:
-                l = int(math.ceil(X.shape[0]/self.cfg.TRAIN.BATCH_SIZE))
-                for k in tqdm(range(l), leave=False):
-                    top = (k+1)*self.cfg.TRAIN.BATCH_SIZE if (k+1)*self.cfg.TRAIN.BATCH_SIZE < X.shape[0] else X.shape[0]
-                    score = self.model.evaluate(
-                        X[k*self.cfg.TRAIN.BATCH_SIZE:top], Y[k*self.cfg.TRAIN.BATCH_SIZE:top], verbose=0)
-                    self.stats['loss_per_crop'] += score[0]
-                    self.stats['iou_per_crop'] += score[1]
-            self.stats['patch_counter'] += X.shape[0]
-
-            # Predict each patch
-            pred = []
-            if self.cfg.TEST.AUGMENTATION:
-                for k in tqdm(range(X.shape[0]), leave=False):
-                    if self.cfg.PROBLEM.NDIM == '2D':
-                        p = ensemble8_2d_predictions(X[k], n_classes=self.cfg.MODEL.N_CLASSES,
-                                pred_func=(lambda img_batch_subdiv: self.model.predict(img_batch_subdiv)))
                     else:
-                        p = ensemble16_3d_predictions(X[k], batch_size_value=self.cfg.TRAIN.BATCH_SIZE,
-                                pred_func=(lambda img_batch_subdiv: self.model.predict(img_batch_subdiv)))
-                    pred.append(p)
-            else:
-                l = int(math.ceil(X.shape[0]/self.cfg.TRAIN.BATCH_SIZE))
-                for k in tqdm(range(l), leave=False):
-                    top = (k+1)*self.cfg.TRAIN.BATCH_SIZE if (k+1)*self.cfg.TRAIN.BATCH_SIZE < X.shape[0] else X.shape[0]
-                    p = self.model.predict(X[k*self.cfg.TRAIN.BATCH_SIZE:top], verbose=0)
-                    pred.append(p[0])
-
-            # Delete X as in 3D there is no full image 
-            if self.cfg.PROBLEM.NDIM == '3D': 
-                del X, p
-
-            # Reconstruct the predictions
-            pred = np.array(pred)
-            if original_data_shape[1:] != t_patch_size:
-                if self.cfg.PROBLEM.NDIM == '3D': original_data_shape = original_data_shape[1:]
-                f_name = merge_data_with_overlap if self.cfg.PROBLEM.NDIM == '2D' else merge_3D_data_with_overlap
-
-                if self.cfg.TEST.REDUCE_MEMORY:
-                    pred = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), padding=self.cfg.DATA.TEST.PADDING, 
-                        overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE)
-                    Y = f_name(Y, original_data_shape[:-1]+(Y.shape[-1],), padding=self.cfg.DATA.TEST.PADDING, 
-                        overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE)
-                else:
-                    obj = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), data_mask=_Y,
-                        padding=self.cfg.DATA.TEST.PADDING, overlap=self.cfg.DATA.TEST.OVERLAP,
-                        verbose=self.cfg.TEST.VERBOSE)
-                    if self.cfg.DATA.TEST.LOAD_GT:
-                        pred, _Y = obj
-                    else:
-                        pred = obj
-                    del obj
-            else:
-                pred = pred[0]
-
-            if self.cfg.DATA.REFLECT_TO_COMPLETE_SHAPE and self.cfg.PROBLEM.NDIM == '3D':
-                pred = pred[-reflected_orig_shape[1]:,-reflected_orig_shape[2]:,-reflected_orig_shape[3]:]
-                if Y is not None:
-                    Y = Y[-reflected_orig_shape[1]:,-reflected_orig_shape[2]:,-reflected_orig_shape[3]:]
-
-            # Argmax if needed
-            if self.cfg.MODEL.N_CLASSES > 1 and self.cfg.DATA.TEST.ARGMAX_TO_OUTPUT:
-                pred = np.expand_dims(np.argmax(pred,-1), -1)
-                if self.cfg.DATA.TEST.LOAD_GT: Y = np.expand_dims(np.argmax(Y,-1), -1)
-
-            # Apply mask
-            if self.cfg.TEST.APPLY_MASK:
-                pred = apply_binary_mask(pred, self.cfg.DATA.TEST.BINARY_MASKS)
-
-            # Save image
-            if self.cfg.PATHS.RESULT_DIR.PER_IMAGE != "":
-                save_tif(np.expand_dims(pred,0), self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filenames, verbose=self.cfg.TEST.VERBOSE)
-
-
-            #####################
-            ### MERGE PATCHES ###
-            #####################
-            if self.cfg.TEST.STATS.MERGE_PATCHES:
-                if self.cfg.DATA.TEST.LOAD_GT and self.cfg.DATA.CHANNELS != "Dv2":
-                    if Y.ndim > pred.ndim: Y = Y[0]
-                    if self.cfg.LOSS.TYPE != 'MASKED_BCE':
-                        _iou_per_image = jaccard_index_numpy((Y>0.5).astype(np.uint8), (pred>0.5).astype(np.uint8))
-                        _ov_iou_per_image = voc_calculation((Y>0.5).astype(np.uint8), (pred>0.5).astype(np.uint8),
-                                                        _iou_per_image)
-                    else:
-                        exclusion_mask = Y < 2
-                        binY = Y * exclusion_mask.astype( float )
-                        _iou_per_image = jaccard_index_numpy((binY>0.5).astype(np.uint8), (pred>0.5).astype(np.uint8))
-                        _ov_iou_per_image = voc_calculation((binY>0.5).astype(np.uint8), (pred>0.5).astype(np.uint8),
-                                                        _iou_per_image)
-                    self.stats['iou_per_image'] += _iou_per_image
-                    self.stats['ov_iou_per_image'] += _ov_iou_per_image
-
-                ############################
-                ### POST-PROCESSING (3D) ###
-                ############################
-                if self.post_processing and self.cfg.PROBLEM.NDIM == '3D':
-                    _iou_post, _ov_iou_post = apply_post_processing(self.cfg, pred, Y)
-                    self.stats['iou_post'] += _iou_post
-                    self.stats['ov_iou_post'] += _ov_iou_post
-                    if pred.ndim == 4 and self.cfg.PROBLEM.NDIM == '3D':
-                        save_tif(np.expand_dims(pred,0), self.cfg.PATHS.RESULT_DIR.PER_IMAGE_POST_PROCESSING,
-                                    filenames, verbose=self.cfg.TEST.VERBOSE)
-                    else:
-                        save_tif(pred, self.cfg.PATHS.RESULT_DIR.PER_IMAGE_POST_PROCESSING, filenames,
-                                    verbose=self.cfg.TEST.VERBOSE)
-
-            self.after_merge_patches(pred, Y, filenames)
-
+                        if self.cfg.DATA.TEST.LOAD_GT: _Y = _Y[0]
+                        if self.cfg.TEST.REDUCE_MEMORY:
+                            _X = crop_3D_data_with_overlap(_X[0], self.cfg.DATA.PATCH_SIZE,
+                                overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
+                                verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                            if self.cfg.DATA.TEST.LOAD_GT:
+                                _Y = crop_3D_data_with_overlap(_Y, self.cfg.DATA.PATCH_SIZE,
+                                    overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
+                                    verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                        else:
+                            obj = crop_3D_data_with_overlap(_X[0], self.cfg.DATA.PATCH_SIZE, data_mask=_Y,
+                                overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
+                                verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
+                            if self.cfg.DATA.TEST.LOAD_GT:
+                                _X, _Y = obj
+                            else:
+                                _X = obj
+                            del obj
+
+                # Evaluate each patch
+                if self.cfg.DATA.TEST.LOAD_GT and self.cfg.TEST.EVALUATE:
+                    l = int(math.ceil(_X.shape[0]/self.cfg.TRAIN.BATCH_SIZE))
+                    for k in tqdm(range(l), leave=False):
+                        top = min((k+1)*self.cfg.TRAIN.BATCH_SIZE, _X.shape[0])
+                        score = self.model.evaluate(
+                            _X[k*self.cfg.TRAIN.BATCH_SIZE:top], _Y[k*self.cfg.TRAIN.BATCH_SIZE:top], verbose=0)
+                        self.stats['loss_per_crop'] += score[0]
+                        self.stats['iou_per_crop'] += score[1]
+                self.stats['patch_counter'] += _X.shape[0]
+
+                # Predict each patch. The merge is done once all of them are predicted
+                predictor.add(_X, functools.partial(self.merge_predicted_patches, Y=_Y, filenames=filenames,
+                    original_data_shape=original_data_shape, t_patch_size=t_patch_size,
+                    reflected_orig_shape=reflected_orig_shape))
+                del _X, _Y
 
         ##################
         ### FULL IMAGE ###
@@ -213,40 +182,210 @@ class Base_Workflow(metaclass=ABCMeta):
                 self.stats['loss'] += score[0]
 
             # Make the prediction
-            if self.cfg.TEST.AUGMENTATION:
-                pred = ensemble8_2d_predictions(
-                    X[0], pred_func=(lambda img_batch_subdiv: self.model.predict(img_batch_subdiv)),
-                    n_classes=self.cfg.MODEL.N_CLASSES)
-                pred = np.expand_dims(pred, 0)
-            else:
-                pred = self.model.predict(X, verbose=0)
+            predictor.add(X, functools.partial(self.process_full_image, Y=Y, filenames=filenames,
+                o_test_shape=o_test_shape))
 
-            # Recover original shape if padded with check_downsample_division
-            pred = pred[:,:o_test_shape[1],:o_test_shape[2]]
-            if self.cfg.DATA.TEST.LOAD_GT: Y = Y[:,:o_test_shape[1],:o_test_shape[2]]
+        if own_predictor:
+            predictor.flush()
 
-            # Save image
-            if pred.ndim == 4 and self.cfg.PROBLEM.NDIM == '3D':
-                save_tif(np.expand_dims(pred,0), self.cfg.PATHS.RESULT_DIR.FULL_IMAGE, filenames,
-                            verbose=self.cfg.TEST.VERBOSE)
+    def merge_predicted_patches(self, pred, Y, filenames, original_data_shape, t_patch_size,
+        reflected_orig_shape=None):
+        """Merge the predicted patches of a sample and continue with its processing (see
+           :func:`~process_merged_patches`).
+
+           Parameters
+           ----------
+           pred : 4D/5D Numpy array
+               Predicted patches.
+
+           Y : 4D/5D Numpy array
+               Ground truth patches. ``None`` if ``DATA.TEST.LOAD_GT`` is not set.
+
+           filenames : List of str
+               Filename of the sample.
+
+           original_data_shape : Tuple of ints
+               Shape of the sample before cropping it.
+
+           t_patch_size : Tuple of ints
+               Shape of the patches, in the same axis order as ``original_data_shape``.
+
+           reflected_orig_shape : Tuple of ints, optional
+               Shape of the sample before reflecting it to complete the patch shape.
+        """
+        if original_data_shape[1:] != t_patch_size:
+            if self.cfg.PROBLEM.NDIM == '3D': original_data_shape = original_data_shape[1:]
+            f_name = merge_data_with_overlap if self.cfg.PROBLEM.NDIM == '2D' else merge_3D_data_with_overlap
+
+            if self.cfg.TEST.REDUCE_MEMORY or not self.cfg.DATA.TEST.LOAD_GT:
+                pred = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), padding=self.cfg.DATA.TEST.PADDING,
+                    overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE,
+                    blending=self.cfg.DATA.TEST.MERGE_BLENDING)
+                if self.cfg.DATA.TEST.LOAD_GT:
+                    Y = f_name(Y, original_data_shape[:-1]+(Y.shape[-1],), padding=self.cfg.DATA.TEST.PADDING,
+                        overlap=self.cfg.DATA.TEST.OVERLAP, verbose=self.cfg.TEST.VERBOSE)
             else:
-                save_tif(pred, self.cfg.PATHS.RESULT_DIR.FULL_IMAGE, filenames, verbose=self.cfg.TEST.VERBOSE)
+                pred, Y = f_name(pred, original_data_shape[:-1]+(pred.shape[-1],), data_mask=Y,
+                    padding=self.cfg.DATA.TEST.PADDING, overlap=self.cfg.DATA.TEST.OVERLAP,
+                    verbose=self.cfg.TEST.VERBOSE, blending=self.cfg.DATA.TEST.MERGE_BLENDING)
+        else:
+            pred = pred[0]
+
+        self.process_merged_patches(pred, Y, filenames, reflected_orig_shape)
+
+    def process_merged_patches(self, pred, Y, filenames, reflected_orig_shape=None):
+        """Save the merged prediction of a sample, calculate its statistics and apply the post-processing.
+
+           Parameters
+           ----------
+           pred : 3D/4D Numpy array
+               Merged prediction. E.g. ``(y, x, channels)`` for ``2D`` or ``(z, y, x, channels)`` for ``3D``.
+
+           Y : 3D/4D Numpy array
+               Merged ground truth. ``None`` if ``DATA.TEST.LOAD_GT`` is not set.
+
+           filenames : List of str
+               Filename of the sample.
+
+           reflected_orig_shape : Tuple of ints, optional
+               Shape of the sample before reflecting it to complete the patch shape.
+        """
+        if self.cfg.DATA.REFLECT_TO_COMPLETE_SHAPE and self.cfg.PROBLEM.NDIM == '3D':
+            pred = pred[-reflected_orig_shape[1]:,-reflected_orig_shape[2]:,-reflected_orig_shape[3]:]
+            if Y is not None:
+                Y = Y[-reflected_orig_shape[1]:,-reflected_orig_shape[2]:,-reflected_orig_shape[3]:]
+
+        # Argmax if needed
+        if self.cfg.MODEL.N_CLASSES > 1 and self.cfg.DATA.TEST.ARGMAX_TO_OUTPUT:
+            pred = np.expand_dims(np.argmax(pred,-1), -1)
+            if self.cfg.DATA.TEST.LOAD_GT: Y = np.expand_dims(np.argmax(Y,-1), -1)
+
+        # Apply mask
+        if self.cfg.TEST.APPLY_MASK:
+            pred = apply_binary_mask(pred, self.cfg.DATA.TEST.BINARY_MASKS)
+
+        # Save image
+        if self.cfg.PATHS.RESULT_DIR.PER_IMAGE != "":
+            save_tif(np.expand_dims(pred,0), self.cfg.PATHS.RESULT_DIR.PER_IMAGE, filenames, verbose=self.cfg.TEST.VERBOSE)
+
+
+        #####################
+        ### MERGE PATCHES ###
+        #####################
+        if self.cfg.TEST.STATS.MERGE_PATCHES:
+            if self.cfg.DATA.TEST.LOAD_GT and self.cfg.DATA.CHANNELS != "Dv2":
+                if Y.ndim > pred.ndim: Y = Y[0]
+                if self.cfg.LOSS.TYPE != 'MASKED_BCE':
+                    metrics = segmentation_metrics(Y, pred, t=0.5)
+                else:
+                    # Pixels with value 2 are excluded, i.e. considered background
+                    metrics = segmentation_metrics((Y>0.5) & (Y<2), pred, t=0.5)
+                self.stats['iou_per_image'] += metrics['iou']
+                self.stats['ov_iou_per_image'] += metrics['ov_iou']
+
+            ############################
+            ### POST-PROCESSING (3D) ###
+            ############################
+            if self.post_processing and self.cfg.PROBLEM.NDIM == '3D':
+                _iou_post, _ov_iou_post = apply_post_processing(self.cfg, pred, Y)
+                self.stats['iou_post'] += _iou_post
+                self.stats['ov_iou_post'] += _ov_iou_post
+                if pred.ndim == 4 and self.cfg.PROBLEM.NDIM == '3D':
+                    save_tif(np.expand_dims(pred,0), self.cfg.PATHS.RESULT_DIR.PER_IMAGE_POST_PROCESSING,
+                                filenames, verbose=self.cfg.TEST.VERBOSE)
+                else:
+                    save_tif(pred, self.cfg.PATHS.RESULT_DIR.PER_IMAGE_POST_PROCESSING, filenames,
+                                verbose=self.cfg.TEST.VERBOSE)
 
-            # Argmax if needed
-            if self.cfg.MODEL.N_CLASSES > 1 and self.cfg.DATA.TEST.ARGMAX_TO_OUTPUT:
-                pred = np.expand_dims(np.argmax(pred,-1), -1)
-                if self.cfg.DATA.TEST.LOAD_GT: Y = np.expand_dims(np.argmax(Y,-1), -1)
+        self.after_merge_patches(pred, Y, filenames)
 
-            if self.cfg.DATA.TEST.LOAD_GT:
-                score[1] = jaccard_index_numpy((Y>0.5).astype(np.uint8), (pred>0.5).astype(np.uint8))
-                self.stats['iou'] += score[1]
-                self.stats['ov_iou'] += voc_calculation((Y>0.5).astype(np.uint8), (pred>0.5).astype(np.uint8), score[1])
+    def process_full_image(self, pred, Y, filenames, o_test_shape):
+        """Save the prediction of a full image and calculate its statistics.
+
+           Parameters
+           ----------
+           pred : 4D Numpy array
+               Prediction of the image padded by :func:`~utils.util.check_downsample_division`. E.g.
+               ``(1, y, x, channels)``.
+
+           Y : 4D Numpy array
+               Ground truth of the image, padded as ``pred``. ``None`` if ``DATA.TEST.LOAD_GT`` is not set.
+
+           filenames : List of str
+               Filename of the image.
+
+           o_test_shape : Tuple of ints
+               Shape of the image before padding it.
+        """
+        # Recover original shape if padded with check_downsample_division
+        pred = pred[:,:o_test_shape[1],:o_test_shape[2]]
+        if self.cfg.DATA.TEST.LOAD_GT: Y = Y[:,:o_test_shape[1],:o_test_shape[2]]
+
+        # Save image
+        if pred.ndim == 4 and self.cfg.PROBLEM.NDIM == '3D':
+            save_tif(np.expand_dims(pred,0), self.cfg.PATHS.RESULT_DIR.FULL_IMAGE, filenames,
+                        verbose=self.cfg.TEST.VERBOSE)
+        else:
+            save_tif(pred, self.cfg.PATHS.RESULT_DIR.FULL_IMAGE, filenames, verbose=self.cfg.TEST.VERBOSE)
+
+        # Argmax if needed
+        if self.cfg.MODEL.N_CLASSES > 1 and self.cfg.DATA.TEST.ARGMAX_TO_OUTPUT:
+            pred = np.expand_dims(np.argmax(pred,-1), -1)
+            if self.cfg.DATA.TEST.LOAD_GT: Y = np.expand_dims(np.argmax(Y,-1), -1)
+
+        if self.cfg.DATA.TEST.LOAD_GT:
+            metrics = segmentation_metrics(Y, pred, t=0.5)
+            self.stats['iou'] += metrics['iou']
+            self.stats['ov_iou'] += metrics['ov_iou']
+
+        if self.cfg.TEST.STATS.FULL_IMG and self.cfg.PROBLEM.NDIM == '2D' and self.post_processing:
+            self.all_pred.append(pred)
+            if self.cfg.DATA.TEST.LOAD_GT: self.all_gt.append(Y)
+
+        self.after_full_image(pred, Y, filenames)
+
+    def predict_3D_by_batches(self, X, Y, filenames):
+        """Predict a 3D volume by batches of patches, adding each batch to the output volume as soon as it is
+           predicted. Only the output volume, its overlap counter and one batch are kept in memory.
+        """
+        if self.cfg.DATA.TEST.LOAD_GT: Y = Y[0]
+        batches = crop_3D_data_with_overlap_by_batches(X[0], self.cfg.DATA.PATCH_SIZE, self.cfg.TRAIN.BATCH_SIZE,
+            data_mask=Y if self.cfg.DATA.TEST.LOAD_GT else None, overlap=self.cfg.DATA.TEST.OVERLAP,
+            padding=self.cfg.DATA.TEST.PADDING, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING,
+            verbose=self.cfg.TEST.VERBOSE)
+
+        pred, ov_map_counter = None, None
+        for batch in tqdm(batches, leave=False):
+            coords, batch_x = batch[0], batch[1]
+
+            # Evaluate each patch
+            if self.cfg.DATA.TEST.LOAD_GT and self.cfg.TEST.EVALUATE:
+                score = self.model.evaluate(batch_x, batch[2], verbose=0)
+                self.stats['loss_per_crop'] += score[0]
+                self.stats['iou_per_crop'] += score[1]
+            self.stats['patch_counter'] += batch_x.shape[0]
+
+            # Predict each patch
+            p = self.predict_batch(batch_x)
+
+            # Create the output volume once the number of output channels is known
+            if pred is None:
+                out_shape = X.shape[1:-1]+(p.shape[-1],)
+                if self.cfg.TEST.STREAMING_MEMMAP:
+                    os.makedirs(self.cfg.PATHS.STREAMING_DIR, exist_ok=True)
+                    f = os.path.join(self.cfg.PATHS.STREAMING_DIR, os.path.splitext(filenames[0])[0]+'.npy')
+                    pred = np.lib.format.open_memmap(f, mode='w+', dtype=np.float32, shape=out_shape)
+                else:
+                    pred = np.zeros(out_shape, dtype=np.float32)
+                ov_map_counter = np.zeros(out_shape[:-1], dtype=np.float32)
 
-            if self.cfg.TEST.STATS.FULL_IMG and self.cfg.PROBLEM.NDIM == '2D' and self.post_processing:
-                self.all_pred.append(pred)
-                if self.cfg.DATA.TEST.LOAD_GT: self.all_gt.append(Y)
+            merge_3D_batch_with_overlap(pred, ov_map_counter, p, coords, padding=self.cfg.DATA.TEST.PADDING,
+                blending=self.cfg.DATA.TEST.MERGE_BLENDING)
 
-            self.after_full_image(pred, Y, filenames)
+        # Average the overlapping areas slice by slice to not create a copy of the volume
+        for z in range(pred.shape[0]):
+            pred[z] /= ov_map_counter[z][...,None]
+        return pred, Y
 
     def normalize_stats(self, image_counter):
         # Per crop
@@ -0,0 +1,117 @@
+import time
+import numpy as np
+
+
+class BatchPredictor():
+    """Predict the patches (or full images) of several samples together in batches of a fixed size. The items of each
+       sample are queued and predicted as soon as a full batch of items with the same shape is available, so the
+       patches of consecutive samples share predict calls instead of ending each sample with a partial batch. When
+       all the items of a sample are predicted its callback is called with their predictions, so the merge and
+       post-processing of the sample can be done.
+
+       Parameters
+       ----------
+       pred_func : function
+           Function that predicts a batch of items. E.g. ``lambda x: model.predict(x, verbose=0)``.
+
+       batch_size : int, optional
+           Number of items to predict on each call to ``pred_func``.
+    """
+    def __init__(self, pred_func, batch_size=1):
+        self.pred_func = pred_func
+        self.batch_size = batch_size
+        # Items waiting to be predicted, grouped by their shape. Each entry is [sample id, first item left, items]
+        self.queues = {}
+        # Predictions of the samples not finished yet
+        self.samples = {}
+        self.next_id = 0
+
+        self.n_samples = 0
+        self.n_items = 0
+        self.n_batches = 0
+        self.predict_time = 0
+        self.start_time = None
+
+    def add(self, data, callback):
+        """Queue the items of a sample to be predicted. Full batches are predicted right away, so the callback of
+           this or previous samples may be called before returning.
+
+           Parameters
+           ----------
+           data : Numpy array
+               Items to predict, stacked on the first axis. E.g. ``(num_of_patches, y, x, channels)``.
+
+           callback : function
+               Function called with the predictions of all the items of ``data``, in the same order, once they are
+               predicted.
+        """
+        if self.start_time is None: self.start_time = time.perf_counter()
+
+        sample_id = self.next_id
+        self.next_id += 1
+        self.samples[sample_id] = {'pred': None, 'total': len(data), 'left': len(data), 'callback': callback}
+
+        queue = self.queues.setdefault(data.shape[1:], [])
+        queue.append([sample_id, 0, data])
+        while sum(len(d)-first for _, first, d in queue) >= self.batch_size:
+            self._predict(queue)
+
+    def flush(self):
+        """Predict all the items queued, even if they do not fill a batch."""
+        for queue in self.queues.values():
+            while len(queue) > 0:
+                self._predict(queue)
+
+    def _predict(self, queue):
+        """Predict the next batch of ``queue`` and route the predictions back to their samples."""
+        pieces, n = [], 0
+        while len(queue) > 0 and n < self.batch_size:
+            sample_id, first, data = queue[0]
+            take = min(self.batch_size-n, len(data)-first)
+            pieces.append((sample_id, first, take, data[first:first+take]))
+            n += take
+            if first+take == len(data):
+                queue.pop(0)
+            else:
+                queue[0][1] = first+take
+        batch = pieces[0][3] if len(pieces) == 1 else np.concatenate([p[3] for p in pieces])
+
+        start = time.perf_counter()
+        pred = self.pred_func(batch)
+        self.predict_time += time.perf_counter()-start
+        self.n_items += n
+        self.n_batches += 1
+
+        offset = 0
+        for sample_id, first, take, _ in pieces:
+            sample = self.samples[sample_id]
+            if take == sample['total']:
+                sample['pred'] = pred[offset:offset+take]
+            else:
+                if sample['pred'] is None:
+                    sample['pred'] = np.zeros((sample['total'],)+pred.shape[1:], dtype=pred.dtype)
+                sample['pred'][first:first+take] = pred[offset:offset+take]
+            offset += take
+
+            sample['left'] -= take
+            if sample['left'] == 0:
+                del self.samples[sample_id]
+                self.n_samples += 1
+                sample['callback'](sample['pred'])
+
+    def print_throughput(self, image_counter, patch_counter):
+        """Print the number of images and patches processed per second since the first sample was added.
+
+           Parameters
+           ----------
+           image_counter : int
+               Number of images processed.
+
+           patch_counter : int
+               Number of patches processed.
+        """
+        elapsed = 0 if self.start_time is None else time.perf_counter()-self.start_time
+        if elapsed == 0: return
+        print("Inference throughput: {:.2f} images/s - {:.2f} patches/s ({} images and {} patches in {:.2f}s)"
+              .format(image_counter/elapsed, patch_counter/elapsed, image_counter, patch_counter, elapsed))
+        print("Predict calls: {} ({} items, {:.2f}s)".format(self.n_batches, self.n_items, self.predict_time))
@@ -85,7 +85,8 @@ class Detection(Base_Workflow):
                         v_size = (1,self.cfg.TEST.DET_VOXEL_SIZE[1], self.cfg.TEST.DET_VOXEL_SIZE[0])
                     print("Detection (class "+str(ch+1)+")")
                     d_metrics = detection_metrics(gt_coordinates, pred_coordinates, tolerance=self.cfg.TEST.DET_TOLERANCE[ch],
-                                                  voxel_size=v_size, verbose=self.cfg.TEST.VERBOSE)
+                                                  voxel_size=v_size, verbose=self.cfg.TEST.VERBOSE,
+                                                  approx=self.cfg.TEST.DET_APPROX_MATCHING)
                     print("Detection metrics: {}".format(d_metrics))
                     all_channel_d_metrics[0] += d_metrics[1]
                     all_channel_d_metrics[1] += d_metrics[3]
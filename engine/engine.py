@@ -3,10 +3,14 @@ import numpy as np
 from tqdm import tqdm
 
 from utils.util import check_masks, create_plots, load_data_from_dir, load_3d_images_from_dir
+from utils.callbacks import GeneratorEpochEnd, PipelineTimings
 from data import data_checks
 from data.data_2D_manipulation import load_and_prepare_2D_train_data, load_data_classification
 from data.data_3D_manipulation import load_and_prepare_3D_data
+from data.data_cache import load_cached_data
 from data.generators import create_train_val_augmentors, create_test_augmentor, check_generator_consistence
+from data.generators.batch_loader import BatchLoader
+from data.generators.tf_data import create_tf_dataset, PipelineTimer
 from models import build_model
 from engine import build_callbacks, prepare_optimizer
 from engine.semantic_seg import Semantic_Segmentation
@@ -14,6 +18,7 @@ from engine.instance_seg import prepare_instance_data, Instance_Segmentation
 from engine.detection import Detection
 from engine.classification import Classification
 from engine.super_resolution import Super_resolution
+from engine.batch_predictor import BatchPredictor
 
 class Engine(object):
 
@@ -71,18 +76,20 @@ class Engine(object):
         if cfg.TRAIN.ENABLE:
             if cfg.PROBLEM.TYPE in ['SEMANTIC_SEG', 'INSTANCE_SEG', 'DETECTION', 'SUPER_RESOLUTION']:
                 if cfg.DATA.TRAIN.IN_MEMORY:
+                    train_cache_dir = os.path.join(cfg.PATHS.DATA_CACHE, 'train') if cfg.DATA.TRAIN.CACHE else None
                     if cfg.PROBLEM.NDIM == '2D':
                         objs = load_and_prepare_2D_train_data(cfg.DATA.TRAIN.PATH, cfg.DATA.TRAIN.MASK_PATH,
                             val_split=cfg.DATA.VAL.SPLIT_TRAIN, seed=cfg.SYSTEM.SEED, shuffle_val=cfg.DATA.VAL.RANDOM,
                             random_crops_in_DA=cfg.DATA.EXTRACT_RANDOM_PATCH, crop_shape=cfg.DATA.PATCH_SIZE,
                             ov=cfg.DATA.TRAIN.OVERLAP, padding=cfg.DATA.TRAIN.PADDING, check_crop=cfg.DATA.TRAIN.CHECK_CROP,
-                            check_crop_path=cfg.PATHS.CROP_CHECKS, reflect_to_complete_shape=cfg.DATA.REFLECT_TO_COMPLETE_SHAPE)
+                            check_crop_path=cfg.PATHS.CROP_CHECKS, reflect_to_complete_shape=cfg.DATA.REFLECT_TO_COMPLETE_SHAPE,
+                            cache_dir=train_cache_dir)
                     else:
                         objs = load_and_prepare_3D_data(cfg.DATA.TRAIN.PATH, cfg.DATA.TRAIN.MASK_PATH,
                             val_split=cfg.DATA.VAL.SPLIT_TRAIN, seed=cfg.SYSTEM.SEED, shuffle_val=cfg.DATA.VAL.RANDOM,
                             random_crops_in_DA=cfg.DATA.EXTRACT_RANDOM_PATCH, crop_shape=cfg.DATA.PATCH_SIZE,
                             ov=cfg.DATA.TRAIN.OVERLAP, padding=cfg.DATA.TRAIN.PADDING,
-                            reflect_to_complete_shape=cfg.DATA.REFLECT_TO_COMPLETE_SHAPE)
+                            reflect_to_complete_shape=cfg.DATA.REFLECT_TO_COMPLETE_SHAPE, cache_dir=train_cache_dir)
 
                     if cfg.DATA.VAL.FROM_TRAIN:
                         X_train, Y_train, X_val, Y_val, self.train_filenames = objs
@@ -100,7 +107,16 @@ class Engine(object):
                 ### VALIDATION ###
                 ##################
                 if not cfg.DATA.VAL.FROM_TRAIN:
-                    if cfg.DATA.VAL.IN_MEMORY:
+                    cached = None
+                    if cfg.DATA.VAL.IN_MEMORY and cfg.DATA.VAL.CACHE:
+                        cached = load_cached_data(os.path.join(cfg.PATHS.DATA_CACHE, 'val'), cfg.DATA.VAL.PATH,
+                            cfg.DATA.VAL.MASK_PATH, is_3d=(cfg.PROBLEM.NDIM == '3D'), crop=True,
+                            crop_shape=cfg.DATA.PATCH_SIZE, overlap=cfg.DATA.VAL.OVERLAP, padding=cfg.DATA.VAL.PADDING,
+                            reflect_to_complete_shape=cfg.DATA.REFLECT_TO_COMPLETE_SHAPE)
+
+                    if cached is not None:
+                        X_val, Y_val = cached[:2]
+                    elif cfg.DATA.VAL.IN_MEMORY:
                         f_name = load_data_from_dir if cfg.PROBLEM.NDIM == '2D' else load_3d_images_from_dir
                         X_val, _, _ = f_name(cfg.DATA.VAL.PATH, crop=True, crop_shape=cfg.DATA.PATCH_SIZE,
                                              overlap=cfg.DATA.VAL.OVERLAP, padding=cfg.DATA.VAL.PADDING,
@@ -195,9 +211,40 @@ class Engine(object):
             self.model.load_weights(self.cfg.PATHS.CHECKPOINT_FILE)
 
         self.callbacks = build_callbacks(self.cfg)
-        self.results = self.model.fit(self.train_generator, validation_data=self.val_generator,
+
+        train_generator, val_generator = self.train_generator, self.val_generator
+        if self.cfg.DATA.TF_DATA.ENABLE:
+            print("Creating tf.data pipelines . . .")
+            timers = [None, None]
+            if self.cfg.DATA.TF_DATA.TIMINGS:
+                timers = [PipelineTimer("Train"), PipelineTimer("Validation")]
+            train_generator = create_tf_dataset(self.train_generator,
+                num_parallel_calls=self.cfg.DATA.TF_DATA.NUM_PARALLEL_CALLS, timer=timers[0])
+            snapshot_dir = self.cfg.PATHS.TF_DATA_SNAPSHOT if self.cfg.DATA.TF_DATA.SNAPSHOT else None
+            val_generator = create_tf_dataset(self.val_generator,
+                num_parallel_calls=self.cfg.DATA.TF_DATA.NUM_PARALLEL_CALLS, cache=self.cfg.DATA.TF_DATA.CACHE,
+                snapshot_dir=snapshot_dir, timer=timers[1])
+            self.callbacks.append(GeneratorEpochEnd([self.train_generator, self.val_generator]))
+            if self.cfg.DATA.TF_DATA.TIMINGS:
+                self.callbacks.append(PipelineTimings(timers))
+        elif self.cfg.SYSTEM.NUM_WORKERS > 1:
+            print("Creating the batches with {} workers ({} mode)".format(self.cfg.SYSTEM.NUM_WORKERS,
+                  self.cfg.SYSTEM.WORKERS_MODE))
+            train_generator = BatchLoader(self.train_generator, workers=self.cfg.SYSTEM.NUM_WORKERS,
+                prefetch=self.cfg.SYSTEM.PREFETCH_BATCHES, mode=self.cfg.SYSTEM.WORKERS_MODE)
+            val_generator = BatchLoader(self.val_generator, workers=self.cfg.SYSTEM.NUM_WORKERS,
+                prefetch=self.cfg.SYSTEM.PREFETCH_BATCHES, mode=self.cfg.SYSTEM.WORKERS_MODE)
+
+        # The BatchLoader prepares the batches in order, so Keras must not shuffle them. The samples are shuffled by the
+        # generators instead, with AUGMENTOR.SHUFFLE_TRAIN_DATA_EACH_EPOCH
+        self.results = self.model.fit(train_generator, validation_data=val_generator,
             validation_steps=len(self.val_generator), steps_per_epoch=len(self.train_generator),
-            epochs=self.cfg.TRAIN.EPOCHS, callbacks=self.callbacks)
+            epochs=self.cfg.TRAIN.EPOCHS, callbacks=self.callbacks,
+            shuffle=not isinstance(train_generator, BatchLoader))
+
+        if isinstance(train_generator, BatchLoader):
+            train_generator.stop()
+            val_generator.stop()
 
         create_plots(self.results, self.job_identifier, self.cfg.PATHS.CHARTS, metric=self.metric)
 
@@ -233,6 +280,9 @@ class Engine(object):
               "###############\n")
         print("Making predictions on test data . . .")
 
+        # Patches are predicted in batches shared between images if TEST.BATCH_ACROSS_IMAGES is set
+        predictor = BatchPredictor(workflow.predict_batch, self.cfg.TRAIN.BATCH_SIZE)
+
         # Process all the images
         it = iter(self.test_generator)
         for i in tqdm(range(len(self.test_generator))):
@@ -267,10 +317,14 @@ class Engine(object):
                         del Y
 
                 # Process each image separately
-                workflow.process_sample(_X, _Y, self.test_filenames[(i*l_X)+j:(i*l_X)+j+1])
+                workflow.process_sample(_X, _Y, self.test_filenames[(i*l_X)+j:(i*l_X)+j+1], predictor=predictor)
+                if not self.cfg.TEST.BATCH_ACROSS_IMAGES:
+                    predictor.flush()
 
                 image_counter += 1
         del _X, _Y
+        predictor.flush()
+        workflow.post_pipeline.shutdown()
 
         workflow.after_all_images(Y)
 
@@ -289,4 +343,7 @@ class Engine(object):
 
         workflow.print_stats(image_counter)
 
+        patch_counter = workflow.stats['patch_counter'] if self.cfg.TEST.STATS.PER_PATCH else predictor.n_items
+        predictor.print_throughput(image_counter, patch_counter)
+
 
@@ -1,13 +1,13 @@
 import os
-import h5py
 import numpy as np
 from skimage.io import imread
 
 from data.post_processing.post_processing import (bc_watershed,bcd_watershed, bdv2_watershed, calculate_optimal_mw_thresholds,
                                                   voronoi_on_mask_2)
+from data.post_processing.chunked_watershed import chunked_watershed
 from data import create_instance_channels, create_test_instance_channels
 from utils.util import save_tif, wrapper_matching_dataset_lazy, wrapper_matching_segCompare
-from utils.matching import matching, match_using_segCompare
+from utils.matching import matching, match_using_segCompare, sparse_label_overlap, average_precision
 
 from engine.base_workflow import Base_Workflow
 
@@ -32,7 +32,8 @@ class Instance_Segmentation(Base_Workflow):
             obj = calculate_optimal_mw_thresholds(self.model, self.cfg.DATA.VAL.PATH,
                 self.orig_val_mask_path, self.cfg.DATA.PATCH_SIZE, self.cfg.DATA.CHANNELS,
                 self.cfg.DATA.VAL.MASK_PATH, self.cfg.DATA.REMOVE_SMALL_OBJ, bin_mask,
-                chart_dir=self.cfg.PATHS.CHARTS, verbose=self.cfg.TEST.VERBOSE)
+                chart_dir=self.cfg.PATHS.CHARTS, verbose=self.cfg.TEST.VERBOSE, batch_size=self.cfg.TRAIN.BATCH_SIZE,
+                workers=self.cfg.DATA.MW_OPTIMIZE_WORKERS)
             if self.cfg.DATA.CHANNELS == "BCD":
                 self.th1_opt, self.th2_opt, self.th3_opt, self.th4_opt, self.th5_opt = obj
             else:
@@ -43,6 +44,28 @@ class Instance_Segmentation(Base_Workflow):
             self.th4_opt, self.th5_opt = self.cfg.DATA.MW_TH4, self.cfg.DATA.MW_TH5
             
     def after_merge_patches(self, pred, Y, filenames):
+        self.post_pipeline.submit(self.instance_post_processing, pred, filenames, callback=self.store_instance_stats)
+
+    def instance_post_processing(self, pred, filenames):
+        """Create the instances of an image with watershed and calculate their statistics. It may run in a thread of
+           ``self.post_pipeline``, so it does not modify ``self``: the results are stored by
+           :func:`~store_instance_stats`.
+
+           Parameters
+           ----------
+           pred : 3D/4D Numpy array
+               Merged prediction. E.g. ``(y, x, channels)`` for ``2D`` or ``(z, y, x, channels)`` for ``3D``.
+
+           filenames : List of str
+               Filename of the image.
+
+           Returns
+           -------
+           results : dict
+               Statistics of the image.
+        """
+        results = {'mAP_50_total': 0, 'mAP_75_total': 0, 'mAP_50_total_vor': 0, 'mAP_75_total_vor': 0}
+
         #############################
         ### INSTANCE SEGMENTATION ###
         #############################
@@ -50,7 +73,18 @@ class Instance_Segmentation(Base_Workflow):
             print("Creating instances with watershed . . .")
             w_dir = os.path.join(self.cfg.PATHS.WATERSHED_DIR, filenames[0])
             check_wa = w_dir if self.cfg.DATA.CHECK_MW else None
-            if self.cfg.DATA.CHANNELS in ["BC", "BCM"]:
+            if len(self.cfg.DATA.MW_CHUNK_SHAPE) > 0:
+                if self.cfg.DATA.CHANNELS in ["BC", "BCM"]:
+                    mode, ths = 'BC', {'thres1': self.th1_opt, 'thres2': self.th2_opt, 'thres3': self.th3_opt}
+                elif self.cfg.DATA.CHANNELS == "BCD":
+                    mode, ths = 'BCD', {'thres1': self.th1_opt, 'thres2': self.th2_opt, 'thres3': self.th3_opt,
+                        'thres4': self.th4_opt, 'thres5': self.th5_opt}
+                else: # "BCDv2"
+                    mode, ths = 'BDv2', {'bin_th': self.th1_opt}
+                w_pred = chunked_watershed(pred, mode=mode, chunk_shape=self.cfg.DATA.MW_CHUNK_SHAPE,
+                    halo=self.cfg.DATA.MW_CHUNK_HALO, workers=self.cfg.DATA.MW_CHUNK_WORKERS,
+                    thres_small=self.cfg.DATA.REMOVE_SMALL_OBJ, remove_before=self.cfg.DATA.REMOVE_BEFORE_MW, **ths)
+            elif self.cfg.DATA.CHANNELS in ["BC", "BCM"]:
                 w_pred = bc_watershed(pred, thres1=self.th1_opt, thres2=self.th2_opt, thres3=self.th3_opt,
                     thres_small=self.cfg.DATA.REMOVE_SMALL_OBJ, remove_before=self.cfg.DATA.REMOVE_BEFORE_MW,
                     save_dir=check_wa)
@@ -73,106 +107,8 @@ class Instance_Segmentation(Base_Workflow):
             if w_pred.ndim == 2:
                 w_pred = np.expand_dims(w_pred,0)
 
-        if self.cfg.TEST.MAP and self.cfg.PROBLEM.TYPE == 'INSTANCE_SEG' and self.cfg.DATA.TEST.LOAD_GT:
-            print("####################\n"
-                  "#  mAP Calculation #\n"
-                  "####################\n")
-
-            # Convert the prediction into an .h5 file
-            os.makedirs(self.cfg.PATHS.MAP_H5_DIR, exist_ok=True)
-            h5file_name = os.path.join(self.cfg.PATHS.MAP_H5_DIR, os.path.splitext(filenames[0])[0]+'.h5')
-            print("Creating prediction h5 file to calculate mAP: {}".format(h5file_name))
-            h5f = h5py.File(h5file_name, 'w')
-            h5f.create_dataset('dataset', data=w_pred, compression="lzf")
-            h5f.close()
-
-            # Prepare mAP call
-            import sys
-            sys.path.insert(0, self.cfg.PATHS.MAP_CODE_DIR)
-            from demo_modified import main as mAP_calculation
-            class Namespace:
-                def __init__(self, **kwargs):
-                    self.__dict__.update(kwargs)
-
-            # Create GT H5 file if it does not exist
-            gt_f = os.path.join(self.cfg.PATHS.TEST_FULL_GT_H5, os.path.splitext(filenames[0])[0]+'.h5')
-            test_file = os.path.join(self.original_test_mask_path, filenames[0])
-            if not os.path.isfile(gt_f):
-                print("GT .h5 file needed for mAP calculation is not found in {} so it will be created "
-                        "from its mask: {}".format(gt_f, test_file))
-
-                if not os.path.isfile(test_file):
-                    raise ValueError("The mask is supossed to have the same name as the image")
-                _Y = imread(test_file).squeeze()
-
-                # If multiple-channel data then only capture the first channel that is assumed to be instance labels
-                if (self.cfg.PROBLEM.NDIM == '2D' and (_Y.shape[0] > 1 and _Y.ndim == 3)) or\
-                    (self.cfg.PROBLEM.NDIM == '3D' and (_Y.shape[0] > 1 and _Y.ndim == 4)):
-                    _Y =  _Y[0]
-
-                # As the mAP code is prepared for 3D we need an extra z dimension and change dtype ot int
-                if _Y.dtype == np.float32: _Y = _Y.astype(np.int32)
-                if _Y.dtype == np.float64: _Y = _Y.astype(np.int64)
-                if _Y.ndim == 2: _Y = np.expand_dims(_Y,0)
-
-                print("Saving .h5 GT data from array shape: {}".format(_Y.shape))
-                os.makedirs(self.cfg.PATHS.TEST_FULL_GT_H5, exist_ok=True)
-                h5f = h5py.File(gt_f, 'w')
-                h5f.create_dataset('dataset', data=_Y, compression="lzf")
-                h5f.close()
-
-            # In case the GT has no labels in this image
-            gt_num_labels = len(np.unique(imread(test_file)))
-            if gt_num_labels > 1:
-                # Calculate mAP
-                args = Namespace(gt_seg=gt_f, predict_seg=h5file_name, predict_score='', threshold="5e3, 3e4",
-                                    threshold_crumb=-1, chunk_size=250, output_name=w_dir, do_txt=1, do_eval=1,
-                                    slices="-1")
-                mAP_calculation(args)
-
-                # Save metric
-                with open(os.path.join(w_dir, 'nucmm_map.txt'), "r") as read_obj:
-                    for line in read_obj:
-                        if 'Average Precision  (AP) @[ IoU=0.50      | area=   all | maxDets=100 ] =' in line:
-                            mAP_50_total += float(line.split()[-1])
-                        elif 'Average Precision  (AP) @[ IoU=0.75      | area=   all | maxDets=100 ] =' in line:
-                            mAP_75_total += float(line.split()[-1])
-            else:
-                print("No labels found in {} file. Skipping sample from mAP calculation . . .".format(test_file))
-
-            if self.cfg.TEST.VORONOI_ON_MASK:
-                print("mAP with Voronoi")
-                # As the mAP code is prepared for 3D we need an extra z dimension
-                if vor_pred.ndim == 2:
-                    vor_pred = np.expand_dims(vor_pred,0)
-
-                h5file_name_vor = os.path.join(self.cfg.PATHS.MAP_H5_DIR, os.path.splitext(filenames[0])[0]+'_voronoi.h5')
-                print("Creating prediction h5 file to calculate mAP: {}".format(h5file_name_vor))
-                h5f = h5py.File(h5file_name_vor, 'w')
-                h5f.create_dataset('dataset', data=vor_pred, compression="lzf")
-                h5f.close()
-
-                if gt_num_labels > 1:
-                    w_dir = os.path.join(self.cfg.PATHS.WATERSHED_DIR, filenames[0], "voronoi")
-                    os.makedirs(w_dir, exist_ok=True)
-                    # Calculate mAP
-                    args = Namespace(gt_seg=gt_f, predict_seg=h5file_name_vor, predict_score='', threshold="5e3, 3e4",
-                                        threshold_crumb=-1, chunk_size=250, output_name=w_dir, do_txt=1, do_eval=1,
-                                        slices="-1")
-                    mAP_calculation(args)
-
-                    # Save metric
-                    with open(os.path.join(w_dir, 'nucmm_map.txt'), "r") as read_obj:
-                        for line in read_obj:
-                            if 'Average Precision  (AP) @[ IoU=0.50      | area=   all | maxDets=100 ] =' in line:
-                                mAP_50_total_vor += float(line.split()[-1])
-                            elif 'Average Precision  (AP) @[ IoU=0.75      | area=   all | maxDets=100 ] =' in line:
-                                mAP_75_total_vor += float(line.split()[-1])
-                else:
-                    print("No labels found in {} file. Skipping sample from mAP calculation (Voronoi). . .".format(test_file))
-
-        if self.cfg.TEST.MATCHING_STATS and self.cfg.PROBLEM.TYPE == 'INSTANCE_SEG' and self.cfg.DATA.TEST.LOAD_GT:
-            print("Calculating matching stats . . .")
+        if (self.cfg.TEST.MAP or self.cfg.TEST.MATCHING_STATS) and self.cfg.PROBLEM.TYPE == 'INSTANCE_SEG' \
+            and self.cfg.DATA.TEST.LOAD_GT:
             test_file = os.path.join(self.original_test_mask_path, filenames[0])
             if not os.path.isfile(test_file):
                 raise ValueError("The mask is supossed to have the same name as the image")
@@ -183,24 +119,50 @@ class Instance_Segmentation(Base_Workflow):
                 (self.cfg.PROBLEM.NDIM == '3D' and (_Y.shape[0] > 1 and _Y.ndim == 4)):
                 _Y =  _Y[0]
 
-            # As the mAP code is prepared for 3D we need an extra z dimension and change dtype ot int
+            # Convert instances to integer and add an extra z dimension as the prediction
             if _Y.dtype == np.float32: _Y = _Y.astype(np.int32)
             if _Y.dtype == np.float64: _Y = _Y.astype(np.int64)
             if _Y.ndim == 2: _Y = np.expand_dims(_Y,0)
 
-            # Convert instances to integer
-            if _Y.dtype == np.float32: _Y = _Y.astype(np.int32)
-            if _Y.dtype == np.float64: _Y = _Y.astype(np.int64)
+            # The overlap between the instances is shared by the mAP and the matching stats
+            overlap = sparse_label_overlap(_Y, w_pred)
+            if self.cfg.TEST.VORONOI_ON_MASK:
+                if vor_pred.ndim == 2: vor_pred = np.expand_dims(vor_pred,0)
+                vor_overlap = sparse_label_overlap(_Y, vor_pred)
+
+        if self.cfg.TEST.MAP and self.cfg.PROBLEM.TYPE == 'INSTANCE_SEG' and self.cfg.DATA.TEST.LOAD_GT:
+            print("####################\n"
+                  "#  mAP Calculation #\n"
+                  "####################\n")
 
-            r_stats = matching(_Y, w_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=False)
+            # In case the GT has no labels in this image
+            if np.any(overlap[0] != 0):
+                results['mAP_50_total'], results['mAP_75_total'] = average_precision(_Y, w_pred, thresh=[0.5, 0.75],
+                    overlap=overlap)
+                print("Average Precision (AP) - IoU=0.50 : {}".format(results['mAP_50_total']))
+                print("Average Precision (AP) - IoU=0.75 : {}".format(results['mAP_75_total']))
+
+                if self.cfg.TEST.VORONOI_ON_MASK:
+                    results['mAP_50_total_vor'], results['mAP_75_total_vor'] = average_precision(_Y, vor_pred,
+                        thresh=[0.5, 0.75], overlap=vor_overlap)
+                    print("Average Precision (AP) (Voronoi) - IoU=0.50 : {}".format(results['mAP_50_total_vor']))
+                    print("Average Precision (AP) (Voronoi) - IoU=0.75 : {}".format(results['mAP_75_total_vor']))
+            else:
+                print("No labels found in {} file. Skipping sample from mAP calculation . . .".format(test_file))
+
+        if self.cfg.TEST.MATCHING_STATS and self.cfg.PROBLEM.TYPE == 'INSTANCE_SEG' and self.cfg.DATA.TEST.LOAD_GT:
+            print("Calculating matching stats . . .")
+            r_stats = matching(_Y, w_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=False,
+                overlap=overlap)
             print(r_stats)
-            self.all_matching_stats.append(r_stats)
+            results['matching_stats'] = r_stats
 
             if self.cfg.TEST.VORONOI_ON_MASK:
-                r_stats = matching(_Y, vor_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=False)
+                r_stats = matching(_Y, vor_pred, thresh=self.cfg.TEST.MATCHING_STATS_THS, report_matches=False,
+                    overlap=vor_overlap)
                 print("Stats with Voronoi")
                 print(r_stats)
-                self.all_matching_stats_voronoi.append(r_stats)
+                results['matching_stats_voronoi'] = r_stats
 
         if self.cfg.TEST.MATCHING_SEGCOMPARE and self.cfg.PROBLEM.TYPE == 'INSTANCE_SEG' and self.cfg.DATA.TEST.LOAD_GT:
             print("Calculating matching stats using segCompare. . .")
@@ -210,13 +172,28 @@ class Instance_Segmentation(Base_Workflow):
             _Y = imread(test_file).squeeze()
             r_stats_segCompare = match_using_segCompare(_Y, w_pred)
             print(r_stats_segCompare)
-            self.all_matching_stats_segCompare.append(r_stats_segCompare)
+            results['segCompare_stats'] = r_stats_segCompare
 
             if self.cfg.TEST.VORONOI_ON_MASK:
                 r_stats_segCompare = match_using_segCompare(_Y, vor_pred)
                 print("Stats with Voronoi")
                 print(r_stats_segCompare)
-                self.all_matching_stats_voronoi_segCompare.append(r_stats_segCompare)
+                results['segCompare_stats_voronoi'] = r_stats_segCompare
+
+        return results
+
+    def store_instance_stats(self, results):
+        """Add the statistics of an image, calculated by :func:`~instance_post_processing`, to the totals."""
+        for k in ['mAP_50_total', 'mAP_75_total', 'mAP_50_total_vor', 'mAP_75_total_vor']:
+            self.stats[k] += results[k]
+        if 'matching_stats' in results:
+            self.all_matching_stats.append(results['matching_stats'])
+        if 'matching_stats_voronoi' in results:
+            self.all_matching_stats_voronoi.append(results['matching_stats_voronoi'])
+        if 'segCompare_stats' in results:
+            self.all_matching_stats_segCompare.append(results['segCompare_stats'])
+        if 'segCompare_stats_voronoi' in results:
+            self.all_matching_stats_voronoi_segCompare.append(results['segCompare_stats_voronoi'])
 
     def after_full_image(self, pred, Y, filenames):
         pass
@@ -254,7 +231,7 @@ class Instance_Segmentation(Base_Workflow):
                 print("Test Average Precision (AP) - IoU=0.75 : {}".format(self.stats['mAP_75_total']))
                 print(" ")
                 if self.cfg.TEST.VORONOI_ON_MASK:
-                    print("Test Average Precision (AP) (Voronoi) - IoU=0.50 : {}".format(self.stats['inst_mAP_50_total_vor']))
+                    print("Test Average Precision (AP) (Voronoi) - IoU=0.50 : {}".format(self.stats['mAP_50_total_vor']))
                     print("Test Average Precision (AP) (Voronoi) - IoU=0.75 : {}".format(self.stats['mAP_75_total_vor']))
                     print(" ")
             if self.cfg.TEST.MATCHING_STATS:
@@ -282,28 +259,25 @@ def prepare_instance_data(cfg):
     original_test_path = None
     original_test_mask_path = None
 
-    # Create selected channels for train data
-    if cfg.TRAIN.ENABLE and not os.path.isdir(cfg.DATA.TRAIN.INSTANCE_CHANNELS_DIR):
-        print("You select to create {} channels from given instance labels and no file is detected in {}. "
-                "So let's prepare the data. Notice that, if you do not modify 'DATA.TRAIN.INSTANCE_CHANNELS_DIR' "
-                "path, this process will be done just once!".format(cfg.DATA.CHANNELS,
-                cfg.DATA.TRAIN.INSTANCE_CHANNELS_DIR))
+    # Create selected channels for train data. Files already created in a previous run are skipped
+    if cfg.TRAIN.ENABLE:
+        print("You select to create {} channels from given instance labels. They will be stored in {}. Notice that, "
+              "if you do not modify 'DATA.TRAIN.INSTANCE_CHANNELS_DIR' path, each file will be processed just once!"
+              .format(cfg.DATA.CHANNELS, cfg.DATA.TRAIN.INSTANCE_CHANNELS_DIR))
         train_filenames = create_instance_channels(cfg)
 
     # Create selected channels for val data
-    if cfg.TRAIN.ENABLE and not cfg.DATA.VAL.FROM_TRAIN and not os.path.isdir(cfg.DATA.VAL.INSTANCE_CHANNELS_DIR):
-        print("You select to create {} channels from given instance labels and no file is detected in {}. "
-                "So let's prepare the data. Notice that, if you do not modify 'DATA.VAL.INSTANCE_CHANNELS_DIR' "
-                "path, this process will be done just once!".format(cfg.DATA.CHANNELS,
-                cfg.DATA.VAL.INSTANCE_CHANNELS_DIR))
+    if cfg.TRAIN.ENABLE and not cfg.DATA.VAL.FROM_TRAIN:
+        print("You select to create {} channels from given instance labels. They will be stored in {}. Notice that, "
+              "if you do not modify 'DATA.VAL.INSTANCE_CHANNELS_DIR' path, each file will be processed just once!"
+              .format(cfg.DATA.CHANNELS, cfg.DATA.VAL.INSTANCE_CHANNELS_DIR))
         create_instance_channels(cfg, data_type='val')
 
     # Create selected channels for test data once
-    if cfg.TEST.ENABLE and not os.path.isdir(cfg.DATA.TEST.INSTANCE_CHANNELS_DIR):
-        print("You select to create {} channels from given instance labels and no file is detected in {}. "
-                "So let's prepare the data. Notice that, if you do not modify 'DATA.TEST.INSTANCE_CHANNELS_DIR' "
-                "path, this process will be done just once!".format(cfg.DATA.CHANNELS,
-                cfg.DATA.TEST.INSTANCE_CHANNELS_DIR))
+    if cfg.TEST.ENABLE:
+        print("You select to create {} channels from given instance labels. They will be stored in {}. Notice that, "
+              "if you do not modify 'DATA.TEST.INSTANCE_CHANNELS_DIR' path, each file will be processed just once!"
+              .format(cfg.DATA.CHANNELS, cfg.DATA.TEST.INSTANCE_CHANNELS_DIR))
         create_test_instance_channels(cfg)
 
     opts = []
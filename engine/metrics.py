@@ -1,4 +1,3 @@
-import time
 import os
 import distutils
 import tensorflow as tf
@@ -7,8 +6,10 @@ from tensorflow.keras import backend as K
 from skimage import measure
 from PIL import Image
 from tensorflow.keras import losses
-from scipy.spatial import distance_matrix
+from scipy.spatial import distance_matrix, cKDTree
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 
 def jaccard_index_numpy(y_true, y_pred):
@@ -33,16 +34,7 @@ def jaccard_index_numpy(y_true, y_pred):
     if y_true.ndim != y_pred.ndim:
         raise ValueError("Dimension mismatch: {} and {} provided".format(y_true.shape, y_pred.shape))
 
-    TP = np.count_nonzero(y_pred * y_true)
-    FP = np.count_nonzero(y_pred * (y_true - 1))
-    FN = np.count_nonzero((y_pred - 1) * y_true)
-
-    if (TP + FP + FN) == 0:
-        jac = 0
-    else:
-        jac = TP / (TP + FP + FN)
-
-    return jac
+    return segmentation_metrics(y_true, y_pred, t=None)['iou']
 
 
 def jaccard_index_numpy_without_background(y_true, y_pred):
@@ -67,16 +59,114 @@ def jaccard_index_numpy_without_background(y_true, y_pred):
     if y_true.ndim != y_pred.ndim:
         raise ValueError("Dimension mismatch: {} and {} provided".format(y_true.shape, y_pred.shape))
 
-    TP = np.count_nonzero(y_pred[...,1:] * y_true[...,1:])
-    FP = np.count_nonzero(y_pred[...,1:] * (y_true[...,1:] - 1))
-    FN = np.count_nonzero((y_pred[...,1:] - 1) * y_true[...,1:])
+    return segmentation_metrics(y_true[...,1:], y_pred[...,1:], t=None)['iou']
+
 
-    if (TP + FP + FN) == 0:
-        jac = 0
+def _chunks(x, y, chunk_size):
+    """Yield flat chunks of ``x`` and ``y`` of at most ``chunk_size`` elements without copying the whole arrays."""
+    if (x.flags['C_CONTIGUOUS'] and y.flags['C_CONTIGUOUS']) or x.ndim < 2:
+        x, y = x.reshape(-1), y.reshape(-1)
+        for i in range(0, x.size, chunk_size):
+            yield x[i:i+chunk_size], y[i:i+chunk_size]
     else:
-        jac = TP / (TP + FP + FN)
+        for a, b in zip(x, y):
+            yield from _chunks(np.ascontiguousarray(a), np.ascontiguousarray(b), chunk_size)
+
+
+def confusion_matrix_numpy(y_true, y_pred, n_classes=2, t=None, chunk_size=2**22):
+    """Count the pixels of each pair of ground truth and predicted classes in a single pass over the data. The data
+       is processed in chunks, so no full-size temporary arrays are created, and the inputs are not modified.
+
+       Parameters
+       ----------
+       y_true : N dim Numpy array
+           Ground truth masks. E.g. ``(num_of_images, x, y, channels)`` for 2D images or
+           ``(volume_number, z, x, y, channels)`` for 3D volumes.
+
+       y_pred : N dim Numpy array
+           Predicted masks. It must have the same shape as ``y_true`` or be broadcastable with it.
+
+       n_classes : int, optional
+           Number of classes. If ``2`` the data is binarized: the pixels over ``t`` (or different from ``0`` if ``t``
+           is ``None``) are foreground. Otherwise the values of the data are used as class indexes.
+
+       t : float, optional
+           Threshold to binarize the data. Only used when ``n_classes`` is ``2``.
+
+       chunk_size : int, optional
+           Number of pixels processed at once.
+
+       Returns
+       -------
+       cm : 2D Numpy array
+           Number of pixels of each ground truth class (rows) predicted as each class (columns). E.g.
+           ``(n_classes, n_classes)``.
+    """
+    if y_true.shape != y_pred.shape:
+        y_true, y_pred = np.broadcast_arrays(y_true, y_pred)
+
+    cm = np.zeros((n_classes, n_classes), dtype=np.int64)
+    for true_chunk, pred_chunk in _chunks(y_true, y_pred, chunk_size):
+        if n_classes == 2:
+            true_chunk = true_chunk != 0 if t is None else true_chunk > t
+            pred_chunk = pred_chunk != 0 if t is None else pred_chunk > t
+            tp = np.count_nonzero(true_chunk & pred_chunk)
+            n_true, n_pred = np.count_nonzero(true_chunk), np.count_nonzero(pred_chunk)
+            cm += [[true_chunk.size-n_true-n_pred+tp, n_pred-tp], [n_true-tp, tp]]
+        else:
+            packed = true_chunk.astype(np.int64)*n_classes + pred_chunk.astype(np.int64)
+            cm += np.bincount(packed, minlength=n_classes**2).reshape(n_classes, n_classes)
+    return cm
+
+
+def iou_per_class(cm):
+    """Calculate the IoU of each class from a confusion matrix. The IoU of the classes not present neither in the
+       ground truth nor in the prediction is ``0``.
+
+       Parameters
+       ----------
+       cm : 2D Numpy array
+           Confusion matrix, as returned by :func:`~confusion_matrix_numpy`.
+
+       Returns
+       -------
+       iou : 1D Numpy array
+           IoU of each class.
+    """
+    tp = np.diag(cm)
+    union = cm.sum(axis=0) + cm.sum(axis=1) - tp
+    iou = np.zeros(len(cm))
+    np.divide(tp, union, out=iou, where=union > 0)
+    return iou
 
-    return jac
+
+def segmentation_metrics(y_true, y_pred, t=0.5):
+    """Calculate the foreground IoU, background IoU, overall IoU (VOC) and Dice of binary masks from a single
+       confusion matrix (see :func:`~confusion_matrix_numpy`).
+
+       Parameters
+       ----------
+       y_true : N dim Numpy array
+           Ground truth masks. E.g. ``(num_of_images, x, y, channels)`` for 2D images or
+           ``(volume_number, z, x, y, channels)`` for 3D volumes.
+
+       y_pred : N dim Numpy array
+           Predicted masks, with the same shape as ``y_true``.
+
+       t : float, optional
+           Threshold to binarize the data. If ``None`` the pixels different from ``0`` are foreground.
+
+       Returns
+       -------
+       metrics : dict
+           ``iou`` (foreground IoU, as :func:`~jaccard_index_numpy`), ``iou_background``, ``ov_iou`` (as
+           :func:`~voc_calculation`) and ``dice``.
+    """
+    cm = confusion_matrix_numpy(y_true, y_pred, n_classes=2, t=t)
+    iou_background, iou = iou_per_class(cm)
+    (_, fp), (fn, tp) = cm
+    return {'iou': iou, 'iou_background': iou_background, 'ov_iou': (iou + iou_background)/2,
+            'dice': 0 if tp+fp+fn == 0 else 2*tp/(2*tp+fp+fn)}
 
 
 def jaccard_index(y_true, y_pred, t=0.5):
@@ -327,28 +417,9 @@ def voc_calculation(y_true, y_pred, foreground):
            VOC score value.
     """
 
-    # Invert the arrays
-    start_time = time.time()
-    y_pred[y_pred == 0] = 2
-    y_pred[y_pred == 1] = 0
-    y_pred[y_pred == 2] = 1
-
-    y_true[y_true == 0] = 2
-    y_true[y_true == 1] = 0
-    y_true[y_true == 2] = 1
-
-    background = jaccard_index_numpy(y_true, y_pred)
+    background = segmentation_metrics(y_true, y_pred, t=None)['iou_background']
     voc = (float)(foreground + background)/2
 
-    # Revert the changes
-    y_pred[y_pred == 0] = 2
-    y_pred[y_pred == 1] = 0
-    y_pred[y_pred == 2] = 1
-
-    y_true[y_true == 0] = 2
-    y_true[y_true == 1] = 0
-    y_true[y_true == 2] = 1
-
     return voc
 
 
@@ -516,7 +587,7 @@ def masked_mse(y_true, y_pred, mask):
     return K.mean(tf.expand_dims(mask*K.square(y_true - y_pred), -1), axis=-1)
 
 
-def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), verbose=False):
+def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), verbose=False, approx=False):
     """Calculate detection metrics based on
 
        Parameters
@@ -534,6 +605,16 @@ def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), verbose=Fals
            Weights to be multiply by each axis. Useful when dealing with anysotropic data to reduce the distance value
            on the axis with less resolution. E.g. ``(1,1,0.5)``.
 
+       verbose : bool, optional
+           To print the number of points and true/false positives.
+
+       approx : bool, optional
+           To approximate the matching using only the pairs closer than ``tolerance`` (see
+           :func:`~approx_detection_matching`) instead of the distances between all of them, so large point sets can
+           be evaluated. The result is not the same: it never counts fewer true positives, but in crowded areas it
+           may count more, as the matching of all the points can leave close pairs unmatched to reduce the total
+           distance of the far ones.
+
        Returns
        -------
        metrics : List of strings
@@ -549,15 +630,18 @@ def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), verbose=Fals
         _true[:,i] *= voxel_size[i]
         _pred[:,i] *= voxel_size[i]
 
-    # Create cost matrix
-    distances = distance_matrix(_pred, _true)
+    if approx:
+        TP = approx_detection_matching(_true, _pred, tolerance)
+    else:
+        # Create cost matrix
+        distances = distance_matrix(_pred, _true)
 
-    pred_ind, true_ind = linear_sum_assignment(distances)
+        pred_ind, true_ind = linear_sum_assignment(distances)
 
-    TP, FP, FN = 0, 0, 0
-    for i in range(len(pred_ind)):
-        if distances[pred_ind[i],true_ind[i]] < tolerance:
-            TP += 1
+        TP, FP, FN = 0, 0, 0
+        for i in range(len(pred_ind)):
+            if distances[pred_ind[i],true_ind[i]] < tolerance:
+                TP += 1
 
     FN = len(_true) - TP
     FP = len(_pred) - TP
@@ -581,6 +665,65 @@ def detection_metrics(true, pred, tolerance=10, voxel_size=(1,1,1), verbose=Fals
         
     return ["Precision", precision, "Recall", recall, "F1", F1]
 
+def approx_detection_matching(true, pred, tolerance=10):
+    """Approximate the true positives of :func:`~detection_metrics` counting the predicted points that can be
+       matched with a ground truth point closer than ``tolerance``. Only the pairs of points closer than ``tolerance``
+       are calculated, with a KD-tree, and the points are grouped by the connected components of the graph those
+       pairs create. Each group is matched separately with ``linear_sum_assignment``, maximizing the number of pairs
+       matched and, among them, minimizing their distance. The groups of one ground truth and one predicted point, the
+       most common, are matched directly.
+
+       The result is the maximum number of pairs closer than ``tolerance`` that can be matched, which is not the
+       number given by :func:`~detection_metrics` with ``approx=False``. There the distances of all the pairs are
+       minimized, including the ones further than ``tolerance``, which in crowded areas can leave close pairs
+       unmatched, so this function may count more true positives, never fewer.
+
+       Parameters
+       ----------
+       true : 2D Numpy array
+           Coordinates of the ground truth points. E.g. ``(num_of_points, 3)``.
+
+       pred : 2D Numpy array
+           Coordinates of the predicted points. E.g. ``(num_of_points, 3)``.
+
+       tolerance : float, optional
+           Maximum distance to consider a point as a true positive.
+
+       Returns
+       -------
+       TP : int
+           Number of true positives.
+    """
+    if len(true) == 0 or len(pred) == 0:
+        return 0
+
+    pairs = cKDTree(pred).sparse_distance_matrix(cKDTree(true), tolerance, output_type='ndarray')
+    pairs = pairs[pairs['v'] < tolerance]
+    if len(pairs) == 0:
+        return 0
+    pair_pred, pair_true, dist = pairs['i'], pairs['j'], pairs['v']
+
+    n_pred = len(pred)
+    n_groups, group = connected_components(coo_matrix((np.ones(len(pairs)), (pair_pred, n_pred+pair_true)),
+                                                      shape=(n_pred+len(true),)*2), directed=False)
+    pair_group = group[pair_pred]
+    single = (np.bincount(group[:n_pred], minlength=n_groups) == 1) & \
+             (np.bincount(group[n_pred:], minlength=n_groups) == 1)
+    TP = int(np.count_nonzero(single[pair_group]))
+
+    order = np.flatnonzero(~single[pair_group])
+    order = order[np.argsort(pair_group[order], kind='stable')]
+    for idx in np.split(order, np.flatnonzero(np.diff(pair_group[order]))+1) if len(order) > 0 else []:
+        p_ids, p_local = np.unique(pair_pred[idx], return_inverse=True)
+        t_ids, t_local = np.unique(pair_true[idx], return_inverse=True)
+        # Pairs further than the tolerance cost more than any set of valid pairs, so the number of valid pairs
+        # matched is maximized first
+        costs = np.full((len(p_ids), len(t_ids)), tolerance*(min(len(p_ids), len(t_ids))+1), dtype=np.float64)
+        costs[p_local, t_local] = dist[idx]
+        p_ind, t_ind = linear_sum_assignment(costs)
+        TP += int(np.count_nonzero(costs[p_ind, t_ind] < tolerance))
+    return TP
+
 def masked_bce_loss( y_true, y_pred ):
     """Binary cross-entropy loss masking pixels of value 2 out.
 
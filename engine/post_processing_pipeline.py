@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PostProcessingPipeline():
+    """Run the post-processing of each image in a pool of threads, so the inference of the next images can start
+       while the previous ones are post-processed. At most ``max_pending`` images are kept in flight: when the queue is
+       full ``submit`` waits for the oldest image to finish. The callbacks, which store the results, are run in the
+       calling thread in the same order the images were submitted, so the statistics do not need any lock.
+
+       Parameters
+       ----------
+       workers : int, optional
+           Number of threads. If ``0`` each image is processed as soon as it is submitted, in the calling thread.
+
+       max_pending : int, optional
+           Maximum number of images submitted and not finished yet.
+    """
+    def __init__(self, workers=0, max_pending=2):
+        self.workers = workers
+        self.max_pending = max(1, max_pending)
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.pending = []
+
+    def submit(self, func, *args, callback=None, **kwargs):
+        """Process an image calling ``func(*args, **kwargs)``. ``callback`` is called with its output once it finishes
+           and all the images submitted before have been stored."""
+        if self.executor is None:
+            out = func(*args, **kwargs)
+            if callback is not None: callback(out)
+            return
+
+        while len(self.pending) >= self.max_pending:
+            self._collect()
+        self.pending.append((self.executor.submit(func, *args, **kwargs), callback))
+
+        # Store the images already finished without waiting for the rest
+        while len(self.pending) > 0 and self.pending[0][0].done():
+            self._collect()
+
+    def _collect(self):
+        """Wait for the oldest image and run its callback. Exceptions raised by ``func`` are raised here."""
+        future, callback = self.pending.pop(0)
+        out = future.result()
+        if callback is not None: callback(out)
+
+    def join(self):
+        """Wait until all the images submitted are processed."""
+        while len(self.pending) > 0:
+            self._collect()
+
+    def shutdown(self):
+        """Wait for all the images and stop the threads."""
+        self.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,12 +1,11 @@
-import math
+import functools
 import numpy as np
-from tqdm import tqdm
 
 from data.data_2D_manipulation import crop_data_with_overlap, merge_data_with_overlap
 from data.data_3D_manipulation import crop_3D_data_with_overlap, merge_3D_data_with_overlap
-from data.post_processing.post_processing import ensemble8_2d_predictions, ensemble16_3d_predictions
 from utils.util import pad_and_reflect, save_tif
 from engine.base_workflow import Base_Workflow
+from engine.batch_predictor import BatchPredictor
 from engine.metrics import PSNR
 
 class Super_resolution(Base_Workflow):
@@ -14,7 +13,11 @@ class Super_resolution(Base_Workflow):
         super().__init__(cfg, model, post_processing)
         self.stats['psnr_per_image'] = 0
 
-    def process_sample(self, X, Y, filenames): 
+    def process_sample(self, X, Y, filenames, predictor=None):
+        own_predictor = predictor is None
+        if own_predictor:
+            predictor = BatchPredictor(self.predict_batch, self.cfg.TRAIN.BATCH_SIZE)
+
         _X = X.copy()
         _Y = Y.copy() if self.cfg.DATA.TEST.LOAD_GT else None
 
@@ -35,24 +38,16 @@ class Super_resolution(Base_Workflow):
                     overlap=self.cfg.DATA.TEST.OVERLAP, padding=self.cfg.DATA.TEST.PADDING,
                     verbose=self.cfg.TEST.VERBOSE, median_padding=self.cfg.DATA.TEST.MEDIAN_PADDING)
 
-        # Predict each patch
-        pred = []
-        if self.cfg.TEST.AUGMENTATION:
-            for k in tqdm(range(_X.shape[0]), leave=False):
-                if self.cfg.PROBLEM.NDIM == '2D':
-                    p = ensemble8_2d_predictions(_X[k], n_classes=self.cfg.MODEL.N_CLASSES,
-                            pred_func=(lambda img_batch_subdiv: self.model.predict(img_batch_subdiv)))
-                else:
-                    p = ensemble16_3d_predictions(_X[k], batch_size_value=1,
-                            pred_func=(lambda img_batch_subdiv: self.model.predict(img_batch_subdiv)))
-                pred.append(np.expand_dims(p, 0))
-        else:
-            for k in tqdm(range(_X.shape[0]), leave=False):
-                p = self.model.predict(_X[k], verbose=0)
-                pred.append(np.expand_dims(p, 0))
+        # Predict each patch. The merge is done once all of them are predicted
+        predictor.add(_X, functools.partial(self.merge_predicted_patches, Y=_Y, filenames=filenames,
+            original_data_shape=original_data_shape, t_patch_size=t_patch_size))
+
+        if own_predictor:
+            predictor.flush()
 
+    def merge_predicted_patches(self, pred, Y, filenames, original_data_shape, t_patch_size,
+        reflected_orig_shape=None):
         # Reconstruct the predictions
-        pred = np.concatenate(pred)
         if original_data_shape[1:] != t_patch_size:
             if self.cfg.PROBLEM.NDIM == '3D': original_data_shape = original_data_shape[1:]
             f_name = merge_data_with_overlap if self.cfg.PROBLEM.NDIM == '2D' else merge_3D_data_with_overlap
@@ -68,8 +63,8 @@ class Super_resolution(Base_Workflow):
     
         # Calculate PSNR
         if self.cfg.DATA.TEST.LOAD_GT:
-            _Y = _Y[0]
-            psnr_per_image = PSNR(pred, _Y)
+            Y = Y[0]
+            psnr_per_image = PSNR(pred, Y)
             self.stats['psnr_per_image'] += psnr_per_image
 
     def after_merge_patches(self, pred, Y, filenames):
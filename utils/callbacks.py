@@ -126,3 +126,53 @@ class TimeHistory(tf.keras.callbacks.Callback):
     def on_epoch_end(self, batch, logs={}):
         self.times.append(time.time() - self.epoch_time_start)
 
+
+
+class GeneratorEpochEnd(tf.keras.callbacks.Callback):
+    """Call ``on_epoch_end`` of the given generators after each epoch. Needed when they are wrapped into a
+       ``tf.data.Dataset``, as Keras only calls it when the generators are given directly.
+
+       Parameters
+       ----------
+       generators : List of tf.keras.utils.Sequence
+           Generators to update.
+    """
+    def __init__(self, generators):
+        super().__init__()
+        self.generators = generators
+
+    def on_epoch_end(self, epoch, logs={}):
+        for g in self.generators:
+            g.on_epoch_end()
+
+
+class PipelineTimings(tf.keras.callbacks.Callback):
+    """Print the time spent on each stage of the input pipeline and on the train steps after each epoch.
+
+       Parameters
+       ----------
+       timers : List of PipelineTimer
+           Timers of the input pipelines.
+    """
+    def __init__(self, timers):
+        super().__init__()
+        self.timers = timers
+
+    def on_epoch_begin(self, epoch, logs={}):
+        self.steps_time = 0
+        self.steps = 0
+        for t in self.timers:
+            t.reset()
+
+    def on_train_batch_begin(self, batch, logs={}):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs={}):
+        self.steps_time += time.perf_counter() - self.step_start
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs={}):
+        print("\nTrain steps total: {:.3f}s - mean: {:.4f}s ({} steps, including the time waiting for the input "
+              "pipeline)".format(self.steps_time, self.steps_time/max(self.steps,1), self.steps))
+        for t in self.timers:
+            t.summary()
@@ -5,6 +5,8 @@ import numpy as np
 from numba import jit
 from tqdm import tqdm
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from collections import namedtuple
 import pandas as pd
 import networkx as nx
@@ -59,6 +61,38 @@ def _label_overlap(x, y):
         overlap[x[i],y[i]] += 1
     return overlap
 
+def sparse_label_overlap(x, y):
+    """Sparse version of :func:`_label_overlap`. Only the pairs of labels that overlap are stored, so the memory
+       needed does not depend on the values of the labels nor on the number of them.
+
+       Parameters
+       ----------
+       x : Numpy array
+           Label image.
+
+       y : Numpy array
+           Label image with the same shape as ``x``.
+
+       Returns
+       -------
+       x_labels : 1D Numpy array
+           Labels of ``x`` sorted, one per row of ``overlap``.
+
+       y_labels : 1D Numpy array
+           Labels of ``y`` sorted, one per column of ``overlap``.
+
+       overlap : scipy.sparse.csr_matrix
+           Number of pixels of each pair of labels. E.g. ``overlap[i,j]`` are the pixels labelled ``x_labels[i]`` in
+           ``x`` and ``y_labels[j]`` in ``y``.
+    """
+    x.shape == y.shape or _raise(ValueError("x and y must have the same shape"))
+    x_labels, x_idx = np.unique(x, return_inverse=True)
+    y_labels, y_idx = np.unique(y, return_inverse=True)
+    overlap = coo_matrix((np.ones(x_idx.size, dtype=np.int64), (x_idx.ravel(), y_idx.ravel())),
+                         shape=(len(x_labels), len(y_labels))).tocsr()
+    overlap.sum_duplicates()
+    return x_labels, y_labels, overlap
+
 def _safe_divide(x,y, eps=1e-10):
     """computes a safe divide which returns 0 if y is zero"""
     if np.isscalar(x) and np.isscalar(y):
@@ -100,6 +134,14 @@ def intersection_over_pred(overlap):
 matching_criteria['iop'] = intersection_over_pred
 
 
+# Same criteria computed only for the overlapping pairs of labels (see sparse_label_overlap). They receive the
+# intersection of each pair and the number of pixels of each of its labels
+sparse_matching_criteria = dict()
+sparse_matching_criteria['iou'] = lambda inter, n_true, n_pred: _safe_divide(inter, n_true + n_pred - inter)
+sparse_matching_criteria['iot'] = lambda inter, n_true, n_pred: _safe_divide(inter, n_true)
+sparse_matching_criteria['iop'] = lambda inter, n_true, n_pred: _safe_divide(inter, n_pred)
+
+
 def precision(tp,fp,fn):
     return tp/(tp+fp) if tp > 0 else 0
 def recall(tp,fp,fn):
@@ -113,7 +155,7 @@ def f1(tp,fp,fn):
     return (2*tp)/(2*tp+fp+fn) if tp > 0 else 0
 
 
-def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
+def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False, sparse=True, overlap=None):
     """Calculate detection/instance segmentation metrics between ground truth and predicted label images.
 
     Currently, the following metrics are implemented:
@@ -141,6 +183,12 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
         matching criterion (default IoU)
     report_matches: bool
         if True, additionally calculate matched_pairs and matched_scores (note, that this returns even gt-pred pairs whose scores are below  'thresh')
+    sparse: bool
+        if True, only the overlapping pairs of objects are stored and the optimal matching is solved separately on
+        each group of objects connected by them, so very large numbers of objects can be matched. Pairs of objects
+        that do not overlap are not reported in matched_pairs
+    overlap: tuple
+        output of sparse_label_overlap(y_true, y_pred), to reuse it when it is already calculated. Only used if sparse
 
     Returns
     -------
@@ -164,36 +212,102 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
     if thresh is None: thresh = 0
     thresh = float(thresh) if np.isscalar(thresh) else map(float,thresh)
 
-    y_true, _, map_rev_true = relabel_sequential(y_true)
-    y_pred, _, map_rev_pred = relabel_sequential(y_pred)
+    if sparse:
+        true_labels, pred_labels, overlap = sparse_label_overlap(y_true, y_pred) if overlap is None else overlap
+        n_pixels_true = np.asarray(overlap.sum(axis=1)).ravel()
+        n_pixels_pred = np.asarray(overlap.sum(axis=0)).ravel()
+        overlap = overlap.tocoo()
+
+        # ignoring background
+        fg = (true_labels[overlap.row] != 0) & (pred_labels[overlap.col] != 0)
+        pair_true, pair_pred, inter = overlap.row[fg], overlap.col[fg], overlap.data[fg]
+        pair_scores = sparse_matching_criteria[criterion](inter, n_pixels_true[pair_true], n_pixels_pred[pair_pred])
+        assert len(pair_scores) == 0 or 0 <= np.min(pair_scores) <= np.max(pair_scores) <= 1
+        map_rev_true = true_labels if true_labels[0] == 0 else np.concatenate([[0], true_labels])
+        map_rev_pred = pred_labels if pred_labels[0] == 0 else np.concatenate([[0], pred_labels])
+        pair_true = pair_true - int(true_labels[0] == 0)
+        pair_pred = pair_pred - int(pred_labels[0] == 0)
+        n_true, n_pred = len(map_rev_true)-1, len(map_rev_pred)-1
+
+        # Group the objects connected by overlapping pairs. As the objects of different groups do not overlap the
+        # optimal matching can be solved on each group separately
+        n_groups, group = connected_components(coo_matrix((np.ones(len(pair_true)), (pair_true, n_true+pair_pred)),
+                                                          shape=(n_true+n_pred,)*2), directed=False)
+        pair_group = group[pair_true]
+        # Groups of one true and one predicted object are matched directly
+        single = (np.bincount(group[:n_true], minlength=n_groups) == 1) & \
+                 (np.bincount(group[n_true:], minlength=n_groups) == 1)
+        single_pairs = np.flatnonzero(single[pair_group])
+        order = np.flatnonzero(~single[pair_group])
+        order = order[np.argsort(pair_group[order], kind='stable')]
+        groups = np.split(order, np.flatnonzero(np.diff(pair_group[order]))+1) if len(order) > 0 else []
+    else:
+        y_true, _, map_rev_true = relabel_sequential(y_true)
+        y_pred, _, map_rev_pred = relabel_sequential(y_pred)
 
-    overlap = label_overlap(y_true, y_pred, check=False)
-    scores = matching_criteria[criterion](overlap)
-    assert 0 <= np.min(scores) <= np.max(scores) <= 1
+        overlap = label_overlap(y_true, y_pred, check=False)
+        scores = matching_criteria[criterion](overlap)
+        assert 0 <= np.min(scores) <= np.max(scores) <= 1
 
-    # ignoring background
-    scores = scores[1:,1:]
-    n_true, n_pred = scores.shape
+        # ignoring background
+        scores = scores[1:,1:]
+        n_true, n_pred = scores.shape
     n_matched = min(n_true, n_pred)
 
+    def _sparse_assignment(thr):
+        # compute optimal matching on each group of overlapping objects with scores as tie-breaker. With a threshold
+        # of 0 all the pairs are valid, so only the scores are taken into account
+        costs = -(pair_scores / (2*n_matched)).astype(float)
+        if thr > 0: costs -= pair_scores >= thr
+        true_ind, pred_ind = [pair_true[single_pairs]], [pair_pred[single_pairs]]
+        match_scores = [pair_scores[single_pairs]]
+        for pairs in groups:
+            t_ids, t_local = np.unique(pair_true[pairs], return_inverse=True)
+            p_ids, p_local = np.unique(pair_pred[pairs], return_inverse=True)
+            group_costs = np.zeros((len(t_ids), len(p_ids)))
+            group_costs[t_local, p_local] = costs[pairs]
+            group_scores = np.zeros((len(t_ids), len(p_ids)), dtype=pair_scores.dtype)
+            group_scores[t_local, p_local] = pair_scores[pairs]
+            t_ind, p_ind = linear_sum_assignment(group_costs)
+            # pairs that do not overlap are left unmatched
+            overlapping = group_scores[t_ind, p_ind] > 0
+            t_ind, p_ind = t_ind[overlapping], p_ind[overlapping]
+            true_ind.append(t_ids[t_ind])
+            pred_ind.append(p_ids[p_ind])
+            match_scores.append(group_scores[t_ind, p_ind])
+        true_ind, pred_ind, match_scores = map(np.concatenate, (true_ind, pred_ind, match_scores))
+        order = np.argsort(true_ind, kind='stable')
+        return true_ind[order], pred_ind[order], match_scores[order]
+
     def _single(thr):
-        not_trivial = n_matched > 0 and np.any(scores >= thr)
-        if not_trivial:
-            # compute optimal matching with scores as tie-breaker
-            costs = -(scores >= thr).astype(float) - scores / (2*n_matched)
-            true_ind, pred_ind = linear_sum_assignment(costs)
-            assert n_matched == len(true_ind) == len(pred_ind)
-            match_ok = scores[true_ind,pred_ind] >= thr
-            tp = np.count_nonzero(match_ok)
+        if sparse:
+            not_trivial = n_matched > 0 and np.any(pair_scores >= thr)
+            if not_trivial:
+                true_ind, pred_ind, match_scores = _sparse_assignment(thr)
+                match_ok = match_scores >= thr
+                # with a threshold of 0 even the objects that do not overlap are matched
+                tp = n_matched if thr <= 0 else np.count_nonzero(match_ok)
+            else:
+                tp = 0
         else:
-            tp = 0
+            not_trivial = n_matched > 0 and np.any(scores >= thr)
+            if not_trivial:
+                # compute optimal matching with scores as tie-breaker
+                costs = -(scores >= thr).astype(float) - scores / (2*n_matched)
+                true_ind, pred_ind = linear_sum_assignment(costs)
+                assert n_matched == len(true_ind) == len(pred_ind)
+                match_scores = scores[true_ind,pred_ind]
+                match_ok = match_scores >= thr
+                tp = np.count_nonzero(match_ok)
+            else:
+                tp = 0
         fp = n_pred - tp
         fn = n_true - tp
         # assert tp+fp == n_pred
         # assert tp+fn == n_true
 
         # the score sum over all matched objects (tp)
-        sum_matched_score = np.sum(scores[true_ind,pred_ind][match_ok]) if not_trivial else 0.0
+        sum_matched_score = np.sum(match_scores[match_ok]) if not_trivial else 0.0
 
         # the score average over all matched objects (tp)
         mean_matched_score = _safe_divide(sum_matched_score, tp)
@@ -222,7 +336,7 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
                 stats_dict.update (
                     # int() to be json serializable
                     matched_pairs  = tuple((int(map_rev_true[i]),int(map_rev_pred[j])) for i,j in zip(1+true_ind,1+pred_ind)),
-                    matched_scores = tuple(scores[true_ind,pred_ind]),
+                    matched_scores = tuple(match_scores),
                     matched_tps    = tuple(map(int,np.flatnonzero(match_ok))),
                 )
             else:
@@ -237,6 +351,89 @@ def matching(y_true, y_pred, thresh=0.5, criterion='iou', report_matches=False):
 
 
 
+def average_precision(y_true, y_pred, thresh=(0.5, 0.75), scores=None, overlap=None):
+    """Calculate the Average Precision (AP) of the predicted instances as COCO does, for all the areas and without
+       limiting the number of detections. The predicted instances are sorted by score and each of them is matched,
+       in that order, with the ground truth instance not matched yet with which it has the highest IoU, if it is
+       at least ``thresh``. AP is the mean of the precision at 101 recall values equally spaced in ``[0, 1]``.
+
+       Parameters
+       ----------
+       y_true : Numpy array
+           Ground truth label image (integer valued).
+
+       y_pred : Numpy array
+           Predicted label image (integer valued).
+
+       thresh : float or List of floats, optional
+           IoU thresholds to calculate the AP at.
+
+       scores : 1D Numpy array, optional
+           Score of each predicted instance, sorted as their labels. If not provided the size of the instances is used
+           as score, so the biggest ones are matched first.
+
+       overlap : tuple, optional
+           Output of :func:`~sparse_label_overlap` for ``y_true`` and ``y_pred``, to reuse it when it is already
+           calculated, e.g. by :func:`~matching`.
+
+       Returns
+       -------
+       ap : float or tuple of floats
+           AP at each threshold. It is ``0`` if there are no instances in ``y_true``.
+    """
+    true_labels, pred_labels, overlap = sparse_label_overlap(y_true, y_pred) if overlap is None else overlap
+    n_pixels_true = np.asarray(overlap.sum(axis=1)).ravel()
+    n_pixels_pred = np.asarray(overlap.sum(axis=0)).ravel()
+    overlap = overlap.tocoo()
+
+    # ignoring background
+    fg = (true_labels[overlap.row] != 0) & (pred_labels[overlap.col] != 0)
+    pair_true, pair_pred, inter = overlap.row[fg], overlap.col[fg], overlap.data[fg]
+    pair_iou = sparse_matching_criteria['iou'](inter, n_pixels_true[pair_true], n_pixels_pred[pair_pred])
+    n_true = np.count_nonzero(true_labels)
+    pred_ids = np.flatnonzero(pred_labels != 0)
+    if scores is None:
+        scores = n_pixels_pred[pred_ids]
+    elif len(scores) != len(pred_ids):
+        raise ValueError("'scores' must have one value per predicted instance ({}), but it has {}"
+                         .format(len(pred_ids), len(scores)))
+
+    # Position of each predicted instance once sorted by score
+    order = np.argsort(-np.asarray(scores), kind='mergesort')
+    rank = np.zeros(len(pred_labels), dtype=np.int64)
+    rank[pred_ids[order]] = np.arange(len(order))
+    rec_thrs = np.linspace(0, 1, 101)
+
+    def _single(thr):
+        if n_true == 0 or len(pred_ids) == 0:
+            return 0.0
+
+        cand = pair_iou >= thr
+        c_true, c_rank, c_iou = pair_true[cand], rank[pair_pred[cand]], pair_iou[cand]
+        tp = np.zeros(len(pred_ids), dtype=bool)
+        if len(np.unique(c_true)) == len(c_true) and len(np.unique(c_rank)) == len(c_rank):
+            # each instance has at most one candidate, which is always the case for thresholds over 0.5
+            tp[c_rank] = True
+        else:
+            matched = set()
+            for i in np.lexsort((-c_iou, c_rank)):
+                if tp[c_rank[i]] or c_true[i] in matched: continue
+                tp[c_rank[i]] = True
+                matched.add(c_true[i])
+
+        tps = np.cumsum(tp)
+        fps = np.cumsum(~tp)
+        recall = tps / n_true
+        precision = tps / (tps + fps)
+        # make the precision monotonically decreasing
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+        inds = np.searchsorted(recall, rec_thrs, side='left')
+        valid = inds < len(precision)
+        return float(np.sum(precision[inds[valid]]) / len(rec_thrs))
+
+    return _single(thresh) if np.isscalar(thresh) else tuple(map(_single, thresh))
+
+
 def matching_dataset(y_true, y_pred, thresh=0.5, criterion='iou', by_image=False, show_progress=True, parallel=False):
     """matching metrics for list of images, see `stardist.matching.matching`
     """
@@ -477,56 +674,19 @@ def match_using_segCompare(y_true, y_pred, BACKGROUND_LABEL=0, thresh_background
 
     """
     
-    #Number of labels
-    groundTruthLabelsNum = np.size(np.unique(y_true))
-    predictedCellsNum = np.size(np.unique(y_pred))
-
-    #Initialize variables
-    groundTruthCellVolume = np.zeros([groundTruthLabelsNum])
-    predictedCellVolume = np.zeros([predictedCellsNum])
-
-    #Relabel (we assume that background is the lowest value in image)
-    if min(np.unique(y_true)) != 0:
-        y_true = relabel_sequential(y_true, 1)[0]-1
-    else:
-        y_true = relabel_sequential(y_true, 1)[0]
-    if min(np.unique(y_pred)) != 0:
-        y_pred = relabel_sequential(y_pred, 1)[0]-1
-    else:
-        y_pred = relabel_sequential(y_pred, 1)[0]  
-
-    predictedCells = np.unique(y_pred)
-    groundTruthCells = np.unique(y_true)
-
-    #Calculate unions, intersections, jaccardIndex, volumes and assymetric inclusion indices
-    #VJI is not strictly neccessary, could be removed or maybe hidden w/ an if statement.
-
-    for predictedCell in predictedCells:
-        #Calculate GroundTruth cell and predictedCellVolume Volume
-        predictedCellVolume[predictedCell] = np.count_nonzero(y_pred==predictedCell)
-
-    df_target = pd.DataFrame(columns = ['target', 'reference', 'target_in_reference'])
-    df_reference = pd.DataFrame(columns = ['target', 'reference', 'reference_in_target'])
-
-    for groundTruthCell in groundTruthCells:
-        gtCell = y_true==groundTruthCell
-
-        validSlices = [np.count_nonzero(gtCell[slice, :, :])>0 for slice in range(np.shape(gtCell)[0])]
-        
-        gtCell = gtCell[validSlices, :, :]
-        groundTruthCellVolume[groundTruthCell] = np.count_nonzero(y_true[validSlices, :, :]==groundTruthCell)
-        matchingCells = np.unique(y_pred[(y_true==groundTruthCell)])
-
-        for predictedCell in matchingCells:
-        
-            pCell =  y_pred[validSlices, :, :]==predictedCell
-        
-            #Calculate union and intersection
-            intersection = (gtCell & pCell).sum()
-
-            df_target.loc[len(df_target.index)] = [predictedCell, groundTruthCell, intersection/predictedCellVolume[predictedCell]]
-            df_reference.loc[len(df_reference.index)] = [predictedCell, groundTruthCell, intersection/groundTruthCellVolume[groundTruthCell]]
-
+    # Intersection of each ground truth cell with each predicted cell. The labels are replaced by their position, so
+    # the lowest value of each image is considered the background
+    _, _, overlap = sparse_label_overlap(y_true, y_pred)
+    groundTruthCellVolume = np.asarray(overlap.sum(axis=1)).ravel()
+    predictedCellVolume = np.asarray(overlap.sum(axis=0)).ravel()
+
+    # Rows are sorted by ground truth cell and then by predicted cell
+    overlap = overlap.tocoo()
+    groundTruthCell, predictedCell, intersection = overlap.row, overlap.col, overlap.data
+    df_target = pd.DataFrame({'target': predictedCell, 'reference': groundTruthCell,
+                              'target_in_reference': intersection/predictedCellVolume[predictedCell]})
+    df_reference = pd.DataFrame({'target': predictedCell, 'reference': groundTruthCell,
+                                 'reference_in_target': intersection/groundTruthCellVolume[groundTruthCell]})
 
     ### - Solve the background associations - ###
     # target --> reference background
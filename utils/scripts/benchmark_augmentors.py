@@ -0,0 +1,67 @@
+import sys
+import time
+import numpy as np
+
+code_dir = "/home/user/BiaPy"
+# Batches: (batch shape, z_size). 3D patches have their z axis merged with the channels as the generators do
+cases = [((32, 256, 256, 1), -1),
+         ((8, 128, 128, 40), 40)]
+# Number of times each case is run. The best time is reported
+repeats = 3
+seed = 0
+
+sys.path.insert(0, code_dir)
+from data.generators.augmentors import (cutout, cutblur, cutnoise, brightness, contrast, brightness_em, contrast_em,
+                                        GridMask, missing_parts, cutout_batch, cutblur_batch, cutnoise_batch,
+                                        brightness_batch, contrast_batch, brightness_em_batch, contrast_em_batch,
+                                        GridMask_batch, missing_parts_batch)
+
+
+def best_time(func, data):
+    """Run ``func`` ``repeats`` times over a copy of ``data`` returning the best time. Copying is not timed as the
+       augmentations may change ``data`` in place."""
+    times = []
+    for _ in range(repeats):
+        data_copy = data.copy()
+        start = time.perf_counter()
+        func(data_copy)
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+
+def per_sample(func):
+    """Apply ``func`` to each sample of a batch, as the generators did before the batch augmentations."""
+    return lambda imgs: [func(img) for img in imgs]
+
+
+rng = np.random.default_rng(seed)
+for shape, z_size in cases:
+    imgs = rng.random(shape, dtype=np.float32)
+    masks = (rng.random(shape) > 0.5).astype(np.uint8)
+    channels = 1 if z_size == -1 else shape[-1]//z_size
+    grid_d = (int(shape[1]*0.4), int(shape[1]*0.8)) if z_size == -1 else \
+        (int(shape[1]*0.4), int(shape[1]*0.8), int(z_size*0.2), int(z_size*0.4))
+    print("Batch {} (z_size {})".format(shape, z_size))
+
+    augs = [
+        ('cutout', lambda img: cutout(img, masks[0].copy(), channels, z_size, res_relation=(1,1,1)),
+         lambda b: cutout_batch(b, masks.copy(), channels, z_size, res_relation=(1,1,1))),
+        ('cutblur', lambda img: cutblur(img), lambda b: cutblur_batch(b)),
+        ('cutnoise', lambda img: cutnoise(img), lambda b: cutnoise_batch(b)),
+        ('brightness', lambda img: brightness(img, (0.1,0.3)), lambda b: brightness_batch(b, (0.1,0.3))),
+        ('contrast', lambda img: contrast(img, (0.1,0.3)), lambda b: contrast_batch(b, (0.1,0.3))),
+        ('brightness_em', lambda img: brightness_em(img, (0.1,0.3)), lambda b: brightness_em_batch(b, (0.1,0.3))),
+        ('contrast_em', lambda img: contrast_em(img, (0.1,0.3)), lambda b: contrast_em_batch(b, (0.1,0.3))),
+        ('missing_parts', lambda img: missing_parts(img), lambda b: missing_parts_batch(b)),
+        ('GridMask', lambda img: GridMask(img, channels, z_size, d_range=grid_d),
+         lambda b: GridMask_batch(b, channels, z_size, d_range=grid_d)),
+    ]
+    for name, sample_f, batch_f in augs:
+        np.random.seed(seed)
+        before = best_time(per_sample(sample_f), imgs)
+        np.random.seed(seed)
+        after = best_time(batch_f, imgs)
+        print("    {}: {:.1f} samples/s per sample - {:.1f} samples/s by batch ({:.1f}x)"
+              .format(name, shape[0]/before, shape[0]/after, before/after))
+
+print("Finished!")
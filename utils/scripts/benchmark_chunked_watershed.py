@@ -0,0 +1,67 @@
+import sys
+import time
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from skimage.segmentation import find_boundaries
+
+code_dir = "/home/user/BiaPy"
+# Synthetic volumes: (shape, number of blobs, radius range). Blobs are twice thinner along z and touch each other
+cases = [((40, 120, 120), 200, (5, 10)),
+         ((40, 120, 120), 500, (4, 9))]
+# Chunk cores and halos to compare with the watershed of the whole volume
+chunk_shape = (16, 48, 48)
+halos = [12, 24]
+volumes = 3
+seed = 0
+
+sys.path.insert(0, code_dir)
+from data.post_processing.post_processing import bc_watershed
+from data.post_processing.chunked_watershed import chunked_watershed
+
+
+def blobs(rng, shape, n, radius):
+    """Foreground and contour channels of ``n`` touching ellipsoids, as 'BC' models predict them."""
+    centers = rng.rand(n, 3)*shape
+    radii = rng.uniform(*radius, n)
+    zz, yy, xx = np.indices(shape)
+    best = np.full(shape, np.inf)
+    lab = np.zeros(shape, dtype=np.int32)
+    for i, (c, r) in enumerate(zip(centers, radii)):
+        d = np.sqrt(((zz-c[0])*2)**2 + (yy-c[1])**2 + (xx-c[2])**2)/r
+        m = (d < 1) & (d < best)
+        best[m], lab[m] = d[m], i+1
+    fg = gaussian_filter((lab > 0).astype(np.float32), 1)
+    contours = find_boundaries(lab, mode='thick').astype(np.float32)
+    return np.stack([fg, contours], axis=-1)
+
+
+def false_merges(a, b):
+    """Number of extra labels of ``b`` that share their best match in ``a``, i.e. joined by ``a``."""
+    fg = b > 0
+    pairs, counts = np.unique(np.stack([b[fg], a[fg]], axis=-1), axis=0, return_counts=True)
+    pairs = pairs[np.lexsort((-counts, pairs[:,0]))]
+    best = pairs[np.r_[True, pairs[1:,0] != pairs[:-1,0]], 1]
+    _, c = np.unique(best[best > 0], return_counts=True)
+    return int((c-1).sum())
+
+
+rng = np.random.RandomState(seed)
+for shape, n, radius in cases:
+    print("Volume {} with {} blobs of radius {}".format(shape, n, radius))
+    for v in range(volumes):
+        data = blobs(rng, shape, n, radius)
+        start = time.perf_counter()
+        full = bc_watershed(data, thres_small=0)
+        t_full = time.perf_counter()-start
+        for halo in halos:
+            start = time.perf_counter()
+            chunked = chunked_watershed(data, chunk_shape=chunk_shape, halo=halo, thres_small=0)
+            t_chunked = time.perf_counter()-start
+            merges, splits = false_merges(chunked, full), false_merges(full, chunked)
+            # Equal up to the label values if each label corresponds to a single label of the other volume
+            equal = merges == 0 and splits == 0 and np.array_equal(chunked > 0, full > 0)
+            print("    volume {} halo {}: {} instances ({} whole volume) - {} false merges, {} false splits - equal: {}"
+                  " - {:.2f}s ({:.2f}s whole volume)".format(v, halo, len(np.unique(chunked))-1, len(np.unique(full))-1,
+                  merges, splits, equal, t_chunked, t_full))
+
+print("Finished!")
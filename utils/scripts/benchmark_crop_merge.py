@@ -0,0 +1,49 @@
+import sys
+import time
+import numpy as np
+
+code_dir = "/home/user/BiaPy"
+# 2D cases: (data shape, crop shape, overlap, padding)
+cases_2d = [((10, 1024, 1024, 1), (256, 256, 1), (0, 0), (0, 0)),
+            ((10, 1024, 1024, 1), (256, 256, 1), (0.5, 0.5), (16, 16)),
+            ((10, 512, 512, 3), (128, 128, 3), (0.75, 0.75), (8, 8))]
+# 3D cases: (data shape, crop shape, overlap, padding)
+cases_3d = [((40, 256, 256, 1), (32, 64, 64, 1), (0, 0, 0), (0, 0, 0)),
+            ((40, 256, 256, 1), (32, 64, 64, 1), (0.5, 0.5, 0.5), (4, 8, 8)),
+            ((40, 256, 256, 2), (16, 32, 32, 2), (0.5, 0.5, 0.5), (2, 4, 4))]
+# Number of times each case is run. The best time is reported
+repeats = 3
+seed = 0
+
+sys.path.insert(0, code_dir)
+from data.data_2D_manipulation import crop_data_with_overlap, merge_data_with_overlap
+from data.data_3D_manipulation import crop_3D_data_with_overlap, merge_3D_data_with_overlap
+
+
+def best_time(func, *args, **kwargs):
+    """Run ``func`` ``repeats`` times returning its output and the best time."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        times.append(time.perf_counter()-start)
+    return out, min(times)
+
+
+rng = np.random.default_rng(seed)
+for ndim, cases in [('2D', cases_2d), ('3D', cases_3d)]:
+    crop_f = crop_data_with_overlap if ndim == '2D' else crop_3D_data_with_overlap
+    merge_f = merge_data_with_overlap if ndim == '2D' else merge_3D_data_with_overlap
+    for shape, crop_shape, overlap, padding in cases:
+        data = rng.random(shape, dtype=np.float32)
+        print("{} data {} into {} with overlap {} and padding {}".format(ndim, shape, crop_shape, overlap, padding))
+
+        crops, crop_time = best_time(crop_f, data, crop_shape, overlap=overlap, padding=padding, verbose=False)
+        print("    Crop: {:.3f}s ({} patches)".format(crop_time, len(crops)))
+
+        merged, merge_time = best_time(merge_f, crops, shape, overlap=overlap, padding=padding, verbose=False)
+        print("    Merge: {:.3f}s".format(merge_time))
+
+        print("    Crop and merge recovers the data: {}".format(np.allclose(merged, data, atol=1e-6)))
+
+print("Finished!")
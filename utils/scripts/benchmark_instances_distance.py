@@ -0,0 +1,56 @@
+import sys
+import time
+import numpy as np
+import scipy.ndimage
+
+code_dir = "/home/user/BiaPy"
+# Synthetic label volumes to create: (shape, number of instances)
+volumes = [((20, 256, 256), 50), ((40, 512, 512), 500), ((80, 512, 512), 2000)]
+# Maximum radius of the synthetic instances
+max_radius = 12
+seed = 0
+
+sys.path.insert(0, code_dir)
+from utils.util import instances_distance_transform
+
+
+def create_synthetic_labels(shape, n_labels, max_radius, rng):
+    """Create a label volume with ``n_labels`` ellipsoids. Later ellipsoids overwrite the previous ones."""
+    vol = np.zeros(shape, dtype=np.int64)
+    for i in range(1, n_labels+1):
+        center = [rng.integers(0, s) for s in shape]
+        radius = rng.integers(2, max_radius+1, size=len(shape))
+        box = tuple(slice(max(c-r,0), min(c+r+1,s)) for c, r, s in zip(center, radius, shape))
+        grid = np.ogrid[box]
+        inside = sum(((g-c)/r)**2 for g, c, r in zip(grid, center, radius)) <= 1
+        vol[box][inside] = i
+    return vol
+
+
+def per_label_distance_transform(vol):
+    """Previous approach: one distance transform over the whole volume per instance."""
+    vol_dist = np.zeros(vol.shape)
+    l = np.unique(vol)
+    for obj in l[1:]:
+        vol_dist += scipy.ndimage.distance_transform_edt(vol==obj)
+    return vol_dist
+
+
+rng = np.random.default_rng(seed)
+for shape, n_labels in volumes:
+    vol = create_synthetic_labels(shape, n_labels, max_radius, rng)
+    print("Volume {} with {} instances".format(shape, len(np.unique(vol))-1))
+
+    start = time.time()
+    old = per_label_distance_transform(vol)
+    old_time = time.time()-start
+    print("    Per label EDT: {:.3f}s".format(old_time))
+
+    start = time.time()
+    new = instances_distance_transform(vol)
+    new_time = time.time()-start
+    print("    Bounding box EDT: {:.3f}s (x{:.1f})".format(new_time, old_time/max(new_time,1e-9)))
+
+    print("    Identical output: {}".format(np.array_equal(old, new)))
+
+print("Finished!")
@@ -0,0 +1,64 @@
+import sys
+import time
+import numpy as np
+
+code_dir = "/home/user/BiaPy"
+# Images (y, x, channels) or volumes (z, y, x, channels) and number of channels of their masks. The last channel
+# of the volume masks is a distance channel, while image masks are uint8 as ImageDataGenerator expects
+cases = [((256, 256, 1), 1),
+         ((512, 512, 3), 2),
+         ((40, 128, 128, 1), 2),
+         ((20, 256, 256, 2), 3)]
+# Spatial augmentations enabled on each run. The elastic field cache is only used by the composed backend
+augs = {'affine': dict(rotation90=True, rand_rot=True, shear=True, zoom=True, shift=True, vflip=True, hflip=True,
+                       zflip=True),
+        'elastic': dict(elastic=True),
+        'elastic cached': dict(elastic=True, e_cache_size=16),
+        'all': dict(rotation90=True, rand_rot=True, shear=True, zoom=True, shift=True, vflip=True, hflip=True,
+                    zflip=True, elastic=True)}
+samples = 8
+repeats = 3
+seed = 0
+
+sys.path.insert(0, code_dir)
+from data.generators.data_2D_generator import ImageDataGenerator
+from data.generators.data_3D_generator import VoxelDataGenerator
+
+
+def best_time(gen, images, masks):
+    """Transform all the ``samples`` with ``gen`` ``repeats`` times returning the best time."""
+    times = []
+    for _ in range(repeats):
+        np.random.seed(seed)
+        start = time.perf_counter()
+        for i in range(samples):
+            gen.apply_transform(images[i], masks[i])
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+
+rng = np.random.default_rng(seed)
+for shape, mask_channels in cases:
+    images = rng.random((samples,)+shape, dtype=np.float32)
+    masks = (rng.random((samples,)+shape[:-1]+(mask_channels,)) > 0.5).astype(np.float32)
+    if len(shape) == 3:
+        masks = masks.astype(np.uint8)
+    else:
+        masks[...,-1] = rng.random(masks.shape[:-1])
+    print("{} {} (mask channels {})".format("Image" if len(shape) == 3 else "Volume", shape, mask_channels))
+
+    for name, aug in augs.items():
+        t = []
+        for backend in ['imgaug', 'composed']:
+            if len(shape) == 3:
+                aug2d = {k: v for k, v in aug.items() if k != 'zflip'}
+                gen = ImageDataGenerator(images, masks, batch_size=1, shape=shape, da_prob=1, spatial_backend=backend,
+                                         **aug2d)
+            else:
+                gen = VoxelDataGenerator(images, masks, batch_size=1, shape=shape, da_prob=1, resolution=(1,1,2),
+                                         spatial_backend=backend, **aug)
+            t.append(best_time(gen, images, masks))
+        print("    {}: {:.1f} samples/s with imgaug - {:.1f} samples/s composed ({:.1f}x)"
+              .format(name, samples/t[0], samples/t[1], t[0]/t[1]))
+
+print("Finished!")
@@ -1,14 +1,11 @@
 import os
 import sys
-import h5py
 import numpy as np
 from skimage.io import imread
 
 code_dir = "/home/user/BiaPy"
-map_code_dir = "/home/user/mAP_3Dvolume"
 input_dir = "/home/user/input"
 gt_dir = "/home/user/input_gt"
-temporal_dir= "/home/user/TEMP"
 
 iou = True
 mAP = True
@@ -18,25 +15,15 @@ matching_segcompare = True
 verbose = True
 
 
-gt_partial_files_dir = os.path.join(temporal_dir, "GT")
-os.makedirs(gt_partial_files_dir, exist_ok=True)
-
 sys.path.insert(0, code_dir)
-from utils.matching import matching, match_using_segCompare
+from utils.matching import matching, match_using_segCompare, sparse_label_overlap, average_precision
 from utils.util import save_tif_pair_discard, wrapper_matching_dataset_lazy, wrapper_matching_segCompare
-from engine.metrics import jaccard_index_numpy, voc_calculation
+from engine.metrics import segmentation_metrics
 
 if iou:
     all_iou = 0
     all_ov_iou = 0  # (overall IoU)
 if mAP:
-    # Prepare mAP call
-    sys.path.insert(0, map_code_dir)
-    from demo_modified import main as mAP_calculation
-    class Namespace:
-        def __init__(self, **kwargs):
-            self.__dict__.update(kwargs)
-
     mAP_50_total = 0
     mAP_75_total = 0
 if matching_stats:
@@ -52,16 +39,18 @@ for n, id_ in enumerate(ids):
     print(" ")
     print("#######################################")
     print("Analizing file {}".format(os.path.join(input_dir, id_)))
-    file_dir = os.path.join(temporal_dir, id_)
-    os.makedirs(file_dir, exist_ok=True)
+
+    # The overlap between the instances is shared by the mAP and the matching stats
+    if mAP or matching_stats:
+        overlap = sparse_label_overlap(mask, img)
 
     ###########################
     # IoU & VOC (overall IoU) #
     ###########################
     if iou:
-        _iou = jaccard_index_numpy((mask>0.5).astype(np.uint8), (img>0.5).astype(np.uint8))
+        metrics = segmentation_metrics(mask, img, t=0.5)
+        _iou, _ov_iou = metrics['iou'], metrics['ov_iou']
         all_iou += _iou
-        _ov_iou = voc_calculation((mask>0.5).astype(np.uint8), (img>0.5).astype(np.uint8), _iou)
         all_ov_iou += _ov_iou
         if verbose: print("Foreground IoU: {} - Overall IoU {}".format(_iou,_ov_iou))
 
@@ -69,46 +58,16 @@ for n, id_ in enumerate(ids):
     # mAP #
     #######
     if mAP:
-        # Convert the prediction into an .h5 file
-        h5file_name = os.path.join(file_dir, os.path.splitext(id_)[0]+'.h5')
-        if verbose: print("Creating prediction h5 file to calculate mAP: {}".format(h5file_name))
-        h5f = h5py.File(h5file_name, 'w')
-        h5f.create_dataset('dataset', data=img, compression="lzf")
-        h5f.close()
-
-        # Create GT H5 file if it does not exist
-        gt_f = os.path.join(gt_partial_files_dir, os.path.splitext(id_)[0]+'.h5')
-        if not os.path.isfile(gt_f):
-            test_file = os.path.join(gt_dir, id_)
-            if verbose: print("GT .h5 file needed for mAP calculation is not found in {} so it will be created "
-                              "from its mask: {}".format(gt_f, test_file))
-
-            if not os.path.isfile(test_file):
-                raise ValueError("The mask is supossed to have the same name as the image")
-
-            if verbose: print("Saving .h5 GT data from array shape: {}".format(mask.squeeze().shape))
-            os.makedirs(gt_partial_files_dir, exist_ok=True)
-            h5f = h5py.File(gt_f, 'w')
-            h5f.create_dataset('dataset', data=mask.squeeze(), compression="lzf")
-            h5f.close()
-
-        # Calculate mAP
-        args = Namespace(gt_seg=gt_f, predict_seg=h5file_name, predict_score='', threshold="5e3, 3e4", threshold_crumb=64,
-                         chunk_size=250, output_name=file_dir, do_txt=1, do_eval=1, slices="-1")
-        mAP_calculation(args)
-
-        with open(os.path.join(temporal_dir, id_, 'nucmm_map.txt'), "r") as read_obj:
-            for line in read_obj:
-                if 'Average Precision  (AP) @[ IoU=0.50      | area=   all | maxDets=100 ] =' in line:
-                    mAP_50_total += float(line.split()[-1])
-                if 'Average Precision  (AP) @[ IoU=0.75      | area=   all | maxDets=100 ] =' in line:
-                    mAP_75_total += float(line.split()[-1])
+        _mAP_50, _mAP_75 = average_precision(mask, img, thresh=[0.5, 0.75], overlap=overlap)
+        mAP_50_total += _mAP_50
+        mAP_75_total += _mAP_75
+        if verbose: print("AP - IoU=0.50 : {} - AP - IoU=0.75 : {}".format(_mAP_50, _mAP_75))
 
     ##################
     # matching stats #
     ##################
     if matching_stats:
-        r_stats = matching(mask, img, thresh=matching_stats_ths, report_matches=False)
+        r_stats = matching(mask, img, thresh=matching_stats_ths, report_matches=False, overlap=overlap)
         if verbose: print(r_stats)
         all_matching_stats.append(r_stats)
 
@@ -155,5 +114,3 @@ if matching_segcompare:
     print("segCompare segmentation rates:")
     print(stats_segCompare)
     print("")
-
-print("Remember to remove the temporal folder: {}".format(temporal_dir))
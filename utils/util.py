@@ -14,7 +14,7 @@ from skimage import measure
 from skimage.segmentation import clear_border, find_boundaries
 from collections import namedtuple
 
-from engine.metrics import jaccard_index_numpy, voc_calculation, DET_calculation
+from engine.metrics import DET_calculation, segmentation_metrics
 from utils.matching import _safe_divide, precision, recall, accuracy, f1
 
 matplotlib.use('pdf')
@@ -202,8 +202,8 @@ def threshold_plots(preds_test, Y_test, det_eval_ge_path, det_eval_path, det_bin
 
         # Metrics (Jaccard + VOC + DET)
         print("Calculate metrics . . .")
-        t_jac[i] = jaccard_index_numpy(Y_test, bin_preds_test)
-        t_voc[i] = voc_calculation(Y_test, bin_preds_test, t_jac[i])
+        metrics = segmentation_metrics(Y_test, bin_preds_test, t=None)
+        t_jac[i], t_voc[i] = metrics['iou'], metrics['ov_iou']
         t_det[i] = DET_calculation(Y_test, bin_preds_test, det_eval_ge_path, det_eval_path, det_bin, n_dig, job_id)
 
         print("t_jac[{}]: {}".format(i, t_jac[i]))
@@ -967,9 +967,9 @@ def calculate_3D_volume_prob_map(Y, Y_path=None, w_foreground=0.94, w_background
     diff_shape = False
     for i in range(l):
         if isinstance(prob_map, list):
-            _map = prob_map[i][0].copy().astype(np.float64)
+            _map = prob_map[i][0].astype(np.float32)
         else:
-            _map = prob_map[i].copy().astype(np.float64)
+            _map = prob_map[i].astype(np.float32)
 
         for k in range(channels):
             for j in range(_map.shape[2]):
@@ -1195,28 +1195,12 @@ def load_data_from_dir(data_dir, crop=False, crop_shape=None, overlap=(0,0), pad
     if return_filenames: filenames = []
 
     for n, id_ in tqdm(enumerate(ids), total=len(ids)):
-        if id_.endswith('.npy'):
-            img = np.load(os.path.join(data_dir, id_))
-        else:
-            img = imread(os.path.join(data_dir, id_))
-        #img = np.asarray(Image.open(os.path.join(data_dir, id_)))
+        img = load_img_from_file(os.path.join(data_dir, id_))
 
         if return_filenames: filenames.append(id_)
 
-        if len(img.shape) == 2:
-            img = np.expand_dims(img, axis=-1)
-        else:
-           if img.shape[0] <= 3: img = img.transpose((1,2,0))
-
         if reflect_to_complete_shape: img = pad_and_reflect(img, crop_shape, verbose=False)
 
-        # Ensure uint8
-        if img.dtype == np.uint16:
-            if np.max(img) > 255:
-                img = normalize(img, 0, 65535)
-            else:
-                img = img.astype(np.uint8)
-
         data_shape.append(img.shape)
         img = np.expand_dims(img, axis=0)
         if crop and img[0].shape != crop_shape[:2]+(img.shape[-1],):
@@ -1402,42 +1386,12 @@ def load_3d_images_from_dir(data_dir, crop=False, crop_shape=None, verbose=False
     data_shape = []
     c_shape = []
     if return_filenames: filenames = []
-    ax = None
 
     # Read images
     for n, id_ in tqdm(enumerate(ids), total=len(ids)):
-        if id_.endswith('.npy'):
-            img = np.load(os.path.join(data_dir, id_))
-        else:
-            img = imread(os.path.join(data_dir, id_))
-            if img.ndim == 4 and id_.endswith('.tif'):
-                # Obtain axis position once
-                if ax is None:
-                    from PIL import Image
-                    from PIL.TiffTags import TAGS
-                    img_aux = Image.open(os.path.join(data_dir, id_))
-                    meta_dict = {TAGS[key] : img_aux.tag[key] for key in img_aux.tag_v2}
-                    axis = meta_dict['ImageDescription'][0].split('\n')[-2].split('=')[-1]
-                    ax = {}
-                    for k, c in enumerate(axis):
-                        ax[c] = k 
-                    del img_aux 
-                if 'Z' in ax:
-                    img = img.transpose((ax['Z'],ax['Y'],ax['X'],ax['C']))
-        img = np.squeeze(img)
-
-        if img.ndim < 3:
-            raise ValueError("Read image seems to be 2D: {}. Path: {}".format(img.shape, os.path.join(data_dir, id_)))
-
-        # Ensure uint8
-        if img.dtype == np.uint16:
-            if np.max(img) > 255:
-                img = normalize(img, 0, 65535)
-            else:
-                img = img.astype(np.uint8)
+        img = load_img_from_file(os.path.join(data_dir, id_), is_3d=True)
 
         if return_filenames: filenames.append(id_)
-        if len(img.shape) == 3: img = np.expand_dims(img, axis=-1)
         if reflect_to_complete_shape: img = pad_and_reflect(img, crop_shape, verbose=verbose)
 
         data_shape.append(img.shape)
@@ -1469,6 +1423,86 @@ def load_3d_images_from_dir(data_dir, crop=False, crop_shape=None, verbose=False
         return data, data_shape, c_shape
 
 
+def tif_axes_order(path):
+    """Read the axes order of a TIFF file from its ``ImageDescription`` tag.
+
+       Parameters
+       ----------
+       path : str
+           Path of the TIFF file.
+
+       Returns
+       -------
+       ax : dict
+           Position of each axis. E.g. ``{'Z': 0, 'C': 1, 'Y': 2, 'X': 3}``. ``None`` is returned if the file has no
+           axes information.
+    """
+    from PIL import Image
+    from PIL.TiffTags import TAGS
+    img_aux = Image.open(path)
+    meta_dict = {TAGS[key] : img_aux.tag[key] for key in img_aux.tag_v2 if key in TAGS}
+    del img_aux
+    try:
+        axis = meta_dict['ImageDescription'][0].split('\n')[-2].split('=')[-1]
+    except (KeyError, IndexError):
+        return None
+    ax = {}
+    for k, c in enumerate(axis):
+        ax[c] = k
+    return ax
+
+
+def load_img_from_file(path, is_3d=False, is_mask=False):
+    """Load one image the same way ``load_data_from_dir`` (2D) and ``load_3d_images_from_dir`` (3D) do, i.e. with the
+       channels in the last axis and converted to ``uint8`` when needed.
+
+       Parameters
+       ----------
+       path : str
+           Path of the image. ``.npy`` files and any format readable by ``skimage.io.imread`` are supported.
+
+       is_3d : bool, optional
+           Whether the image is a 3D volume.
+
+       is_mask : bool, optional
+           Whether the image is a mask. If so, ``uint16`` values are not rescaled to ``uint8`` so instance labels are
+           preserved.
+
+       Returns
+       -------
+       img : 3D/4D Numpy array
+           Image loaded. E.g. ``(y, x, channels)`` or ``(z, y, x, channels)``.
+    """
+    if path.endswith('.npy'):
+        img = np.load(path)
+    else:
+        img = imread(path)
+        if is_3d and img.ndim == 4 and path.endswith('.tif'):
+            ax = tif_axes_order(path)
+            if ax is not None and 'Z' in ax:
+                img = img.transpose((ax['Z'],ax['Y'],ax['X'],ax['C']))
+
+    if is_3d:
+        img = np.squeeze(img)
+        if img.ndim < 3:
+            raise ValueError("Read image seems to be 2D: {}. Path: {}".format(img.shape, path))
+        if img.ndim == 3: img = np.expand_dims(img, axis=-1)
+    else:
+        if img.ndim == 2:
+            img = np.expand_dims(img, axis=-1)
+        else:
+            if img.shape[0] <= 3: img = img.transpose((1,2,0))
+
+    # Ensure uint8
+    if not is_mask and img.dtype == np.uint16:
+        if np.max(img) > 255:
+            img = normalize(img, 0, 65535)
+        else:
+            img = img.astype(np.uint8)
+
+    return img
+
+
 def labels_into_bcd(data_mask, mode="BCD", fb_mode="outer", save_dir=None):
     """Create an array with 3 channels given semantic or instance segmentation data masks. These 3 channels are:
        semantic mask, contours and distance map.
@@ -1515,17 +1549,9 @@ def labels_into_bcd(data_mask, mode="BCD", fb_mode="outer", save_dir=None):
 
         # If only have background -> skip
         if len(l) != 1:
-            vol_dist = np.zeros(vol.shape)
-
             if mode in ["BCD", "BCDv2", "Dv2"]:
-                # For each nucleus
-                for i in tqdm(range(1,len(l)), leave=False):
-                    obj = l[i]
-                    distance = scipy.ndimage.distance_transform_edt(vol==obj)
-                    vol_dist += distance
-
                 # Foreground distance
-                new_mask[img,...,2] = vol_dist.copy()
+                new_mask[img,...,2] = instances_distance_transform(vol)
 
                 # Background distance
                 if mode in ["BCDv2", "Dv2"]:
@@ -1588,6 +1614,46 @@ def labels_into_bcd(data_mask, mode="BCD", fb_mode="outer", save_dir=None):
     return new_mask
 
 
+def instances_distance_transform(vol):
+    """Calculate the distance of each instance pixel to the border of its own instance. Equivalent to adding up
+       ``scipy.ndimage.distance_transform_edt(vol==obj)`` for each label ``obj`` of ``vol`` (but the lowest one, which
+       is considered background) but computing the transform only inside the bounding box of each instance, padded by
+       one pixel, instead of over the whole volume.
+
+       Parameters
+       ----------
+       vol : 2D/3D Numpy array
+           Instance segmentation mask. E.g. ``(y, x)`` or ``(z, y, x)``.
+
+       Returns
+       -------
+       vol_dist : 2D/3D Numpy array
+           Foreground distance map. E.g. ``(y, x)`` or ``(z, y, x)``.
+
+       Notes
+       -----
+       The nearest pixel outside an instance is always inside its padded bounding box, as the pixels of the padding
+       can not belong to the instance, so the distances are exactly the same as the ones calculated over the whole
+       volume. This reduces the cost from ``O(labels x voxels)`` to ``O(voxels)`` approximately.
+    """
+    vol_dist = np.zeros(vol.shape)
+
+    # Relabel so huge label ids do not make find_objects create a big list. Index 0 is the lowest label (background)
+    _, vol_seq = np.unique(vol, return_inverse=True)
+    vol_seq = vol_seq.reshape(vol.shape)
+    slices = scipy.ndimage.find_objects(vol_seq)
+
+    for i in tqdm(range(len(slices)), leave=False):
+        if slices[i] is None: continue
+        # Pad the bounding box by one pixel on each side (within the volume limits)
+        box = tuple(slice(max(s.start-1,0), min(s.stop+1,vol.shape[k])) for k, s in enumerate(slices[i]))
+        obj_mask = vol_seq[box] == i+1
+        distance = scipy.ndimage.distance_transform_edt(obj_mask)
+        vol_dist[box][obj_mask] += distance[obj_mask]
+
+    return vol_dist
+
+
 def check_downsample_division(X, d_levels):
     """Ensures ``X`` shape is divisible by ``2`` times ``d_levels`` adding padding if necessary.
 